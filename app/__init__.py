@@ -267,6 +267,10 @@ def on_startup():
 def on_shutdown():
     scheduler.shutdown()
     from app.utils.concurrency import shutdown_xray_executor
+    from app.xray.operations import flush_user_ops
+
+    # изменения юзеров, ещё не ушедшие на ноды из очередей user_ops
+    flush_user_ops(timeout=10)
 
     shutdown_xray_executor(wait=True)
 
@@ -0,0 +1,137 @@
+"""Диалект-зависимые bulk-операции для горячих счётчиков учёта трафика.
+
+Вместо SELECT существующих строк + INSERT IGNORE + executemany UPDATE — один
+INSERT ... ON DUPLICATE KEY UPDATE (MySQL/MariaDB) или INSERT ... ON CONFLICT
+DO UPDATE (SQLite/PostgreSQL) на чанк строк. Выражение строится один раз и
+выполняется executemany по чанкам: SQLAlchemy кеширует компиляцию, а драйвер
+склеивает параметры в многострочный VALUES (pymysql — до max_stmt_length,
+psycopg2 — insertmanyvalues). Многострочный VALUES на уровне SQLAlchemy
+перекомпилируется на каждый чанк и на больших тиках медленнее самой записи.
+
+Для users/admins вставка невозможна (NOT NULL-колонки без дефолта), поэтому
+инкремент счётчика — UPDATE (на MySQL — с join на derived-таблицу дельт).
+
+Функции только строят [(stmt, params), ...]; выполняет вызывающий
+(safe_execute_batch в app/jobs/record_usages.py — одна транзакция, ретрай дедлоков).
+Модуль зависит только от SQLAlchemy — тестируется на SQLite без окружения панели.
+
+Ограничение: в unique-индексе NULL не конфликтует с NULL, поэтому строки с NULL
+в ключевой колонке (node_id=None — главный xray-инстанс) upsert'ом не сливаются —
+для них вызывающий сохраняет прежний путь select/insert/update.
+"""
+
+from collections.abc import Callable, Iterable
+
+from sqlalchemy import Table, bindparam, case, literal, or_, text, update
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+DEFAULT_CHUNK_SIZE = 1000
+
+MYSQL_DIALECTS = ("mysql", "mariadb")
+
+# (excluded, table) → [(колонка, выражение), ...]; порядок важен для MySQL,
+# где SET вычисляется слева направо и видит уже присвоенные значения.
+SetFactory = Callable[[object, Table], list[tuple[str, object]]]
+
+
+def chunked(items: list, size: int) -> Iterable[list]:
+    size = max(1, size)
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def increment_set(*columns: str) -> SetFactory:
+    """SET col = col + excluded.col для каждой колонки."""
+
+    def factory(excluded, table):
+        return [(name, table.c[name] + excluded[name]) for name in columns]
+
+    return factory
+
+
+def upsert_stmt(dialect: str, table: Table, index_elements: list[str], set_factory: SetFactory):
+    """INSERT ... ON DUPLICATE KEY UPDATE / ON CONFLICT DO UPDATE; index_elements — unique-ключ."""
+    if dialect in MYSQL_DIALECTS:
+        stmt = mysql.insert(table)
+        return stmt.on_duplicate_key_update(set_factory(stmt.inserted, table))
+    stmt = (postgresql if dialect == "postgresql" else sqlite).insert(table)
+    return stmt.on_conflict_do_update(index_elements=index_elements, set_=dict(set_factory(stmt.excluded, table)))
+
+
+def upsert_statements(
+    dialect: str,
+    table: Table,
+    rows: list[dict],
+    index_elements: list[str],
+    set_factory: SetFactory,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> list[tuple]:
+    """upsert_stmt по чанкам rows (executemany).
+
+    Ключи внутри rows должны быть уникальны (PostgreSQL не даёт обновить одну
+    строку дважды за statement) — агрегируйте дельты до вызова.
+    """
+    if not rows:
+        return []
+    stmt = upsert_stmt(dialect, table, index_elements, set_factory)
+    return [(stmt, chunk) for chunk in chunked(rows, chunk_size)]
+
+
+def increment_statements(
+    dialect: str,
+    table: Table,
+    key: str,
+    column: str,
+    deltas: dict[int, int],
+    values: dict | None = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    latest: dict | None = None,
+) -> list[tuple]:
+    """table.column += delta для существующих строк, по чанкам.
+
+    Отсутствующие ключи просто не обновляются. values — дополнительные SET
+    (например online_at), одинаковые для всех строк; latest — такие же SET, но
+    колонка только растёт (значение меньше текущего не пишется, NULL — меньше всех):
+    реплей старого тика не откатывает online_at назад.
+
+    MySQL: один UPDATE с join на derived-таблицу дельт на чанк — executemany
+    UPDATE в pymysql не склеивается и стоит round trip на каждую строку.
+    Остальные диалекты: executemany построчного UPDATE (sqlite3 гоняет его
+    внутри процесса, psycopg2 — execute_batch), он там дешевле join'а.
+    """
+    values, latest = values or {}, latest or {}
+    key_column, target = table.c[key], table.c[column]
+    if dialect not in MYSQL_DIALECTS:
+        monotonic = {
+            col: case((or_(table.c[col].is_(None), table.c[col] < literal(v)), literal(v)), else_=table.c[col])
+            for col, v in latest.items()
+        }
+        stmt = (
+            update(table)
+            .where(key_column == bindparam("_key"))
+            .values({column: target + bindparam("_delta"), **values, **monotonic})
+        )
+        rows = [{"_key": k, "_delta": v} for k, v in deltas.items()]
+        return [(stmt, chunk) for chunk in chunked(rows, chunk_size)]
+
+    # Имена таблицы/колонок — из метаданных модели, значения — только bind-параметры.
+    # MariaDB не умеет VALUES как таблицу — derived-таблица через UNION ALL.
+    name = table.name
+    sets = [f"{name}.{target.name} = {name}.{target.name} + d.v"]
+    sets += [f"{name}.{table.c[col].name} = :{col}" for col in values]
+    for col in latest:
+        current = f"{name}.{table.c[col].name}"
+        sets.append(f"{current} = CASE WHEN {current} IS NULL OR {current} < :{col} THEN :{col} ELSE {current} END")
+    statements = []
+    for chunk in chunked(list(deltas.items()), chunk_size):
+        params = {**values, **latest}
+        selects = []
+        for i, (k, v) in enumerate(chunk):
+            selects.append(f"SELECT :k{i} AS k, :v{i} AS v" if i == 0 else f"SELECT :k{i}, :v{i}")
+            params[f"k{i}"], params[f"v{i}"] = k, v
+        sql = (
+            f"UPDATE {name} JOIN ({' UNION ALL '.join(selects)}) AS d ON {name}.{key_column.name} = d.k "
+            f"SET {', '.join(sets)}"
+        )
+        statements.append((text(sql), params))
+    return statements
@@ -2,15 +2,19 @@
 Functions for managing proxy hosts, users, user templates, nodes, and administrative tasks.
 """
 
+from collections.abc import Iterable
 from datetime import datetime, timedelta
 from enum import Enum
+from itertools import chain
 from typing import Any, cast
 
-from sqlalchemy import and_, delete, func, or_, update
+from sqlalchemy import Table, and_, bindparam, delete, event, func, inspect, or_, select, update
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Query, Session, joinedload
 from sqlalchemy.sql.functions import coalesce
 
+from app.db import usage_tiers
+from app.db.bulk import chunked
 from app.db.models import (
     JWT,
     TLS,
@@ -27,18 +31,22 @@ from app.db.models import (
     NodeUserBlock,
     NodeUserBsUsage,
     NodeUserUsage,
+    NodeUserUsageDaily,
+    NodeUserUsageMonthly,
     NotificationReminder,
     Proxy,
     ProxyHost,
     ProxyInbound,
     ProxyTypes,
     System,
+    UsageRollup,
     User,
     UserDevice,
     UserTemplate,
     UserUsageResetLogs,
     master_inbounds_association,
 )
+from app.db.usage_tiers import DAILY, HOURLY, MONTHLY
 from app.models.admin import AdminCreate, AdminModify, AdminPartialModify
 from app.models.bot import apply_bot_settings_fallback
 from app.models.node import NodeCreate, NodeModify, NodeRole, NodeStatus, NodeUsageResponse
@@ -55,11 +63,25 @@ from app.models.user import (
     UserUsageResponse,
 )
 from app.models.user_template import UserTemplateCreate, UserTemplateModify
+from app.subscription.bot_settings import resolve_bot_settings
 from app.subscription.device_ua import unknown_user_agents_match as _unknown_user_agents_match
+from app.subscription.etag import snapshot_digest
+from app.subscription.user_cache import UserSnapshot, UserSnapshotCache
+from app.subscription.write_behind import DeviceTouch, SubWriteBuffer
 from app.utils.helpers import calculate_expiration_days, calculate_usage_percent
 from app.utils.jwt import create_subscription_token
 from app.xray.cascade_keys import generate_cascade_identity
-from config import NOTIFY_DAYS_LEFT, NOTIFY_REACHED_USAGE_PERCENT, USERS_AUTODELETE_DAYS
+from config import (
+    JOB_FLUSH_SUB_WRITES_INTERVAL,
+    NOTIFY_DAYS_LEFT,
+    NOTIFY_REACHED_USAGE_PERCENT,
+    SUB_ETAG_TTL,
+    SUB_KNOWN_DEVICES_SIZE,
+    SUB_KNOWN_DEVICES_TTL,
+    SUB_USER_CACHE_SIZE,
+    SUB_USER_CACHE_TTL,
+    USERS_AUTODELETE_DAYS,
+)
 
 
 def add_default_host(db: Session, inbound: ProxyInbound):
@@ -275,6 +297,125 @@ def get_user_by_id(db: Session, user_id: int) -> User | None:
     return get_user_queryset(db).filter(User.id == user_id).first()
 
 
+# Снимки юзеров для /sub (см. app/subscription/user_cache.py). Изменённые юзеры копятся в
+# session.info — хуками ниже для ORM-записей и mark_users_changed() для массовых UPDATE —
+# и выкидываются из кэша после коммита: до него читатель снова положил бы старую строку.
+user_snapshots = UserSnapshotCache(SUB_USER_CACHE_SIZE, SUB_USER_CACHE_TTL)
+
+_CHANGED_USER_IDS = "changed_user_ids"
+_ALL_USERS_CHANGED = "all_users_changed"
+# поля, которые пишет сам /sub и учёт трафика: на ответ подписки не влияют
+_SNAPSHOT_IGNORED_FIELDS = frozenset({"sub_updated_at", "sub_last_user_agent", "online_at"})
+
+
+# Отложенная запись визитов /sub (app/subscription/write_behind.py): касания юзеров и устройств
+# копятся в sub_writes и пишутся джобом flush_sub_writes; JOB_FLUSH_SUB_WRITES_INTERVAL = 0 —
+# синхронная запись, как раньше. Вид известных устройств забывает устройства юзера после коммита
+# любой записи его user_devices — хуками ниже и forget_user_devices() для массовых UPDATE.
+SUB_WRITE_BEHIND = JOB_FLUSH_SUB_WRITES_INTERVAL > 0
+sub_writes = SubWriteBuffer(SUB_KNOWN_DEVICES_SIZE if SUB_WRITE_BEHIND else 0, SUB_KNOWN_DEVICES_TTL)
+
+_CHANGED_DEVICE_USER_IDS = "changed_device_user_ids"
+
+
+def forget_user_devices(db: Session, user_ids: Iterable[int]) -> None:
+    """Забыть известные устройства юзеров после коммита db (запись user_devices мимо ORM-объектов)."""
+    db.info.setdefault(_CHANGED_DEVICE_USER_IDS, set()).update(user_ids)
+
+
+def mark_users_changed(db: Session, user_ids: Iterable[int] | None = None) -> None:
+    """Сбросить снимки юзеров после коммита db; None — всех (запись мимо ORM-объектов)."""
+    if user_ids is None:
+        db.info[_ALL_USERS_CHANGED] = True
+    else:
+        db.info.setdefault(_CHANGED_USER_IDS, set()).update(user_ids)
+
+
+def _snapshot_fields_changed(dbuser: User) -> bool:
+    return any(attr.history.has_changes() for attr in inspect(dbuser).attrs if attr.key not in _SNAPSHOT_IGNORED_FIELDS)
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_changed_users(db: Session, flush_context) -> None:
+    if sub_writes.known_enabled:
+        device_user_ids = [
+            cast(int, obj.user_id)
+            for obj in chain(db.new, db.dirty, db.deleted)
+            if isinstance(obj, UserDevice) and obj.user_id
+        ]
+        if device_user_ids:
+            forget_user_devices(db, device_user_ids)
+    if not user_snapshots.enabled:
+        return
+    for obj in chain(db.dirty, db.deleted):
+        if isinstance(obj, User):
+            if obj in db.deleted or _snapshot_fields_changed(obj):
+                mark_users_changed(db, [cast(int, obj.id)])
+        elif isinstance(obj, (Admin, Bot, BotSettings)):
+            mark_users_changed(db)
+    for obj in chain(db.new, db.dirty, db.deleted):
+        if isinstance(obj, (Proxy, NextPlan, NodeUserBsUsage)) and obj.user_id is not None:
+            mark_users_changed(db, [cast(int, obj.user_id)])
+
+
+@event.listens_for(Session, "after_commit")
+def _drop_changed_snapshots(db: Session) -> None:
+    user_ids = db.info.pop(_CHANGED_USER_IDS, None)
+    if db.info.pop(_ALL_USERS_CHANGED, False):
+        user_snapshots.clear()
+    elif user_ids:
+        user_snapshots.invalidate_ids(user_ids)
+    device_user_ids = db.info.pop(_CHANGED_DEVICE_USER_IDS, None)
+    if device_user_ids:
+        sub_writes.forget_devices(device_user_ids)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changed_users(db: Session) -> None:
+    db.info.pop(_CHANGED_USER_IDS, None)
+    db.info.pop(_ALL_USERS_CHANGED, None)
+    db.info.pop(_CHANGED_DEVICE_USER_IDS, None)
+
+
+def get_user_snapshot(db: Session, username: str) -> UserSnapshot | None:
+    """
+    Retrieves a cached subscription snapshot of a user by username, loading it on a cache miss.
+
+    Args:
+        db (Session): Database session.
+        username (str): The username of the user.
+
+    Returns:
+        Optional[UserSnapshot]: The snapshot if the user exists, else None.
+    """
+    snapshot = user_snapshots.get(username)
+    if snapshot is not None:
+        return snapshot
+    epoch = user_snapshots.epoch()
+    dbuser = get_user(db, username)
+    if dbuser is None:
+        return None
+    ensure_subscription_token(db, dbuser)
+    user = UserResponse.model_validate(dbuser)
+    bot_settings = resolve_bot_settings(dbuser)
+    snapshot = UserSnapshot(
+        id=cast(int, dbuser.id),
+        username=cast(str, dbuser.username),
+        created_at=cast(datetime | None, dbuser.created_at),
+        sub_revoked_at=cast(datetime | None, dbuser.sub_revoked_at),
+        expire=cast(int | None, dbuser.expire),
+        device_limit=cast(int | None, dbuser.device_limit),
+        bs_extra=cast(int | None, dbuser.bs_extra),
+        subscription_token=cast(str | None, dbuser.subscription_token),
+        user=user,
+        bot_settings=bot_settings,
+        version=user_snapshots.next_version(),
+        digest=snapshot_digest(user, bot_settings) if SUB_ETAG_TTL > 0 else "",
+    )
+    user_snapshots.put(snapshot, epoch)
+    return snapshot
+
+
 def _normalize_bot_username(bot_username: str | None) -> str | None:
     if bot_username is None:
         return None
@@ -479,6 +620,35 @@ def get_users(
     return query.all()
 
 
+def _clear_node_usages(dbuser: User) -> None:
+    """Расход юзера по нодам на всех уровнях хранения (часы, дни, месяцы)."""
+    dbuser.node_usages.clear()
+    dbuser.node_usages_daily.clear()
+    dbuser.node_usages_monthly.clear()
+
+
+USAGE_TIER_TABLES: dict[str, Table] = {
+    HOURLY: cast(Table, NodeUserUsage.__table__),
+    DAILY: cast(Table, NodeUserUsageDaily.__table__),
+    MONTHLY: cast(Table, NodeUserUsageMonthly.__table__),
+}
+
+
+def get_usage_rollups(db: Session) -> dict[str, datetime]:
+    """{tier: rolled_until} — докуда свёрнуты уровни node_user_usages."""
+    return {tier: rolled_until for tier, rolled_until in db.query(UsageRollup.tier, UsageRollup.rolled_until).all()}
+
+
+def _node_user_traffic(db: Session, start: datetime, end: datetime, condition, join=None) -> dict:
+    """{node_id: used_traffic} за [start, end] с самого крупного уровня хранения, покрывающего отрезок.
+
+    Сумма считается в БД (GROUP BY node_id) — в Python приходит строка на ноду.
+    """
+    rollups = get_usage_rollups(db)
+    segments = usage_tiers.plan(start, end, rollups.get(DAILY), rollups.get(MONTHLY))
+    return usage_tiers.usage_by_node(db.execute, USAGE_TIER_TABLES, segments, condition, join)
+
+
 def get_user_usages(db: Session, dbuser: User, start: datetime, end: datetime) -> list[UserUsageResponse]:
     """
     Retrieves user usages within a specified date range.
@@ -502,11 +672,9 @@ def get_user_usages(db: Session, dbuser: User, start: datetime, end: datetime) -
     for node in db.query(Node).all():
         usages[node.id] = UserUsageResponse(node_id=node.id, node_name=node.name, used_traffic=0)
 
-    cond = and_(NodeUserUsage.user_id == dbuser.id, NodeUserUsage.created_at >= start, NodeUserUsage.created_at <= end)
-
-    for v in db.query(NodeUserUsage).filter(cond):
+    for node_id, used_traffic in _node_user_traffic(db, start, end, lambda t: t.c.user_id == dbuser.id).items():
         try:
-            usages[v.node_id or 0].used_traffic += v.used_traffic
+            usages[node_id or 0].used_traffic += used_traffic
         except KeyError:
             pass
 
@@ -749,11 +917,11 @@ def get_user_device(db: Session, dbuser: User, device_id: int) -> UserDevice | N
     return db.query(UserDevice).filter(UserDevice.user_id == dbuser.id, UserDevice.id == device_id).first()
 
 
-def get_user_device_by_hwid(db: Session, dbuser: User, hwid: str) -> UserDevice | None:
+def get_user_device_by_hwid(db: Session, dbuser: User | UserSnapshot, hwid: str) -> UserDevice | None:
     return db.query(UserDevice).filter(UserDevice.user_id == dbuser.id, UserDevice.hwid == hwid).first()
 
 
-def count_user_devices(db: Session, dbuser: User) -> int:
+def count_user_devices(db: Session, dbuser: User | UserSnapshot) -> int:
     return (
         db.query(func.count(UserDevice.id))
         .filter(
@@ -765,20 +933,20 @@ def count_user_devices(db: Session, dbuser: User) -> int:
     )
 
 
-def is_device_limit_reached(db: Session, dbuser: User) -> bool:
+def is_device_limit_reached(db: Session, dbuser: User | UserSnapshot) -> bool:
     """True when active devices are at or over the limit (e.g. 10/10, 11/10)."""
-    limit = dbuser.device_limit
+    limit = cast(int | None, dbuser.device_limit)
     if not limit:
         return False
-    return count_user_devices(db, dbuser) >= int(limit)
+    return count_user_devices(db, dbuser) >= limit
 
 
-def is_device_limit_exceeded(db: Session, dbuser: User) -> bool:
+def is_device_limit_exceeded(db: Session, dbuser: User | UserSnapshot) -> bool:
     """True when active devices strictly exceed the limit (e.g. 11/10, not 10/10)."""
-    limit = dbuser.device_limit
+    limit = cast(int | None, dbuser.device_limit)
     if not limit:
         return False
-    return count_user_devices(db, dbuser) > int(limit)
+    return count_user_devices(db, dbuser) > limit
 
 
 def create_user_device(db: Session, dbuser: User, device: UserDeviceCreate) -> UserDevice:
@@ -830,7 +998,7 @@ def revoke_user_device(db: Session, dbdevice: UserDevice) -> UserDevice:
     return dbdevice
 
 
-def _update_unknown_device_metadata(
+def _update_device_metadata(
     dbdevice: UserDevice,
     device_os: str | None,
     ver_os: str | None,
@@ -846,9 +1014,60 @@ def _update_unknown_device_metadata(
     dbdevice.last_seen = datetime.utcnow()
 
 
+def _touch_user_device(
+    db: Session,
+    dbuser: User | UserSnapshot,
+    dbdevice: UserDevice,
+    device_os: str | None,
+    ver_os: str | None,
+    device_model: str | None,
+    user_agent: str | None,
+) -> None:
+    """Визит существующего устройства: активное — в буфер sub_writes, отозванное — реактивация коммитом."""
+    user_id, hwid = cast(int, dbuser.id), cast(str, dbdevice.hwid)
+    if SUB_WRITE_BEHIND and dbdevice.status != "revoked":
+        sub_writes.touch_device(
+            user_id, hwid, DeviceTouch(device_os, ver_os, device_model, user_agent, datetime.utcnow())
+        )
+        user_agent = user_agent or cast(str | None, dbdevice.user_agent)
+    else:
+        _update_device_metadata(dbdevice, device_os, ver_os, device_model, user_agent)
+        db.commit()
+        user_agent = cast(str | None, dbdevice.user_agent)
+    sub_writes.remember_device(user_id, hwid, user_agent)
+
+
+def _add_user_device(
+    db: Session,
+    dbuser: User | UserSnapshot,
+    hwid: str,
+    device_os: str | None,
+    ver_os: str | None,
+    device_model: str | None,
+    user_agent: str | None,
+) -> None:
+    dbdevice = UserDevice(
+        user_id=dbuser.id,
+        hwid=hwid,
+        device_os=device_os,
+        ver_os=ver_os,
+        device_model=device_model,
+        user_agent=user_agent,
+        status="active",
+    )
+    db.add(dbdevice)
+    try:
+        db.commit()
+    except IntegrityError:
+        # параллельный запрос того же устройства уже вставил строку
+        db.rollback()
+        return
+    sub_writes.remember_device(cast(int, dbuser.id), hwid, user_agent)
+
+
 def register_user_device(
     db: Session,
-    dbuser: User,
+    dbuser: User | UserSnapshot,
     hwid: str | None,
     device_os: str | None,
     ver_os: str | None,
@@ -856,45 +1075,34 @@ def register_user_device(
     user_agent: str | None,
 ) -> tuple[bool, bool]:
     unknown_hwid = "Неизвестное устройство"
+    user_id = cast(int, dbuser.id)
+    known, known_user_agent = sub_writes.known_device(user_id, hwid or unknown_hwid)
+    if known:
+        # устройство уже активно в БД, а его user_agent в виде не старее строки
+        if not hwid and not _unknown_user_agents_match(known_user_agent, user_agent):
+            return False, True
+        sub_writes.touch_device(
+            user_id, hwid or unknown_hwid, DeviceTouch(device_os, ver_os, device_model, user_agent, datetime.utcnow())
+        )
+        return True, False
+
     if not hwid:
         dbdevice = get_user_device_by_hwid(db, dbuser, unknown_hwid)
         if dbdevice:
             if _unknown_user_agents_match(cast(str | None, dbdevice.user_agent), user_agent):
-                _update_unknown_device_metadata(dbdevice, device_os, ver_os, device_model, user_agent)
-                db.commit()
+                _touch_user_device(db, dbuser, dbdevice, device_os, ver_os, device_model, user_agent)
                 return True, False
             return False, True
         if dbuser.device_limit:
             current = count_user_devices(db, dbuser)
             if current >= dbuser.device_limit:
                 return False, False
-        dbdevice = UserDevice(
-            user_id=dbuser.id,
-            hwid=unknown_hwid,
-            device_os=device_os,
-            ver_os=ver_os,
-            device_model=device_model,
-            user_agent=user_agent,
-            status="active",
-        )
-        db.add(dbdevice)
-        try:
-            db.commit()
-        except IntegrityError:
-            db.rollback()
-            return True, False
+        _add_user_device(db, dbuser, unknown_hwid, device_os, ver_os, device_model, user_agent)
         return True, False
 
     dbdevice = get_user_device_by_hwid(db, dbuser, hwid)
     if dbdevice:
-        dbdevice.device_os = device_os or dbdevice.device_os
-        dbdevice.ver_os = ver_os or dbdevice.ver_os
-        dbdevice.device_model = device_model or dbdevice.device_model
-        dbdevice.user_agent = user_agent or dbdevice.user_agent
-        if dbdevice.status == "revoked":
-            dbdevice.status = "active"
-        dbdevice.last_seen = datetime.utcnow()
-        db.commit()
+        _touch_user_device(db, dbuser, dbdevice, device_os, ver_os, device_model, user_agent)
         return True, False
 
     if dbuser.device_limit:
@@ -902,24 +1110,73 @@ def register_user_device(
         if current >= dbuser.device_limit:
             return False, False
 
-    dbdevice = UserDevice(
-        user_id=dbuser.id,
-        hwid=hwid,
-        device_os=device_os,
-        ver_os=ver_os,
-        device_model=device_model,
-        user_agent=user_agent,
-        status="active",
-    )
-    db.add(dbdevice)
-    try:
-        db.commit()
-    except IntegrityError:
-        db.rollback()
-        return True, False
+    _add_user_device(db, dbuser, hwid, device_os, ver_os, device_model, user_agent)
     return True, False
 
 
+def touch_user_sub(dbuser: User | UserSnapshot, user_agent: str) -> None:
+    """Отложенный update_user_sub: sub_updated_at / sub_last_user_agent запишет джоб flush_sub_writes."""
+    sub_writes.touch_user(cast(int, dbuser.id), user_agent, datetime.utcnow())
+
+
+def write_sub_visits(
+    db: Session,
+    users: dict[int, tuple[datetime, str | None]],
+    devices: dict[tuple[int, str], DeviceTouch],
+    chunk_size: int = 1000,
+) -> None:
+    """
+    Writes buffered /sub visits (SubWriteBuffer.drain()) with executemany UPDATEs in one transaction.
+
+    Rows are sorted by key so concurrent flushes lock rows in the same order. Devices are only
+    updated, never inserted or reactivated: a device deleted or revoked since the visit stays so.
+
+    Args:
+        db (Session): Database session.
+        users (dict): user_id -> (sub_updated_at, sub_last_user_agent).
+        devices (dict): (user_id, hwid) -> DeviceTouch.
+        chunk_size (int): Rows per executemany.
+    """
+    statements = []
+    if users:
+        users_table = cast(Table, User.__table__)
+        stmt = (
+            update(users_table)
+            .where(users_table.c.id == bindparam("_id"))
+            .values(sub_updated_at=bindparam("_at"), sub_last_user_agent=bindparam("_user_agent"))
+        )
+        rows = [{"_id": uid, "_at": at, "_user_agent": ua} for uid, (at, ua) in sorted(users.items())]
+        statements += [(stmt, chunk) for chunk in chunked(rows, chunk_size)]
+    if devices:
+        devices_table = cast(Table, UserDevice.__table__)
+        columns = ("device_os", "ver_os", "device_model", "user_agent")
+        stmt = (
+            update(devices_table)
+            .where(devices_table.c.user_id == bindparam("_user_id"), devices_table.c.hwid == bindparam("_hwid"))
+            .values(
+                {
+                    **{col: coalesce(bindparam(f"_{col}"), devices_table.c[col]) for col in columns},
+                    "last_seen": bindparam("_last_seen"),
+                }
+            )
+        )
+        rows = [
+            {
+                "_user_id": uid,
+                "_hwid": hwid,
+                "_last_seen": touch.last_seen,
+                **{f"_{col}": getattr(touch, col) for col in columns},
+            }
+            for (uid, hwid), touch in sorted(devices.items())
+        ]
+        statements += [(stmt, chunk) for chunk in chunked(rows, chunk_size)]
+    if not statements:
+        return
+    for stmt, params in statements:
+        db.connection().execute(stmt, params)
+    db.commit()
+
+
 def reset_user_data_usage(db: Session, dbuser: User) -> User:
     """
     Resets the data usage of a user and logs the reset.
@@ -938,7 +1195,7 @@ def reset_user_data_usage(db: Session, dbuser: User) -> User:
     db.add(usage_log)
 
     dbuser.used_traffic = 0
-    dbuser.node_usages.clear()
+    _clear_node_usages(dbuser)
     # Сбрасываем агрегатный БС-счётчик: иначе после reset usages юзер остаётся
     # над лимитом и review_bs_nodes держит его заблокированным. Блок (node_user_blocks)
     # снимет сама джоба на следующем тике (≤ JOB_REVIEW_BS_NODES_INTERVAL), заодно
@@ -982,7 +1239,7 @@ def reset_user_by_next(db: Session, dbuser: User, commit: bool = True) -> User:
     )
     db.add(usage_log)
 
-    dbuser.node_usages.clear()
+    _clear_node_usages(dbuser)
     dbuser.status = UserStatus.active.value
 
     dbuser.data_limit = dbuser.next_plan.data_limit + (
@@ -1019,6 +1276,7 @@ def revoke_user_sub(db: Session, dbuser: User) -> User:
         {UserDevice.status: "revoked"},
         synchronize_session=False,
     )
+    forget_user_devices(db, [cast(int, dbuser.id)])
 
     user = UserResponse.model_validate(dbuser)
     for proxy_type, settings in user.proxies.copy().items():
@@ -1085,7 +1343,7 @@ def reset_all_users_data_usage(db: Session, admin: Admin | None = None):
         if dbuser.status not in [UserStatus.on_hold, UserStatus.expired, UserStatus.disabled]:
             dbuser.status = UserStatus.active
         dbuser.usage_logs.clear()
-        dbuser.node_usages.clear()
+        _clear_node_usages(dbuser)
         if dbuser.next_plan:
             db.delete(dbuser.next_plan)
             dbuser.next_plan = None
@@ -1115,6 +1373,7 @@ def disable_all_active_users(db: Session, admin: Admin | None = None):
     query.update(
         {User.status: UserStatus.disabled, User.last_status_change: datetime.utcnow()}, synchronize_session=False
     )
+    mark_users_changed(db)
 
     db.commit()
 
@@ -1146,6 +1405,7 @@ def activate_all_disabled_users(db: Session, admin: Admin | None = None):
     query_for_active_users.update(
         {User.status: UserStatus.active, User.last_status_change: datetime.utcnow()}, synchronize_session=False
     )
+    mark_users_changed(db)
 
     db.commit()
 
@@ -1191,7 +1451,9 @@ def autodelete_expired_users(db: Session, include_limited_users: bool = False) -
     return expired_users
 
 
-def get_all_users_usages(db: Session, admin: Admin, start: datetime, end: datetime) -> list[UserUsageResponse]:
+def get_all_users_usages(
+    db: Session, admin: list[str] | None, start: datetime, end: datetime
+) -> list[UserUsageResponse]:
     """
     Retrieves usage data for all users associated with an admin within a specified time range.
 
@@ -1200,7 +1462,7 @@ def get_all_users_usages(db: Session, admin: Admin, start: datetime, end: dateti
 
     Args:
         db (Session): Database session for querying.
-        admin (Admin): The admin user for which to retrieve user usage data.
+        admin (Optional[List[str]]): Usernames of the admins whose users are counted; all users if empty.
         start (datetime): The start date and time of the period to consider.
         end (datetime): The end date and time of the period to consider.
 
@@ -1217,15 +1479,20 @@ def get_all_users_usages(db: Session, admin: Admin, start: datetime, end: dateti
     for node in db.query(Node).all():
         usages[node.id] = UserUsageResponse(node_id=node.id, node_name=node.name, used_traffic=0)
 
-    admin_users = set(user.id for user in get_users(db=db, admins=admin))
-
-    cond = and_(
-        NodeUserUsage.created_at >= start, NodeUserUsage.created_at <= end, NodeUserUsage.user_id.in_(admin_users)
+    # JOIN users по user_id с фильтром по admin_id вместо IN-списка всех id юзеров админа
+    users = User.__table__
+    admin_ids = select(Admin.id).where(Admin.username.in_(admin)) if admin else None
+    totals = _node_user_traffic(
+        db,
+        start,
+        end,
+        (lambda t: users.c.admin_id.in_(admin_ids)) if admin_ids is not None else None,
+        join=lambda t: (users, users.c.id == t.c.user_id),
     )
 
-    for v in db.query(NodeUserUsage).filter(cond):
+    for node_id, used_traffic in totals.items():
         try:
-            usages[v.node_id or 0].used_traffic += v.used_traffic
+            usages[node_id or 0].used_traffic += used_traffic
         except KeyError:
             pass
 
@@ -1701,11 +1968,16 @@ def get_nodes_usage(db: Session, start: datetime, end: datetime) -> list[NodeUsa
         usages[node.id] = NodeUsageResponse(node_id=node.id, node_name=node.name, uplink=0, downlink=0)
 
     cond = and_(NodeUsage.created_at >= start, NodeUsage.created_at <= end)
+    totals = (
+        db.query(NodeUsage.node_id, func.sum(NodeUsage.uplink), func.sum(NodeUsage.downlink))
+        .filter(cond)
+        .group_by(NodeUsage.node_id)
+    )
 
-    for v in db.query(NodeUsage).filter(cond):
+    for node_id, uplink, downlink in totals:
         try:
-            usages[v.node_id or 0].uplink += v.uplink
-            usages[v.node_id or 0].downlink += v.downlink
+            usages[node_id or 0].uplink += int(uplink or 0)
+            usages[node_id or 0].downlink += int(downlink or 0)
         except KeyError:
             pass
 
@@ -1895,6 +2167,29 @@ def get_bs_usage_totals(db: Session, user_id: int, yyyymm: str) -> int:
     return totals.get(user_id, 0)
 
 
+def get_bs_usage_totals_bulk(db: Session, user_ids: list[int], yyyymm: str, chunk_size: int = 1000) -> dict[int, int]:
+    """get_bs_usage_totals для многих юзеров: одна GROUP BY-выборка на чанк id.
+
+    Юзеры без расхода за месяц в результат не попадают (считать 0).
+    """
+    totals = {}
+    for start in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[start : start + chunk_size]
+        rows = (
+            db.query(NodeUserBsUsage.user_id, func.sum(NodeUserBsUsage.monthly_used))
+            .join(Node, Node.id == NodeUserBsUsage.node_id)
+            .filter(
+                Node.is_bs.is_(True),
+                NodeUserBsUsage.user_id.in_(chunk),
+                NodeUserBsUsage.monthly_period == yyyymm,
+            )
+            .group_by(NodeUserBsUsage.user_id)
+            .all()
+        )
+        totals.update({user_id: int(total or 0) for user_id, total in rows})
+    return totals
+
+
 def get_user_bs_traffic(db: Session, dbuser: User) -> dict[str, int]:
     """Сводка БС-трафика для API пользователя и внешних клиентов."""
     from app.xray.bs_limit import monthly_effective_limit, period_keys
@@ -1926,6 +2221,7 @@ def _bot_settings_for_user(db: Session, dbuser: User) -> dict[str, Any]:
 def reset_user_bs_extra_pool(db: Session, dbuser: User, *, commit: bool = True) -> User:
     """Обнуляет купленный пул bs_extra без проверки настроек (внутренний сброс)."""
     db.execute(update(User).where(User.id == dbuser.id).values(bs_extra=0))
+    mark_users_changed(db, [cast(int, dbuser.id)])
     if commit:
         db.commit()
         db.refresh(dbuser)
@@ -1943,6 +2239,7 @@ def modify_user_bs_extra(db: Session, dbuser: User, *, delta_bytes: int | None =
         db.execute(
             update(User).where(User.id == dbuser.id).values(bs_extra=int(dbuser.bs_extra or 0) + int(delta_bytes))
         )
+        mark_users_changed(db, [cast(int, dbuser.id)])
     else:
         raise ValueError("either delta_bytes or reset must be provided")
     db.commit()
@@ -1971,6 +2268,7 @@ def apply_bs_extra_pool_consumption(
     remaining = int(dbuser.bs_extra or 0)
     new_extra = 0 if remaining <= consume else remaining - consume
     db.execute(update(User).where(User.id == user_id).values(bs_extra=new_extra))
+    mark_users_changed(db, [user_id])
 
 
 def get_blocked_bs_node_ids(db: Session, user_id: int) -> set[int]:
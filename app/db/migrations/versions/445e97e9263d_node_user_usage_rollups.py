@@ -0,0 +1,46 @@
+"""node user usage rollups
+
+Revision ID: 445e97e9263d
+Revises: 69ce0fd73c8a
+Create Date: 2026-10-17 16:41:07.350912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '445e97e9263d'
+down_revision = '69ce0fd73c8a'
+branch_labels = None
+depends_on = None
+
+
+ROLLUP_TABLES = ("node_user_usages_daily", "node_user_usages_monthly")
+
+
+def upgrade() -> None:
+    for table in ROLLUP_TABLES:
+        op.create_table(
+            table,
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("created_at", sa.DateTime(), nullable=False),
+            sa.Column("user_id", sa.Integer(), nullable=True),
+            sa.Column("node_id", sa.Integer(), nullable=True),
+            sa.Column("used_traffic", sa.BigInteger(), nullable=True),
+            sa.ForeignKeyConstraint(["user_id"], ["users.id"]),
+        )
+        op.create_index(f"ix_{table}_created_at_node_id", table, ["created_at", "node_id"])
+        op.create_index(f"ix_{table}_user_id_created_at", table, ["user_id", "created_at"])
+
+    op.create_table(
+        "usage_rollups",
+        sa.Column("tier", sa.String(length=16), primary_key=True),
+        sa.Column("rolled_until", sa.DateTime(), nullable=False),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("usage_rollups")
+    for table in reversed(ROLLUP_TABLES):
+        op.drop_table(table)
@@ -0,0 +1,52 @@
+"""hot query indexes
+
+Revision ID: 69ce0fd73c8a
+Revises: e3a1c5b7d9f2
+Create Date: 2026-10-17 14:02:19.114205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '69ce0fd73c8a'
+down_revision = 'e3a1c5b7d9f2'
+branch_labels = None
+depends_on = None
+
+
+# (имя, таблица, колонки) — под предикаты review_users, учёта трафика и чисток
+INDEXES = [
+    # review: active + expire <= now, напоминания об истечении
+    ("ix_users_status_expire", "users", ["status", "expire"]),
+    # review: active + used_traffic >= data_limit (сравнение читается из индекса)
+    ("ix_users_status_data_limit_used_traffic", "users", ["status", "data_limit", "used_traffic"]),
+    # review: on_hold + on_hold_timeout <= now
+    ("ix_users_status_on_hold_timeout", "users", ["status", "on_hold_timeout"]),
+    # count_online_users
+    ("ix_users_online_at", "users", ["online_at"]),
+    # расход юзера за период
+    ("ix_node_user_usages_user_id_created_at", "node_user_usages", ["user_id", "created_at"]),
+    # расход по нодам за период
+    ("ix_node_user_usages_created_at_node_id", "node_user_usages", ["created_at", "node_id"]),
+    # get_notification_reminder
+    ("ix_notification_reminders_user_id_type_threshold", "notification_reminders", ["user_id", "type", "threshold"]),
+    # чистка истёкших напоминаний
+    ("ix_notification_reminders_expires_at", "notification_reminders", ["expires_at"]),
+]
+
+
+def upgrade() -> None:
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, unique=False)
+
+
+def downgrade() -> None:
+    mysql = op.get_bind().dialect.name in ("mysql", "mariadb")
+    for name, table, columns in reversed(INDEXES):
+        if mysql and columns[0] == "user_id":
+            # MySQL убирает свой индекс внешнего ключа, когда появляется составной
+            # с user_id в начале, и не даст удалить последний — возвращаем одиночный
+            op.create_index(f"ix_{table}_user_id", table, ["user_id"], unique=False)
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,30 @@
+"""usage spool ticks
+
+Revision ID: e3a1c5b7d9f2
+Revises: 5d34e433db0c
+Create Date: 2026-10-17 10:12:41.503118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3a1c5b7d9f2'
+down_revision = '5d34e433db0c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "usage_spool_ticks",
+        sa.Column("tick_id", sa.String(length=32), primary_key=True),
+        sa.Column("applied_at", sa.DateTime(), nullable=False),
+    )
+    op.create_index("ix_usage_spool_ticks_applied_at", "usage_spool_ticks", ["applied_at"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_usage_spool_ticks_applied_at", table_name="usage_spool_ticks")
+    op.drop_table("usage_spool_ticks")
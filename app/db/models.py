@@ -11,6 +11,7 @@ from sqlalchemy import (
     Enum,
     Float,
     ForeignKey,
+    Index,
     Integer,
     String,
     Table,
@@ -120,6 +121,13 @@ class ManagedSetting(Base):
 
 class User(Base):
     __tablename__ = "users"
+    # под предикаты review_users и count_online_users (миграция 69ce0fd73c8a)
+    __table_args__ = (
+        Index("ix_users_status_expire", "status", "expire"),
+        Index("ix_users_status_data_limit_used_traffic", "status", "data_limit", "used_traffic"),
+        Index("ix_users_status_on_hold_timeout", "status", "on_hold_timeout"),
+        Index("ix_users_online_at", "online_at"),
+    )
 
     id = Column(Integer, primary_key=True)
     username = Column(String(34, collation="NOCASE"), unique=True, index=True)
@@ -127,6 +135,8 @@ class User(Base):
     status = Column(Enum(UserStatus), nullable=False, default=UserStatus.active)
     used_traffic = Column(BigInteger, default=0)
     node_usages = relationship("NodeUserUsage", back_populates="user", cascade="all, delete-orphan")
+    node_usages_daily = relationship("NodeUserUsageDaily", back_populates="user", cascade="all, delete-orphan")
+    node_usages_monthly = relationship("NodeUserUsageMonthly", back_populates="user", cascade="all, delete-orphan")
     node_bs_usages = relationship("NodeUserBsUsage", back_populates="user", cascade="all, delete-orphan")
     notification_reminders = relationship("NotificationReminder", back_populates="user", cascade="all, delete-orphan")
     data_limit = Column(BigInteger, nullable=True)
@@ -510,7 +520,11 @@ class Node(Base):
 
 class NodeUserUsage(Base):
     __tablename__ = "node_user_usages"
-    __table_args__ = (UniqueConstraint("created_at", "user_id", "node_id"),)
+    __table_args__ = (
+        UniqueConstraint("created_at", "user_id", "node_id"),
+        Index("ix_node_user_usages_user_id_created_at", "user_id", "created_at"),
+        Index("ix_node_user_usages_created_at_node_id", "created_at", "node_id"),
+    )
 
     id = Column(Integer, primary_key=True)
     created_at = Column(DateTime, unique=False, nullable=False)  # one hour per record
@@ -521,6 +535,49 @@ class NodeUserUsage(Base):
     used_traffic = Column(BigInteger, default=0)
 
 
+class NodeUserUsageDaily(Base):
+    """Свёртка node_user_usages по дням: created_at — начало дня (app/db/usage_tiers.py)."""
+
+    __tablename__ = "node_user_usages_daily"
+    __table_args__ = (
+        Index("ix_node_user_usages_daily_created_at_node_id", "created_at", "node_id"),
+        Index("ix_node_user_usages_daily_user_id_created_at", "user_id", "created_at"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    user = relationship("User", back_populates="node_usages_daily")
+    node_id = Column(Integer, nullable=True)
+    used_traffic = Column(BigInteger, default=0)
+
+
+class NodeUserUsageMonthly(Base):
+    """Свёртка дневных агрегатов по месяцам: created_at — первое число месяца."""
+
+    __tablename__ = "node_user_usages_monthly"
+    __table_args__ = (
+        Index("ix_node_user_usages_monthly_created_at_node_id", "created_at", "node_id"),
+        Index("ix_node_user_usages_monthly_user_id_created_at", "user_id", "created_at"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    user = relationship("User", back_populates="node_usages_monthly")
+    node_id = Column(Integer, nullable=True)
+    used_traffic = Column(BigInteger, default=0)
+
+
+class UsageRollup(Base):
+    """Докуда (исключительно) свёрнут уровень node_user_usages: daily/monthly."""
+
+    __tablename__ = "usage_rollups"
+
+    tier = Column(String(16), primary_key=True)
+    rolled_until = Column(DateTime, nullable=False)
+
+
 class NodeUserBsUsage(Base):
     """По-нодный инкрементальный счётчик расхода для БС-нод (NPVPN-1456).
     Ленивый сброс периодов при инкременте; единственный writer — record_usages."""
@@ -562,8 +619,27 @@ class NodeUsage(Base):
     downlink = Column(BigInteger, default=0)
 
 
+class UsageSpoolTick(Base):
+    """Отметка тика учёта трафика, уже применённого к users/admins.
+
+    Пишется в одной транзакции с инкрементом used_traffic — реплей спула
+    (app/utils/usage_spool.py) по tick_id не засчитывает трафик дважды. Стадии
+    тика в отдельных транзакциях (node_user_usages, node_user_bs_usage) отмечаются
+    своими id — usage_spool.stage_tick_id(tick_id, стадия).
+    """
+
+    __tablename__ = "usage_spool_ticks"
+
+    tick_id = Column(String(32), primary_key=True)
+    applied_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+
 class NotificationReminder(Base):
     __tablename__ = "notification_reminders"
+    __table_args__ = (
+        Index("ix_notification_reminders_user_id_type_threshold", "user_id", "type", "threshold"),
+        Index("ix_notification_reminders_expires_at", "expires_at"),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"))
@@ -0,0 +1,110 @@
+"""Выборка и смена статусов юзеров для review_users одними SQL-запросами.
+
+review() раньше грузил всех active (и всех on_hold) юзеров через
+get_user_queryset — с joinedload admin, next_plan, bot.settings, node_bs_usages —
+только чтобы в Python сравнить used_traffic с data_limit и expire с now.
+Здесь кандидаты отбираются предикатами по индексируемым колонкам (status +
+expire / used_traffic / on_hold_timeout), грузятся только они, а статусы
+меняются UPDATE ... WHERE id IN (...) чанками. Время джоба растёт с числом
+изменений, а не с числом активных юзеров.
+
+users — таблица users или ORM-модель User: у модели колонки — атрибуты
+класса, и UPDATE по ней синхронизирует загруженные в сессию объекты
+(synchronize_session="evaluate"), не выпуская построчных UPDATE. "evaluate"
+сверяет WHERE с объектами в памяти, а не с БД, поэтому смену статуса
+параллельной транзакцией он не видит: review() сначала берёт строки под
+блокировку (lock_status_stmt) и меняет статус только им. Модуль
+зависит только от SQLAlchemy — тестируется на SQLite без окружения панели.
+"""
+
+from collections.abc import Sequence
+from datetime import datetime
+
+from sqlalchemy import and_, func, or_, select, update
+
+DEFAULT_CHUNK_SIZE = 500
+# запас к окну напоминаний об истечении: calculate_expiration_days считает дни
+# по локальному fromtimestamp, точная проверка всё равно делается в Python
+_EXPIRE_SLACK_DAYS = 2
+
+
+def _columns(users):
+    return getattr(users, "c", users)
+
+
+def due_condition(users, now_ts: int):
+    """Юзер исчерпал лимит трафика или истёк (0/NULL — без ограничения)."""
+    c = _columns(users)
+    return or_(
+        and_(c.data_limit > 0, c.used_traffic >= c.data_limit),
+        and_(c.expire > 0, c.expire <= now_ts),
+    )
+
+
+def reminder_condition(users, now_ts: int, usage_percents, days_left):
+    """Юзер может попасть под напоминание: расход ≥ минимального порога или истечение в окне."""
+    c = _columns(users)
+    conditions = []
+    if usage_percents:
+        conditions.append(and_(c.data_limit > 0, c.used_traffic * 100 >= c.data_limit * min(usage_percents)))
+    if days_left:
+        horizon = now_ts + (max(days_left) + _EXPIRE_SLACK_DAYS) * 86400
+        conditions.append(and_(c.expire > 0, c.expire <= horizon))
+    if not conditions:
+        return None
+    # не due: NOT due_condition на NULL-колонках дал бы NULL и потерял бы юзера
+    within_limit = or_(c.data_limit.is_(None), c.data_limit <= 0, c.used_traffic < c.data_limit)
+    not_expired = or_(c.expire.is_(None), c.expire <= 0, c.expire > now_ts)
+    return and_(or_(*conditions), within_limit, not_expired)
+
+
+def on_hold_condition(users, now: datetime):
+    """On-hold юзер подключился после последней правки или вышел его on_hold_timeout."""
+    c = _columns(users)
+    return or_(
+        c.online_at >= func.coalesce(c.edit_at, c.created_at),
+        c.on_hold_timeout <= now,
+    )
+
+
+def candidate_ids_stmt(users, status, condition):
+    c = _columns(users)
+    return select(c.id).where(c.status == status, condition).order_by(c.id)
+
+
+def lock_status_stmt(users, ids: Sequence[int], status):
+    """SELECT ... FOR UPDATE тех из ids, что всё ещё в status: до commit их статус никто не сменит."""
+    c = _columns(users)
+    return select(c.id).where(c.id.in_(ids), c.status == status).order_by(c.id).with_for_update()
+
+
+def set_status_stmt(users, ids: Sequence[int], from_status, status, changed_at: datetime, **values):
+    """UPDATE status для ids, только если статус ещё from_status (его не сменили параллельно)."""
+    c = _columns(users)
+    return (
+        update(users)
+        .where(c.id.in_(ids), c.status == from_status)
+        .values(status=status, last_status_change=changed_at, **values)
+        .execution_options(synchronize_session="evaluate")
+    )
+
+
+def activate_on_hold_statements(users, ids: Sequence[int], on_hold_status, active_status, now: datetime) -> list:
+    """on_hold → active со стартом срока: expire = now + on_hold_expire_duration (как start_user_expire).
+
+    Два UPDATE: синхронизация сессии вычисляет SET в произвольном порядке, и
+    обнуление on_hold_expire_duration в том же UPDATE могло бы опередить расчёт expire.
+    """
+    c = _columns(users)
+    start_expire = (
+        update(users)
+        .where(c.id.in_(ids), c.status == on_hold_status)
+        .values(expire=int(now.timestamp()) + c.on_hold_expire_duration)
+        .execution_options(synchronize_session="evaluate")
+    )
+    return [
+        start_expire,
+        set_status_stmt(
+            users, ids, on_hold_status, active_status, now, on_hold_expire_duration=None, on_hold_timeout=None
+        ),
+    ]
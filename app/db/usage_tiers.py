@@ -0,0 +1,172 @@
+"""Уровни хранения node_user_usages: часовые строки → дневные → месячные агрегаты.
+
+node_user_usages пишется строкой на (час, юзер, нода); дашборды расхода за 30
+дней читали сотни тысяч таких строк. Здесь:
+
+- закрытые периоды сворачиваются в node_user_usages_daily и
+  node_user_usages_monthly (created_at — начало дня/месяца) одним
+  INSERT ... SELECT ... GROUP BY на период. Период перед этим очищается, так что
+  повторная свёртка идемпотентна; строки с node_id NULL (Master) сворачиваются
+  так же;
+- докуда свёрнут каждый уровень, хранит usage_rollups (rolled_until,
+  исключительно). Часовые строки удаляются диапазоном целых дней и только
+  ниже этой границы — агрегаты за них уже есть;
+- запрос за [start, end] раскладывается на сегменты (plan): целые месяцы ниже
+  границы monthly — из месячной таблицы, целые дни ниже границы daily — из
+  дневной, края — из часовой. Сумма по сегментам совпадает с суммой по часовым
+  строкам.
+
+Модуль зависит только от SQLAlchemy — тестируется на SQLite без окружения панели.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, insert, literal, select
+
+HOURLY = "hourly"
+DAILY = "daily"
+MONTHLY = "monthly"
+
+DAY = timedelta(days=1)
+
+
+def floor_day(moment: datetime) -> datetime:
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def ceil_day(moment: datetime) -> datetime:
+    day = floor_day(moment)
+    return day if day == moment else day + DAY
+
+
+def floor_month(moment: datetime) -> datetime:
+    return floor_day(moment).replace(day=1)
+
+
+def next_month(month: datetime) -> datetime:
+    return month.replace(year=month.year + 1, month=1) if month.month == 12 else month.replace(month=month.month + 1)
+
+
+def ceil_month(moment: datetime) -> datetime:
+    month = floor_month(moment)
+    return month if month == moment else next_month(month)
+
+
+def next_period(tier: str, start: datetime) -> datetime:
+    return next_month(start) if tier == MONTHLY else start + DAY
+
+
+@dataclass(frozen=True)
+class Segment:
+    tier: str
+    start: datetime
+    end: datetime
+    # последний часовой сегмент включает end — как прежнее created_at <= end
+    inclusive: bool = False
+
+
+def _whole_periods(tier: str, start: datetime, end: datetime, until: datetime | None):
+    """[first, last) — целые периоды tier внутри [start, end) и ниже until; None, если таких нет."""
+    if until is None:
+        return None
+    first = ceil_month(start) if tier == MONTHLY else ceil_day(start)
+    limit = min(end, until)
+    last = first
+    while next_period(tier, last) <= limit:
+        last = next_period(tier, last)
+    return (first, last) if last > first else None
+
+
+def plan(start: datetime, end: datetime, daily_until: datetime | None, monthly_until: datetime | None) -> list:
+    """Сегменты для суммы расхода за [start, end] по самому крупному уровню, который их покрывает."""
+    if end < start:
+        return []
+    segments = []
+
+    def fill_days(lo: datetime, hi: datetime, inclusive: bool) -> None:
+        days = _whole_periods(DAILY, lo, hi, daily_until)
+        if days is None:
+            segments.append(Segment(HOURLY, lo, hi, inclusive))
+            return
+        if lo < days[0]:
+            segments.append(Segment(HOURLY, lo, days[0]))
+        segments.append(Segment(DAILY, *days))
+        if days[1] < hi or inclusive:
+            segments.append(Segment(HOURLY, days[1], hi, inclusive))
+
+    months = _whole_periods(MONTHLY, start, end, monthly_until)
+    if months is None:
+        fill_days(start, end, True)
+        return segments
+    if start < months[0]:
+        fill_days(start, months[0], False)
+    segments.append(Segment(MONTHLY, *months))
+    fill_days(months[1], end, True)
+    return segments
+
+
+def segment_condition(table, segment: Segment):
+    column = table.c.created_at
+    upper = column <= segment.end if segment.inclusive else column < segment.end
+    return (column >= segment.start) & upper
+
+
+def usage_by_node(execute, tables: dict, segments: list, condition=None, join=None) -> dict:
+    """{node_id: used_traffic} по сегментам plan: GROUP BY node_id на каждом уровне.
+
+    tables — {tier: Table}; condition(table) — доп. фильтр (например, по user_id);
+    join(table) — (таблица, on) для INNER JOIN, если фильтр идёт по её колонкам
+    (users.admin_id вместо списка id юзеров админа).
+    """
+    totals: dict = {}
+    for segment in segments:
+        table = tables[segment.tier]
+        stmt = select(table.c.node_id, func.sum(table.c.used_traffic)).select_from(table)
+        if join is not None:
+            stmt = stmt.join(*join(table))
+        stmt = stmt.where(segment_condition(table, segment))
+        if condition is not None:
+            stmt = stmt.where(condition(table))
+        for node_id, used in execute(stmt.group_by(table.c.node_id)):
+            totals[node_id] = totals.get(node_id, 0) + int(used or 0)
+    return totals
+
+
+def rollup_statements(source, target, start: datetime, end: datetime) -> list:
+    """Пересобрать строки target за период [start, end) из source (GROUP BY user_id, node_id)."""
+    aggregate = (
+        select(
+            literal(start, type_=target.c.created_at.type),
+            source.c.user_id,
+            source.c.node_id,
+            func.sum(source.c.used_traffic),
+        )
+        .where(source.c.created_at >= start, source.c.created_at < end)
+        .group_by(source.c.user_id, source.c.node_id)
+    )
+    return [
+        delete(target).where(target.c.created_at == start),
+        insert(target).from_select(["created_at", "user_id", "node_id", "used_traffic"], aggregate),
+    ]
+
+
+def due_periods(
+    tier: str, rolled_until: datetime | None, first_row: datetime | None, ready_before: datetime, limit: int
+):
+    """Начала периодов tier, которые пора свернуть: закрытых раньше ready_before, не больше limit.
+
+    rolled_until — граница прошлой свёртки; без неё начинаем с периода первой строки источника.
+    """
+    if rolled_until is None:
+        if first_row is None:
+            return []
+        rolled_until = floor_month(first_row) if tier == MONTHLY else floor_day(first_row)
+    periods: list[datetime] = []
+    start = rolled_until
+    while len(periods) < limit and next_period(tier, start) <= ready_before:
+        periods.append(start)
+        start = next_period(tier, start)
+    return periods
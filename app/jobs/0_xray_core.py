@@ -4,13 +4,14 @@ import traceback
 from app import app, logger, scheduler, xray
 from app.db import GetDB, crud
 from app.models.node import NodeStatus
-from app.xray.node import NodeAPIError
+from app.xray import config_transfer
+from app.xray.node_health import DOWN
 from config import (
     JOB_CORE_HEALTH_CHECK_INTERVAL,
+    XRAY_NODE_CONFIG_TRANSFER,
     XRAY_NODE_ERROR_RECONNECT_INTERVAL,
     XRAY_NODE_MAX_CONCURRENT_CONNECTS,
 )
-from xray_api import exc as xray_exc
 
 _error_reconnect_last: dict[int, float] = {}
 
@@ -40,19 +41,22 @@ def core_health_check():
     with GetDB() as db:
         dbnodes = crud.get_nodes(db=db, enabled=True)
 
+    for dbnode in dbnodes:
+        if dbnode.id not in xray.nodes:
+            xray.operations.add_node(dbnode)
+
     reconnects_scheduled = 0
     max_reconnects = max(1, XRAY_NODE_MAX_CONCURRENT_CONNECTS)
 
     for dbnode in dbnodes:
         node_id = dbnode.id
 
-        if node_id not in xray.nodes:
-            xray.operations.add_node(dbnode)
-
-        node = xray.nodes[node_id]
-
         if dbnode.status == NodeStatus.connected:
-            if not node.connected:
+            # состояние — от фонового пробера (jobs/probe_nodes); ещё не проверенную ноду пропускаем
+            health = xray.operations.node_health.get(node_id)
+            if health is None:
+                continue
+            if not health.connected:
                 if reconnects_scheduled >= max_reconnects:
                     continue
                 if not config:
@@ -61,13 +65,8 @@ def core_health_check():
                 reconnects_scheduled += 1
                 continue
 
-            try:
-                # Must hit the node REST API (GET /), not cached _started — ping alone
-                # does not prove Xray is running (e.g. OOM killed the core).
-                if not node.started:
-                    raise AssertionError("Xray core is not started on node")
-                node.api.get_sys_stats(timeout=2)
-            except (ConnectionError, NodeAPIError, xray_exc.XrayError, AssertionError):
+            if health.state == DOWN:
+                # ядро не работает или проверки падают XRAY_NODE_DOWN_AFTER_FAILURES раз подряд
                 if not config:
                     config = xray.config.include_db_users()
                 xray.operations.restart_node(node_id, config)
@@ -115,6 +114,8 @@ def start_core():
 
     # nodes' core
     logger.info("Starting nodes Xray core")
+    if XRAY_NODE_CONFIG_TRANSFER and "zstd" not in config_transfer.SUPPORTED_ENCODINGS:
+        logger.warning("zstandard is not installed (extra compression): node configs are sent gzip-compressed")
     with GetDB() as db:
         dbnodes = crud.get_nodes(db=db, enabled=True)
         node_ids = [dbnode.id for dbnode in dbnodes]
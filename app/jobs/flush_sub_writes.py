@@ -0,0 +1,43 @@
+"""Сброс буфера визитов /sub (crud.sub_writes, app/subscription/write_behind.py) в БД.
+
+Раз в JOB_FLUSH_SUB_WRITES_INTERVAL секунд накопленные sub_updated_at /
+sub_last_user_agent юзеров и last_seen/метаданные устройств пишутся одной
+транзакцией (crud.write_sub_visits). Если запись не прошла (lock wait,
+дедлок, пул) — касания возвращаются в буфер и уйдут следующим тиком.
+"""
+
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import TimeoutError as SATimeoutError
+
+from app import app, logger, scheduler
+from app.db import GetDB, crud
+from config import JOB_FLUSH_SUB_WRITES_INTERVAL
+
+
+def flush_sub_writes():
+    users, devices = crud.sub_writes.drain()
+    if not users and not devices:
+        return
+    try:
+        with GetDB() as db:
+            crud.write_sub_visits(db, users, devices)
+    except (SATimeoutError, OperationalError) as exc:
+        crud.sub_writes.restore(users, devices)
+        logger.warning(
+            "[sub.flush] postponed %d users / %d devices due to %s: %s",
+            len(users),
+            len(devices),
+            type(exc).__name__,
+            exc,
+        )
+
+
+if crud.SUB_WRITE_BEHIND:
+    scheduler.add_job(
+        flush_sub_writes, "interval", seconds=JOB_FLUSH_SUB_WRITES_INTERVAL, coalesce=True, max_instances=1
+    )
+
+    @app.on_event("shutdown")
+    def app_shutdown():
+        # визиты после последнего тика есть только в памяти
+        flush_sub_writes()
@@ -0,0 +1,26 @@
+from app import app, scheduler, xray
+from app.xray.node import probe_health
+from app.xray.node_client import gather_bounded, run_sync
+from app.xray.node_health import probe_all, register_metrics
+from config import XRAY_NODE_HEALTH_CHECK_CONCURRENCY, XRAY_NODE_PROBE_INTERVAL
+
+
+def probe_nodes():
+    # ноды в процессе подключения не трогаем: проверка сбросила бы сессию посреди connect
+    nodes = [
+        (node_id, node)
+        for node_id, node in list(xray.nodes.items())
+        if not xray.operations.is_connect_in_progress(node_id)
+    ]
+    run_sync(
+        probe_all(xray.operations.node_health, nodes, probe_health, gather_bounded, XRAY_NODE_HEALTH_CHECK_CONCURRENCY)
+    )
+
+
+scheduler.add_job(probe_nodes, "interval", seconds=max(1, XRAY_NODE_PROBE_INTERVAL), coalesce=True, max_instances=1)
+
+
+@app.on_event("startup")
+def register_node_health_metrics():
+    # после импорта app и app.db: регистрация на импорте operations ловила дедлок на REGISTRY._lock
+    register_metrics(xray.operations.node_health)
@@ -0,0 +1,92 @@
+"""Reconcile клиентов инбаундов на нодах с желаемым состоянием из БД.
+
+Желаемый конфиг каждой подключённой ноды строится тем же конвейером, что и при
+старте (include_db_users → фильтр инбаундов → каскад → снятие заблокированных),
+сворачивается в отпечатки {tag: {email: crc32}} и сравнивается с тем, что было
+успешно отправлено на ноду (operations.pushed_state). Через Proxyman уходит
+только разница — потерянные add/remove (нода была недоступна, таймаут) чинятся
+без рестарта ядра ноды.
+
+Клиенты для эталона читаются из БД отдельным запросом, мимо client_cache: кэш
+питается теми же событиями юзеров, что и отправка на ноды, и потерянное событие
+испортило бы обе стороны сравнения одинаково.
+
+Пары (tag, email), по которым после начала прохода что-то отправлялось или
+что-то ждёт в очереди user_ops, не трогаем: их состояние новее снимка БД.
+"""
+
+import time
+
+from app import logger, scheduler, xray
+from app.db import GetDB, crud
+from app.xray.node_state import reconcile_ops
+from app.xray.operations import (
+    _blocked_user_ids,
+    _build_node_config,
+    _cascade_kwargs,
+    _get_ready_node_ids,
+    _user_ops,
+    flush_user_ops,
+    pushed_state,
+)
+from config import JOB_RECONCILE_NODE_USERS_INTERVAL
+
+
+def _node_inputs(node_ids) -> dict:
+    """{node_id: (inbound_tags, cascade_kwargs, blocked_user_ids)} одной DB-сессией."""
+    inputs = {}
+    with GetDB() as db:
+        for node_id in node_ids:
+            dbnode = crud.get_node_by_id(db, node_id)
+            if dbnode:
+                inputs[node_id] = (
+                    [i.tag for i in dbnode.inbounds],
+                    _cascade_kwargs(db, dbnode),
+                    _blocked_user_ids(db, node_id),
+                )
+    return inputs
+
+
+def reconcile_node_users():
+    node_ids = [node_id for node_id in _get_ready_node_ids() if pushed_state.known(node_id)]
+    if not node_ids:
+        return
+
+    t0 = time.monotonic()
+    mark = pushed_state.mark()
+    config = xray.config.include_db_users(bypass_cache=True)
+    inputs = _node_inputs(node_ids)
+    # операции, поставленные до чтения БД, должны успеть записать свой результат
+    flush_user_ops(timeout=30)
+
+    cache = {}
+    pushed, removed, nodes = 0, 0, 0
+    for node_id, (inbound_tags, cascade_kwargs, blocked_user_ids) in inputs.items():
+        if not pushed_state.known(node_id):
+            continue  # нода переподключается — снимок соберётся при старте
+        try:
+            node_config = _build_node_config(config, inbound_tags, cascade_kwargs, blocked_user_ids)
+            ops = reconcile_ops(
+                node_config, pushed_state.snapshot(node_id), cache, pushed_state.changed_since(node_id, mark)
+            )
+        except Exception as e:
+            logger.warning(f"[reconcile_node_users] node={node_id} skipped: {type(e).__name__}: {e}")
+            continue
+        if not ops:
+            continue
+        _user_ops.enqueue(node_id, ops, overwrite=False)
+        nodes += 1
+        removed += sum(1 for op in ops if op.client is None)
+        pushed += sum(1 for op in ops if op.client is not None)
+
+    if nodes:
+        logger.info(
+            f"[reconcile_node_users] nodes={nodes}/{len(inputs)} push={pushed} remove={removed} "
+            f"dt={time.monotonic() - t0:.2f}s"
+        )
+
+
+if JOB_RECONCILE_NODE_USERS_INTERVAL > 0:
+    scheduler.add_job(
+        reconcile_node_users, "interval", seconds=JOB_RECONCILE_NODE_USERS_INTERVAL, coalesce=True, max_instances=1
+    )
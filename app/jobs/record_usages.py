@@ -1,137 +1,305 @@
+from array import array
 from collections import defaultdict
-from datetime import datetime, timedelta
+from datetime import UTC, datetime, timedelta
 from operator import attrgetter
+from typing import Any, cast
 
-from pymysql.err import OperationalError
-from sqlalchemy import and_, bindparam, insert, select, text, update
+from sqlalchemy import Table, and_, bindparam, case, insert, select, update
+from sqlalchemy.exc import InterfaceError as SAInterfaceError
+from sqlalchemy.exc import OperationalError as SAOperationalError
+from sqlalchemy.exc import TimeoutError as SATimeoutError
 from sqlalchemy.orm import Session
 from sqlalchemy.sql.dml import Insert
 
-from app import logger, scheduler, xray
+from app import app, logger, scheduler, xray
 from app.db import GetDB, crud
-from app.db.models import Admin, BotSettings, Node, NodeUsage, NodeUserBsUsage, NodeUserUsage, System, User
+from app.db.bulk import increment_set, increment_statements, upsert_statements, upsert_stmt
+from app.db.models import (
+    Admin,
+    BotSettings,
+    Node,
+    NodeUsage,
+    NodeUserBsUsage,
+    NodeUserUsage,
+    System,
+    UsageRollup,
+    UsageSpoolTick,
+    User,
+)
+from app.db.usage_tiers import DAILY
 from app.models.bot import apply_bot_settings_fallback
 from app.utils.concurrency import get_xray_executor
-from app.xray.bs_limit import bs_counter_step, period_keys
+from app.utils.usage_buffer import UsageBuffer
+from app.utils.usage_spool import NodeDelta, UsageSpool, UsageTick, new_tick_id, stage_tick_id
+from app.xray.bs_limit import period_keys
+from app.xray.stats_collector import NodeStatsPoller, get_stats_collector
 from config import (
     DISABLE_RECORDING_NODE_USAGE,
     DISABLE_RECORDING_NODE_USER_USAGE,
     JOB_CLEANUP_NODE_USER_USAGE_INTERVAL,
     JOB_RECORD_NODE_USAGES_INTERVAL,
     JOB_RECORD_USER_USAGES_INTERVAL,
-    NODE_USER_USAGE_CLEANUP_BATCH_SIZE,
-    NODE_USER_USAGE_RETENTION_DAYS,
+    NODE_USER_USAGE_BATCH_WRITE,
+    USAGE_SPOOL_DIR,
+    USAGE_SPOOL_FSYNC,
+    USAGE_SPOOL_SEGMENT_BYTES,
+    USAGE_UPSERT_MAX_ROWS,
+    XRAY_STATS_ASYNC,
+    XRAY_STATS_POLL_INTERVAL,
+    XRAY_STATS_POLL_PER_NODE,
+    XRAY_STATS_POLL_TIMEOUT,
 )
 from xray_api import XRay as XRayAPI
 from xray_api import exc as xray_exc
 
+# Отметки применённых тиков нужны только на окно реплея (следующие запуски джоба).
+USAGE_SPOOL_TICK_RETENTION = timedelta(days=1)
+
+# __table__ моделей типизирован как FromClause, bulk-хелперам нужен Table
+_users_table = cast(Table, User.__table__)
+_admins_table = cast(Table, Admin.__table__)
+_node_usages_table = cast(Table, NodeUsage.__table__)
+_node_user_usages_table = cast(Table, NodeUserUsage.__table__)
+_node_user_bs_usage_table = cast(Table, NodeUserBsUsage.__table__)
+
+_spool: UsageSpool | None = None
+_usage_buffer = UsageBuffer()
+_poller: NodeStatsPoller | None = None
+
+
+def get_usage_spool() -> UsageSpool | None:
+    global _spool
+    if _spool is None and USAGE_SPOOL_DIR:
+        _spool = UsageSpool(USAGE_SPOOL_DIR, segment_bytes=USAGE_SPOOL_SEGMENT_BYTES, fsync=USAGE_SPOOL_FSYNC)
+    return _spool
+
+
+def _marker_statements(db: Session, marker: str | None) -> list | None:
+    """[(вставка отметки стадии тика, None)] для транзакции стадии; None — стадия уже применена (реплей)."""
+    if not marker:
+        return []
+    if db.get(UsageSpoolTick, marker) is not None:
+        return None
+    return [(insert(UsageSpoolTick).values(tick_id=marker, applied_at=datetime.utcnow()), None)]
+
+
+def _usage_hour(db: Session, now: datetime | None) -> datetime:
+    """Час строки node_user_usages; в день, уже свёрнутый в дневной агрегат, не пишем.
+
+    Реплей спула после долгого простоя приносит тики старше границы свёртки
+    (usage_rollups): их трафик уходит в первый несвёрнутый час — иначе он не попал
+    бы ни в дневной, ни в месячный агрегат, а часовую строку удалила бы чистка.
+    """
+    created_at = datetime.fromisoformat((now or datetime.utcnow()).strftime("%Y-%m-%dT%H:00:00"))
+    rollup = db.get(UsageRollup, DAILY)
+    rolled_until = cast(datetime | None, rollup.rolled_until) if rollup is not None else None
+    if rolled_until is not None and created_at < rolled_until:
+        logger.info(f"[record_user_usages] usage of closed hour {created_at} recorded at {rolled_until}")
+        return rolled_until
+    return created_at
+
+
+def _node_deltas(node: NodeDelta) -> dict[int, int]:
+    """uid → дельта трафика ноды с её коэффициентом."""
+    deltas: dict[int, int] = defaultdict(int)
+    for uid, value in zip(node.uids, node.values):
+        deltas[uid] += int(value * node.coefficient)
+    return deltas
+
 
 def safe_execute(db: Session, stmt, params=None):
+    safe_execute_batch(db, [(stmt, params)])
+
+
+def safe_execute_batch(db: Session, statements: list):
+    """Выполнить [(stmt, params), ...] одной транзакцией; на MySQL — с ретраем дедлоков."""
     if db.bind.name == "mysql":
-        if isinstance(stmt, Insert):
-            stmt = stmt.prefix_with("IGNORE")
+        # Отметка тика (usage_spool_ticks) — без IGNORE: дубль PK значит, что стадию уже
+        # применили, и транзакция должна откатиться, а не засчитать трафик второй раз.
+        statements = [
+            (
+                stmt.prefix_with("IGNORE")
+                if isinstance(stmt, Insert) and stmt.table.name != UsageSpoolTick.__tablename__
+                else stmt,
+                params,
+            )
+            for stmt, params in statements
+        ]
 
         tries = 0
         done = False
         while not done:
             try:
-                db.connection().execute(stmt, params)
+                for stmt, params in statements:
+                    db.connection().execute(stmt, params)
                 db.commit()
                 done = True
-            except OperationalError as err:
+            except SAOperationalError as err:
                 # 1213 — deadlock, 1205 — lock wait timeout. Оба транзиентны,
                 # ретраим, иначе джоб падает и статистика тика теряется.
-                if err.args[0] in (1213, 1205) and tries < 3:
+                # SQLAlchemy оборачивает ошибку pymysql — код MySQL в err.orig.
+                code = err.orig.args[0] if err.orig is not None and err.orig.args else None
+                if code in (1213, 1205) and tries < 3:
                     db.rollback()
                     tries += 1
                     continue
                 raise err
 
     else:
-        db.connection().execute(stmt, params)
+        for stmt, params in statements:
+            db.connection().execute(stmt, params)
         db.commit()
 
 
-def record_user_stats(params: list, node_id: int | None, consumption_factor: int = 1):
-    if not params:
+def record_user_stats(node: NodeDelta, now: datetime = None, marker: str | None = None):
+    """node_user_usages одной ноды; marker — отметка стадии заспуленного тика (пишется в той же транзакции)."""
+    if not node.uids:
         return
 
-    created_at = datetime.fromisoformat(datetime.utcnow().strftime("%Y-%m-%dT%H:00:00"))
+    node_id = node.node_id
+    deltas = _node_deltas(node)
 
     with GetDB() as db:
-        # make user usage row if doesn't exist
+        marker_statements = _marker_statements(db, marker)
+        if marker_statements is None:
+            return
+        created_at = _usage_hour(db, now)
+        if node_id is not None:
+            rows = [
+                {"created_at": created_at, "user_id": uid, "node_id": node_id, "used_traffic": value}
+                for uid, value in deltas.items()
+            ]
+            safe_execute_batch(
+                db,
+                marker_statements
+                + upsert_statements(
+                    db.bind.name,
+                    _node_user_usages_table,
+                    rows,
+                    ["created_at", "user_id", "node_id"],
+                    increment_set("used_traffic"),
+                    USAGE_UPSERT_MAX_ROWS,
+                ),
+            )
+            return
+
+        # node_id=None (главный xray-инстанс): NULL не конфликтует в unique-индексе,
+        # upsert плодил бы дубли — прежний путь select/insert/update.
         select_stmt = select(NodeUserUsage.user_id).where(
-            and_(NodeUserUsage.node_id == node_id, NodeUserUsage.created_at == created_at)
+            and_(NodeUserUsage.node_id.is_(None), NodeUserUsage.created_at == created_at)
         )
-        existings = [r[0] for r in db.execute(select_stmt).fetchall()]
-        uids_to_insert = set()
-
-        for p in params:
-            uid = int(p["uid"])
-            if uid in existings:
-                continue
-            uids_to_insert.add(uid)
+        existings = {r[0] for r in db.execute(select_stmt).fetchall()}
+        uids_to_insert = [uid for uid in deltas if uid not in existings]
 
         if uids_to_insert:
             stmt = insert(NodeUserUsage).values(
-                user_id=bindparam("uid"), created_at=created_at, node_id=node_id, used_traffic=0
+                user_id=bindparam("uid"), created_at=created_at, node_id=None, used_traffic=0
             )
             safe_execute(db, stmt, [{"uid": uid} for uid in uids_to_insert])
 
         # record
         stmt = (
             update(NodeUserUsage)
-            .values(used_traffic=NodeUserUsage.used_traffic + bindparam("value") * consumption_factor)
+            .values(used_traffic=NodeUserUsage.used_traffic + bindparam("value"))
             .where(
                 and_(
                     NodeUserUsage.user_id == bindparam("uid"),
-                    NodeUserUsage.node_id == node_id,
+                    NodeUserUsage.node_id.is_(None),
                     NodeUserUsage.created_at == created_at,
                 )
             )
         )
-        safe_execute(db, stmt, params)
+        # строки-нули выше идемпотентны; отметка — в транзакции инкремента
+        safe_execute_batch(
+            db, marker_statements + [(stmt, [{"uid": uid, "value": value} for uid, value in deltas.items()])]
+        )
 
 
-def record_bs_user_stats(params: list, node_id: int, consumption_factor: int = 1):
+def record_users_stats_batch(nodes: list[NodeDelta], now: datetime = None, tick_id: str | None = None):
+    """node_user_usages всех нод тика — одной транзакцией.
+
+    Кортежи (user_id, node_id, delta) всех нод сливаются в колонки array('q') и
+    пишутся upsert'ами по USAGE_UPSERT_MAX_ROWS строк: время тика зависит от числа
+    строк, а не от числа нод (нет checkout сессии и commit на каждую ноду).
+    Главный инстанс (node_id=None) пишется отдельно — см. record_user_stats.
+    С tick_id у каждой из двух транзакций своя отметка стадии тика.
+    """
+    user_ids, node_ids, values = array("q"), array("q"), array("q")
+    main = None
+    for node in nodes:
+        if node.node_id is None:
+            main = node
+            continue
+        deltas = _node_deltas(node)
+        user_ids.extend(deltas.keys())
+        values.extend(deltas.values())
+        node_ids.extend([node.node_id] * len(deltas))
+
+    if user_ids:
+        with GetDB() as db:
+            statements = _marker_statements(db, tick_id and stage_tick_id(tick_id, "nodes"))
+            if statements is not None:
+                created_at = _usage_hour(db, now)
+                stmt = upsert_stmt(
+                    db.bind.name,
+                    _node_user_usages_table,
+                    ["created_at", "user_id", "node_id"],
+                    increment_set("used_traffic"),
+                )
+                step = max(1, USAGE_UPSERT_MAX_ROWS)
+                for start in range(0, len(user_ids), step):
+                    end = start + step
+                    chunk = [
+                        {"created_at": created_at, "user_id": uid, "node_id": node_id, "used_traffic": value}
+                        for uid, node_id, value in zip(user_ids[start:end], node_ids[start:end], values[start:end])
+                    ]
+                    statements.append((stmt, chunk))
+                safe_execute_batch(db, statements)
+
+    if main is not None:
+        record_user_stats(main, now, tick_id and stage_tick_id(tick_id, "node:main"))
+
+
+def _bs_counter_set(excluded, table):
+    # SQL-эквивалент bs_counter_step: ленивый сброс месяца при смене периода.
+    # monthly_used — первым: на MySQL SET видит уже обновлённый monthly_period.
+    return [
+        (
+            "monthly_used",
+            case(
+                (table.c.monthly_period == excluded.monthly_period, table.c.monthly_used + excluded.monthly_used),
+                else_=excluded.monthly_used,
+            ),
+        ),
+        ("monthly_period", excluded.monthly_period),
+    ]
+
+
+def record_bs_user_stats(node: NodeDelta, now: datetime = None, marker: str | None = None):
     """Инкремент node_user_bs_usage для одной БС-ноды (ленивый сброс месяца).
 
     Списание из User.bs_extra (купленный пул) — в той же транзакции, что и usage,
-    по приросту агрегата monthly_used сверх bs_monthly_limit бота.
+    по приросту агрегата monthly_used сверх bs_monthly_limit бота; там же отметка
+    стадии заспуленного тика (marker).
     """
-    if not params:
+    if not node.uids:
         return
 
-    yyyymm = period_keys(datetime.utcnow())
+    yyyymm = period_keys(now or datetime.utcnow())
+    node_id = node.node_id
 
     with GetDB() as db:
-        deltas = {}
-        for p in params:
-            uid = int(p["uid"])
-            deltas[uid] = deltas.get(uid, 0) + int(p["value"] * consumption_factor)
+        marker_statements = _marker_statements(db, marker)
+        if marker_statements is None:
+            return
+        for stmt, _ in marker_statements:
+            db.execute(stmt)
 
+        deltas = _node_deltas(node)
         uids = list(deltas.keys())
-        existing_rows = (
-            db.query(
-                NodeUserBsUsage.user_id,
-                NodeUserBsUsage.monthly_used,
-                NodeUserBsUsage.monthly_period,
-            )
-            .filter(
-                NodeUserBsUsage.node_id == node_id,
-                NodeUserBsUsage.user_id.in_(uids),
-            )
-            .all()
-        )
-        existing = {
-            r.user_id: {
-                "monthly_used": r.monthly_used,
-                "monthly_period": r.monthly_period,
-            }
-            for r in existing_rows
-        }
-
-        old_monthly_aggs = {uid: crud.get_bs_usage_totals(db, uid, yyyymm) for uid in uids}
+        # Агрегат до записи; меняется только строка этой (БС-)ноды, и её вклад в
+        # агрегат текущего месяца растёт ровно на delta — новый агрегат = старый + delta.
+        old_monthly_aggs = crud.get_bs_usage_totals_bulk(db, uids, yyyymm)
 
         user_bot = dict(db.query(User.id, User.bot_id).filter(User.id.in_(uids)).all())
         bot_monthly_limits = {}
@@ -139,36 +307,28 @@ def record_bs_user_stats(params: list, node_id: int, consumption_factor: int = 1
             settings = apply_bot_settings_fallback(data)
             bot_monthly_limits[bot_id] = settings.get("bs_monthly_limit") or 0
 
-        to_insert, to_update = [], []
-        for uid, delta in deltas.items():
-            vals = bs_counter_step(existing.get(uid), delta, yyyymm)
-            if uid in existing:
-                to_update.append({"uid": uid, **vals})
-            else:
-                to_insert.append({"user_id": uid, "node_id": node_id, **vals})
-
-        if to_insert:
-            stmt = insert(NodeUserBsUsage)
+        rows = [
+            {"node_id": node_id, "user_id": uid, "monthly_used": delta, "monthly_period": yyyymm}
+            for uid, delta in deltas.items()
+        ]
+        for stmt, chunk in upsert_statements(
+            db.bind.name,
+            _node_user_bs_usage_table,
+            rows,
+            ["node_id", "user_id"],
+            _bs_counter_set,
+            USAGE_UPSERT_MAX_ROWS,
+        ):
             if db.bind.name == "mysql":
                 stmt = stmt.prefix_with("IGNORE")
-            db.execute(stmt, to_insert)
-
-        if to_update:
-            stmt = (
-                update(NodeUserBsUsage)
-                .where(and_(NodeUserBsUsage.node_id == node_id, NodeUserBsUsage.user_id == bindparam("uid")))
-                .values(
-                    monthly_used=bindparam("monthly_used"),
-                    monthly_period=bindparam("monthly_period"),
-                )
-            )
-            db.execute(stmt, to_update)
+            db.execute(stmt, chunk)
 
-        for uid in uids:
-            new_monthly_agg = crud.get_bs_usage_totals(db, uid, yyyymm)
+        for uid, delta in deltas.items():
+            old_monthly_agg = old_monthly_aggs.get(uid, 0)
             monthly_limit = bot_monthly_limits.get(user_bot.get(uid), 0)
-            crud.apply_bs_extra_pool_consumption(db, uid, old_monthly_aggs[uid], new_monthly_agg, monthly_limit)
+            crud.apply_bs_extra_pool_consumption(db, uid, old_monthly_agg, old_monthly_agg + delta, monthly_limit)
 
+        crud.mark_users_changed(db, uids)  # bs_monthly_used в снимках /sub
         db.commit()
 
 
@@ -177,36 +337,54 @@ def record_node_stats(params: dict, node_id: int | None):
         return
 
     created_at = datetime.fromisoformat(datetime.utcnow().strftime("%Y-%m-%dT%H:00:00"))
+    up = sum(p["up"] for p in params)
+    down = sum(p["down"] for p in params)
 
     with GetDB() as db:
-        # make node usage row if doesn't exist
+        if node_id is not None:
+            row = {"created_at": created_at, "node_id": node_id, "uplink": up, "downlink": down}
+            safe_execute_batch(
+                db,
+                upsert_statements(
+                    db.bind.name,
+                    _node_usages_table,
+                    [row],
+                    ["created_at", "node_id"],
+                    increment_set("uplink", "downlink"),
+                ),
+            )
+            return
+
+        # make node usage row if doesn't exist (node_id=None — см. record_user_stats)
         select_stmt = select(NodeUsage.node_id).where(
-            and_(NodeUsage.node_id == node_id, NodeUsage.created_at == created_at)
+            and_(NodeUsage.node_id.is_(None), NodeUsage.created_at == created_at)
         )
         notfound = db.execute(select_stmt).first() is None
         if notfound:
-            insert_stmt = insert(NodeUsage).values(created_at=created_at, node_id=node_id, uplink=0, downlink=0)
+            insert_stmt = insert(NodeUsage).values(created_at=created_at, node_id=None, uplink=0, downlink=0)
             safe_execute(db, insert_stmt)
 
         # record
         update_stmt = (
             update(NodeUsage)
-            .values(uplink=NodeUsage.uplink + bindparam("up"), downlink=NodeUsage.downlink + bindparam("down"))
-            .where(and_(NodeUsage.node_id == node_id, NodeUsage.created_at == created_at))
+            .values(uplink=NodeUsage.uplink + up, downlink=NodeUsage.downlink + down)
+            .where(and_(NodeUsage.node_id.is_(None), NodeUsage.created_at == created_at))
         )
 
-        safe_execute(db, update_stmt, params)
+        safe_execute(db, update_stmt)
 
 
-def get_users_stats(api: XRayAPI):
+def get_users_stats(api: XRayAPI) -> tuple[array, array]:
+    """Колонки (uids, values), как у AsyncStatsCollector.collect(); нода не ответила — пустые."""
+    totals: dict[int, int] = defaultdict(int)
     try:
-        params = defaultdict(int)
         for stat in filter(attrgetter("value"), api.get_users_stats(reset=True, timeout=30)):
-            params[stat.name.split(".", 1)[0]] += stat.value
-        params = list({"uid": uid, "value": value} for uid, value in params.items())
-        return params
+            uid = stat.name.split(".", 1)[0]
+            if uid.isdigit():
+                totals[int(uid)] += stat.value
     except xray_exc.XrayError:
-        return []
+        return array("q"), array("q")
+    return array("q", totals.keys()), array("q", totals.values())
 
 
 def get_outbounds_stats(api: XRayAPI):
@@ -220,45 +398,67 @@ def get_outbounds_stats(api: XRayAPI):
         return []
 
 
-def record_user_usages():
-    api_instances = {None: xray.api}
-    usage_coefficient = {None: 1}  # default usage coefficient for the main api instance
+def _write_users_usage(
+    users_usage: dict[int, int], admin_usage: dict[int, int], online_at: datetime, tick_id: str | None
+) -> bool:
+    """Инкремент User.used_traffic/Admin.users_usage одной транзакцией.
 
-    for node_id, node in list(xray.nodes.items()):
-        if node.connected and node.started:
-            api_instances[node_id] = node.api
-            usage_coefficient[node_id] = node.usage_coefficient  # fetch the usage coefficient
+    С tick_id в той же транзакции пишется отметка UsageSpoolTick; если она уже есть
+    (тик применён до крэша, а отметка commit в спуле не успела записаться) —
+    возвращаем False и ничего не засчитываем повторно.
+    """
+    with GetDB() as db:
+        statements = []
+        if tick_id:
+            if db.get(UsageSpoolTick, tick_id) is not None:
+                return False
+            statements.append((insert(UsageSpoolTick).values(tick_id=tick_id, applied_at=datetime.utcnow()), None))
+
+        statements += increment_statements(
+            db.bind.name,
+            _users_table,
+            "id",
+            "used_traffic",
+            users_usage,
+            latest={"online_at": online_at},
+            chunk_size=USAGE_UPSERT_MAX_ROWS,
+        )
+        statements += increment_statements(
+            db.bind.name, _admins_table, "id", "users_usage", admin_usage, chunk_size=USAGE_UPSERT_MAX_ROWS
+        )
+        safe_execute_batch(db, statements)
+    # used_traffic — в subscription-userinfo; снимки сбрасываем уже после коммита
+    crud.user_snapshots.invalidate_ids(users_usage)
+    return True
 
-    executor = get_xray_executor()
-    futures = {node_id: executor.submit(get_users_stats, api) for node_id, api in api_instances.items()}
-    # Сбой одной ноды не должен ронять весь джоб и терять статистику остальных.
-    api_params = {}
-    for node_id, future in futures.items():
-        try:
-            api_params[node_id] = future.result()
-        except Exception as e:
-            logger.warning(f"[record_user_usages] failed to collect stats for node {node_id}: {type(e).__name__}: {e}")
-            api_params[node_id] = []
 
-    users_usage = defaultdict(int)
-    for node_id, params in api_params.items():
-        coefficient = usage_coefficient.get(node_id, 1)  # get the usage coefficient for the node
-        for param in params:
-            users_usage[param["uid"]] += int(param["value"] * coefficient)  # apply the usage coefficient
-    users_usage = list({"uid": uid, "value": value} for uid, value in users_usage.items())
+def _record_usage_tick(nodes: list[NodeDelta], now: datetime, tick_id: str | None = None):
+    """Записать дельты одного тика в БД.
+
+    Заспуленный тик (tick_id задан) пишется по стадиям — users/admins, по-нодный
+    учёт, БС-учёт, — каждая в своей транзакции со своей отметкой в usage_spool_ticks
+    (tick_id, stage_tick_id). Ошибку любой стадии он пробрасывает после попытки
+    записать остальные: тик останется в спуле, и реплей допишет только стадии без
+    отметки. Без спула поведение прежнее: ошибка стадии логируется, её трафик теряется.
+    """
+    users_usage: dict[int, int] = defaultdict(int)
+    for node in nodes:
+        for uid, value in _node_deltas(node).items():  # with the node usage coefficient
+            users_usage[uid] += value
     if not users_usage:
         return
 
-    admin_usage = defaultdict(int)
+    admin_usage: dict[int, int] = defaultdict(int)
     try:
         with GetDB() as db:
-            user_ids = [int(u["uid"]) for u in users_usage]
-            user_admin_map = dict(db.query(User.id, User.admin_id).filter(User.id.in_(user_ids)).all())
-        for user_usage in users_usage:
-            admin_id = user_admin_map.get(int(user_usage["uid"]))
+            user_admin_map = dict(db.query(User.id, User.admin_id).filter(User.id.in_(list(users_usage))).all())
+        for uid, value in users_usage.items():
+            admin_id = user_admin_map.get(uid)
             if admin_id:
-                admin_usage[admin_id] += user_usage["value"]
+                admin_usage[admin_id] += value
     except Exception as e:
+        if tick_id:
+            raise
         # Не можем посчитать admin-агрегат — это не повод терять учёт трафика
         # самих юзеров, просто пропускаем admin-обновление этого тика.
         logger.warning(f"[record_user_usages] failed to build admin usage map: {type(e).__name__}: {e}")
@@ -266,24 +466,11 @@ def record_user_usages():
 
     # record users usage
     try:
-        with GetDB() as db:
-            stmt = (
-                update(User)
-                .where(User.id == bindparam("uid"))
-                .values(used_traffic=User.used_traffic + bindparam("value"), online_at=datetime.utcnow())
-            )
-
-            safe_execute(db, stmt, users_usage)
-
-            admin_data = [{"admin_id": admin_id, "value": value} for admin_id, value in admin_usage.items()]
-            if admin_data:
-                admin_update_stmt = (
-                    update(Admin)
-                    .where(Admin.id == bindparam("admin_id"))
-                    .values(users_usage=Admin.users_usage + bindparam("value"))
-                )
-                safe_execute(db, admin_update_stmt, admin_data)
+        if not _write_users_usage(users_usage, admin_usage, now, tick_id):
+            logger.info(f"[record_user_usages] users usage of tick {tick_id} already applied")
     except Exception as e:
+        if tick_id:
+            raise
         # Счётчики xray уже сброшены (reset=True), трафик этого тика потерян
         # безвозвратно — но джоб не должен умирать и пропускать следующие тики.
         logger.error(f"[record_user_usages] failed to write user/admin usage: {type(e).__name__}: {e}")
@@ -291,6 +478,11 @@ def record_user_usages():
     if DISABLE_RECORDING_NODE_USER_USAGE:
         return
 
+    def stage(name: str) -> str | None:
+        return tick_id and stage_tick_id(tick_id, name)
+
+    failed: Exception | None = None
+
     # id всех БС-нод — для них дополнительно ведём node_user_bs_usage.
     try:
         with GetDB() as db:
@@ -298,31 +490,206 @@ def record_user_usages():
     except Exception as e:
         logger.warning(f"[record_user_usages] failed to load BS node ids: {type(e).__name__}: {e}")
         bs_node_ids = set()
+        failed = failed or e
 
-    for node_id, params in api_params.items():
+    if NODE_USER_USAGE_BATCH_WRITE:
         try:
-            record_user_stats(params, node_id, usage_coefficient[node_id])
+            record_users_stats_batch(nodes, now, tick_id)
         except Exception as e:
-            logger.warning(
-                f"[record_user_usages] failed to record node_user_usage for node {node_id}: {type(e).__name__}: {e}"
-            )
+            logger.warning(f"[record_user_usages] failed to record node_user_usage batch: {type(e).__name__}: {e}")
+            failed = failed or e
+
+    for node in nodes:
+        node_id = node.node_id
+        if not NODE_USER_USAGE_BATCH_WRITE:
+            try:
+                record_user_stats(node, now, stage(f"node:{node_id}"))
+            except Exception as e:
+                logger.warning(
+                    f"[record_user_usages] failed to record node_user_usage for node {node_id}: {type(e).__name__}: {e}"
+                )
+                failed = failed or e
         # node_id=None (главный xray-инстанс) никогда не попадает в bs_node_ids
         # (там только целочисленные id нод из БД), поэтому БС-учёт его не трогает.
         if node_id in bs_node_ids:
             try:
-                record_bs_user_stats(params, node_id, usage_coefficient[node_id])
+                record_bs_user_stats(node, now, stage(f"bs:{node_id}"))
             except Exception as e:
                 logger.warning(
                     f"[record_user_usages] failed to record node_user_bs_usage for "
                     f"node {node_id}: {type(e).__name__}: {e}"
                 )
+                failed = failed or e
+
+    if tick_id and failed is not None:
+        raise failed
+
+
+def replay_usage_spool(spool: UsageSpool) -> bool:
+    """Переиграть незакоммиченные тики спула от старых к новым.
+
+    На ошибке связи с БД останавливаемся (БД, скорее всего, всё ещё недоступна) —
+    оставшиеся тики дождутся следующего запуска. Тик, упавший на чём-то другом,
+    повтор не починит: он уходит в карантин спула (файл для ручного реплея), чтобы
+    не держать очередь. True, если спул опустел.
+    """
+    for tick in spool.pending():
+        try:
+            # created_at — POSIX-время; naive UTC, как datetime.utcnow() в остальном учёте
+            created_at = datetime.fromtimestamp(tick.created_at, UTC).replace(tzinfo=None)
+            _record_usage_tick(tick.nodes, created_at, tick.tick_id)
+        except (SAOperationalError, SAInterfaceError, SATimeoutError) as e:
+            logger.warning(
+                f"[record_user_usages] spool replay of tick {tick.tick_id} failed, "
+                f"{spool.pending_count()} ticks pending: {type(e).__name__}: {e}"
+            )
+            return False
+        except Exception as e:
+            try:
+                path = spool.quarantine(tick)
+            except OSError as qe:
+                logger.error(f"[record_user_usages] failed to quarantine spooled tick {tick.tick_id}: {qe}")
+                return False
+            logger.error(
+                f"[record_user_usages] spooled tick {tick.tick_id} quarantined to {path}, "
+                f"replay failed: {type(e).__name__}: {e}"
+            )
+            continue
+        spool.commit(tick.tick_id)
+        logger.info(f"[record_user_usages] replayed spooled tick {tick.tick_id}")
+    return True
+
+
+def collect_users_stats(api_instances: dict, usage_coefficient: dict) -> list[NodeDelta]:
+    """{node_id: api} → колонки uid/value ответивших нод с ненулевым трафиком, без пересборки в dict."""
+    columns: dict = {}
+    if XRAY_STATS_ASYNC:
+        try:
+            columns = get_stats_collector().collect(api_instances, reset=True, timeout=30)
+        except Exception as e:
+            logger.error(f"[record_user_usages] async stats collection failed: {type(e).__name__}: {e}")
+    else:
+        executor = get_xray_executor()
+        futures = {node_id: executor.submit(get_users_stats, api) for node_id, api in api_instances.items()}
+        # Сбой одной ноды не должен ронять весь джоб и терять статистику остальных.
+        for node_id, future in futures.items():
+            try:
+                columns[node_id] = future.result()
+            except Exception as e:
+                logger.warning(
+                    f"[record_user_usages] failed to collect stats for node {node_id}: {type(e).__name__}: {e}"
+                )
+    # None — нода не ответила; пустые колонки — трафика не было
+    return [
+        NodeDelta(node_id, float(usage_coefficient.get(node_id, 1)), *result)
+        for node_id, result in columns.items()
+        if result and result[0]
+    ]
+
+
+def _usage_targets() -> tuple[dict, dict]:
+    api_instances: dict[int | None, XRayAPI] = {None: xray.api}
+    usage_coefficient: dict[int | None, float] = {None: 1}  # default usage coefficient for the main api instance
+
+    # XRayNode — фабрика: __new__ отдаёт ReSTXRayNode/RPyCXRayNode, у самого класса api нет
+    nodes = cast(dict[int, Any], xray.nodes)
+    for node_id, node in list(nodes.items()):
+        if not xray.operations.node_health.usable(node_id):
+            continue
+        try:
+            api_instances[node_id] = node.api
+        except ConnectionError:
+            continue
+        usage_coefficient[node_id] = node.usage_coefficient  # fetch the usage coefficient
+    return api_instances, usage_coefficient
+
+
+def _write_usage_tick(nodes: list[NodeDelta], spool: UsageSpool | None, merged: list[str] | None = None):
+    """merged — удержанные тики по-нодных опросов, которые этот тик заменяет в спуле."""
+    now_utc = datetime.now(UTC)
+    now = now_utc.replace(tzinfo=None)
+    tick_id = None
+    if spool is not None:
+        # Сначала на диск, потом в БД: счётчики xray уже сброшены, другой копии дельт нет.
+        # timestamp() — у aware-времени: у naive utcnow() он зависел бы от таймзоны хоста
+        tick = UsageTick(new_tick_id(), now_utc.timestamp(), nodes)
+        try:
+            if merged:
+                spool.merge(tick, merged)
+            else:
+                spool.append(tick)
+            tick_id = tick.tick_id
+        except OSError as e:
+            if merged:
+                # дельты уже лежат в спуле тиками опросов — отдаём их реплею, а не пишем мимо WAL
+                spool.release(merged)
+                logger.error(f"[record_user_usages] failed to spool tick, poll ticks left for replay: {e}")
+                return
+            logger.error(f"[record_user_usages] failed to spool tick, writing without WAL: {type(e).__name__}: {e}")
+
+    try:
+        _record_usage_tick(nodes, now, tick_id)
+    except Exception as e:
+        logger.error(
+            f"[record_user_usages] failed to write usage, tick {tick_id} kept in spool for replay: "
+            f"{type(e).__name__}: {e}"
+        )
+        return
+
+    if spool is not None and tick_id:
+        spool.commit(tick_id)
+
+
+def get_stats_poller() -> NodeStatsPoller:
+    global _poller
+    if _poller is None:
+        _poller = NodeStatsPoller(
+            get_stats_collector(),
+            _usage_buffer,
+            XRAY_STATS_POLL_INTERVAL,
+            XRAY_STATS_POLL_TIMEOUT,
+            spool=get_usage_spool(),
+        )
+    return _poller
+
+
+def flush_usage_buffer():
+    """Записать накопленное по-нодными опросами одним тиком, закрыв в спуле тики опросов."""
+    deltas, tick_ids = _usage_buffer.drain_ticks()
+    if not deltas:
+        return
+    _write_usage_tick(deltas, get_usage_spool(), tick_ids)
+
+
+def record_user_usages():
+    spool = get_usage_spool()
+    if spool is not None and spool.pending_count():
+        replay_usage_spool(spool)
+
+    api_instances, usage_coefficient = _usage_targets()
+
+    if XRAY_STATS_POLL_PER_NODE:
+        # Опрос идёт по-нодно в фоне; здесь — актуализация набора нод и сброс буфера.
+        get_stats_poller().sync({node_id: (api, usage_coefficient[node_id]) for node_id, api in api_instances.items()})
+        flush_usage_buffer()
+        return
+
+    nodes = collect_users_stats(api_instances, usage_coefficient)
+    if not nodes:
+        return
+
+    _write_usage_tick(nodes, spool)
 
 
 def record_node_usages():
     api_instances = {None: xray.api}
     for node_id, node in list(xray.nodes.items()):
-        if node.connected and node.started:
+        if not xray.operations.node_health.usable(node_id):
+            continue
+        try:
             api_instances[node_id] = node.api
+        except ConnectionError:
+            continue
 
     executor = get_xray_executor()
     futures = {node_id: executor.submit(get_outbounds_stats, api) for node_id, api in api_instances.items()}
@@ -349,28 +716,13 @@ def record_node_usages():
         record_node_stats(params, node_id)
 
 
-def cleanup_node_user_usages():
-    if NODE_USER_USAGE_RETENTION_DAYS <= 0:
+def cleanup_usage_spool_ticks():
+    if not USAGE_SPOOL_DIR:
         return
-    cutoff = datetime.utcnow() - timedelta(days=NODE_USER_USAGE_RETENTION_DAYS)
+    cutoff = datetime.utcnow() - USAGE_SPOOL_TICK_RETENTION
     with GetDB() as db:
-        if db.bind.name == "mysql":
-            result = db.execute(
-                text("DELETE FROM node_user_usages WHERE created_at < :cutoff LIMIT :batch_size"),
-                {"cutoff": cutoff, "batch_size": NODE_USER_USAGE_CLEANUP_BATCH_SIZE},
-            )
-        else:
-            result = db.execute(
-                text(
-                    "DELETE FROM node_user_usages WHERE id IN "
-                    "(SELECT id FROM node_user_usages WHERE created_at < :cutoff LIMIT :batch_size)"
-                ),
-                {"cutoff": cutoff, "batch_size": NODE_USER_USAGE_CLEANUP_BATCH_SIZE},
-            )
+        db.query(UsageSpoolTick).filter(UsageSpoolTick.applied_at < cutoff).delete(synchronize_session=False)
         db.commit()
-        deleted = result.rowcount
-    if deleted > 0:
-        logger.info(f"[cleanup] deleted {deleted} rows from node_user_usages (cutoff={cutoff})")
 
 
 scheduler.add_job(
@@ -380,5 +732,14 @@ scheduler.add_job(
     record_node_usages, "interval", seconds=JOB_RECORD_NODE_USAGES_INTERVAL, coalesce=True, max_instances=1
 )
 scheduler.add_job(
-    cleanup_node_user_usages, "interval", seconds=JOB_CLEANUP_NODE_USER_USAGE_INTERVAL, coalesce=True, max_instances=1
+    cleanup_usage_spool_ticks, "interval", seconds=JOB_CLEANUP_NODE_USER_USAGE_INTERVAL, coalesce=True, max_instances=1
 )
+
+if XRAY_STATS_POLL_PER_NODE:
+
+    @app.on_event("shutdown")
+    def app_shutdown():
+        # дельты опросов после последнего сброса есть только в памяти
+        if _poller is not None:
+            _poller.stop()
+        flush_usage_buffer()
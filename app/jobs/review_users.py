@@ -1,22 +1,31 @@
 import time
-from concurrent.futures import as_completed
+from collections.abc import Sequence
 from datetime import datetime
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, cast
 
 from sqlalchemy.orm import Session
 
 from app import logger, scheduler, xray
 from app.db import (
     GetDB,
+    User,
     get_notification_reminder,
-    get_users,
     reset_user_by_next,
-    start_user_expire,
-    update_user_status,
+)
+from app.db.bulk import chunked
+from app.db.crud import get_user_queryset, mark_users_changed
+from app.db.review import (
+    DEFAULT_CHUNK_SIZE,
+    activate_on_hold_statements,
+    candidate_ids_stmt,
+    due_condition,
+    lock_status_stmt,
+    on_hold_condition,
+    reminder_condition,
+    set_status_stmt,
 )
 from app.models.user import ReminderType, UserResponse, UserStatus
 from app.utils import report
-from app.utils.concurrency import get_xray_executor
 from app.utils.helpers import calculate_expiration_days, calculate_usage_percent
 from config import (
     JOB_REVIEW_USERS_INTERVAL,
@@ -27,6 +36,8 @@ from config import (
     WEBHOOK_ADDRESS,
 )
 
+REVIEW_CHUNK_SIZE = DEFAULT_CHUNK_SIZE
+
 if TYPE_CHECKING:
     from app.db.models import User
 
@@ -82,81 +93,99 @@ def reset_user_by_next_report(db: Session, user: "User"):
     report.user_data_reset_by_next(user=UserResponse.model_validate(user), user_admin=user.admin)
 
 
+def _load_users(db: Session, ids: list[int]) -> list["User"]:
+    """Полные объекты (граф get_user_queryset) только для отобранных id."""
+    users = []
+    for chunk in chunked(ids, REVIEW_CHUNK_SIZE):
+        users.extend(get_user_queryset(db).filter(User.id.in_(chunk)).order_by(User.id).all())
+    return users
+
+
+def _candidates(db: Session, status: UserStatus, condition) -> list["User"]:
+    ids = db.execute(candidate_ids_stmt(User, status, condition)).scalars().all()
+    return _load_users(db, ids)
+
+
+def _lock_in_status(db: Session, users: list["User"], status: UserStatus) -> Sequence[int]:
+    """id из users, которые в БД всё ещё в status; строки заблокированы до commit."""
+    return db.execute(lock_status_stmt(User, [cast(int, u.id) for u in users], status)).scalars().all()
+
+
+def _log_step(step: str, count: int, t0: float) -> None:
+    dur = time.time() - t0
+    logger.info(f"[review] {step}: {count} users in {dur:.3f}s")
+    if dur >= SLOW_STEP_THRESHOLD:
+        logger.info(f"[review][slow] step={step} users={count} took {dur:.3f}s")
+
+
+def _reset_by_next_plan(db: Session, user: "User") -> None:
+    t0 = time.time()
+    reset_user_by_next_report(db, user)
+    dur = time.time() - t0
+    if dur >= SLOW_USER_TOTAL_THRESHOLD:
+        logger.info(f'[review][next_plan][slow] user="{user.username}" total={dur:.3f}s')
+
+
 def review():
+    """Смена статусов active → limited/expired и on_hold → active.
+
+    Кандидаты отбираются SQL-предикатами (app/db/review.py), статусы меняются
+    UPDATE ... WHERE id IN (...) чанками — работа пропорциональна числу изменений.
+    """
     now = datetime.utcnow()
     now_ts = now.timestamp()
     start_ts = time.time()
-    BATCH_SIZE_ACTIVE = 500
-    BATCH_SIZE_ONHOLD = 500
-    REMOVE_BATCH_SIZE = 50
-    checked_active = 0
     applied_next = 0
     limited_count = 0
     expired_count = 0
+    reminder_checked = 0
     on_hold_activated = 0
     with GetDB() as db:
-        _fetch_t0 = time.time()
-        active_users = get_users(db, status=UserStatus.active)
-        _fetch_dur = time.time() - _fetch_t0
-        logger.info(f"[review] fetched {len(active_users)} active users in {_fetch_dur:.3f}s")
-
-        # Process in deterministic order to reduce lock collisions
-        try:
-            active_users.sort(key=lambda u: u.id)
-        except Exception:
-            pass
-
-        changed_in_batch = 0
-        # Collect users that need removal from xray for batch processing
-        users_to_remove = []
-        for user in active_users:
-            checked_active += 1
+        _t0 = time.time()
+        due_users = _candidates(db, UserStatus.active, due_condition(User, now_ts))
+        _log_step("fetched limited/expired active", len(due_users), _t0)
 
+        new_status = {UserStatus.limited: [], UserStatus.expired: []}
+        for user in due_users:
             limited = user.data_limit and user.used_traffic >= user.data_limit
             expired = user.expire and user.expire <= now_ts
-
-            if (limited or expired) and user.next_plan is not None:
-                if user.next_plan is not None:
-                    if user.next_plan.fire_on_either:
-                        reset_user_by_next_report(db, user)
-                        applied_next += 1
-                        continue
-
-                    elif limited and expired:
-                        reset_user_by_next_report(db, user)
-                        applied_next += 1
-                        continue
-
-            if limited:
-                status = UserStatus.limited
-                limited_count += 1
-            elif expired:
-                status = UserStatus.expired
-                expired_count += 1
-            else:
-                if WEBHOOK_ADDRESS:
-                    add_notification_reminders(db, user, now)
+            if not (limited or expired):
                 continue
 
-            users_to_remove.append(user)
-            update_user_status(db, user, status, commit=False)
-
-            report.status_change(
-                username=user.username, status=status, user=UserResponse.model_validate(user), user_admin=user.admin
-            )
+            if user.next_plan is not None and (user.next_plan.fire_on_either or (limited and expired)):
+                _reset_by_next_plan(db, user)
+                applied_next += 1
+                continue
 
-            logger.info(f'User "{user.username}" status changed to {status}')
-            changed_in_batch += 1
+            new_status[UserStatus.limited if limited else UserStatus.expired].append(user)
 
-            # Commit batch periodically to avoid long-held locks
-            if changed_in_batch >= BATCH_SIZE_ACTIVE:
-                try:
-                    db.commit()
-                except Exception as e:
-                    logger.error(f"Failed to commit active batch: {e}")
-                    raise
-                finally:
-                    changed_in_batch = 0
+        _t0 = time.time()
+        users_to_remove = []
+        for status, users in new_status.items():
+            changed = set()
+            for chunk in chunked(users, REVIEW_CHUNK_SIZE):
+                # статус кандидата могли сменить параллельно — меняем только тем, кто ещё active
+                ids = _lock_in_status(db, chunk, UserStatus.active)
+                if not ids:
+                    continue
+                db.execute(set_status_stmt(User, ids, UserStatus.active, status, now))
+                mark_users_changed(db, ids)
+                changed.update(ids)
+            for user in users:
+                if user.id not in changed:
+                    continue
+                users_to_remove.append(user)
+                report.status_change(
+                    username=user.username,
+                    status=status,
+                    user=UserResponse.model_validate(user),
+                    user_admin=user.admin,
+                )
+                logger.info(f'User "{user.username}" status changed to {status}')
+        limited_count = sum(1 for u in users_to_remove if u.status == UserStatus.limited)
+        expired_count = len(users_to_remove) - limited_count
+        # до commit: после него объекты сессии истекают и каждый перечитывался бы отдельным SELECT
+        emails_to_remove = [f"{u.id}.{u.username}" for u in users_to_remove]
 
         # Commit all status changes before removing from xray
         try:
@@ -164,99 +193,64 @@ def review():
         except Exception as e:
             logger.error(f"Failed to commit batched review changes: {e}")
             raise
+        _log_step("limited/expired status update", len(emails_to_remove), _t0)
 
-        # Remove users from xray in batches through the thread pool
-        if users_to_remove:
-            executor = get_xray_executor()
+        # Remove users from xray in one bulk enqueue (streamed per node by the user-ops dispatcher)
+        if emails_to_remove:
             _remove_t0 = time.time()
-            for batch_start in range(0, len(users_to_remove), REMOVE_BATCH_SIZE):
-                batch = users_to_remove[batch_start : batch_start + REMOVE_BATCH_SIZE]
-                futures = {executor.submit(xray.operations.remove_user, u): u for u in batch}
-                for future in as_completed(futures):
-                    u = futures[future]
-                    try:
-                        future.result()
-                    except Exception as e:
-                        logger.warning(f'Failed to remove user "{u.username}" from XRAY: {e}')
+            try:
+                xray.operations.remove_users(emails_to_remove)
+            except Exception as e:
+                logger.warning(f"Failed to remove {len(emails_to_remove)} users from XRAY: {e}")
             _remove_dur = time.time() - _remove_t0
-            logger.info(f"[review] removed {len(users_to_remove)} users from xray in {_remove_dur:.3f}s")
-
-        _fetch_hold_t0 = time.time()
-        on_hold_users = get_users(db, status=UserStatus.on_hold)
-        _fetch_hold_dur = time.time() - _fetch_hold_t0
-        logger.info(f"[review] fetched {len(on_hold_users)} on_hold users in {_fetch_hold_dur:.3f}s")
-        # Deterministic order
-        try:
-            on_hold_users.sort(key=lambda u: u.id)
-        except Exception:
-            pass
-        changed_onhold_batch = 0
-        for user in on_hold_users:
-            _hold_u_t0 = time.time()
-            _t_update_status_hold = 0.0
-            _t_start_expire = 0.0
-
-            if user.edit_at:
-                base_time = datetime.timestamp(user.edit_at)
-            else:
-                base_time = datetime.timestamp(user.created_at)
-
-            # Check if the user is online After or at 'base_time'
-            if user.online_at and base_time <= datetime.timestamp(user.online_at):
-                status = UserStatus.active
+            logger.info(f"[review] removed {len(emails_to_remove)} users from xray in {_remove_dur:.3f}s")
+
+        reminders = reminder_condition(User, now_ts, NOTIFY_REACHED_USAGE_PERCENT, NOTIFY_DAYS_LEFT)
+        if WEBHOOK_ADDRESS and reminders is not None:
+            _t0 = time.time()
+            for user in _candidates(db, UserStatus.active, reminders):
+                add_notification_reminders(db, user, now)
+                reminder_checked += 1
+            db.commit()
+            _log_step("notification reminders", reminder_checked, _t0)
 
-            elif user.on_hold_timeout and (datetime.timestamp(user.on_hold_timeout) <= (now_ts)):
-                # If the user didn't connect within the timeout period, change status to "Active"
-                status = UserStatus.active
+        _t0 = time.time()
+        on_hold_users = _candidates(db, UserStatus.on_hold, on_hold_condition(User, now))
+        _log_step("fetched on_hold to activate", len(on_hold_users), _t0)
 
-            else:
+        _t0 = time.time()
+        activated = set()
+        for chunk in chunked(on_hold_users, REVIEW_CHUNK_SIZE):
+            ids = _lock_in_status(db, chunk, UserStatus.on_hold)
+            if not ids:
+                continue
+            for stmt in activate_on_hold_statements(User, ids, UserStatus.on_hold, UserStatus.active, now):
+                db.execute(stmt)
+            mark_users_changed(db, ids)
+            activated.update(ids)
+        for user in on_hold_users:
+            if user.id not in activated:
                 continue
-
-            _ts0 = time.time()
-            update_user_status(db, user, status, commit=False)
-            _t_update_status_hold = time.time() - _ts0
-            _te0 = time.time()
-            start_user_expire(db, user, commit=False)
-            _t_start_expire = time.time() - _te0
             on_hold_activated += 1
-            changed_onhold_batch += 1
-
-            if changed_onhold_batch >= BATCH_SIZE_ONHOLD:
-                try:
-                    db.commit()
-                except Exception as e:
-                    logger.error(f"Failed to commit on_hold batch: {e}")
-                    raise
-                finally:
-                    changed_onhold_batch = 0
-
             report.status_change(
-                username=user.username, status=status, user=UserResponse.model_validate(user), user_admin=user.admin
+                username=user.username,
+                status=UserStatus.active,
+                user=UserResponse.model_validate(user),
+                user_admin=user.admin,
             )
-
-            logger.info(f'User "{user.username}" status changed to {status}')
-            _hold_u_dur = time.time() - _hold_u_t0
-            if (
-                _hold_u_dur >= SLOW_USER_TOTAL_THRESHOLD
-                or _t_update_status_hold >= SLOW_STEP_THRESHOLD
-                or _t_start_expire >= SLOW_STEP_THRESHOLD
-            ):
-                logger.info(
-                    f'[review][on_hold][slow] user="{user.username}" total={_hold_u_dur:.3f}s '
-                    f"update_status={_t_update_status_hold:.3f}s start_expire={_t_start_expire:.3f}s"
-                )
-        # Final commit for on_hold group
+            logger.info(f'User "{user.username}" status changed to {UserStatus.active}')
         try:
             db.commit()
         except Exception as e:
-            logger.error(f"Failed to commit remaining on_hold changes: {e}")
+            logger.error(f"Failed to commit on_hold changes: {e}")
             raise
+        _log_step("on_hold activation", on_hold_activated, _t0)
 
     duration = time.time() - start_ts
     logger.info(
         f"review finished in {duration:.2f}s; "
-        f"active_checked={checked_active}, applied_next={applied_next}, "
-        f"limited={limited_count}, expired={expired_count}, on_hold_activated={on_hold_activated}"
+        f"applied_next={applied_next}, limited={limited_count}, expired={expired_count}, "
+        f"reminder_checked={reminder_checked}, on_hold_activated={on_hold_activated}"
     )
 
 
@@ -0,0 +1,122 @@
+"""Свёртка node_user_usages в дневные/месячные агрегаты и чистка по уровням.
+
+Логика уровней — app/db/usage_tiers.py. Джоб за запуск:
+1. сворачивает закрытые дни (старше NODE_USER_USAGE_ROLLUP_LAG_HOURS — запас на
+   реплей спула) из часовой таблицы в дневную, затем закрытые месяцы из дневной
+   в месячную; границы пишутся в usage_rollups в той же транзакции, что и период;
+2. удаляет часовые строки старше NODE_USER_USAGE_RETENTION_DAYS целыми днями
+   (created_at в [день, день + 1)) пачками по NODE_USER_USAGE_CLEANUP_BATCH_SIZE —
+   только ниже границы дневной свёртки; так же дневные строки старше
+   NODE_USER_USAGE_DAILY_RETENTION_DAYS — ниже границы месячной.
+
+Тики, пришедшие из спула позже запаса, в свёрнутый день не пишутся — их трафик
+уходит в первый несвёрнутый час (record_usages._usage_hour).
+
+Чистка — DELETE … LIMIT; партиционирование таблиц по дням (DROP PARTITION) требует
+миграции схемы и первичного ключа и остаётся отдельной задачей.
+"""
+
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, select
+
+from app import logger, scheduler
+from app.db import GetDB
+from app.db.crud import USAGE_TIER_TABLES, get_usage_rollups
+from app.db.models import UsageRollup
+from app.db.usage_tiers import DAILY, DAY, HOURLY, MONTHLY, due_periods, floor_day, next_period, rollup_statements
+from config import (
+    JOB_CLEANUP_NODE_USER_USAGE_INTERVAL,
+    NODE_USER_USAGE_CLEANUP_BATCH_SIZE,
+    NODE_USER_USAGE_DAILY_RETENTION_DAYS,
+    NODE_USER_USAGE_RETENTION_DAYS,
+    NODE_USER_USAGE_ROLLUP_LAG_HOURS,
+)
+
+# периодов одного уровня за запуск: первый запуск на старой базе догоняет постепенно
+ROLLUP_PERIODS_PER_RUN = 31
+# чистка останавливается после стольких секунд и продолжает в следующий запуск
+CLEANUP_TIME_BUDGET = 300
+
+
+def _set_rollup(db, tier: str, rolled_until: datetime) -> None:
+    row = db.get(UsageRollup, tier)
+    if row is None:
+        db.add(UsageRollup(tier=tier, rolled_until=rolled_until))
+    else:
+        row.rolled_until = rolled_until
+
+
+def _rollup(db, tier: str, source_tier: str, rolled_until: datetime | None, ready_before: datetime) -> datetime | None:
+    source, target = USAGE_TIER_TABLES[source_tier], USAGE_TIER_TABLES[tier]
+    first_row = None
+    if rolled_until is None:
+        first_row = db.execute(select(func.min(source.c.created_at))).scalar()
+    for start in due_periods(tier, rolled_until, first_row, ready_before, ROLLUP_PERIODS_PER_RUN):
+        t0 = time.time()
+        end = next_period(tier, start)
+        for stmt in rollup_statements(source, target, start, end):
+            db.execute(stmt)
+        _set_rollup(db, tier, end)
+        db.commit()
+        rolled_until = end
+        logger.info(f"[usage_rollup] {tier} {start:%Y-%m-%d} rolled up in {time.time() - t0:.2f}s")
+    return rolled_until
+
+
+def _drop_days(db, tier: str, cutoff: datetime, deadline: float) -> int:
+    """Удалить строки tier целыми днями до cutoff; → число удалённых строк."""
+    table = USAGE_TIER_TABLES[tier]
+    first_row = db.execute(select(func.min(table.c.created_at))).scalar()
+    if first_row is None:
+        return 0
+    deleted = 0
+    day = floor_day(first_row)
+    while day + DAY <= cutoff and time.monotonic() < deadline:
+        in_day = (table.c.created_at >= day) & (table.c.created_at < day + DAY)
+        ids = select(table.c.id).where(in_day).limit(NODE_USER_USAGE_CLEANUP_BATCH_SIZE)
+        if db.bind.name == "mysql":
+            # MySQL не принимает LIMIT в подзапросе IN — DELETE ... LIMIT по тому же диапазону
+            stmt = delete(table).where(in_day).with_dialect_options(mysql_limit=NODE_USER_USAGE_CLEANUP_BATCH_SIZE)
+        else:
+            stmt = delete(table).where(table.c.id.in_(ids.scalar_subquery()))
+        rows = db.execute(stmt).rowcount
+        db.commit()
+        deleted += rows
+        if rows < NODE_USER_USAGE_CLEANUP_BATCH_SIZE:
+            day += DAY
+    return deleted
+
+
+def rollup_node_user_usages():
+    now = datetime.utcnow()
+    with GetDB() as db:
+        rollups = get_usage_rollups(db)
+        daily_until = _rollup(
+            db, DAILY, HOURLY, rollups.get(DAILY), now - timedelta(hours=NODE_USER_USAGE_ROLLUP_LAG_HOURS)
+        )
+        monthly_until = rollups.get(MONTHLY)
+        if daily_until is not None:
+            monthly_until = _rollup(db, MONTHLY, DAILY, monthly_until, daily_until)
+
+        deadline = time.monotonic() + CLEANUP_TIME_BUDGET
+        if NODE_USER_USAGE_RETENTION_DAYS > 0 and daily_until is not None:
+            cutoff = min(floor_day(now - timedelta(days=NODE_USER_USAGE_RETENTION_DAYS)), daily_until)
+            deleted = _drop_days(db, HOURLY, cutoff, deadline)
+            if deleted:
+                logger.info(f"[cleanup] deleted {deleted} rows from node_user_usages (cutoff={cutoff})")
+        if NODE_USER_USAGE_DAILY_RETENTION_DAYS > 0 and monthly_until is not None:
+            cutoff = min(floor_day(now - timedelta(days=NODE_USER_USAGE_DAILY_RETENTION_DAYS)), monthly_until)
+            deleted = _drop_days(db, DAILY, cutoff, deadline)
+            if deleted:
+                logger.info(f"[cleanup] deleted {deleted} rows from node_user_usages_daily (cutoff={cutoff})")
+
+
+scheduler.add_job(
+    rollup_node_user_usages,
+    "interval",
+    seconds=JOB_CLEANUP_NODE_USER_USAGE_INTERVAL,
+    coalesce=True,
+    max_instances=1,
+)
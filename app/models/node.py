@@ -1,3 +1,4 @@
+from datetime import datetime
 from enum import Enum
 
 from pydantic import BaseModel, ConfigDict, Field, field_validator
@@ -10,6 +11,13 @@ class NodeStatus(str, Enum):
     disabled = "disabled"
 
 
+class NodeLiveness(str, Enum):
+    ready = "ready"
+    degraded = "degraded"
+    down = "down"
+    unknown = "unknown"
+
+
 class NodeProtocol(str, Enum):
     rest = "rest"
     rpyc = "rpyc"
@@ -130,3 +138,15 @@ class NodeUsageResponse(BaseModel):
 
 class NodesUsageResponse(BaseModel):
     usages: list[NodeUsageResponse]
+
+
+class NodeHealthResponse(BaseModel):
+    node_id: int
+    name: str
+    status: NodeStatus
+    state: NodeLiveness
+    connected: bool = False
+    rtt_ms: float | None = None
+    last_error: str | None = None
+    consecutive_failures: int = 0
+    checked_at: datetime | None = None
@@ -140,10 +140,10 @@ def disable_all_active_users(
 ):
     """Disable all active users under a specific admin"""
     crud.disable_all_active_users(db=db, admin=dbadmin)
-    startup_config = xray.config.include_db_users()
+    startup_config = xray.config.include_db_users(refresh=True)
     xray.core.restart(startup_config)
     for node_id, node in list(xray.nodes.items()):
-        if node.connected:
+        if xray.operations.node_health.connected(node_id):
             xray.operations.restart_node(node_id, startup_config)
     return {"detail": "Users successfully disabled"}
 
@@ -156,10 +156,10 @@ def activate_all_disabled_users(
 ):
     """Activate all disabled users under a specific admin"""
     crud.activate_all_disabled_users(db=db, admin=dbadmin)
-    startup_config = xray.config.include_db_users()
+    startup_config = xray.config.include_db_users(refresh=True)
     xray.core.restart(startup_config)
     for node_id, node in list(xray.nodes.items()):
-        if node.connected:
+        if xray.operations.node_health.connected(node_id):
             xray.operations.restart_node(node_id, startup_config)
     return {"detail": "Users successfully activated"}
 
@@ -84,11 +84,11 @@ def get_core_stats(admin: Admin = Depends(Admin.get_current)):
 @router.post("/core/restart", responses={403: responses._403})
 def restart_core(admin: Admin = Depends(Admin.check_sudo_admin)):
     """Restart the core and all connected nodes."""
-    startup_config = xray.config.include_db_users()
+    startup_config = xray.config.include_db_users(refresh=True)
     xray.core.restart(startup_config)
 
     for node_id, node in list(xray.nodes.items()):
-        if node.connected:
+        if xray.operations.node_health.connected(node_id):
             xray.operations.restart_node(node_id, startup_config)
 
     return {}
@@ -118,7 +118,7 @@ def modify_core_config(payload: dict, admin: Admin = Depends(Admin.check_sudo_ad
     startup_config = xray.config.include_db_users()
     xray.core.restart(startup_config)
     for node_id, node in list(xray.nodes.items()):
-        if node.connected:
+        if xray.operations.node_health.connected(node_id):
             xray.operations.restart_node(node_id, startup_config)
 
     xray.hosts.update()
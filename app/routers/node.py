@@ -1,5 +1,7 @@
 import asyncio
 import time
+from datetime import UTC, datetime
+from typing import cast
 
 from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, WebSocket
 from sqlalchemy.exc import IntegrityError
@@ -11,6 +13,8 @@ from app.dependencies import get_dbnode, validate_dates
 from app.models.admin import Admin
 from app.models.node import (
     NodeCreate,
+    NodeHealthResponse,
+    NodeLiveness,
     NodeModify,
     NodeResponse,
     NodeSettings,
@@ -85,7 +89,7 @@ async def node_logs(node_id: int, websocket: WebSocket, db: Session = Depends(ge
     if not xray.nodes.get(node_id):
         return await websocket.close(reason="Node not found", code=4404)
 
-    if not xray.nodes[node_id].connected:
+    if not xray.operations.node_health.connected(node_id):
         return await websocket.close(reason="Node is not connected", code=4400)
 
     interval = websocket.query_params.get("interval")
@@ -142,6 +146,32 @@ def get_nodes(db: Session = Depends(get_db), _: Admin = Depends(Admin.check_sudo
     return crud.get_nodes(db)
 
 
+@router.get("/nodes/health", response_model=list[NodeHealthResponse])
+def get_nodes_health(db: Session = Depends(get_db), _: Admin = Depends(Admin.check_sudo_admin)):
+    """Liveness of all nodes as last seen by the background prober. Accessible only to sudo admins."""
+    result = []
+    for dbnode in crud.get_nodes(db):
+        node_id, name, status = cast(int, dbnode.id), cast(str, dbnode.name), cast(NodeStatus, dbnode.status)
+        health = xray.operations.node_health.get(node_id)
+        if health is None:
+            result.append(NodeHealthResponse(node_id=node_id, name=name, status=status, state=NodeLiveness.unknown))
+            continue
+        result.append(
+            NodeHealthResponse(
+                node_id=node_id,
+                name=name,
+                status=status,
+                state=NodeLiveness(health.state),
+                connected=health.connected,
+                rtt_ms=health.rtt * 1000 if health.rtt is not None else None,
+                last_error=health.last_error,
+                consecutive_failures=health.consecutive_failures,
+                checked_at=datetime.fromtimestamp(health.checked_at, tz=UTC) if health.checked_at else None,
+            )
+        )
+    return result
+
+
 @router.put("/node/{node_id}", response_model=NodeResponse)
 def modify_node(
     modified_node: NodeModify,
@@ -1,20 +1,22 @@
 from datetime import UTC, datetime
-from typing import cast
 
 from fastapi import APIRouter, BackgroundTasks, Depends, Header, HTTPException, Path, Request, Response
 from fastapi.responses import HTMLResponse, RedirectResponse
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.exc import TimeoutError as SATimeoutError
 
-from app import logger
+from app import app, logger, xray
 from app.db import GetDB, Session, crud, get_db
 from app.db.models import User
 from app.dependencies import get_validated_sub, validate_dates
 from app.models.user import SubscriptionUserResponse, UserResponse
-from app.subscription.bot_settings import resolve_bot_settings
 from app.subscription.bs_context_builder import build_bs_context
+from app.subscription.compression import SubCompression, add_vary
+from app.subscription.etag import SubscriptionETags, matched_etag, variant_etag
 from app.subscription.headers import build_content_disposition, get_routing_header
 from app.subscription.page import build_subscription_page_context
+from app.subscription.randomness import seeded
+from app.subscription.render_cache import RenderCache, render_key
 from app.subscription.share import generate_subscription
 from app.subscription.subscription_service import (
     SubscriptionClientConfigEntry,
@@ -25,6 +27,7 @@ from app.subscription.subscription_service import (
     resolve_subscription_plan_by_client_type,
     resolve_subscription_plan_by_user_agent,
 )
+from app.subscription.user_cache import UserSnapshot
 from app.subscription.user_info import (
     get_subscription_user_info,
     get_user_note,
@@ -33,6 +36,14 @@ from app.subscription.user_info import (
 from app.templates import render_template
 from app.utils.jwt import get_subscription_payload
 from config import (
+    SUB_COMPRESS_CPU_BUDGET,
+    SUB_COMPRESS_ENCODINGS,
+    SUB_COMPRESS_MIN_BYTES,
+    SUB_ETAG_STABLE_RANDOM,
+    SUB_ETAG_TTL,
+    SUB_RENDER_CACHE_FRESH_FORMATS,
+    SUB_RENDER_CACHE_MB,
+    SUB_RENDER_CACHE_TTL,
     SUBSCRIPTION_PAGE_TEMPLATE,
     USE_CUSTOM_JSON_DEFAULT,
     USE_CUSTOM_JSON_FOR_HAPP,
@@ -59,24 +70,42 @@ client_config: dict[str, SubscriptionClientConfigEntry] = {
 
 router = APIRouter(tags=["Subscription"], prefix=f"/{XRAY_SUBSCRIPTION_PATH}")
 
+render_cache = RenderCache(SUB_RENDER_CACHE_MB * 1024 * 1024, SUB_RENDER_CACHE_TTL, SUB_RENDER_CACHE_FRESH_FORMATS)
+sub_etags = SubscriptionETags(SUB_ETAG_TTL, SUB_RENDER_CACHE_FRESH_FORMATS, SUB_ETAG_STABLE_RANDOM)
+sub_compression = SubCompression(SUB_COMPRESS_ENCODINGS, SUB_COMPRESS_MIN_BYTES, SUB_COMPRESS_CPU_BUDGET)
+
+
+@app.on_event("startup")
+def log_unavailable_sub_encodings():
+    if sub_compression.unavailable:
+        logger.warning(
+            f"SUB_COMPRESS_ENCODINGS: {', '.join(sub_compression.unavailable)} unavailable "
+            f"(install extra compression: brotli, zstandard); using {', '.join(sub_compression.encodings) or 'none'}"
+        )
+
+
+def _hosts_state():
+    """Хосты и инбаунды ядра — вход ETag-валидатора (итерация по xray.hosts загружает их при необходимости)."""
+    return {tag: xray.hosts.get(tag) for tag in xray.hosts}, xray.config.inbounds_by_tag
+
 
 def resolve_subscription_context(token: str, db: Session):
     """
-    Returns tuple: (dbuser or None, is_revoked: bool, created_at)
-    - dbuser is None when token invalid/not found
+    Returns tuple: (snapshot or None, is_revoked: bool, created_at)
+    - snapshot is a cached UserSnapshot (crud.get_user_snapshot), None when token invalid/not found
     - is_revoked True when token is valid but revoked
     """
     sub = get_subscription_payload(token)
     if not sub:
         return None, False, None
-    dbuser: User | None = crud.get_user(db, sub["username"])
-    if not dbuser:
+    snapshot: UserSnapshot | None = crud.get_user_snapshot(db, sub["username"])
+    if not snapshot:
         return None, False, None
     # If token created before user record (e.g., renamed/recreated), treat as invalid
-    if dbuser.created_at and sub.get("created_at") and dbuser.created_at > sub["created_at"]:
+    if snapshot.created_at and sub.get("created_at") and snapshot.created_at > sub["created_at"]:
         return None, False, None
-    revoked = bool(dbuser.sub_revoked_at and sub.get("created_at") and dbuser.sub_revoked_at > sub["created_at"])
-    return dbuser, revoked, sub.get("created_at")
+    revoked = bool(snapshot.sub_revoked_at and sub.get("created_at") and snapshot.sub_revoked_at > sub["created_at"])
+    return snapshot, revoked, sub.get("created_at")
 
 
 def _update_user_sub_bg(user_id: int, user_agent: str) -> None:
@@ -117,7 +146,7 @@ def _update_user_sub_bg(user_id: int, user_agent: str) -> None:
 def build_render_context(
     request: Request,
     db: Session,
-    dbuser: User,
+    dbuser: UserSnapshot,
     user: UserResponse,
     bot_settings: dict,
     *,
@@ -156,7 +185,9 @@ def build_render_context(
         bot_settings=bot_settings,
         get_user_note=get_user_note,
     )
-    user_info = get_subscription_user_info(user, db=db, bot_settings=bot_settings, user_id=cast(int, dbuser.id))
+    user_info = get_subscription_user_info(
+        user, db=db, bot_settings=bot_settings, user_id=dbuser.id, bs_extra=dbuser.bs_extra or 0
+    )
     subscription_userinfo = "; ".join(f"{key}={val}" for key, val in user_info.items())
     response_headers = build_subscription_response_headers(
         request=request,
@@ -178,25 +209,81 @@ def build_render_context(
         bot_settings=bot_settings,
         bs=bs,
         response_headers=response_headers,
+        user_key=(dbuser.id, dbuser.version),
+        user_digest=dbuser.digest,
     )
 
 
-def render_subscription(ctx: SubscriptionRenderContext, plan: SubscriptionRenderPlan) -> Response:
-    """Единая точка генерации ответа подписки по контексту и плану рендера."""
-    conf = generate_subscription(
-        user=ctx.user,
-        config_format=plan.config_format,
-        as_base64=plan.as_base64,
-        reverse=plan.reverse,
-        revoked=ctx.is_revoked,
-        expired=ctx.is_expired,
-        device_limited=ctx.device_limited,
-        device_limited_hard=ctx.device_limited_hard,
-        unsupported_client=ctx.unsupported_blocks,
-        settings=ctx.bot_settings,
-        bs=ctx.bs,
-    )
-    return Response(content=conf, media_type=plan.media_type, headers=ctx.response_headers)
+def _encode_body(key: tuple | None, config_format: str, conf: str, accept_encoding: str | None):
+    """(тело, Content-Encoding) в лучшей кодировке из Accept-Encoding; (conf, None) — отдавать как есть.
+
+    Сжатый вариант закэшированного тела берётся из кэша рендера или сжимается и кладётся рядом с телом.
+    """
+    encodings = sub_compression.acceptable(accept_encoding, len(conf))
+    if not encodings:
+        return conf, None
+    cache_key = key if key is not None and render_cache.cacheable(config_format) else None
+    if cache_key is not None:
+        for encoding in encodings:
+            data = render_cache.get_variant(cache_key, encoding)
+            if data is not None:
+                return data, encoding
+    data = sub_compression.compress(conf.encode(), encodings[0])
+    if data is None:
+        return conf, None
+    if cache_key is not None:
+        render_cache.put_variant(cache_key, encodings[0], data)
+    return data, encodings[0]
+
+
+def render_subscription(
+    ctx: SubscriptionRenderContext,
+    plan: SubscriptionRenderPlan,
+    if_none_match: str | None = None,
+    accept_encoding: str | None = None,
+) -> Response:
+    """Единая точка генерации ответа подписки по контексту и плану рендера.
+
+    Совпавший If-None-Match — 304 без рендера; заголовки (subscription-userinfo и др.) отдаются и в нём.
+    Тело сжимается по Accept-Encoding (app/subscription/compression.py), заголовки ответа не меняются,
+    кроме добавленных Content-Encoding и Vary.
+    """
+    hosts_version = xray.hosts.version
+    etag = sub_etags.validator(ctx, plan, hosts_version, _hosts_state)
+    headers = add_vary(ctx.response_headers) if sub_compression.enabled else ctx.response_headers
+    if etag is not None and (matched := matched_etag(if_none_match, etag)) is not None:
+        return Response(status_code=304, headers={**headers, "etag": matched})
+
+    def generate() -> str:
+        return generate_subscription(
+            user=ctx.user,
+            config_format=plan.config_format,
+            as_base64=plan.as_base64,
+            reverse=plan.reverse,
+            revoked=ctx.is_revoked,
+            expired=ctx.is_expired,
+            device_limited=ctx.device_limited,
+            device_limited_hard=ctx.device_limited_hard,
+            unsupported_client=ctx.unsupported_blocks,
+            settings=ctx.bot_settings,
+            bs=ctx.bs,
+        )
+
+    def render() -> str:
+        if etag is not None and sub_etags.stable_random:
+            # соли SNI/host — от валидатора: тело под этим ETag одинаково в любом воркере и после рендера заново
+            with seeded(etag):
+                return generate()
+        return generate()
+
+    key = render_key(ctx, plan, hosts_version)
+    conf = render_cache.get_or_render(key, plan.config_format, render)
+    content, encoding = _encode_body(key, plan.config_format, conf, accept_encoding)
+    if encoding is not None:
+        headers = {**headers, "content-encoding": encoding}
+    if etag is not None:
+        headers = {**headers, "etag": variant_etag(etag, encoding)}
+    return Response(content=content, media_type=plan.media_type, headers=headers)
 
 
 @router.get("/{token}/")
@@ -211,23 +298,29 @@ def user_subscription(
     x_device_os: str | None = Header(default=None),
     x_ver_os: str | None = Header(default=None),
     x_device_model: str | None = Header(default=None),
+    if_none_match: str | None = Header(default=None),
+    accept_encoding: str | None = Header(default=None),
 ):
     """Provides a subscription link based on the user agent (Clash, V2Ray, etc.)."""
     # 1) Валидация токена и подготовка user/settings.
+    # Снимок юзера из кэша (токен уже сохранён при загрузке); ORM-объект не нужен.
     dbuser, is_revoked, _ = resolve_subscription_context(token, db)
     if not dbuser:
         return Response(status_code=404)
-    crud.ensure_subscription_token(db, dbuser)
     is_expired = bool(dbuser.expire and dbuser.expire > 0 and dbuser.expire < int(datetime.now(UTC).timestamp()))
-    user: UserResponse = UserResponse.model_validate(dbuser)
-    bot_settings = resolve_bot_settings(dbuser)
+    user: UserResponse = dbuser.user
+    bot_settings = dbuser.bot_settings
 
     is_limited = not is_revoked and not is_expired and crud.is_device_limit_reached(db, dbuser)
 
     accept_header = request.headers.get("Accept", "")
     if "text/html" in accept_header:
         # HTML-ветка (страница подписки) обрабатывается отдельно от генерации конфигов.
-        html_context = build_subscription_page_context(db, dbuser, token)
+        # Странице нужен ORM-объект (устройства, связи) — грузим его только здесь.
+        page_user = crud.get_user(db, dbuser.username)
+        if not page_user:
+            return Response(status_code=404)
+        html_context = build_subscription_page_context(db, page_user, token)
         if is_revoked:
             return HTMLResponse(render_template("sub/revoked.html", html_context))
         if is_expired:
@@ -252,9 +345,13 @@ def user_subscription(
         x_device_model=x_device_model,
     )
 
-    # 3) Фоновый апдейт sub_updated_at / sub_last_user_agent — только на этом эндпоинте.
+    # 3) Апдейт sub_updated_at / sub_last_user_agent — только на этом эндпоинте: в буфер
+    #    отложенной записи (джоб flush_sub_writes), если он выключен — фоновой задачей.
     if not is_revoked and not is_expired:
-        background_tasks.add_task(_update_user_sub_bg, dbuser.id, user_agent)
+        if crud.SUB_WRITE_BEHIND:
+            crud.touch_user_sub(dbuser, user_agent)
+        else:
+            background_tasks.add_task(_update_user_sub_bg, dbuser.id, user_agent)
 
     # 4) Выбор плана рендера по User-Agent и возврат ответа.
     plan = resolve_subscription_plan_by_user_agent(
@@ -265,7 +362,7 @@ def user_subscription(
         use_custom_json_for_streisand=USE_CUSTOM_JSON_FOR_STREISAND,
         use_custom_json_for_happ=USE_CUSTOM_JSON_FOR_HAPP,
     )
-    return render_subscription(ctx, plan)
+    return render_subscription(ctx, plan, if_none_match, accept_encoding)
 
 
 @router.get("/{token}/devices/{device_id}/revoke", include_in_schema=False)
@@ -325,17 +422,19 @@ def user_subscription_with_client_type(
     x_device_os: str | None = Header(default=None),
     x_ver_os: str | None = Header(default=None),
     x_device_model: str | None = Header(default=None),
+    if_none_match: str | None = Header(default=None),
+    accept_encoding: str | None = Header(default=None),
 ):
     """Provides a subscription link based on the specified client type (e.g., Clash, V2Ray)."""
     # Эндпоинт с явным client_type: схема похожа на /{token}, но план
     # рендера выбирается не по UA, а по параметру пути.
+    # Снимок юзера из кэша (токен уже сохранён при загрузке); ORM-объект не нужен.
     dbuser, is_revoked, _ = resolve_subscription_context(token, db)
     if not dbuser:
         return Response(status_code=404)
-    crud.ensure_subscription_token(db, dbuser)
     is_expired = bool(dbuser.expire and dbuser.expire > 0 and dbuser.expire < int(datetime.now(UTC).timestamp()))
-    user: UserResponse = UserResponse.model_validate(dbuser)
-    bot_settings = resolve_bot_settings(dbuser)
+    user: UserResponse = dbuser.user
+    bot_settings = dbuser.bot_settings
 
     ctx = build_render_context(
         request,
@@ -361,4 +460,4 @@ def user_subscription_with_client_type(
         )
     except ValueError as exc:
         raise HTTPException(status_code=400, detail="Unknown client type") from exc
-    return render_subscription(ctx, plan)
+    return render_subscription(ctx, plan, if_none_match, accept_encoding)
@@ -255,7 +255,7 @@ def list_user_devices(
 )
 def add_user_device(
     device: UserDeviceCreate,
-    dbuser: UserResponse = Depends(get_validated_user),
+    dbuser: DBUser = Depends(get_validated_user),
     db: Session = Depends(get_db),
 ):
     if dbuser.device_limit and crud.count_user_devices(db, dbuser) >= dbuser.device_limit:
@@ -275,7 +275,7 @@ def add_user_device(
 def update_user_device(
     device_id: int,
     device: UserDeviceUpdate,
-    dbuser: UserResponse = Depends(get_validated_user),
+    dbuser: DBUser = Depends(get_validated_user),
     db: Session = Depends(get_db),
 ):
     dbdevice = crud.get_user_device(db, dbuser, device_id)
@@ -503,10 +503,10 @@ def reset_users_data_usage(db: Session = Depends(get_db), admin: Admin = Depends
     """Reset all users data usage"""
     dbadmin = crud.get_admin(db, admin.username)
     crud.reset_all_users_data_usage(db=db, admin=dbadmin)
-    startup_config = xray.config.include_db_users()
+    startup_config = xray.config.include_db_users(refresh=True)
     xray.core.restart(startup_config)
     for node_id, node in list(xray.nodes.items()):
-        if node.connected:
+        if xray.operations.node_health.connected(node_id):
             xray.operations.restart_node(node_id, startup_config)
     return {"detail": "Users successfully reset."}
 
@@ -5,12 +5,13 @@ from typing import cast
 from app.db import Session, crud
 from app.db.models import User
 from app.subscription.bs_context import BsContext
+from app.subscription.user_cache import UserSnapshot
 from app.xray.bs_limit import bs_stub_remark
 
 
 def build_bs_context(
     db: Session,
-    dbuser: User,
+    dbuser: User | UserSnapshot,
     *,
     is_revoked: bool,
     is_expired: bool,
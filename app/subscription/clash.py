@@ -1,13 +1,13 @@
-import copy
 import json
-from random import choice
 from uuid import UUID
 
 import yaml
 from jinja2.exceptions import TemplateNotFound
 
-from app.subscription.funcs import get_grpc_gun
-from app.templates import render_template
+from app.subscription.funcs import get_grpc_gun, parse_user_agent_list
+from app.subscription.randomness import choice
+from app.templates import render_template, template_registry
+from app.templates.registry import clone
 from app.utils.helpers import yml_uuid_representer
 from config import (
     CLASH_SETTINGS_TEMPLATE,
@@ -16,6 +16,37 @@ from config import (
     USER_AGENT_TEMPLATE,
 )
 
+# проба контекста CLASH_SUBSCRIPTION_TEMPLATE для компиляции шаблона в Frame (app/templates/registry.py):
+# рендер без Jinja и повторного yaml.safe_load; списки — той же формы, что self.data/proxy_remarks
+_FRAME_PROBE = {
+    "conf": {
+        "proxies": [
+            {"name": "a", "type": "vmess", "server": "a.example.com", "port": 443, "udp": True},
+            {"name": "b", "type": "trojan", "server": "b.example.com", "port": 8443, "ws-opts": {"path": "/"}},
+        ],
+        "proxy-groups": [
+            {"name": "g1", "type": "select", "proxies": ["a", "b"]},
+            {"name": "g2", "type": "url-test", "proxies": ["b"]},
+        ],
+        "rules": ["DOMAIN-SUFFIX,example.com,g1", "MATCH,g2"],
+    },
+    "proxy_remarks": ["a", "b"],
+}
+
+
+def _yaml_plain(value):
+    """value в том виде, в каком его вернёт yaml.safe_load после фильтра yaml шаблона: ключи по алфавиту,
+    UUID строкой; прочие типы — ValueError (рендер шаблона целиком)."""
+    if isinstance(value, dict):
+        return {key: _yaml_plain(value[key]) for key in sorted(value)}
+    if isinstance(value, list):
+        return [_yaml_plain(item) for item in value]
+    if isinstance(value, UUID):
+        return str(value)
+    if value is None or type(value) in (str, int, float, bool):
+        return value
+    raise ValueError(f"unexpected {type(value).__name__} in clash config")
+
 
 class ClashConfiguration:
     def __init__(self):
@@ -26,34 +57,29 @@ class ClashConfiguration:
             "rules": [],
         }
         self.proxy_remarks = []
-        self.mux_template = render_template(MUX_TEMPLATE)
-        user_agent_data = json.loads(render_template(USER_AGENT_TEMPLATE))
-
-        if "list" in user_agent_data and isinstance(user_agent_data["list"], list):
-            self.user_agent_list = user_agent_data["list"]
-        else:
-            self.user_agent_list = []
+        # mux, user agent и settings — общие разобранные объекты реестра, не изменяются
+        self.mux_template = template_registry.get(MUX_TEMPLATE, json.loads)
+        self.user_agent_list = template_registry.get(USER_AGENT_TEMPLATE, parse_user_agent_list)
 
         try:
-            self.settings = yaml.load(render_template(CLASH_SETTINGS_TEMPLATE), Loader=yaml.SafeLoader)
+            self.settings = template_registry.get(CLASH_SETTINGS_TEMPLATE, yaml.safe_load)
         except TemplateNotFound:
             self.settings = {}
 
-        del user_agent_data
-
     def render(self, reverse=False):
         if reverse:
             self.data["proxies"].reverse()
 
         yaml.add_representer(UUID, yml_uuid_representer)
-        return yaml.dump(
-            yaml.load(
-                render_template(CLASH_SUBSCRIPTION_TEMPLATE, {"conf": self.data, "proxy_remarks": self.proxy_remarks}),
-                Loader=yaml.SafeLoader,
-            ),
-            sort_keys=False,
-            allow_unicode=True,
-        )
+        context = {"conf": self.data, "proxy_remarks": self.proxy_remarks}
+        tree = None
+        if self.data.keys() == _FRAME_PROBE["conf"].keys():
+            tree = template_registry.render_frame(
+                CLASH_SUBSCRIPTION_TEMPLATE, yaml.safe_load, context, _FRAME_PROBE, _yaml_plain
+            )
+        if tree is None:
+            tree = yaml.load(render_template(CLASH_SUBSCRIPTION_TEMPLATE, context), Loader=yaml.SafeLoader)
+        return yaml.dump(tree, sort_keys=False, allow_unicode=True)
 
     def __str__(self) -> str:
         return self.render()
@@ -77,7 +103,7 @@ class ClashConfiguration:
         host="",
         random_user_agent: bool = False,
     ):
-        config = copy.deepcopy(self.settings.get("http-opts", {"headers": {}}))
+        config = clone(self.settings.get("http-opts", {"headers": {}}))
 
         if path:
             config["path"] = [path]
@@ -99,7 +125,7 @@ class ClashConfiguration:
         is_httpupgrade: bool = False,
         random_user_agent: bool = False,
     ):
-        config = copy.deepcopy(self.settings.get("ws-opts", {}))
+        config = clone(self.settings.get("ws-opts", {}))
         if (host or random_user_agent) and "headers" not in config:
             config["headers"] = {}
         if path:
@@ -118,14 +144,14 @@ class ClashConfiguration:
         return config
 
     def grpc_config(self, path=""):
-        config = copy.deepcopy(self.settings.get("grpc-opts", {}))
+        config = clone(self.settings.get("grpc-opts", {}))
         if path:
             config["grpc-service-name"] = path
 
         return config
 
     def h2_config(self, path="", host=""):
-        config = copy.deepcopy(self.settings.get("h2-opts", {}))
+        config = clone(self.settings.get("h2-opts", {}))
         if path:
             config["path"] = path
         if host:
@@ -134,7 +160,7 @@ class ClashConfiguration:
         return config
 
     def tcp_config(self, path="", host=""):
-        config = copy.deepcopy(self.settings.get("tcp-opts", {}))
+        config = clone(self.settings.get("tcp-opts", {}))
         if path:
             config["path"] = [path]
         if host:
@@ -234,8 +260,7 @@ class ClashConfiguration:
 
         node[f"{network}-opts"] = net_opts
 
-        mux_json = json.loads(self.mux_template)
-        mux_config = mux_json["clash"]
+        mux_config = clone(self.mux_template["clash"])
 
         if mux_enable:
             node["smux"] = mux_config
@@ -0,0 +1,147 @@
+"""Сжатие тел подписки по Accept-Encoding: br / zstd / gzip.
+
+sing-box JSON, v2ray-json с indent=4 и clash YAML на десятки хостов — сотни КБ
+повторяющегося текста, а шли они несжатыми. SubCompression выбирает кодировку
+из Accept-Encoding клиента (q-значения, `*`; при равных q — порядок encodings
+сервера) и сжимает тело. Сжатый вариант закэшированного тела хранится рядом
+с ним в RenderCache (put_variant) — повторные опросы не тратят CPU.
+
+Порог min_bytes: меньшие тела отдаются как есть. Бюджет CPU — доля одного ядра
+(cpu_share), которую можно тратить на сжатие в среднем (токен-бакет с запасом
+на одну секунду): при исчерпании тело уходит несжатым, пока бюджет не
+восполнится, а сжатые варианты из кэша отдаются как обычно.
+
+brotli и zstandard — extra compression в pyproject.toml (он же даёт zstd
+app/xray/config_transfer.py): без них остаётся gzip, а недоступные кодировки
+из настроек (SubCompression.unavailable) роутер пишет в лог на старте. Без
+зависимостей от БД/окружения.
+"""
+
+from __future__ import annotations
+
+import gzip
+import threading
+import time
+from collections.abc import Callable, Iterable
+
+try:
+    import brotli
+except ImportError:  # необязательная зависимость — без неё br не предлагается
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # необязательная зависимость — без неё zstd не предлагается
+    zstandard = None  # type: ignore[assignment]
+
+# порядок предпочтения сервера при равных q: br плотнее всех на тексте, zstd — дешевле по CPU
+SUPPORTED_ENCODINGS = tuple(
+    encoding
+    for encoding, available in (("br", brotli is not None), ("zstd", zstandard is not None), ("gzip", True))
+    if available
+)
+
+
+def parse_accept_encoding(header: str | None) -> dict[str, float]:
+    """Accept-Encoding → {кодировка: q}; кривые q считаются нулём."""
+    result: dict[str, float] = {}
+    for item in (header or "").split(","):
+        name, *params = (part.strip() for part in item.split(";"))
+        if not name:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        result[name.lower()] = q
+    return result
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=5)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=6).compress(data)
+    return gzip.compress(data, compresslevel=6, mtime=0)
+
+
+def decompress(body: bytes, encoding: str | None) -> bytes:
+    """Обратное compress() (тесты и бенчмарк)."""
+    if encoding == "br":
+        return brotli.decompress(body)
+    if encoding == "zstd":
+        return zstandard.ZstdDecompressor().decompress(body)
+    if encoding == "gzip":
+        return gzip.decompress(body)
+    return body
+
+
+def add_vary(headers: dict[str, str], field: str = "Accept-Encoding") -> dict[str, str]:
+    """Копия headers с field в Vary; существующий Vary (в т.ч. из кастомных заголовков) дополняется."""
+    result = dict(headers)
+    key = next((name for name in result if name.lower() == "vary"), "vary")
+    values = [value.strip() for value in result.get(key, "").split(",") if value.strip()]
+    if not any(value.lower() == field.lower() or value == "*" for value in values):
+        values.append(field)
+    result[key] = ", ".join(values)
+    return result
+
+
+class SubCompression:
+    """Выбор кодировки и сжатие в пределах бюджета CPU; encodings пустой или cpu_share = 0 — выключено."""
+
+    def __init__(
+        self,
+        encodings: Iterable[str],
+        min_bytes: int,
+        cpu_share: float,
+        clock: Callable[[], float] = time.monotonic,
+        cpu_clock: Callable[[], float] = time.thread_time,
+    ):
+        encodings = tuple(encodings)
+        self.encodings = tuple(encoding for encoding in encodings if encoding in SUPPORTED_ENCODINGS)
+        # запрошены в настройках, но не установлены (или неизвестны) — для предупреждения на старте
+        self.unavailable = tuple(encoding for encoding in encodings if encoding not in SUPPORTED_ENCODINGS)
+        self.min_bytes = min_bytes
+        self.cpu_share = cpu_share
+        self._clock = clock
+        self._cpu_clock = cpu_clock
+        self._lock = threading.Lock()
+        # секунды CPU, которые ещё можно потратить; запас — одна секунда бюджета
+        self._tokens = cpu_share
+        self._refilled_at = clock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.encodings) and self.cpu_share > 0
+
+    def acceptable(self, accept_encoding: str | None, size: int) -> list[str]:
+        """Кодировки, которые клиент принимает, от лучшей; пусто — отдавать как есть."""
+        if not self.enabled or size < self.min_bytes:
+            return []
+        accepted = parse_accept_encoding(accept_encoding)
+        wildcard = accepted.get("*", 0.0)
+        ranked = [(accepted.get(encoding, wildcard), -i, encoding) for i, encoding in enumerate(self.encodings)]
+        return [encoding for q, _, encoding in sorted(ranked, reverse=True) if q > 0]
+
+    def _available(self) -> bool:
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.cpu_share, self._tokens + (now - self._refilled_at) * self.cpu_share)
+            self._refilled_at = now
+            return self._tokens > 0
+
+    def compress(self, data: bytes, encoding: str) -> bytes | None:
+        """Сжатое data; None — бюджет CPU исчерпан, отдавать как есть."""
+        if not self._available():
+            return None
+        started = self._cpu_clock()
+        result = compress(data, encoding)
+        spent = self._cpu_clock() - started
+        with self._lock:
+            self._tokens -= spent
+        return result
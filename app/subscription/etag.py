@@ -0,0 +1,140 @@
+"""ETag для /sub: повторный опрос без изменений — 304 до generate_subscription.
+
+Клиенты опрашивают подписку по таймеру и каждый раз качали тело целиком.
+Валидатор — хэш всего, от чего тело зависит:
+
+- digest снимка юзера (snapshot_digest): UserResponse без полей, которые меняет
+  сам опрос (sub_updated_at, sub_last_user_agent, online_at) или которые
+  рендер не читает, плюс настройки бота. В отличие от UserSnapshot.version он
+  одинаков после перезагрузки снимка и в любом воркере;
+- digest хостов и инбаундов ядра — раз на xray.hosts.version;
+- план рендера, флаги revoked/expired/лимит устройств/неподдерживаемый клиент
+  и BsContext — как в render_key() кэша рендера;
+- окно времени ttl секунд со сдвигом по id юзера. Оно ограничивает устаревание
+  того, чего во входах нет (DAYS_LEFT/TIME_LEFT в ремарках, правки шаблонов),
+  а сдвиг размазывает смену окна по юзерам.
+
+Форматы со свежей случайностью на каждый запрос (fresh_formats, соли SNI/host)
+ETag не получают. В режиме stable_random получают все: рендер идёт под
+randomness.seeded(валидатор), и тело для валидатора одно и то же.
+
+Без зависимостей от БД/окружения.
+"""
+
+from __future__ import annotations
+
+import dataclasses
+import hashlib
+import json
+import time
+from collections.abc import Callable, Iterable
+from datetime import date
+from enum import Enum
+from typing import Any
+
+# меняются каждым опросом или не попадают в тело подписки
+VOLATILE_USER_FIELDS = frozenset(
+    {"links", "subscription_url", "sub_updated_at", "sub_last_user_agent", "online_at", "lifetime_used_traffic"}
+)
+
+
+def _plain(value: Any) -> Any:
+    """json.dumps(default=...) для того, что встречается в юзере, хостах и конфиге ядра."""
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=repr)
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, date):
+        return value.isoformat()
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json")
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return dataclasses.asdict(value)
+    return str(value)
+
+
+def digest(*parts: Any) -> str:
+    data = json.dumps(parts, sort_keys=True, default=_plain, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+
+def snapshot_digest(user: Any, bot_settings: dict | None) -> str:
+    """Версия содержимого снимка юзера (UserResponse + настройки бота) для валидатора."""
+    return digest(user.model_dump(mode="json", exclude=set(VOLATILE_USER_FIELDS)), bot_settings)
+
+
+def variant_etag(etag: str, encoding: str | None) -> str:
+    """ETag сжатого варианта тела: у разных Content-Encoding сильные валидаторы должны различаться."""
+    return etag if encoding is None else f'{etag[:-1]}-{encoding}"'
+
+
+def _base(tag: str) -> str:
+    return tag.strip().removeprefix("W/").strip('"').partition("-")[0]
+
+
+def matched_etag(if_none_match: str | None, etag: str) -> str | None:
+    """Тег из If-None-Match (список, `*`, W/-префиксы), совпавший с etag или его сжатым вариантом; None — нет.
+
+    Сравнение слабое, как велит RFC 9110 для GET: вариант в другой кодировке — то же содержимое.
+    """
+    if not if_none_match:
+        return None
+    if if_none_match.strip() == "*":
+        return etag
+    base = _base(etag)
+    return next((tag.strip() for tag in if_none_match.split(",") if _base(tag) == base), None)
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    return matched_etag(if_none_match, etag) is not None
+
+
+class SubscriptionETags:
+    """Валидаторы тел подписки; ttl = 0 — выключено."""
+
+    def __init__(
+        self,
+        ttl: float,
+        fresh_formats: Iterable[str] = (),
+        stable_random: bool = False,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.ttl = ttl
+        self.fresh_formats = frozenset(fresh_formats)
+        self.stable_random = stable_random
+        self._clock = clock
+        self._hosts: tuple[int, str] | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def applies(self, config_format: str) -> bool:
+        return self.enabled and (self.stable_random or config_format not in self.fresh_formats)
+
+    def hosts_digest(self, hosts_version: int, hosts_state: Callable[[], Any]) -> str:
+        """digest(hosts_state()) раз на версию хостов: пересчёт только после перезагрузки хостов/конфига."""
+        cached = self._hosts
+        if cached is not None and cached[0] == hosts_version:
+            return cached[1]
+        value = digest(hosts_state())
+        self._hosts = (hosts_version, value)
+        return value
+
+    def validator(self, ctx, plan: tuple, hosts_version: int, hosts_state: Callable[[], Any]) -> str | None:
+        """Сильный ETag (в кавычках) для SubscriptionRenderContext и плана; None — без ETag."""
+        if not self.applies(plan[0]) or ctx.user_key is None or not ctx.user_digest:
+            return None
+        user_id = ctx.user_key[0]
+        window = int((self._clock() + user_id % self.ttl) // self.ttl)
+        flags = (ctx.is_revoked, ctx.is_expired, ctx.device_limited, ctx.device_limited_hard, ctx.unsupported_blocks)
+        value = digest(
+            ctx.user_digest,
+            self.hosts_digest(hosts_version, hosts_state),
+            tuple(plan),
+            flags,
+            ctx.bs,
+            window,
+            self.stable_random,
+        )
+        return f'"{value}"'
@@ -1,3 +1,6 @@
+import json
+
+
 def get_grpc_gun(path: str) -> str:
     if not path.startswith("/"):
         return path
@@ -19,3 +22,11 @@ def get_grpc_multi(path: str) -> str:
     streamname = path.rsplit("/", 1)[1].split("|")[1]
 
     return "%s%s%s" % (servicename, "/", streamname)
+
+
+def parse_user_agent_list(text: str) -> list:
+    """Список из шаблона user_agent/*.json ({"list": [...]}); не список — пустой."""
+    data = json.loads(text)
+    if "list" in data and isinstance(data["list"], list):
+        return data["list"]
+    return []
@@ -0,0 +1,44 @@
+"""Случайность рендера подписки: соли `*` в SNI/host/address и выбор из списков.
+
+По умолчанию — глобальный random и secrets, как раньше. Внутри seeded(seed)
+(режим SUB_ETAG_STABLE_RANDOM, app/routers/subscription.py) — random.Random(seed)
+текущего контекста: тело для одного ETag-валидатора одинаково в любом воркере
+и после вытеснения из кэша рендера, значит, 304 на него честный.
+
+Без зависимостей от окружения панели.
+"""
+
+from __future__ import annotations
+
+import random
+import secrets
+from collections.abc import Iterator, Sequence
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import TypeVar
+
+T = TypeVar("T")
+
+_rng: ContextVar[random.Random | None] = ContextVar("subscription_rng", default=None)
+
+
+def choice(seq: Sequence[T]) -> T:
+    rng = _rng.get()
+    return (rng or random).choice(seq)
+
+
+def token_hex(nbytes: int) -> str:
+    rng = _rng.get()
+    if rng is None:
+        return secrets.token_hex(nbytes)
+    return rng.randbytes(nbytes).hex()
+
+
+@contextmanager
+def seeded(seed: str) -> Iterator[None]:
+    """choice/token_hex внутри блока детерминированы seed (в том же потоке/контексте)."""
+    token = _rng.set(random.Random(seed))
+    try:
+        yield
+    finally:
+        _rng.reset(token)
@@ -0,0 +1,136 @@
+"""Кэш отрендеренных тел подписки: повторный опрос того же клиента — поиск в словаре.
+
+generate_subscription на каждый запрос заново собирает конфиг: Jinja-шаблон
+V2rayJsonConfig, yaml load/dump для clash, json.dumps(indent=4), соли SNI/host.
+Результат зависит только от ключа render_key():
+
+- (id, version) снимка юзера (app/subscription/user_cache.py) — версия строки
+  users и настроек бота: любая их запись даёт новый снимок с новой версией;
+- версия хостов (xray.hosts.version, растёт на каждую перезагрузку хостов и
+  конфига ядра);
+- план рендера (формат, base64, reverse, media type);
+- флаги revoked/expired/лимит устройств/неподдерживаемый клиент и BsContext
+  (frozen dataclass — хэшируется целиком).
+
+Старые версии не инвалидируются, а вытесняются: LRU по суммарному размеру тел
+(max_bytes) и TTL — последний ещё и ограничивает устаревание времени в ремарках
+(DAYS_LEFT, TIME_LEFT). Соли хостов в закэшированном теле одинаковы для всех
+повторов; форматы, где они должны быть свежими на каждый запрос, кэш обходят
+(fresh_formats).
+
+Рядом с телом хранятся его сжатые варианты (put_variant, app/subscription/compression.py):
+они вытесняются вместе с телом и учитываются в max_bytes.
+
+Без зависимостей от БД/окружения.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Iterable
+
+
+def render_key(ctx, plan: tuple, hosts_version: int) -> tuple | None:
+    """Ключ для SubscriptionRenderContext и плана; None — контекст без версии юзера, не кэшируем."""
+    if ctx.user_key is None:
+        return None
+    flags = (ctx.is_revoked, ctx.is_expired, ctx.device_limited, ctx.device_limited_hard, ctx.unsupported_blocks)
+    return (ctx.user_key, hosts_version, tuple(plan), flags, ctx.bs)
+
+
+class RenderCache:
+    """key → тело ответа и его сжатые варианты; вытеснение LRU по сумме их длин до max_bytes и по ttl секундам."""
+
+    def __init__(
+        self,
+        max_bytes: int,
+        ttl: float,
+        fresh_formats: Iterable[str] = (),
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.fresh_formats = frozenset(fresh_formats)
+        self._clock = clock
+        self._lock = threading.Lock()
+        # key → (истекает, тело, {кодировка: сжатое тело})
+        self._entries: OrderedDict[tuple, tuple[float, str, dict[str, bytes]]] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 and self.ttl > 0
+
+    def cacheable(self, config_format: str) -> bool:
+        return self.enabled and config_format not in self.fresh_formats
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _drop(self, key: tuple) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1]) + sum(map(len, entry[2].values()))
+
+    def _evict(self) -> None:
+        while self.size > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+
+    def get(self, key: tuple) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self._clock():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: tuple, body: str) -> None:
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (self._clock() + self.ttl, body, {})
+            self.size += len(body)
+            self._evict()
+
+    def get_variant(self, key: tuple, encoding: str) -> bytes | None:
+        """Сжатый вариант живого тела key; hits/misses не трогает — их считает get()."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self._clock():
+                return None
+            return entry[2].get(encoding)
+
+    def put_variant(self, key: tuple, encoding: str, data: bytes) -> None:
+        """Сохранить сжатый вариант рядом с телом key; без тела (вытеснено, истекло) — не сохраняется."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self._clock() or encoding in entry[2]:
+                return
+            entry[2][encoding] = data
+            self.size += len(data)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def get_or_render(self, key: tuple | None, config_format: str, render: Callable[[], str]) -> str:
+        """Тело из кэша или render() с сохранением; форматы из fresh_formats и key=None — всегда render()."""
+        if key is None or not self.cacheable(config_format):
+            return render()
+        body = self.get(key)
+        if body is None:
+            body = render()
+            self.put(key, body)
+        return body
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
@@ -1,7 +1,5 @@
 import base64
 import logging
-import random
-import secrets
 from collections import defaultdict
 from collections.abc import Callable
 from datetime import datetime as dt
@@ -11,6 +9,7 @@ from typing import TYPE_CHECKING, Literal, cast
 from jdatetime import date as jd
 
 from app import xray
+from app.subscription import randomness
 from app.subscription.bs_context import ZERO_STUB, BsContext, StubEndpoint
 from app.utils.system import get_public_ip, get_public_ipv6, readable_size
 
@@ -140,11 +139,13 @@ def generate_subscription(
 
     resolved_settings = apply_bot_settings_fallback(settings or DEFAULT_BOT_SETTINGS)
 
+    from app.templates import template_registry
     from app.xray.bs_routing import parse_json_object
 
     def _safe_json(raw, name):
+        # строка из настроек бота и есть её версия: разбор один раз, объекты только читаются
         try:
-            return parse_json_object(raw)
+            return template_registry.parse_text(raw, parse_json_object)
         except ValueError as exc:
             logger.warning("[sub] ignoring invalid %s: %s", name, exc)
             return None
@@ -447,24 +448,24 @@ def process_inbounds_and_tags(
                 sni = ""
                 sni_list = host["sni"] or inbound["sni"]
                 if sni_list:
-                    salt = secrets.token_hex(8)
-                    sni = random.choice(sni_list).replace("*", salt)
+                    salt = randomness.token_hex(8)
+                    sni = randomness.choice(sni_list).replace("*", salt)
 
                 if sids := inbound.get("sids"):
-                    inbound["sid"] = random.choice(sids)
+                    inbound["sid"] = randomness.choice(sids)
 
                 req_host = ""
                 req_host_list = host["host"] or inbound["host"]
                 if req_host_list:
-                    salt = secrets.token_hex(8)
-                    req_host = random.choice(req_host_list).replace("*", salt)
+                    salt = randomness.token_hex(8)
+                    req_host = randomness.choice(req_host_list).replace("*", salt)
 
                 address = ""
                 address_list = host["address"]
                 balanced = isinstance(conf, V2rayJsonConfig) and address_list and len(address_list) > 1
                 if address_list and not balanced:
-                    salt = secrets.token_hex(8)
-                    address = random.choice(address_list).replace("*", salt)
+                    salt = randomness.token_hex(8)
+                    address = randomness.choice(address_list).replace("*", salt)
 
                 if host["path"] is not None:
                     path = host["path"].format_map(format_variables)
@@ -512,7 +513,7 @@ def process_inbounds_and_tags(
                     add_kwargs["is_bs"] = True
                 if balanced and isinstance(conf, V2rayJsonConfig):
                     addresses = [
-                        addr.replace("*", secrets.token_hex(8)).format_map(format_variables) for addr in address_list
+                        addr.replace("*", randomness.token_hex(8)).format_map(format_variables) for addr in address_list
                     ]
                     conf.add_balanced(
                         remark=host["remark"].format_map(format_variables),
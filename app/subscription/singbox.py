@@ -1,11 +1,11 @@
-import copy
 import json
-from random import choice
 
 from jinja2.exceptions import TemplateNotFound
 
-from app.subscription.funcs import get_grpc_gun
-from app.templates import render_template
+from app.subscription.funcs import get_grpc_gun, parse_user_agent_list
+from app.subscription.randomness import choice
+from app.templates import template_registry
+from app.templates.registry import clone
 from app.utils.helpers import UUIDEncoder
 from config import MUX_TEMPLATE, SINGBOX_SETTINGS_TEMPLATE, SINGBOX_SUBSCRIPTION_TEMPLATE, USER_AGENT_TEMPLATE
 
@@ -13,22 +13,16 @@ from config import MUX_TEMPLATE, SINGBOX_SETTINGS_TEMPLATE, SINGBOX_SUBSCRIPTION
 class SingBoxConfiguration(str):
     def __init__(self):
         self.proxy_remarks = []
-        self.config = json.loads(render_template(SINGBOX_SUBSCRIPTION_TEMPLATE))
-        self.mux_template = render_template(MUX_TEMPLATE)
-        user_agent_data = json.loads(render_template(USER_AGENT_TEMPLATE))
-
-        if "list" in user_agent_data and isinstance(user_agent_data["list"], list):
-            self.user_agent_list = user_agent_data["list"]
-        else:
-            self.user_agent_list = []
+        # шаблон дополняется outbound'ами — своя структурная копия; mux, user agent и settings общие
+        self.config = clone(template_registry.get(SINGBOX_SUBSCRIPTION_TEMPLATE, json.loads))
+        self.mux_template = template_registry.get(MUX_TEMPLATE, json.loads)
+        self.user_agent_list = template_registry.get(USER_AGENT_TEMPLATE, parse_user_agent_list)
 
         try:
-            self.settings = json.loads(render_template(SINGBOX_SETTINGS_TEMPLATE))
+            self.settings = template_registry.get(SINGBOX_SETTINGS_TEMPLATE, json.loads)
         except TemplateNotFound:
             self.settings = {}
 
-        del user_agent_data
-
     def _remark_validation(self, remark):
         if remark not in self.proxy_remarks:
             return remark
@@ -89,7 +83,7 @@ class SingBoxConfiguration(str):
         return config
 
     def http_config(self, host="", path="", random_user_agent: bool = False):
-        config = copy.deepcopy(
+        config = clone(
             self.settings.get(
                 "httpSettings", {"idle_timeout": "15s", "ping_timeout": "15s", "method": "GET", "headers": {}}
             )
@@ -110,7 +104,7 @@ class SingBoxConfiguration(str):
     def ws_config(
         self, host="", path="", random_user_agent: bool = False, max_early_data=None, early_data_header_name=None
     ):
-        config = copy.deepcopy(self.settings.get("wsSettings", {"headers": {}}))
+        config = clone(self.settings.get("wsSettings", {"headers": {}}))
         if "headers" not in config:
             config["headers"] = {}
 
@@ -128,7 +122,7 @@ class SingBoxConfiguration(str):
         return config
 
     def grpc_config(self, path=""):
-        config = copy.deepcopy(self.settings.get("grpcSettings", {}))
+        config = clone(self.settings.get("grpcSettings", {}))
 
         if path:
             config["service_name"] = path
@@ -136,7 +130,7 @@ class SingBoxConfiguration(str):
         return config
 
     def httpupgrade_config(self, host="", path="", random_user_agent: bool = False):
-        config = copy.deepcopy(self.settings.get("httpupgradeSettings", {"headers": {}}))
+        config = clone(self.settings.get("httpupgradeSettings", {"headers": {}}))
         if "headers" not in config:
             config["headers"] = {}
 
@@ -258,8 +252,7 @@ class SingBoxConfiguration(str):
         if tls in ("tls", "reality"):
             config["tls"] = self.tls_config(sni=sni, fp=fp, tls=tls, pbk=pbk, sid=sid, alpn=alpn, ais=ais)
 
-        mux_json = json.loads(self.mux_template)
-        mux_config = mux_json["sing-box"]
+        mux_config = clone(self.mux_template["sing-box"])
 
         config["multiplex"] = mux_config
         if config["multiplex"]["enabled"]:
@@ -51,6 +51,10 @@ class SubscriptionRenderContext:
     bot_settings: dict
     bs: BsContext
     response_headers: dict[str, str]
+    # (id, version) снимка юзера — ключ кэша отрендеренных тел (app/subscription/render_cache.py)
+    user_key: tuple[int, int] | None = None
+    # digest содержимого снимка — часть ETag-валидатора (app/subscription/etag.py)
+    user_digest: str | None = None
 
 
 def _version_gte(version_str: str, min_version: str) -> bool:
@@ -0,0 +1,141 @@
+"""Кэш снимков юзера для /sub: username → UserSnapshot с LRU и TTL.
+
+Каждый /sub-запрос резолвил токен через crud.get_user (joinedload admin,
+next_plan, bot+settings, node_bs_usages) и UserResponse.model_validate —
+при миллионах юзеров с опросом раз в несколько часов это основная нагрузка
+на БД. Снимок хранит всё, что горячему пути нужно от строки users: уже
+провалидированный UserResponse, настройки бота и поля для проверок токена и
+лимита устройств.
+
+Инвалидация — по id юзера (crud после коммита записи, джобы учёта трафика и
+review) или целиком; TTL ограничивает устаревание от изменений, которые мимо
+неё прошли (конфиг ядра, другой процесс панели).
+
+Гонка «читатель загрузил строку до коммита писателя и кладёт её после
+инвалидации» закрыта эпохой: put() принимает снимок, только если с момента
+epoch(), взятого до чтения из БД, инвалидаций не было.
+
+Снимки и их содержимое общие для всех запросов — их не изменяют.
+Без зависимостей от БД/окружения.
+"""
+
+from __future__ import annotations
+
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """Поля строки users для /sub; имена — как у модели User (подходит вместо dbuser там, где нужны только они)."""
+
+    id: int
+    username: str
+    created_at: datetime | None
+    sub_revoked_at: datetime | None
+    expire: int | None
+    device_limit: int | None
+    bs_extra: int | None
+    subscription_token: str | None
+    user: Any  # UserResponse
+    bot_settings: dict
+    # уникален для каждой загрузки из БД: снимок неизменяем, так что (id, version) — версия
+    # всего, что из него рендерится (в т.ч. настроек бота: их изменение сбрасывает все снимки)
+    version: int = 0
+    # версия содержимого (app/subscription/etag.py snapshot_digest) для ETag; "" — ETag выключен
+    digest: str = ""
+
+
+class UserSnapshotCache:
+    """LRU на max_size снимков со сроком жизни ttl секунд; max_size или ttl = 0 — кэш выключен."""
+
+    def __init__(self, max_size: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[float, UserSnapshot]] = OrderedDict()
+        self._keys_by_id: dict[int, str] = {}
+        self._epoch = 0
+        self._versions = itertools.count(1)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0 and self.ttl > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _key(username: str) -> str:
+        # username в БД с регистронезависимой collation — и ключ тоже
+        return username.lower()
+
+    def next_version(self) -> int:
+        """Версия для нового снимка (UserSnapshot.version)."""
+        return next(self._versions)
+
+    def epoch(self) -> int:
+        """Взять до чтения юзера из БД и передать в put()."""
+        return self._epoch
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None and self._keys_by_id.get(entry[1].id) == key:
+            del self._keys_by_id[entry[1].id]
+
+    def get(self, username: str) -> UserSnapshot | None:
+        if not self.enabled:
+            return None
+        key = self._key(username)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self._clock():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, snapshot: UserSnapshot, epoch: int) -> bool:
+        """Положить снимок, прочитанный после epoch(); False — была инвалидация, снимок мог устареть."""
+        if not self.enabled:
+            return False
+        key = self._key(snapshot.username)
+        with self._lock:
+            if epoch != self._epoch:
+                return False
+            # юзера переименовали — старый ключ указывает на тот же id
+            previous = self._keys_by_id.get(snapshot.id)
+            if previous is not None and previous != key:
+                self._drop(previous)
+            self._drop(key)
+            self._entries[key] = (self._clock() + self.ttl, snapshot)
+            self._keys_by_id[snapshot.id] = key
+            while len(self._entries) > self.max_size:
+                self._drop(next(iter(self._entries)))
+            return True
+
+    def invalidate_ids(self, user_ids: Iterable[int]) -> None:
+        with self._lock:
+            self._epoch += 1
+            for user_id in user_ids:
+                key = self._keys_by_id.get(user_id)
+                if key is not None:
+                    self._drop(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._keys_by_id.clear()
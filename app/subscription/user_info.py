@@ -1,10 +1,12 @@
 import json
 import math
 from datetime import UTC, datetime
+from typing import cast
 
 from app.db import Session, crud
 from app.db.models import User
 from app.models.user import UserResponse
+from app.subscription.user_cache import UserSnapshot
 
 
 def devices_json(devices) -> str:
@@ -37,9 +39,12 @@ def get_user_note(user: UserResponse, note_template: str) -> str:
     return note_template.replace("<days_left>", str(days_left))
 
 
-def get_subscription_user_info(user: UserResponse, *, db=None, bot_settings=None, user_id: int | None = None) -> dict:
+def get_subscription_user_info(
+    user: UserResponse, *, db=None, bot_settings=None, user_id: int | None = None, bs_extra: int | None = None
+) -> dict:
     """upload/download/total/expire для Happ. Если у бота юзера задан БС-лимит и есть
-    БС-расход — download/total отражают месячный агрегат БС, иначе глобальный."""
+    БС-расход — download/total отражают месячный агрегат БС, иначе глобальный.
+    bs_extra — остаток пула, если уже известен (снимок /sub); иначе читается из БД."""
     info = {
         "upload": 0,
         "download": user.used_traffic,
@@ -55,8 +60,9 @@ def get_subscription_user_info(user: UserResponse, *, db=None, bot_settings=None
 
     from app.xray.bs_limit import monthly_effective_limit, period_keys, pick_bs_bar
 
-    dbuser = crud.get_user_by_id(db, user_id)
-    bs_extra = (dbuser.bs_extra or 0) if dbuser else 0
+    if bs_extra is None:
+        dbuser = crud.get_user_by_id(db, user_id)
+        bs_extra = (cast(int | None, dbuser.bs_extra) or 0) if dbuser else 0
     monthly_limit_eff = monthly_effective_limit(monthly_limit, bs_extra)
 
     yyyymm = period_keys(datetime.utcnow())
@@ -74,7 +80,7 @@ def get_empty_subscription_user(user: UserResponse) -> UserResponse:
 def resolve_device_limit_subscription_state(
     user: UserResponse,
     db: Session,
-    dbuser: User,
+    dbuser: User | UserSnapshot,
     is_revoked: bool,
     is_expired: bool,
     bot_settings: dict,
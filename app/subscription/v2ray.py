@@ -2,14 +2,15 @@ import base64
 import copy
 import json
 import urllib.parse as urlparse
-from random import choice
 from urllib.parse import quote
 from uuid import UUID
 
 from jinja2.exceptions import TemplateNotFound
 
-from app.subscription.funcs import get_grpc_gun, get_grpc_multi
-from app.templates import render_template
+from app.subscription.funcs import get_grpc_gun, get_grpc_multi, parse_user_agent_list
+from app.subscription.randomness import choice
+from app.templates import template_registry
+from app.templates.registry import clone
 from app.utils.helpers import UUIDEncoder
 from app.xray.bs_routing import select_routing
 from app.xray.host_balancer import apply_host_balancer, proxy_outbound_tag
@@ -490,36 +491,26 @@ class V2rayJsonConfig(str):
 
     def __init__(self, template_override=None, routing_default=None, routing_bs=None):
         self.config = []
+        # шаблон, mux, user agent и settings — общие разобранные объекты реестра, не изменяются
         if template_override is not None:
-            self.template = json.dumps(template_override)
+            self.template = template_override
         else:
-            self.template = render_template(V2RAY_SUBSCRIPTION_TEMPLATE)
+            self.template = template_registry.get(V2RAY_SUBSCRIPTION_TEMPLATE, json.loads)
         self.routing_default = routing_default
         self.routing_bs = routing_bs
-        self.mux_template = render_template(MUX_TEMPLATE)
-        user_agent_data = json.loads(render_template(USER_AGENT_TEMPLATE))
-
-        if "list" in user_agent_data and isinstance(user_agent_data["list"], list):
-            self.user_agent_list = user_agent_data["list"]
-        else:
-            self.user_agent_list = []
-
-        grpc_user_agent_data = json.loads(render_template(GRPC_USER_AGENT_TEMPLATE))
-
-        if "list" in grpc_user_agent_data and isinstance(grpc_user_agent_data["list"], list):
-            self.grpc_user_agent_data = grpc_user_agent_data["list"]
-        else:
-            self.grpc_user_agent_data = []
+        self.mux_template = template_registry.get(MUX_TEMPLATE, json.loads)
+        self.user_agent_list = template_registry.get(USER_AGENT_TEMPLATE, parse_user_agent_list)
+        self.grpc_user_agent_data = template_registry.get(GRPC_USER_AGENT_TEMPLATE, parse_user_agent_list)
 
         try:
-            self.settings = json.loads(render_template(V2RAY_SETTINGS_TEMPLATE))
+            self.settings = template_registry.get(V2RAY_SETTINGS_TEMPLATE, json.loads)
         except TemplateNotFound:
             self.settings = {}
 
-        del user_agent_data, grpc_user_agent_data
-
     def _assemble_config(self, remarks, outbounds, is_bs=False):
-        json_template = json.loads(self.template)
+        # поверхностная копия: меняются только ключи верхнего уровня (remarks, outbounds, routing,
+        # observatory у балансировщика), вложенные секции шаблона общие для всех конфигов — json.dumps их не меняет
+        json_template = dict(self.template)
         json_template["remarks"] = remarks
         json_template["outbounds"] = outbounds + json_template["outbounds"]
         json_template["routing"] = select_routing(
@@ -592,7 +583,7 @@ class V2rayJsonConfig(str):
     def ws_config(
         self, path: str = "", host: str = "", random_user_agent: bool = False, heartbeatPeriod: int = 0
     ) -> dict:
-        wsSettings = copy.deepcopy(self.settings.get("wsSettings", {}))
+        wsSettings = clone(self.settings.get("wsSettings", {}))
 
         if "headers" not in wsSettings:
             wsSettings["headers"] = {}
@@ -608,7 +599,7 @@ class V2rayJsonConfig(str):
         return wsSettings
 
     def httpupgrade_config(self, path: str = "", host: str = "", random_user_agent: bool = False) -> dict:
-        httpupgradeSettings = copy.deepcopy(self.settings.get("httpupgradeSettings", {}))
+        httpupgradeSettings = clone(self.settings.get("httpupgradeSettings", {}))
 
         if "headers" not in httpupgradeSettings:
             httpupgradeSettings["headers"] = {}
@@ -636,7 +627,7 @@ class V2rayJsonConfig(str):
         keepAlivePeriod: int = 0,
         xhttp_extra: dict | None = None,
     ) -> dict:
-        config = copy.deepcopy(self.settings.get("splithttpSettings", {}))
+        config = clone(self.settings.get("splithttpSettings", {}))
 
         config["mode"] = mode
         if path:
@@ -667,7 +658,7 @@ class V2rayJsonConfig(str):
     def grpc_config(
         self, path: str = "", host: str = "", multiMode: bool = False, random_user_agent: bool = False
     ) -> dict:
-        config = copy.deepcopy(
+        config = clone(
             self.settings.get(
                 "grpcSettings",
                 {
@@ -693,7 +684,7 @@ class V2rayJsonConfig(str):
 
     def tcp_config(self, headers="none", path: str = "", host: str = "", random_user_agent: bool = False) -> dict:
         if headers == "http":
-            config = copy.deepcopy(
+            config = clone(
                 self.settings.get(
                     "tcphttpSettings",
                     {
@@ -712,7 +703,7 @@ class V2rayJsonConfig(str):
                 )
             )
         else:
-            config = copy.deepcopy(
+            config = clone(
                 self.settings.get("tcpSettings", self.settings.get("rawSettings", {"header": {"type": "none"}}))
             )
         if "header" not in config:
@@ -742,11 +733,11 @@ class V2rayJsonConfig(str):
 
     def http_config(self, net="http", path: str = "", host: str = "", random_user_agent: bool = False) -> dict:
         if net == "h2":
-            config = copy.deepcopy(self.settings.get("h2Settings", {"header": {}}))
+            config = clone(self.settings.get("h2Settings", {"header": {}}))
         elif net == "h3":
-            config = copy.deepcopy(self.settings.get("h3Settings", {"header": {}}))
+            config = clone(self.settings.get("h3Settings", {"header": {}}))
         else:
-            config = self.settings.get("httpSettings", {"header": {}})
+            config = clone(self.settings.get("httpSettings", {"header": {}}))
         if "header" not in config:
             config["header"] = {}
 
@@ -761,7 +752,7 @@ class V2rayJsonConfig(str):
         return config
 
     def quic_config(self, path=None, host=None, header=None) -> dict:
-        quicSettings = copy.deepcopy(
+        quicSettings = clone(
             self.settings.get("quicSettings", {"security": "none", "header": {"type": "none"}, "key": ""})
         )
         if "header" not in quicSettings:
@@ -777,7 +768,7 @@ class V2rayJsonConfig(str):
         return quicSettings
 
     def kcp_config(self, seed=None, host=None, header=None) -> dict:
-        kcpSettings = copy.deepcopy(
+        kcpSettings = clone(
             self.settings.get(
                 "kcpSettings",
                 {
@@ -1067,7 +1058,7 @@ class V2rayJsonConfig(str):
         )
 
         if inbound.get("mux_enable", False):
-            mux_config = json.loads(self.mux_template)["v2ray"]
+            mux_config = clone(self.mux_template["v2ray"])
             mux_config["enabled"] = True
             outbound["mux"] = mux_config
 
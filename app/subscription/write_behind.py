@@ -0,0 +1,156 @@
+"""Отложенная запись «последний визит» из /sub: коалесценция в памяти и сброс пачкой.
+
+Каждый /sub-запрос коммитил строку user_devices (last_seen, user_agent,
+метаданные) и отдельной фоновой задачей — users.sub_updated_at и
+sub_last_user_agent. Для клиентов, которые опрашивают подписку раз в минуты,
+это пара UPDATE с коммитом на запрос и блокировки строк users, конкурирующие
+с record_usages/review.
+
+Буфер копит эти касания по юзеру и по (юзер, hwid), оставляя последнее
+(поля устройства — последнее непустое значение, как и при записи в строку), а
+джоб flush_sub_writes забирает их целиком (drain) и пишет executemany UPDATE
+раз в несколько секунд. Потеря буфера при падении процесса теряет только
+отметки визита — как и пропущенная фоновая задача раньше.
+
+Решение о лимите устройств остаётся синхронным. Второй частью буфера служит
+вид «известные устройства»: (юзер, hwid) → user_agent устройств, которые
+этот процесс уже видел активными в БД. Повторный визит такого устройства не
+ходит в user_devices вовсе; новое устройство, реактивация отозванного и
+неизвестные hwid по-прежнему решаются запросом и коммитом в БД. Вид
+забывает устройства юзера при любой записи его user_devices (отзыв,
+удаление, правка в админке) — crud делает это после коммита; TTL
+ограничивает устаревание от записей другого процесса панели.
+
+Без зависимостей от БД/окружения.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass, replace
+from datetime import datetime
+
+
+@dataclass(frozen=True)
+class DeviceTouch:
+    """Накопленный визит устройства; None в полях — «не менять»."""
+
+    device_os: str | None
+    ver_os: str | None
+    device_model: str | None
+    user_agent: str | None
+    last_seen: datetime
+
+    def merge(self, newer: DeviceTouch) -> DeviceTouch:
+        """Более поздний визит поверх этого: непустые поля и last_seen — от последнего."""
+        if newer.last_seen < self.last_seen:
+            return newer.merge(self)
+        return replace(
+            newer,
+            device_os=newer.device_os or self.device_os,
+            ver_os=newer.ver_os or self.ver_os,
+            device_model=newer.device_model or self.device_model,
+            user_agent=newer.user_agent or self.user_agent,
+        )
+
+
+class SubWriteBuffer:
+    """Буфер касаний юзеров/устройств и вид известных устройств (LRU на known_size, TTL known_ttl).
+
+    known_size или known_ttl = 0 — вид выключен, каждое устройство проверяется по БД.
+    """
+
+    def __init__(self, known_size: int, known_ttl: float, clock: Callable[[], float] = time.monotonic):
+        self.known_size = known_size
+        self.known_ttl = known_ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._users: dict[int, tuple[datetime, str | None]] = {}
+        self._devices: dict[tuple[int, str], DeviceTouch] = {}
+        self._known: OrderedDict[tuple[int, str], tuple[float, str | None]] = OrderedDict()
+        self._known_by_user: dict[int, set[str]] = {}
+
+    @property
+    def known_enabled(self) -> bool:
+        return self.known_size > 0 and self.known_ttl > 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._users) + len(self._devices)
+
+    def touch_user(self, user_id: int, user_agent: str | None, at: datetime) -> None:
+        """Визит /sub юзера: sub_updated_at = at, sub_last_user_agent = user_agent."""
+        with self._lock:
+            current = self._users.get(user_id)
+            if current is None or current[0] <= at:
+                self._users[user_id] = (at, user_agent)
+
+    def touch_device(self, user_id: int, hwid: str, touch: DeviceTouch) -> None:
+        with self._lock:
+            key = (user_id, hwid)
+            current = self._devices.get(key)
+            self._devices[key] = touch if current is None else current.merge(touch)
+
+    def drain(self) -> tuple[dict[int, tuple[datetime, str | None]], dict[tuple[int, str], DeviceTouch]]:
+        """Забрать всё накопленное: ({user_id: (at, user_agent)}, {(user_id, hwid): DeviceTouch})."""
+        with self._lock:
+            users, devices = self._users, self._devices
+            self._users, self._devices = {}, {}
+        return users, devices
+
+    def restore(self, users: dict, devices: dict) -> None:
+        """Вернуть результат drain() после неудачной записи; более свежие касания не затираются."""
+        for user_id, (at, user_agent) in users.items():
+            self.touch_user(user_id, user_agent, at)
+        for (user_id, hwid), touch in devices.items():
+            self.touch_device(user_id, hwid, touch)
+
+    def _drop_known(self, key: tuple[int, str]) -> None:
+        if self._known.pop(key, None) is None:
+            return
+        hwids = self._known_by_user.get(key[0])
+        if hwids is not None:
+            hwids.discard(key[1])
+            if not hwids:
+                del self._known_by_user[key[0]]
+
+    def known_device(self, user_id: int, hwid: str) -> tuple[bool, str | None]:
+        """(известно ли устройство активным, его user_agent)."""
+        if not self.known_enabled:
+            return False, None
+        key = (user_id, hwid)
+        with self._lock:
+            entry = self._known.get(key)
+            if entry is None or entry[0] <= self._clock():
+                if entry is not None:
+                    self._drop_known(key)
+                return False, None
+            self._known.move_to_end(key)
+            return True, entry[1]
+
+    def remember_device(self, user_id: int, hwid: str, user_agent: str | None) -> None:
+        """Устройство активно в БД (после коммита)."""
+        if not self.known_enabled:
+            return
+        key = (user_id, hwid)
+        with self._lock:
+            self._drop_known(key)
+            self._known[key] = (self._clock() + self.known_ttl, user_agent)
+            self._known_by_user.setdefault(user_id, set()).add(hwid)
+            while len(self._known) > self.known_size:
+                self._drop_known(next(iter(self._known)))
+
+    def forget_devices(self, user_ids: Iterable[int]) -> None:
+        """Забыть устройства юзеров: их user_devices изменили мимо /sub."""
+        with self._lock:
+            for user_id in user_ids:
+                for hwid in list(self._known_by_user.get(user_id, ())):
+                    self._drop_known((user_id, hwid))
+
+    def forget_all_devices(self) -> None:
+        with self._lock:
+            self._known.clear()
+            self._known_by_user.clear()
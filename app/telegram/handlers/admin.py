@@ -1608,10 +1608,10 @@ def confirm_user_command(call: types.CallbackQuery):
                 pass
     elif data == "restart":
         m = bot.edit_message_text("🔄 Restarting XRay core...", call.message.chat.id, call.message.message_id)
-        config = xray.config.include_db_users()
+        config = xray.config.include_db_users(refresh=True)
         xray.core.restart(config)
         for node_id, node in list(xray.nodes.items()):
-            if node.connected:
+            if xray.operations.node_health.connected(node_id):
                 xray.operations.restart_node(node_id, config)
         bot.edit_message_text(
             "✅ XRay core restarted successfully.", m.chat.id, m.message_id, reply_markup=BotKeyboard.main_menu()
@@ -5,6 +5,7 @@ import jinja2
 from config import CUSTOM_TEMPLATES_DIRECTORY
 
 from .filters import CUSTOM_FILTERS
+from .registry import TemplateRegistry
 
 template_directories = ["app/templates"]
 if CUSTOM_TEMPLATES_DIRECTORY:
@@ -18,3 +19,7 @@ env.globals["now"] = datetime.utcnow
 
 def render_template(template: str, context: dict | None = None) -> str:
     return env.get_template(template).render(context or {})
+
+
+# шаблоны подписки без контекста запроса — разобранные один раз на версию файла (см. registry.py)
+template_registry = TemplateRegistry(env)
@@ -0,0 +1,252 @@
+"""Реестр шаблонов подписки: рендер и парсинг один раз на версию файла.
+
+Конструкторы ClashConfiguration, SingBoxConfiguration и V2rayJsonConfig на
+каждый запрос рендерили Jinja-шаблоны mux/user_agent/settings и парсили их
+JSON/YAML, V2rayJsonConfig ещё и json.loads шаблона на каждый хост. Всё это
+от запроса не зависит:
+
+- get(name, parse) рендерит шаблон без контекста и парсит один раз на mtime
+  файла шаблона (правка файла подхватывается без рестарта, как auto_reload у
+  Jinja); отсутствующий шаблон перепроверяется раз в MISSING_RECHECK секунд;
+- parse_text(raw, parse) — то же для JSON из настроек бота: сама строка и есть
+  версия настроек (LRU на max_texts строк).
+
+Разобранные значения общие для всех запросов и не изменяются — то, что
+дополняется per-host полями, берётся через clone(). Шаблоны, которым нужен
+контекст запроса (clash/default.yml), компилируются в Frame (render_frame):
+вывод шаблона с маркерами на месте списков контекста, который заполняется без
+Jinja и повторного парсинга.
+
+Без зависимостей от окружения панели: jinja2.Environment передаётся снаружи.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from typing import Any
+
+from jinja2 import Environment, Template
+from jinja2.exceptions import TemplateNotFound
+
+MISSING_RECHECK = 5.0
+_MISSING = object()
+
+
+def clone(value: Any) -> Any:
+    """Структурная копия JSON/YAML-дерева: новые dict и list, листья (строки, числа, None) общие."""
+    if isinstance(value, dict):
+        return {key: clone(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [clone(item) for item in value]
+    return value
+
+
+class TemplateRegistry:
+    """(шаблон, parse) → разобранный вывод шаблона, пока не изменился файл."""
+
+    def __init__(self, env: Environment, max_texts: int = 64, clock: Callable[[], float] = time.monotonic):
+        self._env = env
+        self._clock = clock
+        self.max_texts = max_texts
+        self._lock = threading.Lock()
+        # key → (filename, mtime_ns, value); для отсутствующего шаблона — (None, recheck_at, _MISSING)
+        self._entries: dict[tuple, tuple[str | None, float, Any]] = {}
+        self._texts: OrderedDict[tuple, Any] = OrderedDict()
+
+    @staticmethod
+    def _mtime(filename: str) -> int | None:
+        try:
+            return os.stat(filename).st_mtime_ns
+        except OSError:
+            return None
+
+    def get(self, name: str, parse: Callable[[str], Any] | None = None) -> Any:
+        """Вывод шаблона name, разобранный parse (None — текст); TemplateNotFound, если шаблона нет."""
+
+        def make(template: Template) -> Any:
+            text = template.render()
+            return parse(text) if parse is not None else text
+
+        return self._cached((name, parse), name, make)
+
+    def render_frame(
+        self,
+        name: str,
+        parse: Callable[[str], Any],
+        context: dict,
+        probe: dict,
+        normalize: Callable[[Any], Any] | None = None,
+    ) -> Any | None:
+        """parse(вывод шаблона name с context) через Frame; None — рендерить честно.
+
+        None — шаблон не компилируется или normalize не смог привести значение (ValueError). Frame свой
+        на каждый набор пустых списков context: пустой список шаблон может вывести не как список
+        (`key:` без значения → None), поэтому пустые списки не маркируются, а подставляются как есть.
+        """
+        empty = frozenset(path for path, value in _lists(context) if not value)
+        frame = self._cached(
+            ("frame", name, parse, normalize, empty),
+            name,
+            lambda template: Frame.build(template.render, parse, _emptied(probe, empty), normalize),
+        )
+        if frame is None:
+            return None
+        try:
+            return frame.fill(context)
+        except ValueError:
+            return None
+
+    def _cached(self, key: tuple, name: str, make: Callable[[Template], Any]) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None:
+            filename, stamp, value = entry
+            if filename is None:
+                if self._clock() < stamp:
+                    raise TemplateNotFound(name)
+            elif self._mtime(filename) == stamp:
+                return value
+        try:
+            template = self._env.get_template(name)
+        except TemplateNotFound:
+            self._entries[key] = (None, self._clock() + MISSING_RECHECK, _MISSING)
+            raise
+        # mtime — до рендера: правка файла между ними даст лишний перерендер, а не устаревшее значение
+        mtime = self._mtime(template.filename) if template.filename else None
+        value = make(template)
+        if mtime is not None:
+            self._entries[key] = (template.filename, mtime, value)
+        return value
+
+    def parse_text(self, raw: str | None, parse: Callable[[str | None], Any]) -> Any:
+        """parse(raw) с кэшем по самой строке; исключения parse не кэшируются."""
+        key = (raw, parse)
+        with self._lock:
+            if key in self._texts:
+                self._texts.move_to_end(key)
+                return self._texts[key]
+        value = parse(raw)
+        with self._lock:
+            self._texts[key] = value
+            while len(self._texts) > self.max_texts:
+                self._texts.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._texts.clear()
+
+
+def _lists(context: dict, path: tuple[str, ...] = ()):
+    """(путь, список) для списков на верхнем уровне context и во вложенных dict."""
+    for key, value in context.items():
+        if isinstance(value, list):
+            yield (*path, key), value
+        elif isinstance(value, dict):
+            yield from _lists(value, (*path, key))
+
+
+def _emptied(context: dict, paths: frozenset, path: tuple[str, ...] = ()) -> dict:
+    """Копия context, где списки по путям paths пустые."""
+    result: dict[str, Any] = {}
+    for key, value in context.items():
+        if isinstance(value, list) and (*path, key) in paths:
+            result[key] = []
+        elif isinstance(value, dict):
+            result[key] = _emptied(value, paths, (*path, key))
+        else:
+            result[key] = value
+    return result
+
+
+def _ordered(tree: Any) -> Any:
+    """Дерево для сравнения с учётом порядка ключей (== у dict его не учитывает)."""
+    if isinstance(tree, dict):
+        return [(key, _ordered(value)) for key, value in tree.items()]
+    if isinstance(tree, list):
+        return [_ordered(item) for item in tree]
+    return tree
+
+
+class Frame:
+    """Разобранный вывод шаблона, где непустые списки контекста заменены маркерами.
+
+    Маркер — строка-элемент списка; fill() вклеивает на его место элементы
+    настоящего списка (так {{ list | yaml }} внутри другого списка YAML тоже
+    работает).
+    """
+
+    def __init__(self, tree: Any, markers: dict[str, tuple[str, ...]], normalize: Callable[[Any], Any] | None = None):
+        self.tree = tree
+        self._markers = markers
+        self._normalize = normalize
+
+    @staticmethod
+    def _lookup(context: dict, path: tuple[str, ...]) -> list:
+        value: Any = context
+        for part in path:
+            value = value[part]
+        return value
+
+    def fill(self, context: dict) -> Any:
+        """Дерево для context той же формы и с теми же пустыми списками, что и проба build()."""
+        values = {marker: self._lookup(context, path) for marker, path in self._markers.items()}
+        if self._normalize is not None:
+            values = {marker: self._normalize(value) for marker, value in values.items()}
+        return self._fill(self.tree, values, set())
+
+    def _fill(self, node: Any, values: dict[str, list], used: set[str]) -> Any:
+        if isinstance(node, dict):
+            return {key: self._fill(item, values, used) for key, item in node.items()}
+        if isinstance(node, list):
+            result: list[Any] = []
+            for item in node:
+                if isinstance(item, str) and item in values:
+                    # повторная вставка того же списка — копией: общие объекты yaml.dump вывел бы якорями
+                    result.extend(clone(values[item]) if item in used else values[item])
+                    used.add(item)
+                else:
+                    result.append(self._fill(item, values, used))
+            return result
+        return node
+
+    @classmethod
+    def build(
+        cls,
+        render: Callable[[dict], str],
+        parse: Callable[[str], Any],
+        probe: dict,
+        normalize: Callable[[Any], Any] | None = None,
+    ) -> Frame | None:
+        """Скомпилировать шаблон render(context) → parse по пробе.
+
+        Непустые списки probe (на верхнем уровне или значением вложенного dict) становятся маркерами.
+        normalize приводит вставляемый список к виду, в котором его вернул бы parse после фильтра шаблона
+        (порядок ключей, типы листьев). Если fill(probe) не совпал с честным рендером probe с учётом порядка
+        ключей (шаблон обходит список циклом, берёт длину или элемент и т.п.), шаблон не компилируется —
+        None. Списки пробы — хотя бы из двух элементов.
+        """
+        markers: dict[str, tuple[str, ...]] = {}
+
+        def mark(value: Any, path: tuple[str, ...]) -> Any:
+            if isinstance(value, list) and value:
+                marker = f"__frame_{len(markers)}_{'_'.join(path)}__"
+                markers[marker] = path
+                return [marker]
+            if isinstance(value, dict):
+                return {key: mark(item, (*path, key)) for key, item in value.items()}
+            return value
+
+        marked = {key: mark(value, (key,)) for key, value in probe.items()}
+        try:
+            frame = cls(parse(render(marked)), markers, normalize)
+            if _ordered(frame.fill(probe)) != _ordered(parse(render(probe))):
+                return None
+        except Exception:
+            # шаблон не переварил маркеры (индексирует список, фильтры по элементам) — только честный рендер
+            return None
+        return frame
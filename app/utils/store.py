@@ -46,6 +46,8 @@ class DictStorage(dict):
     def __init__(self, update_func):
         super().__init__()
         self.update_func = update_func
+        # растёт на каждое update(): по нему кэши производных данных (рендер подписок) видят перезагрузку
+        self.version = 0
 
     def __getitem__(self, key):
         if not self:
@@ -85,3 +87,4 @@ class DictStorage(dict):
 
     def update(self):
         self.update_func(self)
+        self.version += 1
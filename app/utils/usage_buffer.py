@@ -0,0 +1,63 @@
+"""Общий буфер дельт трафика между по-нодным опросом и записью в БД.
+
+Опросчики нод (app/xray/stats_collector.NodeStatsPoller) складывают сюда
+колонки uid/value каждой ноды со своей частотой, джоб record_user_usages
+забирает накопленное целиком (drain) со своей — запись в БД не ждёт самую
+медленную ноду и не идёт всплесками в такт опросу.
+
+Счётчики xray к моменту add() уже сброшены (reset=True), поэтому при включённом
+usage-спуле опросчик сначала пишет опрос в спул отдельным тиком, а сюда
+передаёт его tick_id: drain_ticks() отдаёт их вместе с дельтами, и запись
+сводного тика закрывает их (UsageSpool.merge). Без зависимостей от БД/окружения —
+тестируется как usage_spool.
+"""
+
+from __future__ import annotations
+
+import threading
+from array import array
+
+from app.utils.usage_spool import NodeDelta
+
+
+class UsageBuffer:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._nodes: dict[int | None, dict[int, int]] = {}
+        self._coefficients: dict[int | None, float] = {}
+        self._tick_ids: list[str] = []
+
+    def add(
+        self, node_id: int | None, coefficient: float, uids: array, values: array, tick_id: str | None = None
+    ) -> None:
+        """Прибавить дельты одного опроса ноды (до коэффициента); tick_id — тик этого опроса в спуле."""
+        if not uids:
+            return
+        with self._lock:
+            if tick_id is not None:
+                self._tick_ids.append(tick_id)
+            totals = self._nodes.setdefault(node_id, {})
+            for uid, value in zip(uids, values):
+                totals[uid] = totals.get(uid, 0) + value
+            # коэффициент ноды между сбросами не меняется чаще, чем правят ноду в админке —
+            # берём последний известный
+            self._coefficients[node_id] = coefficient
+
+    def drain(self) -> list[NodeDelta]:
+        """Забрать всё накопленное и очистить буфер."""
+        return self.drain_ticks()[0]
+
+    def drain_ticks(self) -> tuple[list[NodeDelta], list[str]]:
+        """Как drain(), плюс tick_id спуленных опросов, вошедших в эти дельты."""
+        with self._lock:
+            nodes, coefficients, tick_ids = self._nodes, self._coefficients, self._tick_ids
+            self._nodes, self._coefficients, self._tick_ids = {}, {}, []
+        deltas = [
+            NodeDelta(node_id, float(coefficients[node_id]), array("q", totals.keys()), array("q", totals.values()))
+            for node_id, totals in nodes.items()
+        ]
+        return deltas, tick_ids
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(totals) for totals in self._nodes.values())
@@ -0,0 +1,376 @@
+"""Локальный append-only спул тиков учёта трафика (write-ahead перед записью в БД).
+
+record_user_usages снимает счётчики xray с reset=True: если запись в БД после этого
+упала (дедлок, недоступность MySQL), трафик тика терялся безвозвратно. Спул пишет
+по-нодные дельты тика в сегментный файл ДО записи в БД, а после успешного коммита
+дописывает отметку commit. Незакоммиченные тики переигрываются следующим запуском
+джоба; идемпотентность реплея по tick_id обеспечивается на стороне БД
+(таблица usage_spool_ticks), поэтому потеря отметки commit безопасна. Стадии тика,
+которые пишутся отдельными транзакциями (по-нодный учёт, БС-учёт), отмечаются
+своими id (stage_tick_id) — реплей дописывает только недостающие.
+
+По-нодный опрос (XRAY_STATS_POLL_PER_NODE) спулит каждый опрос отдельным тиком
+с hold=True: такие тики копятся в UsageBuffer, и реплей их не трогает, пока
+процесс жив. Сброс буфера пишет один сводный тик фреймом merge, который в
+той же записи закрывает тики опросов, — сводный тик и тики опросов никогда не
+бывают незакоммичены одновременно.
+
+Формат сегмента — последовательность фреймов: <kind:u8><len:u32><crc32:u32><payload>.
+Данные тика — колоночные array('q') (uid/value), без dict на каждую запись.
+Порванный хвост сегмента (крэш посреди записи) отбрасывается при чтении.
+Тик, который не читается или не декодируется, pending() логирует и отмечает
+commit — иначе он держал бы свой сегмент и все следующие вечно.
+
+Тик, который читается, но не записывается в БД по причине, которую повтор не
+исправит, реплей выносит в карантин (quarantine/<tick_id>.tick — один фрейм тика)
+и только потом коммитит. Для ручного реплея файл кладут обратно в каталог спула:
+при старте такие файлы снова ставятся в очередь, а отметки стадий в БД не дадут
+засчитать уже применённое повторно.
+
+Без зависимостей от БД/окружения — тестируется как bs_limit/inbound_filter.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import io
+import logging
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+from array import array
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+
+KIND_TICK = 1
+KIND_COMMIT = 2
+KIND_MERGE = 3  # <n:u32><n × tick_id><тик>: тик, заменяющий n незакоммиченных тиков
+
+_FRAME = struct.Struct("<BII")
+_COUNT = struct.Struct("<I")
+_TICK_HEAD = struct.Struct("<16sdI")
+_NODE_HEAD = struct.Struct("<qdI")
+_NO_NODE = -1  # node_id=None (главный xray-инстанс)
+
+SEGMENT_PREFIX = "usage-"
+SEGMENT_SUFFIX = ".seg"
+QUARANTINE_DIR = "quarantine"
+TICK_FILE_SUFFIX = ".tick"
+
+logger = logging.getLogger("uvicorn.error")
+
+
+@dataclass
+class NodeDelta:
+    """Дельты одной ноды за тик: параллельные колонки uid/value (до коэффициента)."""
+
+    node_id: int | None
+    coefficient: float
+    uids: array = field(default_factory=lambda: array("q"))
+    values: array = field(default_factory=lambda: array("q"))
+
+
+@dataclass
+class UsageTick:
+    tick_id: str
+    created_at: float
+    nodes: list[NodeDelta]
+
+
+def new_tick_id() -> str:
+    return uuid.uuid4().hex
+
+
+def stage_tick_id(tick_id: str, stage: str) -> str:
+    """id отметки стадии тика в usage_spool_ticks — 32 hex-символа, как у самого tick_id."""
+    return hashlib.blake2b(f"{tick_id}:{stage}".encode(), digest_size=16).hexdigest()
+
+
+def encode_tick(tick: UsageTick) -> bytes:
+    parts = [_TICK_HEAD.pack(bytes.fromhex(tick.tick_id), tick.created_at, len(tick.nodes))]
+    for node in tick.nodes:
+        if len(node.uids) != len(node.values):
+            raise ValueError("uids and values must have the same length")
+        node_id = _NO_NODE if node.node_id is None else node.node_id
+        parts.append(_NODE_HEAD.pack(node_id, node.coefficient, len(node.uids)))
+        parts.append(node.uids.tobytes())
+        parts.append(node.values.tobytes())
+    return b"".join(parts)
+
+
+def decode_tick(payload: bytes) -> UsageTick:
+    raw_id, created_at, nodes_count = _TICK_HEAD.unpack_from(payload, 0)
+    offset = _TICK_HEAD.size
+    nodes = []
+    for _ in range(nodes_count):
+        node_id, coefficient, n = _NODE_HEAD.unpack_from(payload, offset)
+        offset += _NODE_HEAD.size
+        size = n * 8
+        uids = array("q")
+        uids.frombytes(payload[offset : offset + size])
+        offset += size
+        values = array("q")
+        values.frombytes(payload[offset : offset + size])
+        offset += size
+        nodes.append(NodeDelta(None if node_id == _NO_NODE else node_id, coefficient, uids, values))
+    if offset != len(payload):
+        raise ValueError("tick payload length does not match its node headers")
+    return UsageTick(raw_id.hex(), created_at, nodes)
+
+
+def _frame(kind: int, payload: bytes) -> bytes:
+    return _FRAME.pack(kind, len(payload), zlib.crc32(payload)) + payload
+
+
+def _split_merge(payload: bytes) -> tuple[list[str], bytes]:
+    """Payload фрейма merge → (id заменённых тиков, payload тика)."""
+    (count,) = _COUNT.unpack_from(payload, 0)
+    end = _COUNT.size + 16 * count
+    if end > len(payload):
+        raise ValueError("merge frame is shorter than its tick id list")
+    ids = [payload[start : start + 16].hex() for start in range(_COUNT.size, end, 16)]
+    return ids, payload[end:]
+
+
+def iter_frames(path: str) -> Iterator[tuple[int, int, bytes]]:
+    """(offset, kind, payload) по всем целым фреймам сегмента; на порванном хвосте — стоп."""
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset + _FRAME.size <= len(data):
+        kind, length, crc = _FRAME.unpack_from(data, offset)
+        start = offset + _FRAME.size
+        payload = data[start : start + length]
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            return
+        yield offset, kind, payload
+        offset = start + length
+
+
+class UsageSpool:
+    """Сегментный WAL тиков учёта трафика.
+
+    append() пишет тик и делает fsync — после возврата тик переживёт крэш процесса.
+    commit() дописывает отметку без fsync: её потеря лишь приводит к повторному
+    (идемпотентному) реплею. Сегменты без незакоммиченных тиков удаляются с головы.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = 64 * 1024 * 1024, fsync: bool = True):
+        self.directory = directory
+        self.segment_bytes = max(1, segment_bytes)
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        # tick_id → (seq сегмента, offset фрейма); порядок вставки = порядок тиков
+        self._pending: dict[str, tuple[int, int]] = {}
+        self._segments: dict[int, set[str]] = {}
+        # тики, которые держит этот процесс (append(hold=True)) — pending() их пропускает
+        self._held: set[str] = set()
+        self._active_seq = 0
+        self._active: io.BufferedWriter | None = None
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+        self._open_segment(max(self._segments, default=0) + 1)
+        self._requeue_tick_files()
+
+    def _path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{seq:012d}{SEGMENT_SUFFIX}")
+
+    def _load(self):
+        seqs = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                try:
+                    seqs.append(int(name[len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        # фреймы по порядку записи: commit и merge закрывают только уже записанные тики
+        for seq in sorted(seqs):
+            self._segments[seq] = set()
+            for offset, kind, payload in iter_frames(self._path(seq)):
+                if kind == KIND_TICK:
+                    self._add_pending(payload[:16].hex(), seq, offset)
+                elif kind == KIND_MERGE:
+                    merged, tick_payload = _split_merge(payload)
+                    self._add_pending(tick_payload[:16].hex(), seq, offset)
+                    for tick_id in merged:
+                        self._forget(tick_id)
+                elif kind == KIND_COMMIT:
+                    self._forget(payload[:16].hex())
+        self._drop_committed_segments()
+
+    def _requeue_tick_files(self):
+        """Вернуть в очередь тики, положенные в каталог спула из карантина."""
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(TICK_FILE_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                ticks = [decode_tick(payload) for _, kind, payload in iter_frames(path) if kind == KIND_TICK]
+            except (OSError, struct.error, ValueError) as e:
+                logger.error(f"[usage_spool] can't requeue tick file {name}: {type(e).__name__}: {e}")
+                continue
+            for tick in ticks:
+                self.append(tick)
+            os.remove(path)
+            logger.info(f"[usage_spool] requeued {len(ticks)} tick(s) from {name}")
+
+    def _add_pending(self, tick_id: str, seq: int, offset: int):
+        self._pending[tick_id] = (seq, offset)
+        self._segments[seq].add(tick_id)
+
+    def _forget(self, tick_id: str) -> bool:
+        self._held.discard(tick_id)
+        location = self._pending.pop(tick_id, None)
+        if location is None:
+            return False
+        self._segments[location[0]].discard(tick_id)
+        return True
+
+    def _open_segment(self, seq: int) -> io.BufferedWriter:
+        if self._active is not None:
+            self._active.close()
+        self._active_seq = seq
+        self._segments.setdefault(seq, set())
+        # Новый сегмент на каждый старт: не дописываем за возможно порванный хвост.
+        self._active = open(self._path(seq), "ab")
+        return self._active
+
+    def _write(self, frame: bytes, sync: bool) -> int:
+        active = self._active
+        if active is None:
+            # OSError — вызывающие уже обрабатывают его как недоступный спул
+            raise OSError("usage spool is closed")
+        if active.tell() >= self.segment_bytes:
+            active = self._open_segment(self._active_seq + 1)
+            self._drop_committed_segments()
+        offset = active.tell()
+        active.write(frame)
+        active.flush()
+        if sync and self.fsync:
+            os.fsync(active.fileno())
+        return offset
+
+    def _drop_committed_segments(self):
+        for seq in sorted(self._segments):
+            if seq == self._active_seq or self._segments[seq]:
+                break
+            del self._segments[seq]
+            try:
+                os.remove(self._path(seq))
+            except FileNotFoundError:
+                pass
+
+    def append(self, tick: UsageTick, hold: bool = False) -> None:
+        """Записать тик; hold — его заберёт merge() этого процесса, pending() его не отдаёт."""
+        frame = _frame(KIND_TICK, encode_tick(tick))
+        with self._lock:
+            offset = self._write(frame, sync=True)
+            self._add_pending(tick.tick_id, self._active_seq, offset)
+            if hold:
+                self._held.add(tick.tick_id)
+
+    def merge(self, tick: UsageTick, tick_ids: list[str]) -> None:
+        """Записать tick вместо незакоммиченных tick_ids одним фреймом (с fsync)."""
+        payload = _COUNT.pack(len(tick_ids)) + b"".join(bytes.fromhex(t) for t in tick_ids) + encode_tick(tick)
+        frame = _frame(KIND_MERGE, payload)
+        with self._lock:
+            offset = self._write(frame, sync=True)
+            self._add_pending(tick.tick_id, self._active_seq, offset)
+            for tick_id in tick_ids:
+                self._forget(tick_id)
+            self._drop_committed_segments()
+
+    def release(self, tick_ids: list[str]) -> None:
+        """Отдать удержанные тики реплею (merge не состоялся)."""
+        with self._lock:
+            self._held.difference_update(tick_ids)
+
+    def commit(self, tick_id: str) -> None:
+        with self._lock:
+            if tick_id not in self._pending:
+                return
+            self._write(_frame(KIND_COMMIT, bytes.fromhex(tick_id)), sync=False)
+            self._forget(tick_id)
+            self._drop_committed_segments()
+
+    def quarantine(self, tick: UsageTick) -> str:
+        """Сохранить тик в quarantine/<tick_id>.tick (с fsync) и закоммитить; → путь файла."""
+        directory = os.path.join(self.directory, QUARANTINE_DIR)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{tick.tick_id}{TICK_FILE_SUFFIX}")
+        with open(path, "wb") as f:
+            f.write(_frame(KIND_TICK, encode_tick(tick)))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        self.commit(tick.tick_id)
+        return path
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def pending(self) -> Iterator[UsageTick]:
+        """Незакоммиченные тики от старых к новым, кроме удержанных; payload читается с диска лениво.
+
+        Битый фрейм (нет файла, CRC, не декодируется) пропускается с отметкой commit.
+        """
+        with self._lock:
+            locations = [item for item in self._pending.items() if item[0] not in self._held]
+        for tick_id, (seq, offset) in locations:
+            try:
+                tick = self._read_tick(seq, offset)
+            except (OSError, struct.error, ValueError) as e:
+                logger.error(
+                    f"[usage_spool] dropping unreadable tick {tick_id} "
+                    f"(segment {seq}, offset {offset}): {type(e).__name__}: {e}"
+                )
+                self.commit(tick_id)
+                continue
+            yield tick
+
+    def _read_tick(self, seq: int, offset: int) -> UsageTick:
+        with open(self._path(seq), "rb") as f:
+            f.seek(offset)
+            kind, length, crc = _FRAME.unpack(f.read(_FRAME.size))
+            payload = f.read(length)
+        if kind not in (KIND_TICK, KIND_MERGE) or len(payload) != length or zlib.crc32(payload) != crc:
+            raise ValueError("frame kind, length or crc mismatch")
+        return decode_tick(_split_merge(payload)[1] if kind == KIND_MERGE else payload)
+
+    def close(self):
+        with self._lock:
+            if self._active is not None:
+                self._active.close()
+                self._active = None
+
+
+def tick_from_params(api_params: dict, usage_coefficient: dict, tick_id: str = None, created_at: float = None):
+    """Собрать UsageTick из {node_id: [{"uid", "value"}]}."""
+    nodes = []
+    for node_id, params in api_params.items():
+        if not params:
+            continue
+        delta = NodeDelta(node_id, float(usage_coefficient.get(node_id, 1)))
+        for p in params:
+            delta.uids.append(int(p["uid"]))
+            delta.values.append(int(p["value"]))
+        nodes.append(delta)
+    return UsageTick(tick_id or new_tick_id(), time.time() if created_at is None else created_at, nodes)
+
+
+def params_from_tick(tick: UsageTick) -> tuple[dict, dict]:
+    """Обратное к tick_from_params: (api_params, usage_coefficient)."""
+    return params_from_deltas(tick.nodes)
+
+
+def params_from_deltas(nodes: list[NodeDelta]) -> tuple[dict, dict]:
+    api_params, usage_coefficient = {}, {}
+    for node in nodes:
+        api_params[node.node_id] = [{"uid": uid, "value": value} for uid, value in zip(node.uids, node.values)]
+        usage_coefficient[node.node_id] = node.coefficient
+    return api_params, usage_coefficient
@@ -8,9 +8,10 @@ from app.utils.system import check_port
 from app.xray import operations
 from app.xray.config import XRayConfig
 from app.xray.core import XRayCore
+from app.xray.grpc_channels import channel_key
 from app.xray.host_addresses import resolve_host_addresses, resolve_host_node_ids
 from app.xray.inbound_filter import apply_inbound_filter
-from app.xray.node import XRayNode
+from app.xray.node import XRayNode, channel_pool
 from config import XRAY_ASSETS_PATH, XRAY_EXECUTABLE_PATH, XRAY_JSON
 from xray_api import XRay as XRayAPI
 from xray_api import exceptions, types
@@ -27,7 +28,9 @@ finally:
     config = XRayConfig(XRAY_JSON, api_port=api_port)
     del api_port
 
-api = XRayAPI(config.api_host, config.api_port)
+api = XRayAPI(
+    config.api_host, config.api_port, channel=channel_pool.acquire(channel_key(config.api_host, config.api_port))
+)
 
 nodes: dict[int, XRayNode] = {}
 
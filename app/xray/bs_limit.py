@@ -3,6 +3,9 @@
 Без зависимостей от БД/окружения — тестируются как cascade_config/inbound_filter.
 """
 
+import threading
+from collections import OrderedDict
+
 
 def period_keys(now):
     """Маркер месяца счётчика 'YYYY-MM' — ленивый сброс при смене месяца."""
@@ -95,18 +98,48 @@ def bs_stub_remark(text_list):
     return " ".join(p for p in parts if p)
 
 
+# (id(inbound), blocked) → (inbound, пересобранный инбаунд): ноды с одинаковым набором
+# заблокированных получают один и тот же объект — его JSON-фрагмент сериализуется
+# один раз (app/xray/config_json.py). Запись держит исходный инбаунд, совпадение — по `is`.
+_STRIPPED_MAX = 64
+_stripped: OrderedDict = OrderedDict()
+_stripped_lock = threading.Lock()
+
+
+def _strip_inbound(inbound, blocked, prefixes):
+    key = (id(inbound), blocked)
+    with _stripped_lock:
+        entry = _stripped.get(key)
+        if entry is not None and entry[0] is inbound:
+            _stripped.move_to_end(key)
+            return entry[1]
+    settings = inbound["settings"]
+    new_inbound = dict(inbound)
+    new_inbound["settings"] = {
+        **settings,
+        "clients": [c for c in settings["clients"] if not str(c.get("email", "")).startswith(prefixes)],
+    }
+    with _stripped_lock:
+        _stripped[key] = (inbound, new_inbound)
+        while len(_stripped) > _STRIPPED_MAX:
+            _stripped.popitem(last=False)
+    return new_inbound
+
+
 def strip_blocked_clients(config, blocked_user_ids):
     """Копия config без клиентов заблокированных user_id во всех инбаундах.
 
     Матчинг по префиксу email '<uid>.' (email клиента = '<user_id>.<username>').
     Пустой набор → исходный объект без копирования (no-op). Затронутые инбаунды
     пересобираются новыми dict, поэтому функция корректна даже при поверхностном
-    config.copy() и не мутирует вход.
+    config.copy() и не мутирует вход. Для одного исходного инбаунда и набора
+    заблокированных возвращается один и тот же объект (см. _stripped).
     """
     if not blocked_user_ids:
         return config
     cfg = config.copy()
-    prefixes = tuple(f"{uid}." for uid in blocked_user_ids)
+    blocked = frozenset(blocked_user_ids)
+    prefixes = tuple(f"{uid}." for uid in blocked)
     new_inbounds = []
     for inbound in cfg["inbounds"]:
         settings = inbound.get("settings")
@@ -114,10 +147,6 @@ def strip_blocked_clients(config, blocked_user_ids):
         if not clients:
             new_inbounds.append(inbound)
             continue
-        new_settings = dict(settings)
-        new_settings["clients"] = [c for c in clients if not str(c.get("email", "")).startswith(prefixes)]
-        new_inbound = dict(inbound)
-        new_inbound["settings"] = new_settings
-        new_inbounds.append(new_inbound)
+        new_inbounds.append(_strip_inbound(inbound, blocked, prefixes))
     cfg["inbounds"] = new_inbounds
     return cfg
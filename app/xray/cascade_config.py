@@ -6,8 +6,8 @@ xray_config.json (а не служебного сгенерённого инба
 с параметрами, прочитанными из его определения (резолвинг — в operations.py).
 
 Без тяжёлых импортов (app.db, config, xray_api), чтобы покрываться pytest без БД.
-cascade_config копирует входной конфиг (base_config.copy() → deepcopy у XRayConfig)
-и не мутирует оригинал.
+cascade_config копирует входной конфиг (base_config.copy() — copy-on-write у
+XRayConfig) и не мутирует оригинал: изменяемые секции заменяются копиями.
 """
 
 from __future__ import annotations
@@ -165,7 +165,7 @@ def cascade_config(base_config, *, role, cascade_clients=None, entry_routes=None
         for route in entry_routes:
             groups.setdefault(route["entry_inbound_tag"], []).append(route)
 
-        routing = cfg.setdefault("routing", {})
+        routing = cfg["routing"] = dict(cfg.get("routing") or {})
         has_balancer = False
         for entry_tag, group in groups.items():
             # уникальные outbound-теги группы, сохраняя порядок.
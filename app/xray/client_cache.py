@@ -0,0 +1,138 @@
+"""Кэш списков клиентов по инбаундам для XRayConfig.include_db_users.
+
+include_db_users каждый раз делал deepcopy конфига и group_concat-запрос по
+users × proxies × excluded_inbounds, заново собирая каждого клиента. Здесь
+клиенты лежат готовыми по инбаундам ({tag: {user_id: client}}): полная
+загрузка из БД — один раз (и после invalidate()/max_age), дальше кэш
+поддерживается событиями add/update/remove_user из app/xray/operations, а
+сборка конфига — только склейка готовых списков.
+
+version растёт на каждое изменение — по нему потребители (кэш фрагментов
+конфига, реконсилятор) понимают, что клиенты поменялись.
+
+События, пришедшие во время полной загрузки, записываются и применяются
+поверх неё: снимок БД мог их не увидеть. Без зависимостей от БД/окружения.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections.abc import Callable, Iterable
+
+_XTLS_NETWORKS = ("tcp", "raw", "kcp")
+
+
+def build_client(inbound: dict, email: str, settings: dict) -> dict:
+    """Клиент инбаунда в конфиге xray; flow снимается, если транспорт его не поддерживает."""
+    client = {"email": email, **settings}
+    # XTLS currently only supports transmission methods of TCP and mKCP
+    if client.get("flow") and (
+        inbound.get("network", "tcp") not in _XTLS_NETWORKS
+        or inbound.get("tls") not in ("tls", "reality")
+        or inbound.get("header_type") == "http"
+    ):
+        del client["flow"]
+    return client
+
+
+class ClientCache:
+    """Клиенты по инбаундам одного XRayConfig (owner) с версией.
+
+    loader() → iterable (user_id, {tag: client}) по всем активным юзерам;
+    вызывается вне блокировки, события на время загрузки откладываются.
+    """
+
+    def __init__(self, max_age: float = 0):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._owner = None
+        self._loaded_at = 0.0
+        self._by_tag: dict[str, dict[int, dict]] = {}
+        self._user_tags: dict[int, tuple] = {}
+        self._replay: list | None = None
+        self._assembled: tuple[int, dict] | None = None
+        self.version = 0
+
+    def _fresh(self, owner) -> bool:
+        if self._owner is not owner:
+            return False
+        return not self.max_age or time.monotonic() - self._loaded_at < self.max_age
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._owner = None
+
+    def _assemble(self) -> dict[str, tuple]:
+        # до следующего изменения отдаём один и тот же объект: по нему include_db_users
+        # переиспользует собранные инбаунды, а config_json — их JSON-фрагменты
+        if self._assembled is None or self._assembled[0] != self.version:
+            self._assembled = (self.version, {tag: tuple(clients.values()) for tag, clients in self._by_tag.items()})
+        return self._assembled[1]
+
+    def clients(self, owner, loader: Callable[[], Iterable]) -> dict[str, tuple]:
+        """{tag: (client, ...)} для owner; при необходимости — полная загрузка через loader.
+
+        Результат неизменяемый и общий для всех вызовов одной версии; объекты
+        клиентов — общие с кэшем: их не изменяют.
+        """
+        with self._lock:
+            if self._fresh(owner):
+                return self._assemble()
+        with self._load_lock:
+            with self._lock:
+                if self._fresh(owner):
+                    return self._assemble()
+                self._replay = []
+            try:
+                rows = list(loader())
+            except BaseException:
+                with self._lock:
+                    self._replay = None
+                raise
+            with self._lock:
+                self._by_tag, self._user_tags = {}, {}
+                for user_id, clients_by_tag in rows:
+                    self._set(user_id, clients_by_tag)
+                for user_id, clients_by_tag in self._replay:
+                    self._set(user_id, clients_by_tag)
+                self._replay = None
+                self._owner = owner
+                self._loaded_at = time.monotonic()
+                self.version += 1
+                return self._assemble()
+
+    def _set(self, user_id: int, clients_by_tag: dict | None) -> None:
+        for tag in self._user_tags.pop(user_id, ()):
+            clients = self._by_tag.get(tag)
+            if clients is not None:
+                clients.pop(user_id, None)
+        if clients_by_tag:
+            for tag, client in clients_by_tag.items():
+                self._by_tag.setdefault(tag, {})[user_id] = client
+            self._user_tags[user_id] = tuple(clients_by_tag)
+
+    def set_user(self, user_id: int, clients_by_tag: dict | None) -> None:
+        """Заменить всех клиентов юзера; None/{} — юзер неактивен или удалён."""
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append((user_id, clients_by_tag))
+            if self._owner is None and self._replay is None:
+                return  # кэш не загружен — следующая загрузка прочитает БД
+            self._set(user_id, clients_by_tag)
+            self.version += 1
+
+    def remove_user(self, user_id: int) -> None:
+        self.set_user(user_id, None)
+
+    def user_tags(self, user_id: int) -> tuple | None:
+        """Инбаунды юзера по кэшу; None — кэш не загружен или юзера в нём нет."""
+        with self._lock:
+            if self._owner is None:
+                return None
+            return self._user_tags.get(user_id)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._user_tags)
@@ -13,7 +13,21 @@ from app.db import models as db_models
 from app.models.proxy import ProxyTypes
 from app.models.user import UserStatus
 from app.utils.crypto import get_cert_SANs
-from config import DEBUG, XRAY_EXCLUDE_INBOUND_TAGS, XRAY_FALLBACKS_INBOUND_TAG
+from app.xray.client_cache import ClientCache, build_client
+from app.xray.config_json import JsonFragmentCache
+from config import (
+    DEBUG,
+    XRAY_CLIENT_CACHE_MAX_AGE,
+    XRAY_CONFIG_JSON_CACHE_MB,
+    XRAY_EXCLUDE_INBOUND_TAGS,
+    XRAY_FALLBACKS_INBOUND_TAG,
+)
+
+# max_age=0 → кэш не устаревает по времени; полное перечитывание БД — через include_db_users(refresh=True)
+client_cache = ClientCache(max_age=XRAY_CLIENT_CACHE_MAX_AGE)
+config_json_cache = JsonFragmentCache(max_bytes=XRAY_CONFIG_JSON_CACHE_MB * 1024 * 1024)
+# (базовый конфиг, результат client_cache.clients, собранный список инбаундов) последнего include_db_users
+_assembled: tuple | None = None
 
 
 def merge_dicts(a, b):  # B will override A dictionary key and values
@@ -332,14 +346,25 @@ class XRayConfig(dict):
                 return outbound
 
     def to_json(self, **json_kwargs):
-        return json.dumps(self, **json_kwargs)
+        if json_kwargs:
+            return json.dumps(self, **json_kwargs)
+        # тяжёлые инбаунды — из кэша JSON-фрагментов (общие для конфигов всех нод)
+        return config_json_cache.dumps(self)
 
     def copy(self):
-        return deepcopy(self)
-
-    def include_db_users(self) -> XRayConfig:
-        config = self.copy()
+        """Поверхностная copy-on-write копия.
+
+        Секции (inbounds, outbounds, routing, ...) общие с оригиналом: кто меняет
+        секцию, сначала заменяет её копией (cfg["inbounds"] = [...]), а не правит
+        на месте. Списки клиентов в собранных конфигах — неизменяемые tuple.
+        """
+        config = XRayConfig.__new__(XRayConfig)
+        dict.update(config, self)
+        config.__dict__.update(self.__dict__)
+        return config
 
+    def _db_clients(self):
+        """(user_id, {tag: client}) по всем active/on_hold юзерам — полная загрузка кэша клиентов."""
         with GetDB() as db:
             query = (
                 db.query(
@@ -366,46 +391,61 @@ class XRayConfig(dict):
             )
             result = query.all()
 
-            grouped_data = defaultdict(list)
-
-            for row in result:
-                grouped_data[row.type].append(
-                    (
-                        row.id,
-                        row.username,
-                        row.settings,
-                        [i for i in row.excluded_inbound_tags.split(",") if i] if row.excluded_inbound_tags else None,
-                    )
-                )
-
-            for proxy_type, rows in grouped_data.items():
-                inbounds = self.inbounds_by_protocol.get(proxy_type)
-                if not inbounds:
-                    continue
-
-                for inbound in inbounds:
-                    clients = config.get_inbound(inbound["tag"])["settings"]["clients"]
-
-                    for row in rows:
-                        user_id, username, settings, excluded_inbound_tags = row
-
-                        if excluded_inbound_tags and inbound["tag"] in excluded_inbound_tags:
-                            continue
-
-                        client = {"email": f"{user_id}.{username}", **settings}
-
-                        # XTLS currently only supports transmission methods of TCP and mKCP
-                        if client.get("flow") and (
-                            inbound.get("network", "tcp") not in ("tcp", "raw", "kcp")
-                            or (
-                                inbound.get("network", "tcp") in ("tcp", "raw", "kcp")
-                                and inbound.get("tls") not in ("tls", "reality")
-                            )
-                            or inbound.get("header_type") == "http"
-                        ):
-                            del client["flow"]
+        by_user = defaultdict(dict)
+        for row in result:
+            inbounds = self.inbounds_by_protocol.get(row.type)
+            if not inbounds:
+                continue
+            excluded_inbound_tags = set(row.excluded_inbound_tags.split(",")) if row.excluded_inbound_tags else ()
+            email = f"{row.id}.{row.username}"
+            clients = by_user[row.id]
+            for inbound in inbounds:
+                if inbound["tag"] not in excluded_inbound_tags:
+                    clients[inbound["tag"]] = build_client(inbound, email, row.settings)
+        return by_user.items()
+
+    def _clients_from_db(self) -> dict[str, tuple]:
+        """{tag: (client, ...)} прямо из БД, мимо client_cache."""
+        by_tag = defaultdict(list)
+        for _, clients in self._db_clients():
+            for tag, client in clients.items():
+                by_tag[tag].append(client)
+        return {tag: tuple(clients) for tag, clients in by_tag.items()}
+
+    def include_db_users(self, refresh: bool = False, bypass_cache: bool = False) -> XRayConfig:
+        """Копия конфига с клиентами из БД.
+
+        Клиенты берутся из client_cache (см. app/xray/client_cache.py); refresh=True —
+        перечитать БД (после массовых изменений юзеров в обход add/update/remove_user).
+        bypass_cache=True — собрать клиентов отдельным запросом, не трогая кэш: эталон
+        для сверки (reconcile_node_users), который не может разойтись с БД вместе с кэшем.
+        """
+        global _assembled
+
+        if bypass_cache:
+            clients_by_tag = self._clients_from_db()
+        else:
+            if refresh:
+                client_cache.invalidate()
+            clients_by_tag = client_cache.clients(self, self._db_clients)
 
-                        clients.append(client)
+        config = self.copy()
+        assembled = _assembled
+        if assembled is not None and assembled[0] is self and assembled[1] is clients_by_tag:
+            # клиенты не менялись — те же объекты инбаундов (и их JSON-фрагменты в config_json_cache)
+            config["inbounds"] = assembled[2]
+        else:
+            # копируются только инбаунды с клиентами; объекты клиентов общие с кэшем
+            inbounds = []
+            for inbound in self["inbounds"]:
+                clients = clients_by_tag.get(inbound["tag"])
+                if clients:
+                    settings = inbound["settings"]
+                    inbound = {**inbound, "settings": {**settings, "clients": (*settings["clients"], *clients)}}
+                inbounds.append(inbound)
+            config["inbounds"] = inbounds
+            if not bypass_cache:
+                _assembled = (self, clients_by_tag, inbounds)
 
         if DEBUG:
             with open("generated_config-debug.json", "w") as f:
@@ -0,0 +1,91 @@
+"""Сериализация конфигов xray с кэшем JSON-фрагментов инбаундов.
+
+Конфиги нод выводятся из одного базового (XRayConfig.copy — copy-on-write):
+инбаунды без изменений — это те же объекты, что в базовом конфиге, а
+strip_blocked_clients для одинакового набора заблокированных возвращает один и
+тот же пересобранный инбаунд. Поэтому тяжёлые инбаунды (с клиентами)
+сериализуются один раз и кэшируются по идентичности объекта; документ ноды
+склеивается из готовых фрагментов и json.dumps лёгких секций. При массовом
+переподключении 200 нод клиентов сериализуем O(users), а не O(nodes × users).
+
+Вывод побайтно совпадает с json.dumps(config). Без зависимостей от БД/окружения.
+"""
+
+from __future__ import annotations
+
+import json
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class JsonFragmentCache:
+    """LRU {id(inbound): (inbound, json)} с бюджетом по суммарной длине фрагментов.
+
+    Запись держит сам объект инбаунда — его id не переиспользуется, пока запись жива;
+    совпадение проверяется по `is`. max_bytes=0 — кэш выключен.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[int, tuple[dict, str]] = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def inbound_json(self, inbound: dict) -> str:
+        settings = inbound.get("settings")
+        if not self.max_bytes or not isinstance(settings, dict) or not settings.get("clients"):
+            return json.dumps(inbound)  # лёгкий инбаунд — кэшировать дороже, чем сериализовать
+        key = id(inbound)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is inbound:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        fragment = json.dumps(inbound)
+        with self._lock:
+            self.misses += 1
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old[1])
+            if len(fragment) <= self.max_bytes:
+                self._entries[key] = (inbound, fragment)
+                self._size += len(fragment)
+                while self._size > self.max_bytes:
+                    _, (_, evicted) = self._entries.popitem(last=False)
+                    self._size -= len(evicted)
+        return fragment
+
+    def pieces(self, config: dict) -> list[str]:
+        """Документ кусками: тяжёлые инбаунды — закэшированные объекты строк (по ним
+        config_transfer кэширует и их сжатые версии)."""
+        pieces = ["{"]
+        for i, (key, value) in enumerate(config.items()):
+            if i:
+                pieces.append(", ")
+            pieces.append(json.dumps(key))
+            pieces.append(": ")
+            if key == "inbounds" and isinstance(value, list | tuple):
+                pieces.append("[")
+                for j, inbound in enumerate(value):
+                    if j:
+                        pieces.append(", ")
+                    pieces.append(self.inbound_json(inbound))
+                pieces.append("]")
+            else:
+                pieces.append(json.dumps(value))
+        pieces.append("}")
+        return pieces
+
+    def dumps(self, config: dict) -> str:
+        # один join по всем кускам: документ ноды — десятки МБ, лишние склейки копируют его целиком
+        return "".join(self.pieces(config))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
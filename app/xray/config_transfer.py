@@ -0,0 +1,256 @@
+"""Передача конфига на REST-ноды: сжатое тело и патч от предыдущей версии.
+
+Прежний протокол (/start, /restart): {"session_id", "config": "<json-строка>"}
+— конфиг закодирован в JSON дважды и идёт несжатым на каждый connect/restart.
+Если нода в ответе /connect объявляет "config_transfer": {"encodings": [...],
+"patch": bool}, панель шлёт:
+
+- полный конфиг объектом: {"session_id", "config_format": "object",
+  "digest", "config": {...}};
+- или патч: {"session_id", "config_format": "patch", "patch": {"base", "target",
+  "config", "clients"}} — если нода запускала конфиг с digest == base. В
+  patch.config лежит конфиг без клиентов в инбаундах из patch.clients; их
+  клиенты = клиенты этого инбаунда из base без remove (по email) с заменой/
+  дописыванием upsert (apply_patch — эталон для ноды). Нода сверяет digest
+  результата с target и при несовпадении (или чужом base) отвечает 409 —
+  панель тут же шлёт полный конфиг.
+
+Тело сжимается (Content-Encoding: zstd — если установлен zstandard из extra
+compression — или gzip) как последовательность gzip-членов / zstd-фреймов: сжатые версии
+тяжёлых инбаундов кэшируются и переиспользуются для всех нод.
+
+digest — sha256 канонической формы конфига (ключи отсортированы, клиенты
+инбаунда — в отсортированном порядке): порядок клиентов xray не важен, и
+нода получает тот же digest после применения патча. Без зависимостей от
+БД/окружения.
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from collections.abc import Callable
+
+from app.xray.config_json import JsonFragmentCache
+
+try:
+    import zstandard
+except ImportError:  # необязательная зависимость — без неё только gzip
+    zstandard = None  # type: ignore[assignment]
+
+SUPPORTED_ENCODINGS = ("zstd", "gzip") if zstandard is not None else ("gzip",)
+PATCH_MISMATCH_STATUS = 409
+COMPRESS_PIECE_MIN = 64 * 1024
+_IDENTITY_CACHE_MAX = 256
+
+
+class _IdentityCache:
+    """LRU {id(obj): (obj, value)} — как в config_json: запись держит объект, совпадение по `is`."""
+
+    def __init__(self, max_entries: int = _IDENTITY_CACHE_MAX):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, obj, extra=None):
+        with self._lock:
+            entry = self._entries.get((id(obj), extra))
+            if entry is not None and entry[0] is obj:
+                self._entries.move_to_end((id(obj), extra))
+                return entry[1]
+        return None
+
+    def put(self, obj, value, extra=None):
+        with self._lock:
+            self._entries[(id(obj), extra)] = (obj, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+
+_digests = _IdentityCache()
+
+
+def _clients(inbound) -> list | tuple | None:
+    settings = inbound.get("settings") if inbound else None
+    return settings.get("clients") if isinstance(settings, dict) else None
+
+
+def _inbound_digest(inbound: dict) -> str:
+    clients = _clients(inbound)
+    if not clients:
+        return _sha256(json.dumps(inbound, sort_keys=True))
+    digest = _digests.get(inbound)
+    if digest is None:
+        canonical_clients = sorted(json.dumps(c, sort_keys=True) for c in clients)
+        canonical = {**inbound, "settings": {**inbound["settings"], "clients": canonical_clients}}
+        digest = _digests.put(inbound, _sha256(json.dumps(canonical, sort_keys=True)))
+    return digest
+
+
+def _sha256(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def config_digest(config: dict) -> str:
+    """sha256 канонической формы конфига; клиенты инбаунда — как множество."""
+    parts = []
+    for key in sorted(config):
+        value = config[key]
+        if key == "inbounds" and isinstance(value, list | tuple):
+            value_digest = "[" + ",".join(_inbound_digest(inbound) for inbound in value) + "]"
+        else:
+            value_digest = json.dumps(value, sort_keys=True)
+        parts.append(f"{json.dumps(key)}:{value_digest}")
+    return _sha256("\n".join(parts))
+
+
+def build_patch(base: dict, target: dict, max_ratio: float = 0.5) -> dict | None:
+    """Патч base → target или None, если он не выгоднее полного конфига.
+
+    Инбаунд идёт патчем, если он с тем же tag был в base и у всех клиентов
+    обоих есть email; остальные инбаунды — целиком в patch.config.
+    """
+    base_inbounds = {inbound.get("tag"): inbound for inbound in base.get("inbounds") or []}
+    inbounds, clients_patch = [], {}
+    total = changed = 0
+    for inbound in target.get("inbounds") or []:
+        clients = _clients(inbound)
+        old_clients = _clients(base_inbounds.get(inbound.get("tag")))
+        if not clients or old_clients is None or not all("email" in c for c in (*clients, *old_clients)):
+            inbounds.append(inbound)
+            continue
+        old_by_email = {c["email"]: c for c in old_clients}
+        upsert = []
+        for client in clients:
+            old = old_by_email.get(client["email"])
+            # объекты клиентов общие с кэшем клиентов — обычно хватает `is`
+            if old is not client and old != client:
+                upsert.append(client)
+        emails = {c["email"] for c in clients}
+        remove = [email for email in old_by_email if email not in emails]
+        inbounds.append({**inbound, "settings": {**inbound["settings"], "clients": []}})
+        clients_patch[inbound["tag"]] = {"remove": remove, "upsert": upsert}
+        total += len(clients)
+        changed += len(upsert) + len(remove)
+    if not clients_patch or changed > max_ratio * total:
+        return None
+    return {
+        "base": config_digest(base),
+        "target": config_digest(target),
+        "config": {**target, "inbounds": inbounds},
+        "clients": clients_patch,
+    }
+
+
+def apply_patch(base: dict, patch: dict) -> dict:
+    """Эталонное применение патча (сторона ноды): → конфиг с digest == patch["target"]."""
+    base_inbounds = {inbound.get("tag"): inbound for inbound in base.get("inbounds") or []}
+    inbounds = []
+    for inbound in patch["config"]["inbounds"]:
+        change = patch["clients"].get(inbound.get("tag"))
+        if change is not None:
+            removed = set(change["remove"])
+            upsert = {c["email"]: c for c in change["upsert"]}
+            clients = []
+            for client in _clients(base_inbounds[inbound["tag"]]) or ():
+                if client["email"] in removed:
+                    continue
+                clients.append(upsert.pop(client["email"], client))
+            clients.extend(upsert.values())
+            inbound = {**inbound, "settings": {**inbound["settings"], "clients": clients}}
+        inbounds.append(inbound)
+    return {**patch["config"], "inbounds": inbounds}
+
+
+def _compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return gzip.compress(data, compresslevel=5, mtime=0)
+
+
+def decompress(body: bytes, encoding: str | None) -> bytes:
+    """Разжать тело из нескольких gzip-членов / zstd-фреймов (сторона ноды и тесты)."""
+    if encoding == "gzip":
+        return gzip.decompress(body)
+    if encoding == "zstd":
+        reader = zstandard.ZstdDecompressor().stream_reader(body, read_across_frames=True)
+        return reader.read()
+    return body
+
+
+class ConfigTransfer:
+    """Отправка конфига одной ноде; помнит последний успешно отправленный (digest, config).
+
+    post(path, body: bytes, headers: dict, timeout) → (status_code, data).
+    """
+
+    def __init__(self, post: Callable, fragments: JsonFragmentCache, patch_max_ratio: float = 0.5):
+        self.post = post
+        self.fragments = fragments
+        self.patch_max_ratio = patch_max_ratio
+        self.capabilities: dict | None = None
+        self._sent: tuple[str, dict] | None = None
+        self._compressed = _IdentityCache()
+
+    def set_capabilities(self, capabilities: dict | None) -> None:
+        """Возможности из ответа /connect; None — нода знает только прежний протокол."""
+        self.capabilities = capabilities if isinstance(capabilities, dict) else None
+
+    def forget(self) -> None:
+        self._sent = None
+
+    @property
+    def encoding(self) -> str | None:
+        encodings = (self.capabilities or {}).get("encodings") or ()
+        return next((e for e in SUPPORTED_ENCODINGS if e in encodings), None)
+
+    def _encode(self, pieces: list[str], encoding: str | None) -> bytes:
+        if encoding is None:
+            return "".join(pieces).encode()
+        out, run = [], []
+        for piece in pieces:
+            if len(piece) < COMPRESS_PIECE_MIN:
+                run.append(piece)
+                continue
+            if run:
+                out.append(_compress("".join(run).encode(), encoding))
+                run = []
+            compressed = self._compressed.get(piece, encoding)
+            if compressed is None:
+                compressed = self._compressed.put(piece, _compress(piece.encode(), encoding), encoding)
+            out.append(compressed)
+        if run:
+            out.append(_compress("".join(run).encode(), encoding))
+        return b"".join(out)
+
+    def _post(self, path: str, pieces: list[str], timeout) -> tuple[int, dict]:
+        encoding = self.encoding
+        headers = {"Content-Type": "application/json"}
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        return self.post(path, self._encode(pieces, encoding), headers, timeout)
+
+    def send(self, path: str, session_id, config: dict, timeout) -> tuple[int, dict]:
+        if self.capabilities is None:
+            body = {"session_id": session_id, "config": self.fragments.dumps(config)}
+            return self.post(path, json.dumps(body).encode(), {"Content-Type": "application/json"}, timeout)
+
+        digest = config_digest(config)
+        if self._sent is not None and self.capabilities.get("patch"):
+            patch = build_patch(self._sent[1], config, self.patch_max_ratio)
+            if patch is not None:
+                body = {"session_id": session_id, "config_format": "patch", "patch": patch}
+                status, data = self._post(path, [json.dumps(body)], timeout)
+                if status != PATCH_MISMATCH_STATUS:
+                    self._sent = (digest, config) if status == 200 else None
+                    return status, data
+
+        head = json.dumps({"session_id": session_id, "config_format": "object", "digest": digest})
+        pieces = [head[:-1] + ', "config": ', *self.fragments.pieces(config), "}"]
+        status, data = self._post(path, pieces, timeout)
+        self._sent = (digest, config) if status == 200 else None
+        return status, data
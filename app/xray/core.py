@@ -111,7 +111,8 @@ class XRayCore:
             config = self.inbound_filter(config)
 
         if config.get("log", {}).get("logLevel") in ("none", "error"):
-            config["log"]["logLevel"] = "warning"
+            config = config.copy()
+            config["log"] = {**config["log"], "logLevel": "warning"}
 
         cmd = [self.executable_path, "run", "-config", "stdin:"]
         self.process = subprocess.Popen(
@@ -0,0 +1,190 @@
+"""Долгоживущие gRPC-каналы к xray-инстансам: один мультиплексированный канал на адресата.
+
+ReSTXRayNode._setup_api открывал новый secure channel на каждый start/restart,
+а wait_for_grpc_ready — ещё и на каждую попытку ожидания. Каналы gRPC
+потокобезопасны и мультиплексируют вызовы, поэтому здесь канал на адресата
+(адрес, порт, сертификат, target name) один и живёт между переподключениями
+ноды:
+
+- ChannelPool.acquire/release ведут счётчик владельцев; канал без владельцев
+  закрывается, если не понадобился за idle_ttl;
+- состояние каждого канала отслеживается (channel.subscribe); закрытый
+  (SHUTDOWN) канал при следующем обращении пересоздаётся, переподключение после
+  обрыва gRPC делает сам с бэкоффом не дольше max_reconnect_backoff;
+- ChannelLease — канал одного владельца (ноды): смена адресата (новый
+  сертификат) отпускает прежний.
+
+Keepalive: сервер API xray — grpc-go с политикой по умолчанию (MinTime 5 мин,
+пинги без активных вызовов запрещены) и рвёт соединение с GOAWAY
+too_many_pings, если пинговать чаще. Поэтому keepalive_time не меньше 5 минут
+и только при активных вызовах. Без зависимостей от БД/окружения.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections.abc import Callable
+
+import grpc
+
+MIN_KEEPALIVE_TIME = 300
+DEFAULT_IDLE_TTL = 600
+
+
+def channel_key(address: str, port: int, ssl_cert: bytes | None = None, ssl_target_name: str | None = None) -> tuple:
+    return (address, port, ssl_cert, ssl_target_name)
+
+
+def channel_options(
+    ssl_target_name: str | None = None, keepalive_time: float = MIN_KEEPALIVE_TIME, max_reconnect_backoff: float = 10
+) -> tuple:
+    options: tuple[tuple[str, int | str], ...] = (
+        ("grpc.keepalive_time_ms", int(max(MIN_KEEPALIVE_TIME, keepalive_time) * 1000)),
+        ("grpc.keepalive_timeout_ms", 20_000),
+        ("grpc.keepalive_permit_without_calls", 0),
+        ("grpc.initial_reconnect_backoff_ms", 1_000),
+        ("grpc.max_reconnect_backoff_ms", int(max_reconnect_backoff * 1000)),
+    )
+    if ssl_target_name:
+        options += (("grpc.ssl_target_name_override", ssl_target_name),)
+    return options
+
+
+def new_channel(key: tuple, options: tuple) -> grpc.Channel:
+    address, port, ssl_cert, _ = key
+    target = f"{address}:{port}"
+    if ssl_cert is None:
+        return grpc.insecure_channel(target, options=options)
+    creds = grpc.ssl_channel_credentials(root_certificates=ssl_cert)
+    return grpc.secure_channel(target, credentials=creds, options=options)
+
+
+class _Entry:
+    __slots__ = ("channel", "state", "refs", "idle_since")
+
+    def __init__(self, channel: grpc.Channel):
+        self.channel = channel
+        self.state: grpc.ChannelConnectivity | None = None
+        self.refs = 0
+        self.idle_since: float | None = None
+
+
+class ChannelPool:
+    def __init__(
+        self,
+        keepalive_time: float = MIN_KEEPALIVE_TIME,
+        max_reconnect_backoff: float = 10,
+        idle_ttl: float = DEFAULT_IDLE_TTL,
+        factory: Callable[[tuple, tuple], grpc.Channel] = new_channel,
+    ):
+        self.keepalive_time = keepalive_time
+        self.max_reconnect_backoff = max_reconnect_backoff
+        self.idle_ttl = idle_ttl
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._entries: dict[tuple, _Entry] = {}
+
+    def _watch(self, key: tuple, entry: _Entry) -> None:
+        def on_state(state):
+            entry.state = state
+            if state == grpc.ChannelConnectivity.SHUTDOWN:
+                with self._lock:
+                    if self._entries.get(key) is entry:
+                        del self._entries[key]
+
+        entry.channel.subscribe(on_state, try_to_connect=False)
+
+    def _entry_unlocked(self, key: tuple) -> _Entry:
+        entry = self._entries.get(key)
+        if entry is None or entry.state == grpc.ChannelConnectivity.SHUTDOWN:
+            options = channel_options(key[3], self.keepalive_time, self.max_reconnect_backoff)
+            refs = entry.refs if entry else 0
+            entry = self._entries[key] = _Entry(self.factory(key, options))
+            entry.refs = refs
+            self._watch(key, entry)
+        return entry
+
+    def get(self, key: tuple) -> grpc.Channel:
+        """Живой канал адресата (без учёта владельцев) — создаётся при необходимости."""
+        with self._lock:
+            return self._entry_unlocked(key).channel
+
+    def acquire(self, key: tuple) -> grpc.Channel:
+        with self._lock:
+            expired = self._sweep_unlocked()
+            entry = self._entry_unlocked(key)
+            entry.refs += 1
+            entry.idle_since = None
+        for channel in expired:
+            _close(channel)
+        return entry.channel
+
+    def release(self, key: tuple) -> None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.refs <= 0:
+                return
+            entry.refs -= 1
+            if not entry.refs:
+                entry.idle_since = time.monotonic()
+
+    def state(self, key: tuple) -> grpc.ChannelConnectivity | None:
+        entry = self._entries.get(key)
+        return entry.state if entry else None
+
+    def _sweep_unlocked(self) -> list[grpc.Channel]:
+        deadline = time.monotonic() - self.idle_ttl
+        expired = []
+        for key, entry in list(self._entries.items()):
+            if not entry.refs and entry.idle_since is not None and entry.idle_since < deadline:
+                del self._entries[key]
+                expired.append(entry.channel)
+        return expired
+
+    def close(self, key: tuple) -> None:
+        """Закрыть канал сразу (например, адресат точно недоступен); следующий get создаст новый."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None:
+            _close(entry.channel)
+
+    def close_all(self) -> None:
+        with self._lock:
+            entries, self._entries = list(self._entries.values()), {}
+        for entry in entries:
+            _close(entry.channel)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def _close(channel) -> None:
+    try:
+        channel.close()
+    except Exception:
+        pass
+
+
+class ChannelLease:
+    """Канал пула у одного владельца: не больше одного адресата одновременно."""
+
+    def __init__(self, pool: ChannelPool):
+        self.pool = pool
+        self.key: tuple | None = None
+        self._lock = threading.Lock()
+
+    def channel(self, key: tuple) -> grpc.Channel:
+        with self._lock:
+            if key == self.key:
+                return self.pool.get(key)
+            if self.key is not None:
+                self.pool.release(self.key)
+            self.key = key
+            return self.pool.acquire(key)
+
+    def release(self) -> None:
+        with self._lock:
+            if self.key is not None:
+                self.pool.release(self.key)
+                self.key = None
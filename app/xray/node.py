@@ -1,26 +1,33 @@
+import asyncio
+import os
 import re
 import socket
 import ssl
 import tempfile
 import threading
 import time
-from collections import deque
+from collections import OrderedDict, deque
 from contextlib import contextmanager
 
 import grpc
-import requests
 import rpyc
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.poolmanager import PoolManager
 from websocket import WebSocketConnectionClosedException, WebSocketTimeoutException, create_connection
 
 from app.models.node import NodeProtocol
-from app.xray.config import XRayConfig
+from app.xray.config import XRayConfig, config_json_cache
+from app.xray.config_transfer import ConfigTransfer
+from app.xray.grpc_channels import ChannelLease, ChannelPool, channel_key
+from app.xray.node_client import AsyncNodeClient, NodeAPIError, run_sync
 from config import (
+    XRAY_GRPC_KEEPALIVE_TIME,
+    XRAY_GRPC_MAX_RECONNECT_BACKOFF,
     XRAY_NODE_CERT_FETCH_TIMEOUT,
+    XRAY_NODE_CONFIG_PATCH_MAX_RATIO,
+    XRAY_NODE_CONFIG_TRANSFER,
     XRAY_NODE_GRPC_READY_RETRIES,
     XRAY_NODE_GRPC_READY_RETRY_DELAY,
     XRAY_NODE_GRPC_READY_TIMEOUT,
+    XRAY_NODE_HTTP2,
     XRAY_NODE_REST_CONNECT_TIMEOUT,
     XRAY_NODE_REST_DISCONNECT_TIMEOUT,
     XRAY_NODE_REST_INFO_TIMEOUT,
@@ -30,6 +37,81 @@ from config import (
     XRAY_NODE_REST_STOP_TIMEOUT,
 )
 from xray_api import XRay as XRayAPI
+from xray_api import exc as xray_exc
+
+
+def _read_lines(path: str) -> list[str]:
+    with open(path) as file:
+        return [line.strip() for line in file.readlines()]
+
+
+def _certificate_files(certificates) -> tuple:
+    return tuple(
+        (path, os.path.getmtime(path))
+        for certificate in certificates
+        for path in (certificate.get("certificateFile"), certificate.get("keyFile"))
+        if path
+    )
+
+
+# id(inbound) → (inbound, (файл, mtime)..., инбаунд с подставленными сертификатами): один
+# и тот же объект для всех нод — JSON-фрагмент инбаунда сериализуется один раз (config_json)
+_INLINED_MAX = 64
+_inlined: OrderedDict = OrderedDict()
+_inlined_lock = threading.Lock()
+
+
+def _inline_inbound(inbound: dict, certificates: list) -> dict:
+    files = _certificate_files(certificates)
+    key = id(inbound)
+    with _inlined_lock:
+        entry = _inlined.get(key)
+        if entry is not None and entry[0] is inbound and entry[1] == files:
+            return entry[2]
+    new_certificates = []
+    for certificate in certificates:
+        certificate = dict(certificate)
+        if certificate.get("certificateFile"):
+            certificate["certificate"] = _read_lines(certificate.pop("certificateFile"))
+        if certificate.get("keyFile"):
+            certificate["key"] = _read_lines(certificate.pop("keyFile"))
+        new_certificates.append(certificate)
+    streamSettings = inbound["streamSettings"]
+    new_inbound = {
+        **inbound,
+        "streamSettings": {
+            **streamSettings,
+            "tlsSettings": {**streamSettings["tlsSettings"], "certificates": new_certificates},
+        },
+    }
+    with _inlined_lock:
+        _inlined[key] = (inbound, files, new_inbound)
+        while len(_inlined) > _INLINED_MAX:
+            _inlined.popitem(last=False)
+    return new_inbound
+
+
+def inline_certificate_files(config: XRayConfig) -> XRayConfig:
+    """Подставить содержимое certificateFile/keyFile в TLS-сертификаты инбаундов (файлов на ноде нет).
+
+    Конфиг copy-on-write (XRayConfig.copy): затронутые инбаунды пересобираются
+    копиями, вход не мутируется. Файлы перечитываются при смене mtime.
+    """
+    inbounds = []
+    changed = False
+    for inbound in config.get("inbounds", []):
+        streamSettings = inbound.get("streamSettings") or {}
+        tlsSettings = streamSettings.get("tlsSettings") or {}
+        certificates = tlsSettings.get("certificates") or []
+        if any(c.get("certificateFile") or c.get("keyFile") for c in certificates):
+            inbound = _inline_inbound(inbound, certificates)
+            changed = True
+        inbounds.append(inbound)
+    if not changed:
+        return config
+    config = config.copy()
+    config["inbounds"] = inbounds
+    return config
 
 
 def string_to_temp_file(content: str):
@@ -39,24 +121,10 @@ def string_to_temp_file(content: str):
     return file
 
 
-class SANIgnoringAdaptor(HTTPAdapter):
-    def init_poolmanager(self, connections, maxsize, block=False):
-        self.poolmanager = PoolManager(num_pools=connections, maxsize=maxsize, block=block, assert_hostname=False)
-
-
-class NodeAPIError(Exception):
-    def __init__(self, status_code, detail):
-        self.status_code = status_code
-        self.detail = detail
-
-
-def _safe_close_grpc_channel(channel) -> None:
-    if channel is None:
-        return
-    try:
-        channel.close()
-    except Exception:
-        pass
+# один долгоживущий канал на адресата (main core и ноды) — см. app/xray/grpc_channels.py
+channel_pool = ChannelPool(
+    keepalive_time=XRAY_GRPC_KEEPALIVE_TIME, max_reconnect_backoff=XRAY_GRPC_MAX_RECONNECT_BACKOFF
+)
 
 
 def wait_for_grpc_ready(
@@ -64,26 +132,31 @@ def wait_for_grpc_ready(
     port: int,
     ssl_cert: bytes,
     ssl_target_name: str = "Gozargah",
+    lease: ChannelLease | None = None,
 ) -> XRayAPI:
     retries = max(1, XRAY_NODE_GRPC_READY_RETRIES)
     timeout = max(1, XRAY_NODE_GRPC_READY_TIMEOUT)
     retry_delay = max(0, XRAY_NODE_GRPC_READY_RETRY_DELAY)
     last_exc = None
+    key = channel_key(address, port, ssl_cert, ssl_target_name)
 
     for attempt in range(1, retries + 1):
-        api = XRayAPI(
-            address=address,
-            port=port,
-            ssl_cert=ssl_cert,
-            ssl_target_name=ssl_target_name,
-        )
+        # канал пула переживает неудачные попытки: переподключается сам gRPC
+        channel = lease.channel(key) if lease is not None else channel_pool.get(key)
+        ready = grpc.channel_ready_future(channel)
         try:
-            grpc.channel_ready_future(api._channel).result(timeout=timeout)
-            return api
+            ready.result(timeout=timeout)
+            return XRayAPI(
+                address=address,
+                port=port,
+                ssl_cert=ssl_cert,
+                ssl_target_name=ssl_target_name,
+                channel=channel,
+            )
         except (grpc.FutureTimeoutError, grpc.FutureCancelledError, ValueError) as exc:
             last_exc = exc
-            # Stop orphaned connectivity polling threads before the next attempt.
-            _safe_close_grpc_channel(api._channel)
+            # Stop orphaned connectivity polling of the ready future before the next attempt.
+            ready.cancel()
             if attempt < retries and retry_delay:
                 time.sleep(retry_delay)
 
@@ -122,43 +195,42 @@ class ReSTXRayNode:
         self._keyfile = string_to_temp_file(ssl_key)
         self._certfile = string_to_temp_file(ssl_cert)
 
-        self.session = requests.Session()
-        self.session.mount("https://", SANIgnoringAdaptor())
-        self.session.cert = (self._certfile.name, self._keyfile.name)
-
         self._session_id = None
         self._rest_api_url = f"https://{self.address.strip('/')}:{self.port}"
+        self._client = AsyncNodeClient(
+            self._rest_api_url, cert=(self._certfile.name, self._keyfile.name), http2=XRAY_NODE_HTTP2
+        )
 
         self._ssl_context = ssl.create_default_context()
         self._ssl_context.check_hostname = False
         self._ssl_context.verify_mode = ssl.CERT_NONE
-        self._ssl_context.load_cert_chain(certfile=self.session.cert[0], keyfile=self.session.cert[1])
+        self._ssl_context.load_cert_chain(certfile=self._certfile.name, keyfile=self._keyfile.name)
         self._logs_ws_url = f"wss://{self.address.strip('/')}:{self.port}/logs"
         self._logs_queues = []
         self._logs_bg_thread = threading.Thread(target=self._bg_fetch_logs, daemon=True)
 
         self._api = None
+        self._grpc_lease = ChannelLease(channel_pool)
         self._started = False
         self._grpc_lock = threading.Lock()
+        self._config_transfer = ConfigTransfer(
+            self._post_body, config_json_cache, patch_max_ratio=XRAY_NODE_CONFIG_PATCH_MAX_RATIO
+        )
 
     def _recreate_session(self):
         try:
-            self.session.close()
+            self._client.reset()
         except Exception:
             pass
-        self.session = requests.Session()
-        self.session.mount("https://", SANIgnoringAdaptor())
-        self.session.cert = (self._certfile.name, self._keyfile.name)
 
     def _discard_grpc_api_unlocked(self):
         self._api = None
 
     def _close_grpc_api_unlocked(self):
-        api = self._api
+        # канал не закрываем: он в пуле и пригодится при переподключении (без владельцев
+        # пул закроет его сам через idle_ttl)
         self._api = None
-        if api is None:
-            return
-        _safe_close_grpc_channel(getattr(api, "_channel", None))
+        self._grpc_lease.release()
 
     def _close_grpc_api(self):
         with self._grpc_lock:
@@ -183,67 +255,72 @@ class ReSTXRayNode:
         self._node_certfile = None
         self._session_id = None
         self._started = False
+        self._config_transfer.set_capabilities(None)
+        self._config_transfer.forget()
         if recreate_session:
             self._recreate_session()
 
     def _prepare_config(self, config: XRayConfig):
-        for inbound in config.get("inbounds", []):
-            streamSettings = inbound.get("streamSettings") or {}
-            tlsSettings = streamSettings.get("tlsSettings") or {}
-            certificates = tlsSettings.get("certificates") or []
-            for certificate in certificates:
-                if certificate.get("certificateFile"):
-                    with open(certificate["certificateFile"]) as file:
-                        certificate["certificate"] = [line.strip() for line in file.readlines()]
-                        del certificate["certificateFile"]
-
-                if certificate.get("keyFile"):
-                    with open(certificate["keyFile"]) as file:
-                        certificate["key"] = [line.strip() for line in file.readlines()]
-                        del certificate["keyFile"]
+        return inline_certificate_files(config)
 
-        return config
+    async def arequest(self, path: str, timeout: int, **params):
+        status, data = await self._client.post(path, timeout, json={"session_id": self._session_id, **params})
+        if status == 200:
+            return data
+        raise NodeAPIError(status, data.get("detail") if isinstance(data, dict) else data)
 
     def make_request(self, path: str, timeout: int, **params):
-        try:
-            req_timeout = max(1, int(timeout))
-            connect_timeout = min(10, req_timeout)
-            res = self.session.post(
-                self._rest_api_url + path,
-                timeout=(connect_timeout, req_timeout),
-                json={"session_id": self._session_id, **params},
-            )
-            data = res.json()
-        except Exception as e:
-            exc = NodeAPIError(0, str(e))
-            raise exc
+        return run_sync(self.arequest(path, timeout, **params))
 
-        if res.status_code == 200:
-            return data
-        else:
-            exc = NodeAPIError(res.status_code, data["detail"])
-            raise exc
+    def _post_body(self, path: str, body: bytes, headers: dict, timeout: int):
+        return run_sync(self._client.post(path, timeout, content=body, headers=headers))
 
-    @property
-    def connected(self):
+    def _send_config(self, path: str, config: XRayConfig, timeout: int):
+        status, data = self._config_transfer.send(path, self._session_id, config, timeout)
+        if status != 200:
+            raise NodeAPIError(status, data.get("detail") if isinstance(data, dict) else data)
+        return data
+
+    async def aconnected(self):
         if not self._session_id:
             return False
         try:
-            self.make_request("/ping", timeout=XRAY_NODE_REST_PING_TIMEOUT)
+            await self.arequest("/ping", timeout=XRAY_NODE_REST_PING_TIMEOUT)
             return True
         except NodeAPIError:
             self._reset_local_state()
             return False
 
     @property
-    def started(self):
-        res = self.make_request("/", timeout=XRAY_NODE_REST_INFO_TIMEOUT)
+    def connected(self):
+        return run_sync(self.aconnected())
+
+    async def astarted(self):
+        res = await self.arequest("/", timeout=XRAY_NODE_REST_INFO_TIMEOUT)
         remote_started = res.get("started", False)
         self._started = remote_started
         if not remote_started:
             self._close_grpc_api()
         return remote_started
 
+    @property
+    def started(self):
+        return run_sync(self.astarted())
+
+    async def aprobe(self) -> str:
+        """Проверка для core_health_check без блокировки event loop — см. probe_health."""
+        if not await self.aconnected():
+            return "disconnected"
+        try:
+            # Must hit the node REST API (GET /), not cached _started — ping alone
+            # does not prove Xray is running (e.g. OOM killed the core).
+            if not await self.astarted():
+                return "stopped"
+            await asyncio.to_thread(self.api.get_sys_stats, timeout=2)
+        except (ConnectionError, NodeAPIError, xray_exc.XrayError):
+            return "stopped"
+        return "ok"
+
     @property
     def api(self):
         if not self._session_id:
@@ -251,11 +328,13 @@ class ReSTXRayNode:
 
         if not self._api:
             if self._started is True:
+                ssl_cert = self._node_cert.encode()
                 self._api = XRayAPI(
                     address=self.address,
                     port=self.api_port,
-                    ssl_cert=self._node_cert.encode(),
+                    ssl_cert=ssl_cert,
                     ssl_target_name="Gozargah",
+                    channel=self._grpc_lease.channel(channel_key(self.address, self.api_port, ssl_cert, "Gozargah")),
                 )
             else:
                 raise ConnectionError("Node is not started")
@@ -267,6 +346,7 @@ class ReSTXRayNode:
             self.address,
             self.api_port,
             self._node_cert.encode(),
+            lease=self._grpc_lease,
         )
         with self._grpc_lock:
             self._discard_grpc_api_unlocked()
@@ -283,10 +363,12 @@ class ReSTXRayNode:
         self._close_temp_file(getattr(self, "_node_certfile", None))
         self._node_cert = fetch_server_certificate(self.address, self.port, XRAY_NODE_CERT_FETCH_TIMEOUT)
         self._node_certfile = string_to_temp_file(self._node_cert)
-        self.session.verify = self._node_certfile.name
+        self._client.set_verify(self._node_certfile.name)
 
         res = self.make_request("/connect", timeout=XRAY_NODE_REST_CONNECT_TIMEOUT)
         self._session_id = res["session_id"]
+        if XRAY_NODE_CONFIG_TRANSFER:
+            self._config_transfer.set_capabilities(res.get("config_transfer"))
 
     def disconnect(self):
         try:
@@ -320,10 +402,9 @@ class ReSTXRayNode:
             pass
 
         config = self._prepare_config(config)
-        json_config = config.to_json()
 
         try:
-            res = self.make_request("/start", timeout=XRAY_NODE_REST_START_TIMEOUT, config=json_config)
+            res = self._send_config("/start", config, XRAY_NODE_REST_START_TIMEOUT)
         except NodeAPIError as exc:
             if exc.detail == "Xray is started already":
                 self._started = True
@@ -350,9 +431,7 @@ class ReSTXRayNode:
             self.connect()
 
         config = self._prepare_config(config)
-        json_config = config.to_json()
-
-        res = self.make_request("/restart", timeout=XRAY_NODE_REST_RESTART_TIMEOUT, config=json_config)
+        res = self._send_config("/restart", config, XRAY_NODE_REST_RESTART_TIMEOUT)
 
         self._started = True
         self._setup_api()
@@ -363,7 +442,7 @@ class ReSTXRayNode:
         while self._logs_queues:
             try:
                 websocket_url = f"{self._logs_ws_url}?session_id={self._session_id}&interval=0.7"
-                self._ssl_context.load_verify_locations(self.session.verify)
+                self._ssl_context.load_verify_locations(self._node_certfile.name)
                 ws = create_connection(websocket_url, sslopt={"context": self._ssl_context}, timeout=2)
                 while self._logs_queues:
                     try:
@@ -447,6 +526,7 @@ class RPyCXRayNode:
 
         self._service = Service()
         self._api = None
+        self._grpc_lease = ChannelLease(channel_pool)
 
     def disconnect(self):
         try:
@@ -454,6 +534,7 @@ class RPyCXRayNode:
             del self.connection
         except AttributeError:
             pass
+        self._grpc_lease.release()
 
     def connect(self):
         self.disconnect()
@@ -510,22 +591,7 @@ class RPyCXRayNode:
         return self.remote.fetch_xray_version()
 
     def _prepare_config(self, config: XRayConfig):
-        for inbound in config.get("inbounds", []):
-            streamSettings = inbound.get("streamSettings") or {}
-            tlsSettings = streamSettings.get("tlsSettings") or {}
-            certificates = tlsSettings.get("certificates") or []
-            for certificate in certificates:
-                if certificate.get("certificateFile"):
-                    with open(certificate["certificateFile"]) as file:
-                        certificate["certificate"] = [line.strip() for line in file.readlines()]
-                        del certificate["certificateFile"]
-
-                if certificate.get("keyFile"):
-                    with open(certificate["keyFile"]) as file:
-                        certificate["key"] = [line.strip() for line in file.readlines()]
-                        del certificate["keyFile"]
-
-        return config
+        return inline_certificate_files(config)
 
     def start(self, config: XRayConfig):
         config = self._prepare_config(config)
@@ -539,6 +605,7 @@ class RPyCXRayNode:
                 self.address,
                 self.api_port,
                 self._node_cert.encode(),
+                lease=self._grpc_lease,
             )
         except ConnectionError:
             start_time = time.time()
@@ -646,3 +713,26 @@ class XRayNode:
             )
 
         raise ValueError(f"Unsupported node protocol: {protocol}")
+
+
+def _probe_sync(node) -> str:
+    if not node.connected:
+        return "disconnected"
+    try:
+        if not node.started:
+            return "stopped"
+        node.api.get_sys_stats(timeout=2)
+    except (ConnectionError, NodeAPIError, xray_exc.XrayError):
+        return "stopped"
+    return "ok"
+
+
+async def probe_health(node) -> str:
+    """Проверка ноды для core_health_check: "ok", "disconnected" (нет сессии) или "stopped" (ядро не работает).
+
+    REST-ноды проверяются на node_loop без блокировки, остальные — в пуле потоков.
+    """
+    aprobe = getattr(node, "aprobe", None)
+    if aprobe is not None:
+        return await aprobe()
+    return await asyncio.to_thread(_probe_sync, node)
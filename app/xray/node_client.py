@@ -0,0 +1,205 @@
+"""Асинхронный клиент REST API ноды и общий event loop для него.
+
+ReSTXRayNode делал каждый запрос блокирующим requests.Session.post, а
+core_health_check обходил ноды последовательно: одна зависшая нода держала
+тик на таймаутах своих запросов, 200 нод — минуты. Здесь:
+
+- AsyncNodeClient — клиент одной ноды: httpx.AsyncClient с keep-alive и
+  HTTP/2 по XRAY_NODE_HTTP2. httpx и h2 — extra node-http2 в pyproject.toml
+  (`uv sync --extra node-http2`); без httpx — прежний requests.Session в пуле
+  потоков, API тот же, а включённый без h2 HTTP/2 — предупреждение в лог;
+- все клиенты живут на одном фоновом event loop (node_loop); синхронный API
+  ReSTXRayNode — тонкая обёртка run_sync(coro);
+- gather_bounded — конкурентный обход нод с ограничением параллелизма.
+
+Без зависимостей от БД/окружения.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import logging
+import ssl
+import threading
+from collections.abc import Awaitable, Coroutine, Iterable
+from typing import Any, TypeVar
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.poolmanager import PoolManager
+
+try:
+    import httpx
+except ImportError:  # необязательная зависимость — без неё requests в пуле потоков
+    httpx = None  # type: ignore[assignment]
+
+try:
+    import h2  # noqa: F401
+except ImportError:
+    HTTP2_AVAILABLE = False
+else:
+    HTTP2_AVAILABLE = httpx is not None
+
+logger = logging.getLogger("uvicorn.error")
+
+T = TypeVar("T")
+
+
+@functools.cache
+def _warn_http2_unavailable() -> None:
+    logger.warning("XRAY_NODE_HTTP2 is on but httpx/h2 are not installed (extra node-http2), using HTTP/1.1")
+
+
+class NodeAPIError(Exception):
+    def __init__(self, status_code, detail):
+        self.status_code = status_code
+        self.detail = detail
+
+
+class SANIgnoringAdaptor(HTTPAdapter):
+    def init_poolmanager(self, connections, maxsize, block=False):
+        self.poolmanager = PoolManager(num_pools=connections, maxsize=maxsize, block=block, assert_hostname=False)
+
+
+class _LoopThread:
+    """Event loop в daemon-потоке; создаётся при первом обращении."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="node-client-loop", daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def run(self, coro: Coroutine[Any, Any, T], timeout: float | None = None) -> T:
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("run_sync called from the node client loop; await the coroutine instead")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def submit(self, coro: Coroutine[Any, Any, Any]) -> None:
+        asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+node_loop = _LoopThread()
+
+
+def run_sync(coro: Coroutine[Any, Any, T], timeout: float | None = None) -> T:
+    """Выполнить корутину на node_loop и дождаться результата (из обычного потока)."""
+    return node_loop.run(coro, timeout)
+
+
+async def gather_bounded(aws: Iterable[Awaitable], limit: int) -> list:
+    """asyncio.gather не более чем по limit одновременно; исключения возвращаются в результатах."""
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def bounded(aw):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*(bounded(aw) for aw in aws), return_exceptions=True)
+
+
+def _ssl_context(cert: tuple[str, str] | None, verify: str | None) -> ssl.SSLContext:
+    context = ssl.create_default_context(cafile=verify)
+    # как SANIgnoringAdaptor: самоподписанный сертификат ноды выписан не на её адрес
+    context.check_hostname = False
+    if cert:
+        context.load_cert_chain(certfile=cert[0], keyfile=cert[1])
+    return context
+
+
+class AsyncNodeClient:
+    """POST-запросы к REST API одной ноды → (status_code, json).
+
+    cert — (certfile, keyfile) клиента, verify — файл сертификата ноды. Сетевые
+    ошибки и не-JSON ответы — NodeAPIError(0, ...), как у прежнего make_request.
+    """
+
+    def __init__(
+        self, base_url: str, cert: tuple[str, str] | None = None, http2: bool = False, max_connections: int = 4
+    ):
+        self.base_url = base_url
+        self.cert = cert
+        self.verify: str | None = None
+        if http2 and not HTTP2_AVAILABLE:
+            _warn_http2_unavailable()
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self.max_connections = max_connections
+        self._client: httpx.AsyncClient | requests.Session | None = None
+
+    def set_verify(self, verify: str | None) -> None:
+        self.verify = verify
+        self.reset()
+
+    def reset(self) -> None:
+        """Закрыть соединения; следующий запрос откроет новые."""
+        client, self._client = self._client, None
+        if client is None:
+            return
+        if isinstance(client, requests.Session):
+            client.close()
+        else:
+            node_loop.submit(client.aclose())
+
+    def _new_client(self) -> httpx.AsyncClient | requests.Session:
+        if httpx is not None:
+            verify = _ssl_context(self.cert, self.verify) if self.base_url.startswith("https") else False
+            return httpx.AsyncClient(
+                base_url=self.base_url,
+                http2=self.http2,
+                verify=verify,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections, max_keepalive_connections=self.max_connections
+                ),
+            )
+        session = requests.Session()
+        session.mount("https://", SANIgnoringAdaptor())
+        session.cert = self.cert
+        if self.verify:
+            session.verify = self.verify
+        return session
+
+    async def post(
+        self,
+        path: str,
+        timeout: float,
+        *,
+        json: Any = None,
+        content: bytes | None = None,
+        headers: dict | None = None,
+    ) -> tuple[int, Any]:
+        client = self._client
+        if client is None:
+            client = self._client = self._new_client()
+        req_timeout = max(1, int(timeout))
+        connect_timeout = min(10, req_timeout)
+        try:
+            if isinstance(client, requests.Session):
+                res = await asyncio.to_thread(
+                    client.post,
+                    self.base_url + path,
+                    json=json,
+                    data=content,
+                    headers=headers,
+                    timeout=(connect_timeout, req_timeout),
+                )
+                return res.status_code, res.json()
+            response = await client.post(
+                path,
+                json=json,
+                content=content,
+                headers=headers,
+                timeout=httpx.Timeout(req_timeout, connect=connect_timeout),
+            )
+            return response.status_code, response.json()
+        except Exception as e:
+            raise NodeAPIError(0, str(e)) from e
@@ -0,0 +1,181 @@
+"""Реестр живости нод: состояние обновляет фоновый пробер, вызывающие читают за O(1).
+
+Раньше каждый путь сам решал, жива ли нода: _get_ready_nodes смотрел на
+приватные флаги, а restart_node, record_usages, роутеры — дёргали сетевое
+node.connected прямо в запросе. Теперь ноды опрашивает один пробер
+(app/jobs/probe_nodes.py, probe_all) с фиксированным интервалом, а
+вызывающие читают результат здесь.
+
+Состояние по результату проверки (probe_health: "ok"/"stopped"/"disconnected"):
+    "ok"                        → ready (degraded, если RTT > slow_rtt)
+    "stopped" / "disconnected"  → down сразу: ядро не работает или нет сессии
+    исключение проверки         → degraded, down после down_after подряд
+
+События operations (подключение, рестарт, ошибка, удаление ноды) обновляют
+состояние сразу, не дожидаясь пробера. Без зависимостей от БД/окружения.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections.abc import Awaitable, Callable, Iterable
+from dataclasses import dataclass, replace
+
+logger = logging.getLogger("uvicorn.error")
+
+READY = "ready"
+DEGRADED = "degraded"
+DOWN = "down"
+STATES = (READY, DEGRADED, DOWN)
+
+
+@dataclass(frozen=True)
+class NodeHealth:
+    node_id: int
+    state: str
+    # есть ли сессия с нодой — по нему решается connect vs restart
+    connected: bool
+    rtt: float | None = None
+    last_error: str | None = None
+    consecutive_failures: int = 0
+    checked_at: float | None = None
+
+
+class NodeHealthRegistry:
+    def __init__(self, down_after: int = 3, slow_rtt: float = 0):
+        self.down_after = max(1, down_after)
+        self.slow_rtt = slow_rtt
+        self._lock = threading.Lock()
+        self._nodes: dict[int, NodeHealth] = {}
+
+    def get(self, node_id: int) -> NodeHealth | None:
+        return self._nodes.get(node_id)
+
+    def state(self, node_id: int) -> str | None:
+        health = self._nodes.get(node_id)
+        return health.state if health else None
+
+    def connected(self, node_id: int) -> bool:
+        health = self._nodes.get(node_id)
+        return bool(health and health.connected)
+
+    def usable(self, node_id: int) -> bool:
+        """Ready или degraded: на ноду имеет смысл слать запросы."""
+        health = self._nodes.get(node_id)
+        return bool(health and health.connected and health.state != DOWN)
+
+    def down(self, node_id: int) -> bool:
+        health = self._nodes.get(node_id)
+        return bool(health and health.state == DOWN)
+
+    def snapshot(self) -> list[NodeHealth]:
+        with self._lock:
+            return list(self._nodes.values())
+
+    def record(self, node_id: int, result: str | BaseException, rtt: float | None = None) -> NodeHealth:
+        """Результат проверки probe_health (или её исключение) → новое состояние ноды."""
+        now = time.time()
+        with self._lock:
+            previous = self._nodes.get(node_id)
+            failures = previous.consecutive_failures if previous else 0
+            if result == "ok":
+                state = DEGRADED if self.slow_rtt and rtt is not None and rtt > self.slow_rtt else READY
+                health = NodeHealth(node_id, state, True, rtt, None, 0, now)
+            elif isinstance(result, BaseException):
+                failures += 1
+                health = NodeHealth(
+                    node_id,
+                    DEGRADED if failures < self.down_after else DOWN,
+                    previous.connected if previous else False,
+                    rtt,
+                    f"{type(result).__name__}: {result}",
+                    failures,
+                    now,
+                )
+            else:
+                error = "Xray core is not started on node" if result == "stopped" else "Node is not connected"
+                health = NodeHealth(node_id, DOWN, result != "disconnected", rtt, error, failures + 1, now)
+            self._nodes[node_id] = health
+        if previous is not None and previous.state != health.state:
+            logger.info(f"[node.health] node_id={node_id} {previous.state} → {health.state}: {health.last_error}")
+        return health
+
+    def mark_ready(self, node_id: int) -> None:
+        """Нода только что подключена/перезапущена."""
+        with self._lock:
+            previous = self._nodes.get(node_id)
+            rtt = previous.rtt if previous else None
+            self._nodes[node_id] = NodeHealth(node_id, READY, True, rtt, None, 0, time.time())
+
+    def mark_down(self, node_id: int, error: str | None = None) -> None:
+        with self._lock:
+            previous = self._nodes.get(node_id) or NodeHealth(node_id, DOWN, False)
+            self._nodes[node_id] = replace(
+                previous,
+                state=DOWN,
+                connected=False,
+                last_error=error,
+                consecutive_failures=previous.consecutive_failures + 1,
+                checked_at=time.time(),
+            )
+
+    def forget(self, node_id: int) -> None:
+        with self._lock:
+            self._nodes.pop(node_id, None)
+
+
+async def probe_all(
+    registry: NodeHealthRegistry,
+    nodes: Iterable[tuple[int, object]],
+    probe: Callable[[object], Awaitable[str]],
+    gather: Callable[[Iterable[Awaitable], int], Awaitable[list]],
+    limit: int,
+) -> None:
+    """Проверить ноды конкурентно (не более limit одновременно) и записать результаты в registry."""
+
+    async def probe_one(node_id, node):
+        started = time.monotonic()
+        try:
+            result = await probe(node)
+        except Exception as exc:
+            result = exc
+        registry.record(node_id, result, time.monotonic() - started)
+
+    await gather((probe_one(node_id, node) for node_id, node in nodes), limit)
+
+
+class NodeHealthCollector:
+    """Gauges реестра для /metrics — читаются при scrape, фоновой работы нет."""
+
+    def __init__(self, registry: NodeHealthRegistry):
+        self.registry = registry
+
+    def collect(self):
+        from prometheus_client.core import GaugeMetricFamily
+
+        state = GaugeMetricFamily("xray_node_state", "1 for the current liveness state", labels=["node_id", "state"])
+        rtt = GaugeMetricFamily("xray_node_probe_rtt_seconds", "Last health probe round trip", labels=["node_id"])
+        failures = GaugeMetricFamily(
+            "xray_node_consecutive_failures", "Failed health probes in a row", labels=["node_id"]
+        )
+        for health in self.registry.snapshot():
+            node_id = str(health.node_id)
+            for name in STATES:
+                state.add_metric([node_id, name], 1 if health.state == name else 0)
+            if health.rtt is not None:
+                rtt.add_metric([node_id], health.rtt)
+            failures.add_metric([node_id], health.consecutive_failures)
+        yield state
+        yield rtt
+        yield failures
+
+
+def register_metrics(registry: NodeHealthRegistry) -> None:
+    try:
+        from prometheus_client import REGISTRY
+
+        REGISTRY.register(NodeHealthCollector(registry))
+    except Exception as exc:
+        logger.warning("[metrics] failed to register node health collector: %s", exc)
@@ -0,0 +1,168 @@
+"""Желаемое vs отправленное состояние клиентов инбаундов на нодах.
+
+Для каждой ноды храним {tag: {email: fingerprint}} — что было успешно отправлено:
+полный снимок при старте/рестарте ноды (из её итогового конфига) плюс
+результаты отдельных AlterInbound-операций. Неудачная операция помечает пару
+(tag, email) как неизвестную (None) — реконсилятор её переотправит.
+
+Реконсилятор (app/jobs/reconcile_node_users.py) строит из БД желаемый конфиг
+ноды тем же конвейером, что и при старте, и отправляет через Proxyman только
+разницу — вместо полного рестарта ноды с include_db_users.
+
+fingerprint — crc32 канонического JSON клиента: компактно (int на клиента) и
+не зависит от порядка ключей. Без зависимостей от БД/окружения.
+"""
+
+from __future__ import annotations
+
+import json
+import threading
+import zlib
+
+from app.xray.user_ops import ALTER, REMOVE, UserOp
+
+
+def client_fingerprint(client: dict) -> int:
+    return zlib.crc32(json.dumps(client, sort_keys=True, separators=(",", ":"), default=str).encode())
+
+
+def config_fingerprints(config: dict, cache: dict | None = None) -> dict[str, dict[str, int]]:
+    """{tag: {email: fingerprint}} по всем инбаундам с клиентами.
+
+    cache — {id(client): fingerprint} на время одного прохода: конфиги нод
+    разделяют объекты клиентов базового конфига, считать их заново незачем.
+    """
+    result: dict[str, dict[str, int]] = {}
+    for inbound in config.get("inbounds") or []:
+        tag = inbound.get("tag")
+        clients = (inbound.get("settings") or {}).get("clients")
+        if not tag or clients is None:
+            continue
+        fingerprints = result[tag] = {}
+        for client in clients:
+            email = client.get("email")
+            if not email:
+                continue
+            if cache is None:
+                fingerprints[email] = client_fingerprint(client)
+                continue
+            key = id(client)
+            fp = cache.get(key)
+            if fp is None:
+                fp = cache[key] = client_fingerprint(client)
+            fingerprints[email] = fp
+    return result
+
+
+def config_clients(config: dict) -> dict[tuple[str, str], tuple[str, dict]]:
+    """{(tag, email): (protocol, client)} — для сборки Account при отправке разницы."""
+    result = {}
+    for inbound in config.get("inbounds") or []:
+        tag = inbound.get("tag")
+        for client in (inbound.get("settings") or {}).get("clients") or []:
+            if tag and client.get("email"):
+                result[(tag, client["email"])] = (inbound.get("protocol"), client)
+    return result
+
+
+def diff_state(desired: dict, pushed: dict) -> tuple[list[tuple[str, str]], list[tuple[str, str]]]:
+    """→ (to_push, to_remove) списками (tag, email).
+
+    to_push — нет на ноде, отпечаток отличается или неизвестен; to_remove — лишние.
+    Инбаунды, которых нет в желаемом конфиге, не трогаем: на ноде их нет вовсе.
+    """
+    to_push, to_remove = [], []
+    for tag, wanted in desired.items():
+        have = pushed.get(tag, {})
+        for email, fp in wanted.items():
+            if have.get(email) != fp:
+                to_push.append((tag, email))
+        for email in have:
+            if email not in wanted:
+                to_remove.append((tag, email))
+    return to_push, to_remove
+
+
+class PushedState:
+    """Потокобезопасный реестр отправленного состояния по нодам.
+
+    Каждая запись результата получает порядковый номер: реконсилятор берёт
+    mark() до чтения БД и не трогает пары, изменённые после — их желаемое
+    состояние в его снимке БД могло уже устареть.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._nodes: dict[int, dict[str, dict[str, int | None]]] = {}
+        self._changes: dict[int, dict[tuple[str, str], int]] = {}
+        self._seq = 0
+
+    def mark(self) -> int:
+        with self._lock:
+            return self._seq
+
+    def reset(self, node_id: int, fingerprints: dict) -> None:
+        """Полный снимок после успешного старта/рестарта ноды."""
+        with self._lock:
+            self._seq += 1
+            self._nodes[node_id] = {tag: dict(fps) for tag, fps in fingerprints.items()}
+            self._changes[node_id] = {}
+
+    def drop(self, node_id: int) -> None:
+        with self._lock:
+            self._seq += 1
+            self._nodes.pop(node_id, None)
+            self._changes.pop(node_id, None)
+
+    def changed_since(self, node_id: int, mark: int) -> set[tuple[str, str]]:
+        """(tag, email), по которым на ноду что-то отправлялось после mark."""
+        with self._lock:
+            return {key for key, seq in self._changes.get(node_id, {}).items() if seq > mark}
+
+    def known(self, node_id: int) -> bool:
+        with self._lock:
+            return node_id in self._nodes
+
+    def snapshot(self, node_id: int) -> dict:
+        with self._lock:
+            return {tag: dict(fps) for tag, fps in self._nodes.get(node_id, {}).items()}
+
+    def record(self, node_id: int, op: UserOp, ok: bool) -> None:
+        """Учесть результат операции; о нодах без снимка ничего не знаем — пропускаем."""
+        with self._lock:
+            state = self._nodes.get(node_id)
+            if state is None:
+                return
+            tag_state = state.get(op.tag)
+            if tag_state is None:
+                return  # инбаунда нет в конфиге ноды (фильтр инбаундов)
+            self._seq += 1
+            self._changes[node_id][(op.tag, op.email)] = self._seq
+            if not ok:
+                tag_state[op.email] = None
+            elif op.kind == REMOVE:
+                tag_state.pop(op.email, None)
+            else:
+                tag_state[op.email] = client_fingerprint(op.client) if op.client is not None else None
+
+
+def reconcile_ops(
+    desired_config: dict, pushed: dict, cache: dict | None = None, skip: set | None = None
+) -> list[UserOp]:
+    """Операции, приводящие pushed к desired_config; пары из skip не трогаем.
+
+    Account не собирается: у операции есть client и protocol, отправитель
+    строит Account сам и только для тех операций, что дойдут до ноды.
+    """
+    to_push, to_remove = diff_state(config_fingerprints(desired_config, cache), pushed)
+    if skip:
+        to_push = [key for key in to_push if key not in skip]
+        to_remove = [key for key in to_remove if key not in skip]
+    ops = [UserOp(REMOVE, tag, email) for tag, email in to_remove]
+    if to_push:
+        clients = config_clients(desired_config)
+        for tag, email in to_push:
+            protocol, client = clients[(tag, email)]
+            # alter (remove + add) безопасен при любом фактическом состоянии ноды
+            ops.append(UserOp(ALTER, tag, email, client=client, protocol=protocol))
+    return ops
@@ -1,24 +1,36 @@
 import threading
 import time
+from collections.abc import Iterable
 from functools import cache
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, cast
 
 from sqlalchemy.exc import SQLAlchemyError
 
 from app import logger, xray
 from app.db import GetDB, crud
 from app.models.node import NodeStatus
-from app.models.user import UserResponse
-from app.utils.concurrency import threaded_function
+from app.models.proxy import ProxyTypes
+from app.models.user import UserResponse, UserStatus
+from app.utils.concurrency import get_xray_executor, threaded_function
 from app.xray.bs_limit import strip_blocked_clients
 from app.xray.cascade_config import cascade_config
+from app.xray.client_cache import build_client
+from app.xray.config import client_cache
 from app.xray.inbound_filter import apply_inbound_filter
 from app.xray.node import XRayNode
+from app.xray.node_health import NodeHealthRegistry
+from app.xray.node_state import PushedState, config_fingerprints
+from app.xray.user_ops import ADD, ALTER, REMOVE, UserOp, UserOpDispatcher
+from app.xray.user_stream import stream_user_ops
 from config import (
     XRAY_NODE_CONNECT_RETRIES,
     XRAY_NODE_CONNECT_RETRY_DELAY,
     XRAY_NODE_CONNECT_STALE_TIMEOUT,
+    XRAY_NODE_DEGRADED_RTT_MS,
+    XRAY_NODE_DOWN_AFTER_FAILURES,
     XRAY_NODE_MAX_CONCURRENT_CONNECTS,
+    XRAY_USER_OPS_BATCH_WINDOW,
+    XRAY_USER_OPS_MAX_IN_FLIGHT,
 )
 from xray_api import XRay as XRayAPI
 from xray_api.types.account import Account, XTLSFlows
@@ -35,28 +47,38 @@ def _is_closed_grpc_channel_error(exc: Exception) -> bool:
     return "closed channel" in msg or "channel closed" in msg
 
 
-def _get_ready_nodes():
-    """Return nodes that look ready based on cached flags only — no network calls.
+def _node_looks_ready(node) -> bool:
+    try:
+        if hasattr(node, "_started"):
+            is_started = bool(getattr(node, "_started"))
+            has_session = bool(getattr(node, "_session_id", None))
+        elif hasattr(node, "started"):
+            is_started = bool(getattr(node, "started"))
+            has_session = True
+        else:
+            return False
+    except Exception:
+        return False
+    return is_started and has_session
+
+
+def _get_ready_nodes() -> list[tuple[int, "XRayNode"]]:
+    """Return (node_id, node) pairs that look ready based on cached flags only — no network calls.
 
     Network properties (`node.connected`, `node.started`) hit each node over HTTP and
     serialize the caller; one slow node × ~200 nodes can stall the starlette threadpool.
+    Nodes the background prober marked as down (node_health) are skipped too.
     """
-    ready = []
-    for node in list(xray.nodes.values()):
-        try:
-            if hasattr(node, "_started"):
-                is_started = bool(getattr(node, "_started"))
-                has_session = bool(getattr(node, "_session_id", None))
-            elif hasattr(node, "started"):
-                is_started = bool(getattr(node, "started"))
-                has_session = True
-            else:
-                continue
-        except Exception:
-            continue
-        if is_started and has_session:
-            ready.append(node)
-    return ready
+    return [
+        (node_id, node)
+        for node_id, node in list(xray.nodes.items())
+        if _node_looks_ready(node) and not node_health.down(node_id)
+    ]
+
+
+def _get_ready_node_ids() -> list[int]:
+    """То же, что _get_ready_nodes, но id нод — для очередей user_ops."""
+    return [node_id for node_id, _ in _get_ready_nodes()]
 
 
 @cache
@@ -76,9 +98,10 @@ def refresh_master_inbounds(db):
 
 
 @threaded_function
-def _add_user_to_inbound(api: XRayAPI, inbound_tag: str, account: Account):
+def _add_user_to_inbound(api: XRayAPI, inbound_tag: str, account: Account) -> bool:
     try:
         api.add_inbound_user(tag=inbound_tag, user=account, timeout=10)
+        return True
     except xray.exc.EmailNotFoundError as e:
         # User may be absent on this inbound/node; removal is idempotent.
         logger.debug(
@@ -97,17 +120,20 @@ def _add_user_to_inbound(api: XRayAPI, inbound_tag: str, account: Account):
             logger.error(
                 f"[xray.add_user.call][unexpected] inbound={inbound_tag} email={getattr(account, 'email', 'unknown')} error={type(e).__name__}: {e}"
             )
+    return False
 
 
 @threaded_function
-def _remove_user_from_inbound(api: XRayAPI, inbound_tag: str, email: str):
+def _remove_user_from_inbound(api: XRayAPI, inbound_tag: str, email: str) -> bool:
     try:
         api.remove_inbound_user(tag=inbound_tag, email=email, timeout=10)
+        return True
     except xray.exc.EmailNotFoundError as e:
         # User may be absent on this inbound/node; removal is idempotent.
         logger.debug(
             f"[xray.remove_user.call][error] inbound={inbound_tag} email={email} error={type(e).__name__}: {e}"
         )
+        return True
     except (xray.exc.ConnectionError, xray.exc.TimeoutError) as e:
         logger.warning(
             f"[xray.remove_user.call][error] inbound={inbound_tag} email={email} error={type(e).__name__}: {e}"
@@ -121,10 +147,11 @@ def _remove_user_from_inbound(api: XRayAPI, inbound_tag: str, email: str):
             logger.error(
                 f"[xray.remove_user.call][unexpected] inbound={inbound_tag} email={email} error={type(e).__name__}: {e}"
             )
+    return False
 
 
 @threaded_function
-def _alter_inbound_user(api: XRayAPI, inbound_tag: str, account: Account):
+def _alter_inbound_user(api: XRayAPI, inbound_tag: str, account: Account) -> bool:
     try:
         api.remove_inbound_user(tag=inbound_tag, email=account.email, timeout=10)
     except xray.exc.EmailNotFoundError as e:
@@ -147,6 +174,7 @@ def _alter_inbound_user(api: XRayAPI, inbound_tag: str, account: Account):
             )
     try:
         api.add_inbound_user(tag=inbound_tag, user=account, timeout=10)
+        return True
     except (xray.exc.EmailExistsError, xray.exc.ConnectionError, xray.exc.TimeoutError) as e:
         logger.warning(
             f"[xray.alter_user.call][error] step=add inbound={inbound_tag} email={account.email} error={type(e).__name__}: {e}"
@@ -160,19 +188,82 @@ def _alter_inbound_user(api: XRayAPI, inbound_tag: str, account: Account):
             logger.error(
                 f"[xray.alter_user.call][unexpected] step=add inbound={inbound_tag} email={account.email} error={type(e).__name__}: {e}"
             )
+    return False
 
 
-def add_user(dbuser: "DBUser"):
-    if dbuser is None:
-        logger.warning("[xray.add_user] called with dbuser=None; skipping")
-        return
-    user = UserResponse.model_validate(dbuser)
-    email = f"{dbuser.id}.{dbuser.username}"
+def _op_account(op: UserOp):
+    """Account операции; у операций реконсилятора он собирается из клиента конфига."""
+    if op.account is None and op.client is not None:
+        op.account = ProxyTypes(op.protocol).account_model(**op.client)
+    return op.account
 
-    t0 = time.monotonic()
-    ready_nodes = _get_ready_nodes()
-    total_nodes = len(xray.nodes)
 
+def _send_user_ops(node_id: int | None, ops: list[UserOp]):
+    """Отправить пачку операций одного инстанса подряд по его каналу (задача xray-pool)."""
+    if node_id is None:
+        api = xray.api
+    else:
+        node = xray.nodes.get(node_id)
+        if node is None:
+            return  # нода удалена — стартовый конфиг при connect соберётся из БД
+        try:
+            api = node.api
+        except Exception as e:
+            logger.warning(f"[xray.user_ops] node={node_id} api unavailable, {len(ops)} ops dropped: {e}")
+            for op in ops:
+                pushed_state.record(node_id, op, False)
+            return
+    if XRAY_USER_OPS_MAX_IN_FLIGHT > 1:
+        # add/remove — неблокирующими вызовами по каналу инстанса, alter — ниже по очереди
+        streamed = [op for op in ops if op.kind != ALTER]
+        ops = [op for op in ops if op.kind == ALTER]
+        if streamed:
+            results, errors = stream_user_ops(api, streamed, _op_account, XRAY_USER_OPS_MAX_IN_FLIGHT, timeout=10)
+            if errors:
+                logger.warning(
+                    f"[xray.user_ops] node={node_id} failed {sum(errors.values())}/{len(streamed)} ops: {dict(errors)}"
+                )
+            if node_id is not None:
+                for op, ok in zip(streamed, results):
+                    pushed_state.record(node_id, op, ok)
+    for op in ops:
+        if op.kind == ADD:
+            ok = _add_user_to_inbound.__wrapped__(api, op.tag, _op_account(op))
+        elif op.kind == ALTER:
+            ok = _alter_inbound_user.__wrapped__(api, op.tag, _op_account(op))
+        else:
+            ok = _remove_user_from_inbound.__wrapped__(api, op.tag, op.email)
+        if node_id is not None:
+            pushed_state.record(node_id, op, ok)
+
+
+# что успешно отправлено на каждую ноду — база для реконсилятора (jobs/reconcile_node_users)
+pushed_state = PushedState()
+# коллектор /metrics регистрируется на старте приложения (app/jobs/probe_nodes.py), не на импорте:
+# collect() пула БД держит REGISTRY._lock и импортирует app.db → crud → operations
+node_health = NodeHealthRegistry(down_after=XRAY_NODE_DOWN_AFTER_FAILURES, slow_rtt=XRAY_NODE_DEGRADED_RTT_MS / 1000)
+_user_ops = UserOpDispatcher(_send_user_ops, get_xray_executor().submit, XRAY_USER_OPS_BATCH_WINDOW)
+
+
+def flush_user_ops(timeout: float | None = None) -> bool:
+    return _user_ops.flush(timeout)
+
+
+def _enqueue_user_ops(ops: list[UserOp]) -> int:
+    """Поставить операции в очереди main core и всех готовых нод; → число нод."""
+    node_ids = _get_ready_node_ids()
+    _user_ops.enqueue(None, ops)  # main core
+    for node_id in node_ids:
+        _user_ops.enqueue(node_id, ops)
+    return len(node_ids)
+
+
+def _user_accounts(user: UserResponse, email: str):
+    """(inbound_tag, account, client) по всем инбаундам юзера, с поправкой flow под транспорт.
+
+    client — тот же клиент, что include_db_users кладёт в конфиг (build_client): по
+    нему ведутся кэш клиентов и учёт отправленного на ноды состояния (node_state).
+    """
     for proxy_type, inbound_tags in user.inbounds.items():
         for inbound_tag in inbound_tags:
             inbound = xray.config.inbounds_by_tag.get(inbound_tag, {})
@@ -180,29 +271,39 @@ def add_user(dbuser: "DBUser"):
             try:
                 proxy_settings = user.proxies[proxy_type].dict(no_obj=True)
             except KeyError:
-                pass
+                proxy_settings = {}
             account = proxy_type.account_model(email=email, **proxy_settings)
-
-            # XTLS currently only supports transmission methods of TCP and mKCP
-            if getattr(account, "flow", None) and (
-                inbound.get("network", "tcp") not in ("tcp", "kcp")
-                or (inbound.get("network", "tcp") in ("tcp", "kcp") and inbound.get("tls") not in ("tls", "reality"))
-                or inbound.get("header_type") == "http"
-            ):
+            client = build_client(inbound, email, proxy_settings)
+            if getattr(account, "flow", None) and "flow" not in client:
                 account.flow = XTLSFlows.NONE
 
-            _add_user_to_inbound(xray.api, inbound_tag, account)  # main core
-            for node in ready_nodes:
-                try:
-                    _add_user_to_inbound(node.api, inbound_tag, account)
-                except Exception as e:
-                    logger.warning(
-                        f'[xray.add_user] node call failed user="{dbuser.username}" '
-                        f'inbound="{inbound_tag}": {type(e).__name__}: {e}'
-                    )
+            yield inbound_tag, account, client
+
+
+def _cache_user_clients(dbuser: "DBUser", ops: list[UserOp]):
+    """Обновить кэш клиентов include_db_users по событию юзера."""
+    if dbuser.status in (UserStatus.active, UserStatus.on_hold):
+        client_cache.set_user(cast(int, dbuser.id), {op.tag: op.client for op in ops if op.kind != REMOVE})
+    else:
+        client_cache.remove_user(cast(int, dbuser.id))
+
+
+def add_user(dbuser: "DBUser"):
+    if dbuser is None:
+        logger.warning("[xray.add_user] called with dbuser=None; skipping")
+        return
+    user = UserResponse.model_validate(dbuser)
+    email = f"{dbuser.id}.{dbuser.username}"
+
+    t0 = time.monotonic()
+    ops = [
+        UserOp(ADD, inbound_tag, email, account, client) for inbound_tag, account, client in _user_accounts(user, email)
+    ]
+    _cache_user_clients(dbuser, ops)
+    nodes_ready = _enqueue_user_ops(ops)
     logger.info(
-        f"[xray.add_user] done email={email} nodes_ready={len(ready_nodes)} "
-        f"nodes_total={total_nodes} dt={time.monotonic() - t0:.2f}s"
+        f"[xray.add_user] queued email={email} ops={len(ops)} nodes_ready={nodes_ready} "
+        f"nodes_total={len(xray.nodes)} dt={time.monotonic() - t0:.2f}s"
     )
 
 
@@ -226,31 +327,38 @@ def remove_user(dbuser: "DBUser"):
     if not target_inbounds:
         target_inbounds = set(xray.config.inbounds_by_tag.keys())
 
-    try:
-        total_inbounds = len(xray.config.inbounds_by_tag)
-    except Exception:
-        total_inbounds = 0
-    try:
-        total_nodes = len(xray.nodes)
-    except Exception:
-        total_nodes = 0
+    ops = [UserOp(REMOVE, inbound_tag, email) for inbound_tag in target_inbounds]
+    client_cache.remove_user(cast(int, dbuser.id))
+    nodes_ready = _enqueue_user_ops(ops)
     logger.info(
-        f"[xray.remove_user] start email={email} target_inbounds={len(target_inbounds)} total_inbounds={total_inbounds} nodes={total_nodes}"
+        f"[xray.remove_user] queued email={email} target_inbounds={len(target_inbounds)} "
+        f"nodes_ready={nodes_ready} nodes_total={len(xray.nodes)}"
     )
 
-    ready_nodes = _get_ready_nodes()
-    logger.info(f"[xray.remove_user] nodes_ready={len(ready_nodes)} nodes_total={total_nodes}")
 
-    for inbound_tag in target_inbounds:
-        _remove_user_from_inbound(xray.api, inbound_tag, email)
-        for node in ready_nodes:
-            # Не допускаем падения при недоступной ноде
-            try:
-                _remove_user_from_inbound(node.api, inbound_tag, email)
-            except Exception as e:
-                logger.warning(
-                    f'XRAY node check/remove failed for user "{dbuser.username}" on inbound "{inbound_tag}": {type(e).__name__}: {e}'
-                )
+def remove_users(emails: Iterable[str]) -> int:
+    """Снять пачку юзеров со всех инстансов одной постановкой в очереди; → число операций.
+
+    Для массовых смен статуса (review): email — "{id}.{username}", инбаунды берутся
+    из кэша клиентов без UserResponse.model_validate по каждому юзеру, для
+    неизвестных кэшу — все инбаунды конфига (удаление отсутствующего идемпотентно).
+    """
+    t0 = time.monotonic()
+    all_tags = tuple(xray.config.inbounds_by_tag)
+    ops: list[UserOp] = []
+    users = 0
+    for email in emails:
+        user_id = int(email.split(".", 1)[0])
+        tags = client_cache.user_tags(user_id) or all_tags
+        client_cache.remove_user(user_id)
+        ops.extend(UserOp(REMOVE, tag, email) for tag in tags)
+        users += 1
+    nodes_ready = _enqueue_user_ops(ops)
+    logger.info(
+        f"[xray.remove_users] queued users={users} ops={len(ops)} nodes_ready={nodes_ready} "
+        f"nodes_total={len(xray.nodes)} dt={time.monotonic() - t0:.2f}s"
+    )
+    return len(ops)
 
 
 def update_user(dbuser: "DBUser"):
@@ -261,55 +369,18 @@ def update_user(dbuser: "DBUser"):
     email = f"{dbuser.id}.{dbuser.username}"
 
     t0 = time.monotonic()
-    ready_nodes = _get_ready_nodes()
-    total_nodes = len(xray.nodes)
-
-    active_inbounds = []
-    for proxy_type, inbound_tags in user.inbounds.items():
-        for inbound_tag in inbound_tags:
-            active_inbounds.append(inbound_tag)
-            inbound = xray.config.inbounds_by_tag.get(inbound_tag, {})
-
-            try:
-                proxy_settings = user.proxies[proxy_type].dict(no_obj=True)
-            except KeyError:
-                pass
-            account = proxy_type.account_model(email=email, **proxy_settings)
-
-            # XTLS currently only supports transmission methods of TCP and mKCP
-            if getattr(account, "flow", None) and (
-                inbound.get("network", "tcp") not in ("tcp", "kcp")
-                or (inbound.get("network", "tcp") in ("tcp", "kcp") and inbound.get("tls") not in ("tls", "reality"))
-                or inbound.get("header_type") == "http"
-            ):
-                account.flow = XTLSFlows.NONE
-
-            _alter_inbound_user(xray.api, inbound_tag, account)  # main core
-            for node in ready_nodes:
-                try:
-                    _alter_inbound_user(node.api, inbound_tag, account)
-                except Exception as e:
-                    logger.warning(
-                        f'[xray.update_user] node alter failed user="{dbuser.username}" '
-                        f'inbound="{inbound_tag}": {type(e).__name__}: {e}'
-                    )
-
-    for inbound_tag in xray.config.inbounds_by_tag:
-        if inbound_tag in active_inbounds:
-            continue
-        # remove disabled inbounds
-        _remove_user_from_inbound(xray.api, inbound_tag, email)
-        for node in ready_nodes:
-            try:
-                _remove_user_from_inbound(node.api, inbound_tag, email)
-            except Exception as e:
-                logger.warning(
-                    f"[xray.update_user] node remove (disabled inbound) failed "
-                    f'user="{dbuser.username}" inbound="{inbound_tag}": {type(e).__name__}: {e}'
-                )
+    ops = [
+        UserOp(ALTER, inbound_tag, email, account, client)
+        for inbound_tag, account, client in _user_accounts(user, email)
+    ]
+    active_inbounds = {op.tag for op in ops}
+    # remove disabled inbounds
+    ops += [UserOp(REMOVE, tag, email) for tag in xray.config.inbounds_by_tag if tag not in active_inbounds]
+    _cache_user_clients(dbuser, ops)
+    nodes_ready = _enqueue_user_ops(ops)
     logger.info(
-        f"[xray.update_user] done email={email} nodes_ready={len(ready_nodes)} "
-        f"nodes_total={total_nodes} dt={time.monotonic() - t0:.2f}s"
+        f"[xray.update_user] queued email={email} ops={len(ops)} nodes_ready={nodes_ready} "
+        f"nodes_total={len(xray.nodes)} dt={time.monotonic() - t0:.2f}s"
     )
 
 
@@ -342,20 +413,11 @@ def remove_user_from_node(dbuser: "DBUser", node_id: int):
     """Снять пользователя ТОЛЬКО с указанной ноды (по её API), не трогая остальные."""
     if dbuser is None:
         return
-    node = xray.nodes.get(node_id)
-    if node is None:
+    if node_id not in xray.nodes:
         return  # нода не подключена — фильтрация стартового конфига снимет её при connect
     email = f"{dbuser.id}.{dbuser.username}"
     user = UserResponse.model_validate(dbuser)
-    for inbound_tag in _user_inbound_tags(user):
-        try:
-            _remove_user_from_inbound(node.api, inbound_tag, email)
-        except Exception as e:
-            logger.warning(
-                f"[xray.remove_user_from_node] node={node_id} "
-                f'user="{dbuser.username}" inbound="{inbound_tag}": '
-                f"{type(e).__name__}: {e}"
-            )
+    _user_ops.enqueue(node_id, [UserOp(REMOVE, inbound_tag, email) for inbound_tag in _user_inbound_tags(user)])
     logger.info(f"[xray.remove_user_from_node] email={email} node_id={node_id}")
 
 
@@ -363,33 +425,14 @@ def add_user_to_node(dbuser: "DBUser", node_id: int):
     """Вернуть пользователя ТОЛЬКО на указанную ноду (по её API)."""
     if dbuser is None:
         return
-    node = xray.nodes.get(node_id)
-    if node is None:
+    if node_id not in xray.nodes:
         return
     email = f"{dbuser.id}.{dbuser.username}"
     user = UserResponse.model_validate(dbuser)
-    for proxy_type, inbound_tags in user.inbounds.items():
-        for inbound_tag in inbound_tags:
-            inbound = xray.config.inbounds_by_tag.get(inbound_tag, {})
-            try:
-                proxy_settings = user.proxies[proxy_type].dict(no_obj=True)
-            except KeyError:
-                proxy_settings = {}
-            account = proxy_type.account_model(email=email, **proxy_settings)
-            if getattr(account, "flow", None) and (
-                inbound.get("network", "tcp") not in ("tcp", "kcp")
-                or (inbound.get("network", "tcp") in ("tcp", "kcp") and inbound.get("tls") not in ("tls", "reality"))
-                or inbound.get("header_type") == "http"
-            ):
-                account.flow = XTLSFlows.NONE
-            try:
-                _add_user_to_inbound(node.api, inbound_tag, account)
-            except Exception as e:
-                logger.warning(
-                    f"[xray.add_user_to_node] node={node_id} "
-                    f'user="{dbuser.username}" inbound="{inbound_tag}": '
-                    f"{type(e).__name__}: {e}"
-                )
+    ops = [
+        UserOp(ADD, inbound_tag, email, account, client) for inbound_tag, account, client in _user_accounts(user, email)
+    ]
+    _user_ops.enqueue(node_id, ops)
     logger.info(f"[xray.add_user_to_node] email={email} node_id={node_id}")
 
 
@@ -481,7 +524,17 @@ def _node_specific_config(base_config, node_inbound_tags):
     return apply_inbound_filter(base_config, node_inbound_tags)
 
 
+def _build_node_config(config, node_inbound_tags, cascade_kwargs, blocked_user_ids):
+    """Итоговый конфиг ноды: фильтр инбаундов → каскад → снятие заблокированных юзеров."""
+    return strip_blocked_clients(
+        cascade_config(_node_specific_config(config, node_inbound_tags), **cascade_kwargs),
+        blocked_user_ids,
+    )
+
+
 def remove_node(node_id: int):
+    pushed_state.drop(node_id)
+    node_health.forget(node_id)
     if node_id in xray.nodes:
         try:
             xray.nodes[node_id].disconnect()
@@ -525,6 +578,10 @@ def _change_node_status(node_id: int, status: NodeStatus, message: str = None, v
                 return False
 
             crud.update_node_status(db, dbnode, status, message, version)
+            if status == NodeStatus.connected:
+                node_health.mark_ready(node_id)
+            elif status == NodeStatus.error:
+                node_health.mark_down(node_id, message)
             return True
         except SQLAlchemyError as exc:
             db.rollback()
@@ -645,17 +702,15 @@ def _connect_node_impl(node_id, config=None, force: bool = False):
         except KeyError:
             node = xray.operations.add_node(dbnode)
 
+        pushed_state.drop(node_id)
         for attempt in range(1, retries + 1):
             _connect_semaphore.acquire()
             try:
                 _cleanup_node_connection(node)
                 logger.info(f'Connecting to "{dbnode.name}" node (attempt {attempt}/{retries})')
-                node.start(
-                    strip_blocked_clients(
-                        cascade_config(_node_specific_config(config, node_inbound_tags), **cascade_kwargs),
-                        blocked_user_ids,
-                    )
-                )
+                node_config = _build_node_config(config, node_inbound_tags, cascade_kwargs, blocked_user_ids)
+                node.start(node_config)
+                pushed_state.reset(node_id, config_fingerprints(node_config))
                 version = node.get_version()
                 _change_node_status(node_id, NodeStatus.connected, version=version)
                 logger.info(f'Connected to "{dbnode.name}" node, xray run on v{version}')
@@ -727,7 +782,7 @@ def restart_node(node_id, config=None):
     except KeyError:
         node = xray.operations.add_node(dbnode)
 
-    if not node.connected:
+    if not node_health.connected(node_id):
         return connect_node(node_id, config)
 
     try:
@@ -736,12 +791,11 @@ def restart_node(node_id, config=None):
         if config is None:
             config = xray.config.include_db_users()
 
-        node.restart(
-            strip_blocked_clients(
-                cascade_config(_node_specific_config(config, node_inbound_tags), **cascade_kwargs),
-                blocked_user_ids,
-            )
-        )
+        node_config = _build_node_config(config, node_inbound_tags, cascade_kwargs, blocked_user_ids)
+        pushed_state.drop(node_id)
+        node.restart(node_config)
+        pushed_state.reset(node_id, config_fingerprints(node_config))
+        node_health.mark_ready(node_id)
         logger.info(f'Xray core of "{dbnode.name}" node restarted')
     except Exception as e:
         try:
@@ -0,0 +1,265 @@
+"""Асинхронный сбор статистики юзеров со всех xray-инстансов (grpc.aio).
+
+Синхронный путь (xray_api.Stats.query_stats в xray-pool) занимает по потоку на
+ноду на всё время RPC и разбирает каждую запись в StatResponse, а record_usages
+потом ещё раз режет имя по '.'. Здесь все ноды опрашиваются параллельно из
+одного event loop в собственном потоке, а ответ QueryStats сразу сворачивается
+в колонки array('q') uid/value — без объекта на каждую запись.
+
+grpc.aio-каналы привязаны к loop'у, поэтому живут в нём же и переиспользуются
+между тиками (ключ — адрес/порт/сертификат); каналы, не использованные дольше
+CHANNEL_IDLE_TTL (нода удалена или переподключилась с новым сертификатом),
+закрываются.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from array import array
+from collections.abc import Iterable
+
+import grpc
+
+from app.utils.usage_spool import NodeDelta, UsageTick, new_tick_id
+from app.xray.grpc_channels import channel_options
+from xray_api.exceptions import RelatedError, XrayError
+from xray_api.proto.app.stats.command import command_pb2, command_pb2_grpc
+
+logger = logging.getLogger("uvicorn.error")
+
+USER_PREFIX = "user>>>"
+CHANNEL_IDLE_TTL = 600
+COLLECT_GRACE = 5  # запас collect() сверх gRPC-дедлайна: gather ждёт самый медленный инстанс
+
+
+def parse_users_usage(stats: Iterable) -> tuple[array, array]:
+    """Записи QueryStats("user>>>") → колонки (uids, values).
+
+    Имя записи — user>>>{uid}.{username}>>>traffic>>>{uplink|downlink}; uplink и
+    downlink одного uid суммируются, нулевые и нечисловые uid пропускаются.
+    """
+    totals: dict[int, int] = {}
+    start = len(USER_PREFIX)
+    for stat in stats:
+        value = stat.value
+        if not value:
+            continue
+        name = stat.name
+        dot = name.find(".", start)
+        if dot < 0 or not name.startswith(USER_PREFIX):
+            continue
+        uid = name[start:dot]
+        if not uid.isdigit():
+            continue
+        uid = int(uid)
+        totals[uid] = totals.get(uid, 0) + value
+    return array("q", totals.keys()), array("q", totals.values())
+
+
+def columns_to_params(uids: array, values: array) -> list[dict]:
+    """Колонки → [{"uid", "value"}]; record_usages пишет в БД сами колонки (NodeDelta)."""
+    return [{"uid": uid, "value": value} for uid, value in zip(uids, values)]
+
+
+def _channel_key(api) -> tuple:
+    return (api.address, api.port, getattr(api, "ssl_cert", None), getattr(api, "ssl_target_name", None))
+
+
+class AsyncStatsCollector:
+    """Опрос QueryStats на многих инстансах из одного event loop.
+
+    collect() потокобезопасен и блокирует вызывающий поток (джоб APScheduler)
+    до ответа всех инстансов или их таймаутов; потоки xray-pool не занимаются.
+    Ответы пишутся в результат по мере прихода: сбой или зависание одной ноды
+    не обнуляет уже собранное с остальных (их счётчики уже сброшены).
+    """
+
+    def __init__(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="xray-stats-aio", daemon=True)
+        self._thread.start()
+        self._channels: dict[tuple, grpc.aio.Channel] = {}
+        self._last_used: dict[tuple, float] = {}
+
+    def _channel(self, key: tuple) -> grpc.aio.Channel:
+        self._last_used[key] = self._loop.time()
+        channel = self._channels.get(key)
+        if channel is None:
+            address, port, ssl_cert, ssl_target_name = key
+            target = f"{address}:{port}"
+            options = channel_options(ssl_target_name)
+            if ssl_cert is None:
+                channel = grpc.aio.insecure_channel(target, options=options)
+            else:
+                creds = grpc.ssl_channel_credentials(root_certificates=ssl_cert)
+                channel = grpc.aio.secure_channel(target, credentials=creds, options=options)
+            self._channels[key] = channel
+        return channel
+
+    async def _query(self, key: tuple, reset: bool, timeout: float) -> tuple[array, array]:
+        stub = command_pb2_grpc.StatsServiceStub(self._channel(key))
+        try:
+            response = await stub.QueryStats(
+                command_pb2.QueryStatsRequest(pattern=USER_PREFIX, reset=reset), timeout=timeout
+            )
+        except grpc.RpcError as e:
+            raise RelatedError(e)
+        return parse_users_usage(response.stat)
+
+    async def _collect_one(self, node_id, api, reset: bool, timeout: float, collected: dict):
+        try:
+            collected[node_id] = await self._query(_channel_key(api), reset, timeout)
+        except XrayError:
+            pass
+        except Exception as e:
+            logger.warning(f"[stats-aio] failed to collect stats for node {node_id}: {type(e).__name__}: {e}")
+
+    async def _collect(self, targets: dict, reset: bool, timeout: float, collected: dict):
+        await asyncio.gather(
+            *(self._collect_one(node_id, api, reset, timeout, collected) for node_id, api in targets.items())
+        )
+
+        idle_since = self._loop.time() - CHANNEL_IDLE_TTL
+        for key in [key for key, used in self._last_used.items() if used < idle_since]:
+            del self._last_used[key]
+            try:
+                await self._channels.pop(key).close()
+            except Exception as e:
+                logger.warning(f"[stats-aio] failed to close idle channel {key[0]}:{key[1]}: {e}")
+
+    def collect(self, targets: dict, reset: bool = True, timeout: float = 30) -> dict:
+        """{node_id: api} → {node_id: (uids, values) | None}; None — инстанс не ответил.
+
+        api — объект xray_api.XRay: берутся только его адрес и TLS-параметры.
+        Если опрос целиком не уложился в срок, возвращается то, что успели собрать.
+        """
+        if not targets:
+            return {}
+        # ключи заполнены заранее: loop только меняет значения, копия ниже безопасна
+        collected: dict = dict.fromkeys(targets)
+        future = asyncio.run_coroutine_threadsafe(self._collect(targets, reset, timeout, collected), self._loop)
+        try:
+            future.result(timeout=timeout + COLLECT_GRACE)
+        except Exception as e:
+            future.cancel()
+            missing = [node_id for node_id, columns in collected.items() if columns is None]
+            logger.error(
+                f"[stats-aio] stats collection aborted, nodes without result {missing}: {type(e).__name__}: {e}"
+            )
+        return dict(collected)
+
+    def close(self):
+        async def _close():
+            for channel in self._channels.values():
+                await channel.close()
+            self._channels.clear()
+            self._last_used.clear()
+
+        asyncio.run_coroutine_threadsafe(_close(), self._loop).result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+
+
+class NodeStatsPoller:
+    """По-нодный опрос статистики в loop'е коллектора: своя задача на каждую ноду.
+
+    Старт каждой задачи сдвинут на случайную долю интервала, период — с джиттером,
+    у каждого опроса свой дедлайн: медленная нода задерживает только себя.
+    Результаты копятся в UsageBuffer, который забирает record_user_usages.
+    Со spool каждый опрос сперва пишется в usage-спул удержанным тиком: счётчики
+    ноды уже сброшены, и до сброса буфера дельта не должна жить только в памяти.
+    """
+
+    def __init__(
+        self,
+        collector: AsyncStatsCollector,
+        buffer,
+        interval: float,
+        timeout: float,
+        jitter: float = 0.1,
+        spool=None,
+    ):
+        self.collector = collector
+        self.buffer = buffer
+        self.spool = spool
+        self.interval = max(0.1, interval)
+        self.timeout = max(0.1, min(timeout, self.interval))
+        self.jitter = jitter
+        self._tasks: dict = {}  # node_id → (channel key, asyncio.Task)
+        self._coefficients: dict = {}
+
+    def sync(self, targets: dict) -> None:
+        """{node_id: (api, usage_coefficient)} — актуальный набор опрашиваемых инстансов.
+
+        Задачи новых нод стартуют, пропавших (или сменивших адрес/сертификат) —
+        останавливаются. Потокобезопасно: работа выполняется в loop'е коллектора.
+        """
+        keys = {node_id: _channel_key(api) for node_id, (api, _) in targets.items()}
+        coefficients = {node_id: coefficient for node_id, (_, coefficient) in targets.items()}
+        future = asyncio.run_coroutine_threadsafe(self._sync(keys, coefficients), self.collector._loop)
+        future.result(timeout=5)
+
+    async def _sync(self, keys: dict, coefficients: dict):
+        self._coefficients = coefficients
+        for node_id, (key, task) in list(self._tasks.items()):
+            if keys.get(node_id) != key or task.done():
+                task.cancel()
+                del self._tasks[node_id]
+        for node_id, key in keys.items():
+            if node_id not in self._tasks:
+                self._tasks[node_id] = (key, asyncio.create_task(self._poll(node_id, key)))
+
+    async def _poll(self, node_id, key: tuple):
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(random.uniform(0, self.interval))
+        while True:
+            started = loop.time()
+            try:
+                uids, values = await self.collector._query(key, reset=True, timeout=self.timeout)
+            except XrayError:
+                pass
+            except Exception as e:
+                logger.warning(f"[stats-poll] failed to poll node {node_id}: {type(e).__name__}: {e}")
+            else:
+                coefficient = self._coefficients.get(node_id, 1)
+                if self.spool is None:
+                    self.buffer.add(node_id, coefficient, uids, values)
+                elif uids:
+                    # в потоке целиком: отмена задачи не разорвёт запись в спул и add()
+                    await asyncio.to_thread(self._store, node_id, coefficient, uids, values)
+            period = self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+            await asyncio.sleep(max(0.0, period - (loop.time() - started)))
+
+    def _store(self, node_id, coefficient: float, uids: array, values: array) -> None:
+        tick = UsageTick(new_tick_id(), time.time(), [NodeDelta(node_id, float(coefficient), uids, values)])
+        try:
+            self.spool.append(tick, hold=True)
+        except OSError as e:
+            logger.error(f"[stats-poll] usage spool write failed, node {node_id} delta kept in memory only: {e}")
+            self.buffer.add(node_id, coefficient, uids, values)
+            return
+        self.buffer.add(node_id, coefficient, uids, values, tick.tick_id)
+
+    def stop(self) -> None:
+        async def _stop():
+            for _, task in self._tasks.values():
+                task.cancel()
+            self._tasks.clear()
+
+        asyncio.run_coroutine_threadsafe(_stop(), self.collector._loop).result(timeout=5)
+
+
+_collector: AsyncStatsCollector | None = None
+_collector_lock = threading.Lock()
+
+
+def get_stats_collector() -> AsyncStatsCollector:
+    global _collector
+    with _collector_lock:
+        if _collector is None:
+            _collector = AsyncStatsCollector()
+        return _collector
@@ -0,0 +1,134 @@
+"""Очередь изменений юзеров на xray-инстансах с коалесцированием по окну.
+
+add_user/update_user/remove_user раньше отправляли по задаче в xray-pool на
+каждую пару (инбаунд × нода), а update_user — ещё и remove+add на каждую. Здесь
+операции копятся в очереди своего инстанса (main core или нода) в течение
+окна, повторы для одного (tag, email) схлопываются, и очередь целиком уходит
+одной задачей пула — вызовы идут подряд по одному каналу.
+
+Коалесцирование (pending, new) по (tag, email):
+    new = remove                     → remove
+    pending ∈ {remove, alter} или new = alter → alter (remove + add)
+    иначе (add, add)                 → add с последним account
+
+Сам отправитель (send) и пул (submit) передаются снаружи — модуль без
+зависимостей от окружения и тестируется как bs_limit/inbound_filter.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections.abc import Callable
+from dataclasses import dataclass
+
+logger = logging.getLogger("uvicorn.error")
+
+ADD = "add"
+REMOVE = "remove"
+ALTER = "alter"
+
+
+@dataclass
+class UserOp:
+    kind: str
+    tag: str
+    email: str
+    account: object = None
+    # клиент инбаунда в виде конфига xray — по нему учитывается отправленное состояние (node_state)
+    client: dict | None = None
+    protocol: str | None = None
+
+
+def merge_op(pending: UserOp | None, new: UserOp) -> UserOp:
+    if pending is None or new.kind == REMOVE:
+        return new
+    if pending.kind in (REMOVE, ALTER) or new.kind == ALTER:
+        return UserOp(ALTER, new.tag, new.email, new.account, new.client, new.protocol)
+    return new
+
+
+class UserOpDispatcher:
+    """Очереди операций по инстансам (target — node_id, None для main core).
+
+    send(target, ops) выполняется в пуле (submit) и не пересекается сам с собой
+    для одного target: пока очередь инстанса отправляется, новые операции копятся
+    и уходят следующей пачкой.
+    """
+
+    def __init__(self, send: Callable, submit: Callable, window: float):
+        self.send = send
+        self.submit = submit
+        self.window = window
+        self._cond = threading.Condition()
+        self._pending: dict = {}  # target → {(tag, email): UserOp}
+        self._due: dict = {}  # target → monotonic-время отправки
+        self._running: set = set()
+        self._thread: threading.Thread | None = None
+
+    def enqueue(self, target, ops: list[UserOp], overwrite: bool = True) -> None:
+        """overwrite=False — не трогать (tag, email), для которых в очереди уже есть операция.
+
+        Так ставит свои операции реконсилятор: ожидающая в очереди операция
+        новее его снимка БД.
+        """
+        if not ops:
+            return
+        with self._cond:
+            queue = self._pending.setdefault(target, {})
+            for op in ops:
+                key = (op.tag, op.email)
+                pending = queue.get(key)
+                if pending is not None and not overwrite:
+                    continue
+                queue[key] = merge_op(pending, op)
+            self._due.setdefault(target, time.monotonic() + self.window)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="xray-user-ops", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                waiting = {t: due for t, due in self._due.items() if t not in self._running}
+                ready = [t for t, due in waiting.items() if due <= now]
+                if not ready:
+                    self._cond.wait(min(waiting.values()) - now if waiting else None)
+                    continue
+                batches = []
+                for target in ready:
+                    del self._due[target]
+                    batches.append((target, list(self._pending.pop(target).values())))
+                    self._running.add(target)
+            for target, ops in batches:
+                try:
+                    self.submit(self._drain, target, ops)
+                except RuntimeError as e:  # пул уже остановлен (shutdown)
+                    logger.warning(f"[xray.user_ops] dropped target={target} ops={len(ops)}: {e}")
+                    with self._cond:
+                        self._running.discard(target)
+                        self._cond.notify_all()
+
+    def _drain(self, target, ops: list[UserOp]):
+        try:
+            self.send(target, ops)
+        except Exception as e:
+            logger.error(f"[xray.user_ops] send failed target={target} ops={len(ops)}: {type(e).__name__}: {e}")
+        finally:
+            with self._cond:
+                self._running.discard(target)
+                self._cond.notify_all()
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Дождаться отправки всего накопленного; False — не успели за timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._running:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
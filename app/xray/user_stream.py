@@ -0,0 +1,77 @@
+"""Потоковая отправка add/remove юзеров по одному каналу инстанса.
+
+Очередь инстанса (user_ops) раньше уходила блокирующими AlterInbound подряд:
+каждая операция ждала ответа, и пачка из тысяч удалений (review() в полночь)
+шла со скоростью RTT до ноды. Здесь вызовы идут неблокирующими future по тому
+же (общему, см. grpc_channels) каналу, и в полёте держится не больше limit RPC.
+
+Коалесцированная очередь содержит не больше одной операции на (tag, email),
+поэтому порядок между ними не важен. alter (remove + add одного email) сюда не
+попадает — его шаги должны идти по очереди. Ошибки не логируются поштучно, а
+считаются по типам: при массовом сбое (нода ушла) это одна строка, а не тысячи.
+Без зависимостей от БД/окружения.
+"""
+
+from __future__ import annotations
+
+import threading
+from collections import Counter
+from collections.abc import Callable
+
+import grpc
+
+from app.xray.user_ops import ADD, REMOVE, UserOp
+from xray_api.exceptions import EmailNotFoundError, RelatedError
+
+
+def _error(future: grpc.Future) -> BaseException | None:
+    try:
+        exc = future.exception()
+    except grpc.FutureCancelledError as e:
+        return e
+    if isinstance(exc, grpc.RpcError):
+        return RelatedError(exc)
+    return exc
+
+
+def stream_user_ops(
+    api, ops: list[UserOp], account_of: Callable[[UserOp], object], limit: int, timeout: float | None = None
+) -> tuple[list[bool], Counter]:
+    """Отправить add/remove из ops через api.alter_inbound_future, не более limit одновременно.
+
+    → (успех по каждой операции в порядке ops, число ошибок по имени типа).
+    Удаление отсутствующего email считается успехом, как и в последовательной
+    отправке.
+    """
+    slots = threading.BoundedSemaphore(max(1, limit))
+    sent: list[tuple[int, grpc.Future]] = []
+    ok = [False] * len(ops)
+    errors: Counter = Counter()
+
+    def release(_future):
+        slots.release()
+
+    for i, op in enumerate(ops):
+        slots.acquire()
+        try:
+            if op.kind == ADD:
+                operation = api.add_user_operation(account_of(op))
+            elif op.kind == REMOVE:
+                operation = api.remove_user_operation(op.email)
+            else:
+                raise ValueError(f"{op.kind} can not be streamed")
+            future = api.alter_inbound_future(op.tag, operation, timeout)
+        except Exception as e:
+            slots.release()
+            errors[type(e).__name__] += 1
+            continue
+        future.add_done_callback(release)
+        sent.append((i, future))
+
+    for i, future in sent:
+        error = _error(future)
+        if error is None or (ops[i].kind == REMOVE and isinstance(error, EmailNotFoundError)):
+            ok[i] = True
+        else:
+            errors[type(error).__name__] += 1
+    return ok, errors
@@ -36,6 +36,15 @@ XRAY_EXECUTABLE_PATH = config("XRAY_EXECUTABLE_PATH", default="/usr/local/bin/xr
 XRAY_ASSETS_PATH = config("XRAY_ASSETS_PATH", default="/usr/local/share/xray")
 XRAY_EXCLUDE_INBOUND_TAGS = config("XRAY_EXCLUDE_INBOUND_TAGS", default="").split()
 XRAY_THREAD_POOL_SIZE = config("XRAY_THREAD_POOL_SIZE", cast=int, default=20)
+# Окно (сек), в котором изменения юзеров копятся в очереди ноды и схлопываются перед отправкой
+XRAY_USER_OPS_BATCH_WINDOW = config("XRAY_USER_OPS_BATCH_WINDOW", cast=float, default=0.2)
+# Сколько add/remove одного инстанса держать в полёте по его каналу (1 — строго по очереди)
+XRAY_USER_OPS_MAX_IN_FLIGHT = config("XRAY_USER_OPS_MAX_IN_FLIGHT", cast=int, default=64)
+# Кэш клиентов include_db_users ведётся событиями юзеров; раз в столько секунд — полное перечитывание БД
+# (страховка от изменений в обход xray.operations). 0 — только по событиям и refresh
+XRAY_CLIENT_CACHE_MAX_AGE = config("XRAY_CLIENT_CACHE_MAX_AGE", cast=float, default=3600)
+# Бюджет (МБ) кэша JSON-фрагментов инбаундов с клиентами для конфигов нод; 0 — выключено
+XRAY_CONFIG_JSON_CACHE_MB = config("XRAY_CONFIG_JSON_CACHE_MB", cast=int, default=256)
 SYNC_INBOUNDS_MAX_CONCURRENCY = config("SYNC_INBOUNDS_MAX_CONCURRENCY", cast=int, default=8)
 SYNC_INBOUNDS_DB_CHUNK_SIZE = config("SYNC_INBOUNDS_DB_CHUNK_SIZE", cast=int, default=200)
 XRAY_SUBSCRIPTION_URL_PREFIX = config("XRAY_SUBSCRIPTION_URL_PREFIX", default="").strip("/")
@@ -57,6 +66,38 @@ SUBSCRIPTION_LEGACY_SECRET_KEYS = config(
     default="",
     cast=lambda v: [key.strip() for key in v.split(",") if key.strip()],
 )
+# Кэш снимков юзеров для /sub (app/subscription/user_cache.py): сколько юзеров держать и сколько
+# секунд снимок живёт без инвалидации (записи юзера через crud и джобы её делают сами). 0 — выключено
+SUB_USER_CACHE_SIZE = config("SUB_USER_CACHE_SIZE", cast=int, default=100000)
+SUB_USER_CACHE_TTL = config("SUB_USER_CACHE_TTL", cast=float, default=300)
+# Кэш отрендеренных подписок (app/subscription/render_cache.py): бюджет в МБ (0 — выключено, по умолчанию),
+# срок жизни тела в секундах и форматы, которые всегда рендерятся заново (свежие соли SNI/host на каждый запрос)
+SUB_RENDER_CACHE_MB = config("SUB_RENDER_CACHE_MB", cast=int, default=0)
+SUB_RENDER_CACHE_TTL = config("SUB_RENDER_CACHE_TTL", cast=float, default=300)
+SUB_RENDER_CACHE_FRESH_FORMATS = config(
+    "SUB_RENDER_CACHE_FRESH_FORMATS",
+    default="",
+    cast=lambda v: [f.strip() for f in v.split(",") if f.strip()],
+)
+# ETag для /sub (app/subscription/etag.py): сколько секунд живёт валидатор (0 — выключено, по умолчанию) —
+# предел устаревания DAYS_LEFT/TIME_LEFT в ремарках для клиента, получающего 304. SUB_ETAG_STABLE_RANDOM —
+# соли SNI/host детерминированы валидатором, ETag получают и форматы из SUB_RENDER_CACHE_FRESH_FORMATS
+SUB_ETAG_TTL = config("SUB_ETAG_TTL", cast=float, default=0)
+SUB_ETAG_STABLE_RANDOM = config("SUB_ETAG_STABLE_RANDOM", cast=bool, default=False)
+# Сжатие тел /sub по Accept-Encoding (app/subscription/compression.py): кодировки в порядке предпочтения
+# (br и zstd — из extra compression, недоступные пишутся в лог на старте; пусто — выключено), порог размера тела
+# в байтах и бюджет CPU на сжатие — доля одного ядра (0 — выключено); сжатые варианты тел хранятся в кэше рендера
+SUB_COMPRESS_ENCODINGS = config(
+    "SUB_COMPRESS_ENCODINGS",
+    default="br,zstd,gzip",
+    cast=lambda v: [e.strip().lower() for e in v.split(",") if e.strip()],
+)
+SUB_COMPRESS_MIN_BYTES = config("SUB_COMPRESS_MIN_BYTES", cast=int, default=1024)
+SUB_COMPRESS_CPU_BUDGET = config("SUB_COMPRESS_CPU_BUDGET", cast=float, default=0.5)
+# Вид известных устройств для отложенной записи визитов /sub (app/subscription/write_behind.py): сколько пар
+# (юзер, hwid) держать и сколько секунд доверять им без проверки по БД; 0 — каждое устройство проверяется по БД
+SUB_KNOWN_DEVICES_SIZE = config("SUB_KNOWN_DEVICES_SIZE", cast=int, default=200000)
+SUB_KNOWN_DEVICES_TTL = config("SUB_KNOWN_DEVICES_TTL", cast=float, default=300)
 
 CUSTOM_TEMPLATES_DIRECTORY = config("CUSTOM_TEMPLATES_DIRECTORY", default=None)
 SUBSCRIPTION_PAGE_TEMPLATE = config("SUBSCRIPTION_PAGE_TEMPLATE", default="subscription/index.html")
@@ -139,7 +180,29 @@ NOTIFY_DAYS_LEFT = config(
 
 DISABLE_RECORDING_NODE_USAGE = config("DISABLE_RECORDING_NODE_USAGE", cast=bool, default=False)
 DISABLE_RECORDING_NODE_USER_USAGE = config("DISABLE_RECORDING_NODE_USER_USAGE", cast=bool, default=False)
+# Часовые строки node_user_usages хранятся столько дней (0 — всегда); старше — только дневные/месячные агрегаты
 NODE_USER_USAGE_RETENTION_DAYS = config("NODE_USER_USAGE_RETENTION_DAYS", cast=int, default=0)
+# Дневные агрегаты (node_user_usages_daily) — столько дней, дальше месячные; 0 — всегда
+NODE_USER_USAGE_DAILY_RETENTION_DAYS = config("NODE_USER_USAGE_DAILY_RETENTION_DAYS", cast=int, default=0)
+# День сворачивается в агрегат, когда закрыт не меньше стольких часов (запас на реплей спула тиков)
+NODE_USER_USAGE_ROLLUP_LAG_HOURS = config("NODE_USER_USAGE_ROLLUP_LAG_HOURS", cast=int, default=3)
+# node_user_usages всех нод тика — одной транзакцией (False — по сессии на ноду, как раньше)
+NODE_USER_USAGE_BATCH_WRITE = config("NODE_USER_USAGE_BATCH_WRITE", cast=bool, default=True)
+# Максимум строк в одном upsert-выражении учёта трафика
+USAGE_UPSERT_MAX_ROWS = config("USAGE_UPSERT_MAX_ROWS", cast=int, default=1000)
+# Сбор статистики юзеров со всех нод из одного grpc.aio event loop (False — потоками xray-pool)
+XRAY_STATS_ASYNC = config("XRAY_STATS_ASYNC", cast=bool, default=True)
+# По-нодный опрос статистики со своим интервалом/дедлайном; JOB_RECORD_USER_USAGES_INTERVAL
+# тогда лишь частота сброса накопленного в БД. С USAGE_SPOOL_DIR каждый опрос сразу пишется в спул,
+# без него дельты между опросом и сбросом живут только в памяти.
+XRAY_STATS_POLL_PER_NODE = config("XRAY_STATS_POLL_PER_NODE", cast=bool, default=False)
+XRAY_STATS_POLL_INTERVAL = config("XRAY_STATS_POLL_INTERVAL", cast=float, default=10)
+XRAY_STATS_POLL_TIMEOUT = config("XRAY_STATS_POLL_TIMEOUT", cast=float, default=10)
+
+# Write-ahead спул тиков учёта трафика: пусто — выключен (трафик тика теряется при сбое записи в БД)
+USAGE_SPOOL_DIR = config("USAGE_SPOOL_DIR", default="")
+USAGE_SPOOL_SEGMENT_BYTES = config("USAGE_SPOOL_SEGMENT_BYTES", cast=int, default=64 * 1024 * 1024)
+USAGE_SPOOL_FSYNC = config("USAGE_SPOOL_FSYNC", cast=bool, default=True)
 
 # headers: profile-update-interval, support-url, profile-title
 SUB_UPDATE_INTERVAL = config("SUB_UPDATE_INTERVAL", default="12")
@@ -205,6 +268,10 @@ JOB_REVIEW_USERS_INTERVAL = config("JOB_REVIEW_USERS_INTERVAL", cast=int, defaul
 JOB_REVIEW_BS_NODES_INTERVAL = config("JOB_REVIEW_BS_NODES_INTERVAL", cast=int, default=60)
 JOB_SEND_NOTIFICATIONS_INTERVAL = config("JOB_SEND_NOTIFICATIONS_INTERVAL", cast=int, default=30)
 JOB_CLEANUP_NODE_USER_USAGE_INTERVAL = config("JOB_CLEANUP_NODE_USER_USAGE_INTERVAL", cast=int, default=3600)
+# сверка клиентов на нодах с БД и дозаливка разницы через Proxyman; 0 — выключено
+JOB_RECONCILE_NODE_USERS_INTERVAL = config("JOB_RECONCILE_NODE_USERS_INTERVAL", cast=int, default=300)
+# сброс буфера визитов /sub (sub_updated_at, last_seen устройств) в БД; 0 — синхронная запись на каждый запрос
+JOB_FLUSH_SUB_WRITES_INTERVAL = config("JOB_FLUSH_SUB_WRITES_INTERVAL", cast=int, default=5)
 NODE_USER_USAGE_CLEANUP_BATCH_SIZE = config("NODE_USER_USAGE_CLEANUP_BATCH_SIZE", cast=int, default=50000)
 
 # review job: пороги для диагностического лога [review][on_hold][slow] (секунды)
@@ -225,6 +292,22 @@ XRAY_NODE_REST_DISCONNECT_TIMEOUT = config("XRAY_NODE_REST_DISCONNECT_TIMEOUT",
 XRAY_NODE_REST_START_TIMEOUT = config("XRAY_NODE_REST_START_TIMEOUT", cast=int, default=30)
 XRAY_NODE_REST_RESTART_TIMEOUT = config("XRAY_NODE_REST_RESTART_TIMEOUT", cast=int, default=30)
 XRAY_NODE_REST_STOP_TIMEOUT = config("XRAY_NODE_REST_STOP_TIMEOUT", cast=int, default=10)
+# HTTP/2 к REST-нодам: нужен extra node-http2 (`uv sync --extra node-http2`), без него — HTTP/1.1
+XRAY_NODE_HTTP2 = config("XRAY_NODE_HTTP2", cast=bool, default=False)
+# сколько нод core_health_check проверяет одновременно
+XRAY_NODE_HEALTH_CHECK_CONCURRENCY = config("XRAY_NODE_HEALTH_CHECK_CONCURRENCY", cast=int, default=32)
+# фоновая проверка живости нод (node_health): интервал, порог down и «медленный» RTT для degraded
+XRAY_NODE_PROBE_INTERVAL = config("XRAY_NODE_PROBE_INTERVAL", cast=int, default=10)
+XRAY_NODE_DOWN_AFTER_FAILURES = config("XRAY_NODE_DOWN_AFTER_FAILURES", cast=int, default=3)
+XRAY_NODE_DEGRADED_RTT_MS = config("XRAY_NODE_DEGRADED_RTT_MS", cast=int, default=2000)
+# сжатая передача конфига и патчи от предыдущей версии — для нод, объявивших config_transfer
+XRAY_NODE_CONFIG_TRANSFER = config("XRAY_NODE_CONFIG_TRANSFER", cast=bool, default=True)
+# патч шлётся, если изменённых клиентов не больше этой доли; иначе — полный конфиг
+XRAY_NODE_CONFIG_PATCH_MAX_RATIO = config("XRAY_NODE_CONFIG_PATCH_MAX_RATIO", cast=float, default=0.5)
 XRAY_NODE_GRPC_READY_TIMEOUT = config("XRAY_NODE_GRPC_READY_TIMEOUT", cast=int, default=20)
 XRAY_NODE_GRPC_READY_RETRIES = config("XRAY_NODE_GRPC_READY_RETRIES", cast=int, default=3)
 XRAY_NODE_GRPC_READY_RETRY_DELAY = config("XRAY_NODE_GRPC_READY_RETRY_DELAY", cast=int, default=2)
+# keepalive долгоживущих gRPC-каналов (секунды; меньше 300 не бывает — сервер xray разорвёт
+# соединение за частые пинги) и потолок паузы между попытками переподключения
+XRAY_GRPC_KEEPALIVE_TIME = config("XRAY_GRPC_KEEPALIVE_TIME", cast=int, default=300)
+XRAY_GRPC_MAX_RECONNECT_BACKOFF = config("XRAY_GRPC_MAX_RECONNECT_BACKOFF", cast=int, default=10)
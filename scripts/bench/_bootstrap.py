@@ -0,0 +1,22 @@
+"""Подготовка sys.path/sys.modules для бенчмарков.
+
+Как и tests/conftest.py: регистрируем app (и его подпакеты) пустыми пакетами
+с реальными путями, чтобы импортировать чистые модули без запуска
+app/__init__.py (FastAPI, xray-бинарь, БД).
+"""
+
+import pathlib
+import sys
+import types
+
+ROOT = pathlib.Path(__file__).resolve().parents[2]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+for name in ("app", "app.db", "app.xray", "app.subscription", "app.utils"):
+    if name in sys.modules:
+        continue
+    module = types.ModuleType(name)
+    module.__path__ = [str(ROOT.joinpath(*name.split(".")))]
+    module.__package__ = name
+    sys.modules[name] = module
@@ -0,0 +1,131 @@
+"""Сборка конфига с клиентами: прежний include_db_users vs кэш клиентов (app/xray/client_cache.py).
+
+legacy — как раньше на каждый вызов: deepcopy базового конфига и сборка
+каждого клиента из строк group_concat-запроса (время самого запроса к БД
+сюда НЕ входит — на проде оно добавляется к legacy). cached — копия базового
+конфига и склейка готовых списков из кэша. Отдельно: полная загрузка кэша и
+стоимость одного события (update_user).
+
+    python scripts/bench/include_db_users.py --users 10000 100000 500000
+"""
+
+import argparse
+import statistics
+import time
+import uuid
+from collections import defaultdict
+from copy import deepcopy
+
+import _bootstrap  # noqa: F401
+
+from app.xray.client_cache import ClientCache, build_client
+
+INBOUNDS = [
+    {"tag": "vless-reality", "protocol": "vless", "network": "tcp", "tls": "reality", "header_type": ""},
+    {"tag": "vless-ws", "protocol": "vless", "network": "ws", "tls": "tls", "header_type": ""},
+    {"tag": "vmess-ws", "protocol": "vmess", "network": "ws", "tls": "tls", "header_type": ""},
+    {"tag": "trojan-tcp", "protocol": "trojan", "network": "tcp", "tls": "tls", "header_type": ""},
+]
+
+
+def base_config():
+    return {
+        "log": {"loglevel": "warning"},
+        "inbounds": [
+            {"tag": i["tag"], "protocol": i["protocol"], "port": 443 + n, "settings": {"clients": []}}
+            for n, i in enumerate(INBOUNDS)
+        ],
+        "outbounds": [{"tag": "direct", "protocol": "freedom"}],
+        "routing": {"rules": []},
+    }
+
+
+def query_rows(users: int) -> list:
+    """Строки как у запроса include_db_users: (id, username, type, settings, excluded)."""
+    rows = []
+    for uid in range(1, users + 1):
+        name = f"user{uid}"
+        excluded = ["vless-ws"] if uid % 10 == 0 else None
+        rows.append((uid, name, "vless", {"id": str(uuid.uuid4()), "flow": "xtls-rprx-vision"}, excluded))
+        rows.append((uid, name, "vmess", {"id": str(uuid.uuid4())}, None))
+        if uid % 3 == 0:
+            rows.append((uid, name, "trojan", {"password": uuid.uuid4().hex, "flow": ""}, None))
+    return rows
+
+
+def by_protocol():
+    result = defaultdict(list)
+    for inbound in INBOUNDS:
+        result[inbound["protocol"]].append(inbound)
+    return result
+
+
+def legacy(base, rows, inbounds_by_protocol):
+    config = deepcopy(base)
+    tags = {i["tag"]: i for i in config["inbounds"]}
+    for user_id, username, proxy_type, settings, excluded in rows:
+        for inbound in inbounds_by_protocol[proxy_type]:
+            if excluded and inbound["tag"] in excluded:
+                continue
+            tags[inbound["tag"]]["settings"]["clients"].append(build_client(inbound, f"{user_id}.{username}", settings))
+    return config
+
+
+def loader(rows, inbounds_by_protocol):
+    by_user = defaultdict(dict)
+    for user_id, username, proxy_type, settings, excluded in rows:
+        for inbound in inbounds_by_protocol[proxy_type]:
+            if not excluded or inbound["tag"] not in excluded:
+                by_user[user_id][inbound["tag"]] = build_client(inbound, f"{user_id}.{username}", settings)
+    return by_user.items()
+
+
+def cached(base, cache, owner, load):
+    config = deepcopy(base)
+    tags = {i["tag"]: i for i in config["inbounds"]}
+    for tag, clients in cache.clients(owner, load).items():
+        tags[tag]["settings"]["clients"] += clients
+    return config
+
+
+def median_ms(fn, rounds):
+    times = []
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[10_000, 100_000, 500_000])
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    inbounds_by_protocol = by_protocol()
+    base = base_config()
+    print(f"inbounds={len(INBOUNDS)} rounds={args.rounds} (медианы, мс)")
+    print(f"{'users':>8} {'legacy':>10} {'cached':>10} {'load':>10} {'event':>8}")
+    for users in args.users:
+        rows = query_rows(users)
+        owner = object()
+        cache = ClientCache()
+
+        def load():
+            return loader(rows, inbounds_by_protocol)
+
+        t0 = time.perf_counter()
+        cache.clients(owner, load)
+        load_ms = (time.perf_counter() - t0) * 1000
+
+        legacy_ms = median_ms(lambda: legacy(base, rows, inbounds_by_protocol), args.rounds)
+        cached_ms = median_ms(lambda: cached(base, cache, owner, load), args.rounds)
+        client = {"email": "1.user1", "id": str(uuid.uuid4())}
+        event_ms = median_ms(lambda: cache.set_user(1, {"vless-reality": client, "vmess-ws": client}), 101)
+        assert cached(base, cache, owner, load)["inbounds"][0]["settings"]["clients"]
+        print(f"{users:>8} {legacy_ms:>10.1f} {cached_ms:>10.1f} {load_ms:>10.1f} {event_ms:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Сериализация стартовых конфигов нод: json.dumps на каждую ноду vs кэш фрагментов (app/xray/config_json.py).
+
+Модель массового переподключения: один базовый конфиг с клиентами, часть
+нод — с одинаковым набором заблокированных (БС-ноды), часть — без. Конфиг
+ноды выводится copy-on-write (strip_blocked_clients), как в operations.
+
+    python scripts/bench/node_config_json.py --users 10000 100000 --nodes 200
+"""
+
+import argparse
+import json
+import time
+import uuid
+
+import _bootstrap  # noqa: F401
+
+from app.xray.bs_limit import strip_blocked_clients
+from app.xray.config_json import JsonFragmentCache
+
+
+class Config(dict):
+    def copy(self):
+        return Config(self)
+
+
+def base_config(users: int) -> Config:
+    def clients(flow):
+        return tuple(
+            {"email": f"{uid}.user{uid}", "id": str(uuid.uuid4()), **({"flow": flow} if flow else {})}
+            for uid in range(1, users + 1)
+        )
+
+    return Config(
+        {
+            "log": {"loglevel": "warning"},
+            "inbounds": [
+                {"tag": "API_INBOUND", "protocol": "dokodemo-door", "port": 8080, "settings": {"address": "127.0.0.1"}},
+                {"tag": "vless-reality", "protocol": "vless", "settings": {"clients": clients("xtls-rprx-vision")}},
+                {"tag": "vmess-ws", "protocol": "vmess", "settings": {"clients": clients(None)}},
+            ],
+            "outbounds": [{"tag": "direct", "protocol": "freedom"}],
+            "routing": {"rules": []},
+        }
+    )
+
+
+def node_configs(config: Config, nodes: int, users: int) -> list:
+    blocked = set(range(1, users // 100 + 1))
+    return [strip_blocked_clients(config, blocked if i % 4 == 0 else set()) for i in range(nodes)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--nodes", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"nodes={args.nodes} (каждая 4-я — с одинаковым набором заблокированных), секунды на все ноды")
+    print(f"{'users':>8} {'json.dumps':>11} {'fragments':>10} {'MB/node':>8}")
+    for users in args.users:
+        configs = node_configs(base_config(users), args.nodes, users)
+
+        # документы не копим: на 100k юзеров 200 конфигов — это гигабайты строк
+        t0 = time.perf_counter()
+        size = max(len(json.dumps(cfg)) for cfg in configs)
+        plain_s = time.perf_counter() - t0
+
+        cache = JsonFragmentCache()
+        t0 = time.perf_counter()
+        for cfg in configs:
+            cache.dumps(cfg)
+        cached_s = time.perf_counter() - t0
+
+        assert all(cache.dumps(cfg) == json.dumps(cfg) for cfg in configs[:4])
+        print(f"{users:>8} {plain_s:>11.2f} {cached_s:>10.2f} {size / 2**20:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""Сжатие тел подписки: размер и CPU на кодировку для каждого формата.
+
+Тела — те же, что в subscription_render.py (N хостов со смесью инбаундов).
+Для каждой доступной кодировки (app/subscription/compression.py — br/zstd
+только если установлены brotli/zstandard) печатается размер, во сколько раз
+меньше исходного и p50 времени сжатия: столько CPU стоит первый запрос, пока
+вариант не лёг в кэш рендера, и каждый запрос формата из FRESH_FORMATS.
+
+    python scripts/bench/subscription_compression.py --hosts 50 --repeat 50
+"""
+
+import argparse
+import statistics
+import time
+
+import _bootstrap  # noqa: F401
+from subscription_render import FORMATS, render
+
+from app.subscription.compression import SUPPORTED_ENCODINGS, compress
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hosts", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"hosts={args.hosts} repeat={args.repeat}")
+    print(f"{'format':<11} {'encoding':>8} {'KB':>7} {'ratio':>6} {'p50 ms':>8}")
+    for name, factory in FORMATS.items():
+        body = render(factory, args.hosts).encode()
+        print(f"{name:<11} {'identity':>8} {len(body) / 1024:>7.1f} {1:>6.1f} {0:>8.2f}")
+        for encoding in SUPPORTED_ENCODINGS:
+            times = []
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                data = compress(body, encoding)
+                times.append((time.perf_counter() - t0) * 1000)
+            print(
+                f"{name:<11} {encoding:>8} {len(data) / 1024:>7.1f} {len(body) / len(data):>6.1f}"
+                f" {statistics.median(times):>8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Рендер подписки на запрос: 50 хостов в каждом формате (v2ray-json, clash, clash-meta, sing-box).
+
+Меряется то, что generate_subscription делает на каждый запрос: конструктор
+класса конфига, add() на каждый хост и render(); build — p50 без render().
+Смесь инбаундов — vless-reality/tcp, vless/ws+tls с mux, vmess/grpc,
+trojan/ws, shadowsocks. Реестр шаблонов (app/templates/registry.py) в режиме
+cached прогрет, в режиме cold сбрасывается перед каждым запросом — цена
+первого запроса после правки шаблона.
+
+    python scripts/bench/subscription_render.py --hosts 50 --repeat 200
+"""
+
+import argparse
+import statistics
+import sys
+import time
+import types
+import uuid
+
+import _bootstrap  # noqa: F401
+
+# app/utils/system.py (фильтры шаблонов) регистрирует джоб в планировщике панели на импорте
+sys.modules["app"].scheduler = types.SimpleNamespace(scheduled_job=lambda *a, **kw: lambda fn: fn)
+
+from app.subscription.clash import ClashConfiguration, ClashMetaConfiguration  # noqa: E402
+from app.subscription.singbox import SingBoxConfiguration  # noqa: E402
+from app.subscription.v2ray import V2rayJsonConfig  # noqa: E402
+from app.templates import template_registry  # noqa: E402
+
+BASE_INBOUND = {
+    "port": 443,
+    "tls": "none",
+    "sni": "",
+    "host": "",
+    "path": "",
+    "header_type": "none",
+    "alpn": None,
+    "fp": "",
+    "pbk": "",
+    "sid": "",
+    "spx": "",
+    "ais": "",
+    "mux_enable": False,
+    "fragment_setting": "",
+    "noise_setting": "",
+    "random_user_agent": False,
+    "xhttp_extra": None,
+}
+INBOUNDS = [
+    {
+        "protocol": "vless",
+        "network": "tcp",
+        "tls": "reality",
+        "sni": "www.example.com",
+        "fp": "chrome",
+        "pbk": "Z84J2IelR9ch3k8VtlVhhs5ycBUlXA7wHBWcBrjqnAw",
+        "sid": "6ba85179e30d4fc2",
+    },
+    {"protocol": "vless", "network": "ws", "tls": "tls", "sni": "cdn.example.com", "path": "/ws", "mux_enable": True},
+    {"protocol": "vmess", "network": "grpc", "tls": "tls", "sni": "grpc.example.com", "path": "grpc"},
+    {"protocol": "trojan", "network": "ws", "tls": "tls", "sni": "tr.example.com", "path": "/tr", "host": "tr.example"},
+    {"protocol": "shadowsocks", "network": "tcp"},
+]
+SETTINGS = {
+    "vless": {"id": uuid.UUID(int=1), "flow": "xtls-rprx-vision"},
+    "vmess": {"id": uuid.UUID(int=2)},
+    "trojan": {"password": "trojan-password"},
+    "shadowsocks": {"password": "ss-password", "method": "chacha20-ietf-poly1305"},
+}
+FORMATS = {
+    "v2ray-json": V2rayJsonConfig,
+    "clash": ClashConfiguration,
+    "clash-meta": ClashMetaConfiguration,
+    "sing-box": SingBoxConfiguration,
+}
+
+
+def build(factory, hosts: int):
+    conf = factory()
+    for i in range(hosts):
+        inbound = {**BASE_INBOUND, **INBOUNDS[i % len(INBOUNDS)]}
+        conf.add(
+            remark=f"🚀 Host {i} [{inbound['protocol']} - {inbound['network']}]",
+            address=f"node{i}.example.com",
+            inbound=inbound,
+            settings=SETTINGS[inbound["protocol"]],
+        )
+    return conf
+
+
+def render(factory, hosts: int) -> str:
+    return build(factory, hosts).render()
+
+
+def p95(values):
+    return statistics.quantiles(values, n=20)[-1] if len(values) > 1 else values[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hosts", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"hosts={args.hosts} repeat={args.repeat}, мс на запрос")
+    print(f"{'format':<11} {'mode':>7} {'p50 ms':>8} {'p95 ms':>8} {'build':>8} {'KB':>6}")
+    for name, factory in FORMATS.items():
+        for mode in ("cold", "cached"):
+            times, builds = [], []
+            for _ in range(args.repeat):
+                if mode == "cold":
+                    template_registry.clear()
+                t0 = time.perf_counter()
+                conf = build(factory, args.hosts)
+                t1 = time.perf_counter()
+                body = conf.render()
+                times.append((time.perf_counter() - t0) * 1000)
+                builds.append((t1 - t0) * 1000)
+            print(
+                f"{name:<11} {mode:>7} {statistics.median(times):>8.2f} {p95(times):>8.2f}"
+                f" {statistics.median(builds):>8.2f} {len(body) / 1024:>6.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
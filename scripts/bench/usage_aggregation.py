@@ -0,0 +1,279 @@
+"""Расход за период (/api/user/{username}/usage, /api/users/usage, /api/nodes/usage): Python-сумма vs GROUP BY.
+
+Фикстура — файловая SQLite с --rows часовыми строками node_user_usages (по
+умолчанию 10M), юзерами, разложенными по --admins, и node_usages по нодам;
+собирается один раз (INSERT ... SELECT из рекурсивного CTE, индексы как в
+моделях) и переиспользуется через --db. Для каждого запроса меряем p50/p95 и
+число строк, пришедших в Python:
+
+- legacy — как было в crud: строки node_user_usages за период итерируются и
+  суммируются в dict; для /api/users/usage перед этим грузятся все юзеры
+  админа ради IN-списка id;
+- group_by — GROUP BY node_id в БД, для админа JOIN users по admin_id;
+- tiered — то же поверх дневных/месячных агрегатов (app/db/usage_tiers.py).
+
+    python scripts/bench/usage_aggregation.py --db /tmp/usage.db --rows 10000000 --days 30
+"""
+
+import argparse
+import os
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+import _bootstrap  # noqa: F401
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    UniqueConstraint,
+    create_engine,
+    func,
+    select,
+    text,
+)
+
+from app.db import usage_tiers
+from app.db.usage_tiers import DAILY, HOURLY, MONTHLY
+
+FIRST_HOUR = datetime(2026, 1, 1)
+
+metadata = MetaData()
+users = Table(
+    "users",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("username", String(34)),
+    Column("admin_id", Integer, index=True),
+)
+node_usages = Table(
+    "node_usages",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("created_at", DateTime, nullable=False),
+    Column("node_id", Integer),
+    Column("uplink", BigInteger),
+    Column("downlink", BigInteger),
+    UniqueConstraint("created_at", "node_id"),
+)
+
+
+def usage_table(name, *extra):
+    return Table(
+        name,
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("created_at", DateTime, nullable=False),
+        Column("user_id", Integer),
+        Column("node_id", Integer),
+        Column("used_traffic", BigInteger),
+        Index(f"ix_{name}_created_at_node_id", "created_at", "node_id"),
+        Index(f"ix_{name}_user_id_created_at", "user_id", "created_at"),
+        *extra,
+    )
+
+
+TABLES = {
+    HOURLY: usage_table("node_user_usages", UniqueConstraint("created_at", "user_id", "node_id")),
+    DAILY: usage_table("node_user_usages_daily"),
+    MONTHLY: usage_table("node_user_usages_monthly"),
+}
+usages = TABLES[HOURLY]
+
+# формат DateTime у SQLAlchemy на SQLite — иначе сравнения с параметрами по строкам разъедутся
+SQLITE_TS = "strftime('%Y-%m-%d %H:%M:%S.000000', :first, '+' || (i / :per_hour) || ' hours')"
+
+
+def build(engine, rows: int, users_count: int, admins: int, nodes: int, hours: int) -> dict:
+    """Залить фикстуру; → границы свёрток {tier: rolled_until}."""
+    per_hour = -(-rows // hours)
+    users_count = max(users_count, per_hour)  # (час, юзер, нода) уникальны: на час не больше строки на юзера
+    with engine.begin() as conn:
+        for table in TABLES.values():
+            # индексы — после заливки, так в разы быстрее
+            for index in table.indexes:
+                index.drop(conn, checkfirst=True)
+        conn.execute(
+            users.insert(),
+            [{"id": i, "username": f"user{i}", "admin_id": i % admins + 1} for i in range(1, users_count + 1)],
+        )
+        conn.execute(
+            node_usages.insert(),
+            [
+                {
+                    "created_at": FIRST_HOUR + timedelta(hours=h),
+                    "node_id": n or None,
+                    "uplink": 10**6 + h,
+                    "downlink": 10**7 + n,
+                }
+                for h in range(hours)
+                for n in range(nodes + 1)
+            ],
+        )
+    step = 1_000_000
+    for offset in range(0, rows, step):
+        with engine.begin() as conn:
+            conn.execute(
+                text(
+                    "WITH RECURSIVE seq(i) AS (SELECT :lo UNION ALL SELECT i + 1 FROM seq WHERE i + 1 < :hi) "
+                    "INSERT INTO node_user_usages (created_at, user_id, node_id, used_traffic) "
+                    f"SELECT {SQLITE_TS}, "
+                    "(i % :per_hour + (i / :per_hour) * 7919) % :users + 1, "
+                    "NULLIF((i + i / :per_hour) % (:nodes + 1), 0), "
+                    "abs(random() % 100000000) FROM seq"
+                ),
+                {
+                    "lo": offset,
+                    "hi": min(offset + step, rows),
+                    "per_hour": per_hour,
+                    "first": FIRST_HOUR.isoformat(" "),
+                    "users": users_count,
+                    "nodes": nodes,
+                },
+            )
+        print(f"  filled {min(offset + step, rows):,}/{rows:,}", flush=True)
+    with engine.begin() as conn:
+        for table in TABLES.values():
+            for index in table.indexes:
+                index.create(conn)
+
+    last_hour = FIRST_HOUR + timedelta(hours=hours)
+    daily_until = usage_tiers.floor_day(last_hour)
+    monthly_until = usage_tiers.floor_month(daily_until)
+    with engine.begin() as conn:
+        for tier, source, until in ((DAILY, HOURLY, daily_until), (MONTHLY, DAILY, monthly_until)):
+            start = usage_tiers.floor_day(FIRST_HOUR)
+            while usage_tiers.next_period(tier, start) <= until:
+                end = usage_tiers.next_period(tier, start)
+                for stmt in usage_tiers.rollup_statements(TABLES[source], TABLES[tier], start, end):
+                    conn.execute(stmt)
+                start = end
+    return {DAILY: daily_until, MONTHLY: monthly_until}
+
+
+def legacy_sum(conn, condition) -> tuple[dict, int]:
+    totals, count = {}, 0
+    for row in conn.execute(select(usages).where(condition)):
+        totals[row.node_id] = totals.get(row.node_id, 0) + row.used_traffic
+        count += 1
+    return totals, count
+
+
+def user_usage(conn, mode, rollups, user_id, start, end):
+    if mode == "legacy":
+        return legacy_sum(
+            conn, (usages.c.user_id == user_id) & (usages.c.created_at >= start) & (usages.c.created_at <= end)
+        )
+    daily, monthly = (rollups[DAILY], rollups[MONTHLY]) if mode == "tiered" else (None, None)
+    segments = usage_tiers.plan(start, end, daily, monthly)
+    totals = usage_tiers.usage_by_node(conn.execute, TABLES, segments, lambda t: t.c.user_id == user_id)
+    return totals, len(totals)
+
+
+def admin_usage(conn, mode, rollups, admin_id, start, end):
+    if mode == "legacy":
+        # get_users(admins=...) грузил юзеров целиком ради IN-списка
+        ids = [row.id for row in conn.execute(select(users).where(users.c.admin_id == admin_id))]
+        totals, count = legacy_sum(
+            conn, usages.c.user_id.in_(ids) & (usages.c.created_at >= start) & (usages.c.created_at <= end)
+        )
+        return totals, count + len(ids)
+    daily, monthly = (rollups[DAILY], rollups[MONTHLY]) if mode == "tiered" else (None, None)
+    segments = usage_tiers.plan(start, end, daily, monthly)
+    totals = usage_tiers.usage_by_node(
+        conn.execute,
+        TABLES,
+        segments,
+        lambda t: users.c.admin_id == admin_id,
+        join=lambda t: (users, users.c.id == t.c.user_id),
+    )
+    return totals, len(totals)
+
+
+def nodes_usage(conn, mode, rollups, _, start, end):
+    cond = (node_usages.c.created_at >= start) & (node_usages.c.created_at <= end)
+    totals, count = {}, 0
+    if mode == "legacy":
+        rows = conn.execute(select(node_usages).where(cond))
+        rows = ((r.node_id, r.uplink, r.downlink) for r in rows)
+    else:
+        rows = conn.execute(
+            select(node_usages.c.node_id, func.sum(node_usages.c.uplink), func.sum(node_usages.c.downlink))
+            .where(cond)
+            .group_by(node_usages.c.node_id)
+        )
+    for node_id, uplink, downlink in rows:
+        up, down = totals.get(node_id, (0, 0))
+        totals[node_id] = (up + uplink, down + downlink)
+        count += 1
+    return totals, count
+
+
+QUERIES = {
+    "/api/user/{username}/usage": (user_usage, ("legacy", "group_by", "tiered")),
+    "/api/users/usage": (admin_usage, ("legacy", "group_by", "tiered")),
+    "/api/nodes/usage": (nodes_usage, ("legacy", "group_by")),
+}
+
+
+def p95(values):
+    return statistics.quantiles(values, n=20)[-1] if len(values) > 1 else values[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default="usage_bench.db", help="файл фикстуры; если есть — переиспользуется")
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--admins", type=int, default=10)
+    parser.add_argument("--nodes", type=int, default=20)
+    parser.add_argument("--hours", type=int, default=24 * 60, help="глубина истории")
+    parser.add_argument("--days", type=int, default=30, help="окно запроса, как у дашборда")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    fresh = not os.path.exists(args.db)
+    engine = create_engine(f"sqlite:///{args.db}")
+    if fresh:
+        metadata.create_all(engine)
+        t0 = time.perf_counter()
+        print(f"building fixture {args.db}: {args.rows:,} rows")
+        build(engine, args.rows, args.users, args.admins, args.nodes, args.hours)
+        print(f"  done in {time.perf_counter() - t0:.0f}s")
+    with engine.connect() as conn:
+        total = conn.execute(select(func.count()).select_from(usages)).scalar()
+        users_count = conn.execute(select(func.max(users.c.id))).scalar()
+        admins = conn.execute(select(func.max(users.c.admin_id))).scalar()
+        last_hour = conn.execute(select(func.max(usages.c.created_at))).scalar()
+        daily_until = usage_tiers.floor_day(last_hour)
+        rollups = {DAILY: daily_until, MONTHLY: usage_tiers.floor_month(daily_until)}
+
+        end = last_hour
+        start = end - timedelta(days=args.days)
+        rng = random.Random(1)
+        print(f"rows={total:,} window={args.days}d repeat={args.repeat}")
+        print(f"{'endpoint':<28} {'mode':>9} {'p50 ms':>9} {'p95 ms':>9} {'rows→py':>9}")
+        for endpoint, (query, modes) in QUERIES.items():
+            keys = [rng.randint(1, users_count if query is user_usage else admins) for _ in range(args.repeat)]
+            for mode in modes:
+                times, fetched = [], []
+                for key in keys:
+                    t0 = time.perf_counter()
+                    _, count = query(conn, mode, rollups, key, start, end)
+                    times.append((time.perf_counter() - t0) * 1000)
+                    fetched.append(count)
+                print(
+                    f"{endpoint:<28} {mode:>9} {statistics.median(times):>9.1f} {p95(times):>9.1f}"
+                    f" {statistics.median(fetched):>9.0f}"
+                )
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
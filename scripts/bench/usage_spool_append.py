@@ -0,0 +1,75 @@
+"""Стоимость записи тика в usage-спул (app/utils/usage_spool.py).
+
+Тик = по-нодные дельты uid/value; меряем append (с fsync и без), commit
+и чтение незакоммиченного тика при реплее.
+
+    python scripts/bench/usage_spool_append.py --users 100000 --nodes 1 10 50
+"""
+
+import argparse
+import statistics
+import tempfile
+import time
+
+import _bootstrap  # noqa: F401
+
+from app.utils.usage_spool import UsageSpool, tick_from_params
+
+
+def build_params(users: int, nodes: int) -> tuple[dict, dict]:
+    # пользователи равномерно раскиданы по нодам, как при обычной балансировке
+    api_params = {node_id: [] for node_id in range(1, nodes + 1)}
+    for uid in range(1, users + 1):
+        api_params[uid % nodes + 1].append({"uid": uid, "value": 1_000_000 + uid})
+    return api_params, {node_id: 1.0 for node_id in api_params}
+
+
+def measure(users: int, nodes: int, fsync: bool, rounds: int) -> dict:
+    api_params, coefficients = build_params(users, nodes)
+    encode, append, commit, replay = [], [], [], []
+    with tempfile.TemporaryDirectory() as directory:
+        spool = UsageSpool(directory, fsync=fsync)
+        for _ in range(rounds):
+            t0 = time.perf_counter()
+            tick = tick_from_params(api_params, coefficients)
+            t1 = time.perf_counter()
+            spool.append(tick)
+            t2 = time.perf_counter()
+            next(spool.pending())
+            t3 = time.perf_counter()
+            spool.commit(tick.tick_id)
+            t4 = time.perf_counter()
+            encode.append(t1 - t0)
+            append.append(t2 - t1)
+            replay.append(t3 - t2)
+            commit.append(t4 - t3)
+        spool.close()
+    return {
+        "build_ms": statistics.median(encode) * 1000,
+        "append_ms": statistics.median(append) * 1000,
+        "replay_read_ms": statistics.median(replay) * 1000,
+        "commit_ms": statistics.median(commit) * 1000,
+        "bytes": users * 16,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--nodes", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"users={args.users} rounds={args.rounds} (медианы, мс)")
+    print(f"{'nodes':>6} {'fsync':>6} {'build':>8} {'append':>8} {'replay':>8} {'commit':>8} {'MiB':>6}")
+    for nodes in args.nodes:
+        for fsync in (True, False):
+            r = measure(args.users, nodes, fsync, args.rounds)
+            print(
+                f"{nodes:>6} {str(fsync):>6} {r['build_ms']:>8.2f} {r['append_ms']:>8.2f} "
+                f"{r['replay_read_ms']:>8.2f} {r['commit_ms']:>8.2f} {r['bytes'] / 2**20:>6.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
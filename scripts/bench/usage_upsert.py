@@ -0,0 +1,137 @@
+"""node_user_usages за тик: прежний SELECT + INSERT IGNORE + UPDATE vs upsert (app/db/bulk.py).
+
+По одной сессии/транзакции на ноду, как в record_user_stats. Меряем число
+SQL-выражений (cursor.execute/executemany) и wall time на тик на файловой
+SQLite (с коммитами на диск). Round trip'ы до MySQL здесь не видны — на
+проде разница в числе выражений важнее локального времени.
+
+    python scripts/bench/usage_upsert.py --nodes 10 200 --users-per-node 500
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import _bootstrap  # noqa: F401
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    Table,
+    UniqueConstraint,
+    and_,
+    bindparam,
+    create_engine,
+    event,
+    insert,
+    select,
+    update,
+)
+
+from app.db.bulk import increment_set, upsert_statements
+
+metadata = MetaData()
+usages = Table(
+    "node_user_usages",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("created_at", DateTime, nullable=False),
+    Column("user_id", Integer),
+    Column("node_id", Integer),
+    Column("used_traffic", BigInteger, default=0),
+    UniqueConstraint("created_at", "user_id", "node_id"),
+)
+
+
+def legacy_write(conn, params, node_id, created_at):
+    existing = {
+        r[0]
+        for r in conn.execute(
+            select(usages.c.user_id).where(and_(usages.c.node_id == node_id, usages.c.created_at == created_at))
+        )
+    }
+    to_insert = [{"uid": p["uid"]} for p in params if p["uid"] not in existing]
+    if to_insert:
+        conn.execute(
+            insert(usages)
+            .prefix_with("OR IGNORE")
+            .values(user_id=bindparam("uid"), created_at=created_at, node_id=node_id, used_traffic=0),
+            to_insert,
+        )
+    conn.execute(
+        update(usages)
+        .values(used_traffic=usages.c.used_traffic + bindparam("value"))
+        .where(
+            and_(usages.c.user_id == bindparam("uid"), usages.c.node_id == node_id, usages.c.created_at == created_at)
+        ),
+        params,
+    )
+
+
+def upsert_write(conn, params, node_id, created_at):
+    rows = [
+        {"created_at": created_at, "user_id": p["uid"], "node_id": node_id, "used_traffic": p["value"]} for p in params
+    ]
+    for stmt, chunk in upsert_statements(
+        "sqlite", usages, rows, ["created_at", "user_id", "node_id"], increment_set("used_traffic")
+    ):
+        conn.execute(stmt, chunk)
+
+
+def counting_engine(directory):
+    engine = create_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+    metadata.create_all(engine)
+    statements = [0]
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count(*args):
+        statements[0] += 1
+
+    return engine, statements
+
+
+def measure(write, nodes: int, users_per_node: int, rounds: int) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        engine, statements = counting_engine(directory)
+        api_params = {
+            node_id: [{"uid": node_id * users_per_node + i, "value": 1000 + i} for i in range(users_per_node)]
+            for node_id in range(1, nodes + 1)
+        }
+        hour = datetime(2026, 1, 1)
+        times, counts = [], []
+        for i in range(rounds):
+            # первый тик часа — вставки, следующие — инкременты существующих строк
+            created_at = hour + timedelta(hours=i // 2)
+            statements[0] = 0
+            t0 = time.perf_counter()
+            for node_id, params in api_params.items():
+                with engine.begin() as conn:
+                    write(conn, params, node_id, created_at)
+            times.append(time.perf_counter() - t0)
+            counts.append(statements[0])
+        engine.dispose()
+    return {"ms": statistics.median(times) * 1000, "statements": statistics.median(counts)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, nargs="+", default=[10, 200])
+    parser.add_argument("--users-per-node", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=6)
+    args = parser.parse_args()
+
+    print(f"users/node={args.users_per_node} rounds={args.rounds} (медианы на тик)")
+    print(f"{'nodes':>6} {'mode':>8} {'stmts':>7} {'ms':>9}")
+    for nodes in args.nodes:
+        for name, write in (("legacy", legacy_write), ("upsert", upsert_write)):
+            r = measure(write, nodes, args.users_per_node, args.rounds)
+            print(f"{nodes:>6} {name:>8} {r['statements']:>7.0f} {r['ms']:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,17 @@
 app/__init__.py поднимает FastAPI и тяжёлые зависимости при импорте.
 Чтобы тесты app.xray.inbound_filter (без БД/окружения) работали без полного
 окружения, заглушаем app как пустой пакет до того, как pytest начнёт сбор.
+
+Общие фикстуры: clock/cpu_clock — ручные часы для clock=-параметров кэшей,
+render_ctx — фабрика контекстов рендера подписки.
 """
 
 import pathlib
 import sys
 import types
 
+import pytest
+
 _APP_DIR = pathlib.Path(__file__).parent.parent / "app"
 
 # Регистрируем app как пустой пакет — тогда `from app.xray.inbound_filter import …`
@@ -40,3 +45,42 @@ if "app.subscription" not in sys.modules:
     subscription_stub.__path__ = [str(_APP_DIR / "subscription")]
     subscription_stub.__package__ = "app.subscription"
     sys.modules["app.subscription"] = subscription_stub
+
+
+class ManualClock:
+    """Часы для clock=/cpu_clock= кэшей и бюджетов: время двигает сам тест (clock.now = ...)."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return ManualClock()
+
+
+@pytest.fixture
+def cpu_clock():
+    return ManualClock()
+
+
+@pytest.fixture
+def render_ctx():
+    """Фабрика контекстов рендера подписки с полями, которые читают render_key и ETag-валидатор."""
+    from app.subscription.bs_context import BsContext
+
+    def make(user_key=(1, 7), user_digest="u1", bs=None, **flags):
+        values = dict(is_revoked=False, is_expired=False, device_limited=False, device_limited_hard=False)
+        values.update(flags)
+        return types.SimpleNamespace(
+            user_key=user_key,
+            user_digest=user_digest,
+            bs=bs or BsContext.empty(),
+            unsupported_blocks=False,
+            **values,
+        )
+
+    return make
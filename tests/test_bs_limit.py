@@ -17,8 +17,9 @@ from app.xray.bs_limit import (
 
 
 class FakeConfig(dict):
+    # как XRayConfig.copy(): поверхностная copy-on-write копия
     def copy(self):
-        return FakeConfig(copy.deepcopy(dict(self)))
+        return FakeConfig(self)
 
 
 def base():
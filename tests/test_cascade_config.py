@@ -10,10 +10,10 @@ from app.xray.cascade_config import (
 
 
 class FakeConfig(dict):
-    """Имитирует XRayConfig: .copy() делает deepcopy (как в app/xray/config.py)."""
+    """Имитирует XRayConfig: .copy() поверхностный, copy-on-write (как в app/xray/config.py)."""
 
     def copy(self):
-        return FakeConfig(copy.deepcopy(dict(self)))
+        return FakeConfig(self)
 
 
 def base():
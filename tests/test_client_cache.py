@@ -0,0 +1,90 @@
+import threading
+
+from app.xray.client_cache import ClientCache, build_client
+
+TCP_REALITY = {"tag": "vless-reality", "network": "tcp", "tls": "reality", "header_type": ""}
+WS_TLS = {"tag": "vless-ws", "network": "ws", "tls": "tls", "header_type": ""}
+
+
+def test_build_client_strips_flow_when_unsupported():
+    settings = {"id": "u1", "flow": "xtls-rprx-vision"}
+    assert build_client(TCP_REALITY, "1.alice", settings) == {"email": "1.alice", **settings}
+    assert build_client(WS_TLS, "1.alice", settings) == {"email": "1.alice", "id": "u1"}
+    assert "flow" not in build_client({**TCP_REALITY, "tls": "none"}, "1.alice", settings)
+    assert "flow" not in build_client({**TCP_REALITY, "header_type": "http"}, "1.alice", settings)
+    assert "flow" in build_client({**TCP_REALITY, "network": "raw"}, "1.alice", settings)
+    assert settings == {"id": "u1", "flow": "xtls-rprx-vision"}  # вход не меняется
+
+
+def rows(*user_ids):
+    return [(uid, {"a": {"email": f"{uid}.u"}, "b": {"email": f"{uid}.u"}}) for uid in user_ids]
+
+
+def test_loads_once_and_applies_events():
+    owner = object()
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return rows(1, 2)
+
+    cache = ClientCache()
+    cache.set_user(9, {"a": {"email": "9.u"}})  # до загрузки событие не нужно — загрузка прочитает БД
+    assert cache.clients(owner, loader) == {
+        "a": ({"email": "1.u"}, {"email": "2.u"}),
+        "b": ({"email": "1.u"}, {"email": "2.u"}),
+    }
+    version = cache.version
+
+    cache.set_user(3, {"a": {"email": "3.u"}})
+    cache.set_user(1, {"b": {"email": "1.renamed"}})  # инбаунд a исключён, username сменился
+    cache.remove_user(2)
+    assert cache.clients(owner, loader) == {"a": ({"email": "3.u"},), "b": ({"email": "1.renamed"},)}
+    assert cache.version == version + 3
+    assert len(loads) == 1 and len(cache) == 2
+
+
+def test_reload_on_new_owner_and_invalidate():
+    cache = ClientCache()
+    first, second = object(), object()
+    assert cache.clients(first, lambda: rows(1)) == {"a": ({"email": "1.u"},), "b": ({"email": "1.u"},)}
+    # новый XRayConfig (смена конфига ядра) — перечитываем
+    assert cache.clients(second, lambda: rows(2))["a"] == ({"email": "2.u"},)
+    cache.invalidate()
+    assert cache.clients(second, lambda: rows(3))["a"] == ({"email": "3.u"},)
+
+
+def test_events_during_load_are_replayed():
+    cache = ClientCache()
+    started, release = threading.Event(), threading.Event()
+
+    def slow_loader():
+        started.set()
+        release.wait(5)
+        return rows(1, 2)  # снимок БД до удаления юзера 2
+
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(cache.clients("owner", slow_loader)))
+    thread.start()
+    assert started.wait(5)
+    cache.remove_user(2)
+    release.set()
+    thread.join(5)
+    assert result["a"] == ({"email": "1.u"},)
+
+
+def test_clients_result_is_shared_until_next_change():
+    cache = ClientCache()
+    first = cache.clients("owner", lambda: rows(1))
+    assert cache.clients("owner", lambda: rows(1)) is first
+    cache.set_user(2, {"a": {"email": "2.u"}})
+    second = cache.clients("owner", lambda: rows(1))
+    assert second is not first and second["a"] == ({"email": "1.u"}, {"email": "2.u"})
+
+
+def test_user_tags_known_only_after_load():
+    cache = ClientCache()
+    assert cache.user_tags(1) is None
+    cache.clients("owner", lambda: rows(1))
+    assert cache.user_tags(1) == ("a", "b")
+    assert cache.user_tags(2) is None
@@ -0,0 +1,74 @@
+import json
+
+from app.xray.bs_limit import strip_blocked_clients
+from app.xray.config_json import JsonFragmentCache
+
+
+class FakeConfig(dict):
+    # как XRayConfig.copy(): поверхностная copy-on-write копия
+    def copy(self):
+        return FakeConfig(self)
+
+
+def base(users=50):
+    clients = tuple({"email": f"{uid}.user{uid}", "id": f"uuid-{uid}"} for uid in range(1, users + 1))
+    return FakeConfig(
+        {
+            "log": {"loglevel": "warning"},
+            "inbounds": [
+                {"tag": "API_INBOUND", "protocol": "dokodemo-door", "settings": {"address": "127.0.0.1"}},
+                {"tag": "vless", "protocol": "vless", "settings": {"clients": clients, "decryption": "none"}},
+                {"tag": "empty", "protocol": "vmess", "settings": {"clients": []}},
+            ],
+            "outbounds": [{"tag": "direct", "protocol": "freedom"}],
+        }
+    )
+
+
+def test_dumps_matches_json_dumps():
+    cache = JsonFragmentCache()
+    cfg = base()
+    assert cache.dumps(cfg) == json.dumps(cfg)
+    assert cache.dumps(FakeConfig()) == json.dumps({})
+
+
+def test_shared_inbounds_are_serialized_once():
+    cache = JsonFragmentCache()
+    cfg = base()
+    # конфиги нод: та же база, разные лёгкие секции
+    for node in range(10):
+        node_cfg = cfg.copy()
+        node_cfg["outbounds"] = cfg["outbounds"] + [{"tag": f"out-{node}", "protocol": "freedom"}]
+        assert cache.dumps(node_cfg) == json.dumps(node_cfg)
+    assert (cache.misses, cache.hits) == (1, 9)
+
+
+def test_same_blocked_set_reuses_stripped_inbound():
+    cache = JsonFragmentCache()
+    cfg = base()
+    first = strip_blocked_clients(cfg, {1, 2})
+    second = strip_blocked_clients(cfg, {2, 1})
+    other = strip_blocked_clients(cfg, {3})
+    assert first["inbounds"][1] is second["inbounds"][1]
+    assert other["inbounds"][1] is not first["inbounds"][1]
+    for node_cfg in (first, second, other):
+        assert cache.dumps(node_cfg) == json.dumps(node_cfg)
+    assert (cache.misses, cache.hits) == (2, 1)
+    assert len(cfg["inbounds"][1]["settings"]["clients"]) == 50  # база не тронута
+
+
+def test_budget_evicts_oldest_and_zero_disables():
+    one = base()
+    size = len(json.dumps(one["inbounds"][1]))
+    cache = JsonFragmentCache(max_bytes=size * 2)
+    configs = [base() for _ in range(3)]
+    for cfg in configs:
+        cache.dumps(cfg)
+    cache.dumps(configs[0])  # вытеснен
+    cache.dumps(configs[2])
+    assert (cache.misses, cache.hits) == (4, 1)
+
+    disabled = JsonFragmentCache(max_bytes=0)
+    disabled.dumps(one)
+    disabled.dumps(one)
+    assert (disabled.misses, disabled.hits) == (0, 0)
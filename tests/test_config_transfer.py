@@ -0,0 +1,199 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.xray.config_json import JsonFragmentCache
+from app.xray.config_transfer import (
+    ConfigTransfer,
+    apply_patch,
+    build_patch,
+    config_digest,
+    decompress,
+)
+
+
+def make_config(users, inbound_tags=("vless", "vmess")):
+    return {
+        "log": {"loglevel": "warning"},
+        "inbounds": [
+            {"tag": "API_INBOUND", "protocol": "dokodemo-door", "settings": {"address": "127.0.0.1"}},
+            *(
+                {
+                    "tag": tag,
+                    "protocol": tag,
+                    "settings": {"clients": tuple({"email": f"{uid}.u{uid}", "id": f"{tag}-{uid}"} for uid in users)},
+                }
+                for tag in inbound_tags
+            ),
+        ],
+        "outbounds": [{"tag": "direct", "protocol": "freedom"}],
+    }
+
+
+class StandInNode:
+    """Локальная нода с протоколом config_transfer: разжимает тело, применяет патч, сверяет digest."""
+
+    def __init__(self, encodings=("gzip",), patch=True):
+        self.capabilities = {"encodings": list(encodings), "patch": patch}
+        self.config = None
+        self.requests = []
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers["Content-Length"]))
+                encoding = self.headers.get("Content-Encoding")
+                body = json.loads(decompress(raw, encoding))
+                node.requests.append((encoding, len(raw), body))
+                status, data = node.handle(body)
+                payload = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def handle(self, body):
+        fmt = body.get("config_format")
+        if fmt is None:
+            self.config = json.loads(body["config"])
+        elif fmt == "object":
+            assert config_digest(body["config"]) == body["digest"]
+            self.config = body["config"]
+        else:
+            patch = body["patch"]
+            if self.config is None or config_digest(self.config) != patch["base"]:
+                return 409, {"detail": "base config mismatch"}
+            config = apply_patch(self.config, patch)
+            if config_digest(config) != patch["target"]:
+                return 409, {"detail": "target digest mismatch"}
+            self.config = config
+        return 200, {"started": True}
+
+    def post(self, path, body, headers, timeout):
+        request = urllib.request.Request(self.url + path, data=body, headers=headers, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as res:
+                return res.status, json.loads(res.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def node():
+    node = StandInNode()
+    yield node
+    node.close()
+
+
+def make_transfer(node, capabilities=True, max_ratio=0.5):
+    transfer = ConfigTransfer(node.post, JsonFragmentCache(), patch_max_ratio=max_ratio)
+    transfer.set_capabilities(node.capabilities if capabilities else None)
+    return transfer
+
+
+def test_digest_ignores_client_order_and_key_order():
+    config = make_config(range(1, 50))
+    shuffled = make_config(range(49, 0, -1))
+    shuffled["inbounds"][1]["settings"]["clients"] = tuple(
+        dict(reversed(c.items())) for c in shuffled["inbounds"][1]["settings"]["clients"]
+    )
+    assert config_digest(config) == config_digest(shuffled)
+    assert config_digest(config) != config_digest(make_config(range(1, 51)))
+
+
+def test_patch_round_trip():
+    base = make_config(range(1, 100))
+    target = make_config(range(5, 103))
+    target["inbounds"][2]["settings"]["clients"][10]["id"] = "rotated"
+
+    patch = build_patch(base, target)
+
+    assert patch["clients"]["vless"] == {
+        "remove": ["1.u1", "2.u2", "3.u3", "4.u4"],
+        "upsert": [{"email": f"{uid}.u{uid}", "id": f"vless-{uid}"} for uid in (100, 101, 102)],
+    }
+    assert len(patch["clients"]["vmess"]["upsert"]) == 4
+    assert all(not i.get("settings", {}).get("clients") for i in patch["config"]["inbounds"])
+    assert config_digest(apply_patch(base, patch)) == config_digest(target) == patch["target"]
+
+
+def test_patch_skipped_when_most_clients_change():
+    assert build_patch(make_config(range(1, 10)), make_config(range(100, 110))) is None
+    assert build_patch(make_config(range(1, 10)), make_config(range(1, 10))) is not None
+
+
+def test_legacy_node_gets_double_encoded_config(node):
+    transfer = make_transfer(node, capabilities=False)
+    config = make_config(range(1, 10))
+
+    assert transfer.send("/start", "sid", config, 5) == (200, {"started": True})
+
+    encoding, _, body = node.requests[-1]
+    assert encoding is None and isinstance(body["config"], str)
+    assert node.config == json.loads(json.dumps(config))
+
+
+def test_full_then_patch(node):
+    transfer = make_transfer(node)
+    config = make_config(range(1, 2000))
+
+    transfer.send("/start", "sid", config, 5)
+    encoding, full_size, body = node.requests[-1]
+    assert encoding == "gzip" and body["config_format"] == "object"
+    assert full_size < len(json.dumps(config)) / 3
+
+    changed = make_config(range(2, 2001))
+    assert transfer.send("/restart", "sid", changed, 5)[0] == 200
+    _, patch_size, body = node.requests[-1]
+    assert body["config_format"] == "patch"
+    assert patch_size < full_size / 10
+    assert config_digest(node.config) == config_digest(changed)
+
+
+def test_base_mismatch_falls_back_to_full(node):
+    transfer = make_transfer(node)
+    transfer.send("/start", "sid", make_config(range(1, 100)), 5)
+    node.config = make_config(range(1, 3))  # нода перезапустилась с другим конфигом
+
+    target = make_config(range(1, 101))
+    assert transfer.send("/restart", "sid", target, 5)[0] == 200
+
+    assert [r[2]["config_format"] for r in node.requests[-2:]] == ["patch", "object"]
+    assert config_digest(node.config) == config_digest(target)
+
+
+def test_failed_send_forgets_base(node):
+    transfer = make_transfer(node)
+    transfer.send("/start", "sid", make_config(range(1, 100)), 5)
+    node.handle = lambda body: (500, {"detail": "boom"})
+
+    assert transfer.send("/restart", "sid", make_config(range(1, 101)), 5) == (500, {"detail": "boom"})
+    assert transfer._sent is None
+
+
+def test_zstd_body():
+    pytest.importorskip("zstandard")
+    node = StandInNode(encodings=("gzip", "zstd"))
+    try:
+        transfer = make_transfer(node)
+        config = make_config(range(1, 500))
+        assert transfer.send("/start", "sid", config, 5)[0] == 200
+        assert node.requests[-1][0] == "zstd"
+        assert config_digest(node.config) == config_digest(config)
+    finally:
+        node.close()
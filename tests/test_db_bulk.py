@@ -0,0 +1,189 @@
+"""app/db/bulk.py: чанкованные upsert'ы и bulk-инкременты счётчиков.
+
+Модуль грузим напрямую через importlib: `import app.db.bulk` запустил бы
+app/db/__init__.py (логгер панели, engine) — см. tests/test_settings_apps_managed_gate.py.
+"""
+
+import importlib.util
+import pathlib
+from datetime import datetime
+
+import pytest
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    UniqueConstraint,
+    case,
+    create_engine,
+    select,
+)
+from sqlalchemy.dialects import mysql
+
+_spec = importlib.util.spec_from_file_location(
+    "app_db_bulk", pathlib.Path(__file__).parent.parent / "app" / "db" / "bulk.py"
+)
+bulk = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(bulk)
+
+metadata = MetaData()
+usages = Table(
+    "node_user_usages",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("created_at", DateTime, nullable=False),
+    Column("user_id", Integer),
+    Column("node_id", Integer),
+    Column("used_traffic", BigInteger, default=0),
+    UniqueConstraint("created_at", "user_id", "node_id"),
+)
+bs_usage = Table(
+    "node_user_bs_usage",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("node_id", Integer, nullable=False),
+    Column("user_id", Integer, nullable=False),
+    Column("monthly_used", BigInteger, nullable=False, default=0),
+    Column("monthly_period", String(7)),
+    UniqueConstraint("node_id", "user_id"),
+)
+users = Table(
+    "users",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("used_traffic", BigInteger, default=0),
+    Column("online_at", DateTime),
+)
+
+HOUR = datetime(2026, 1, 1, 10)
+
+
+@pytest.fixture
+def conn():
+    engine = create_engine("sqlite://")
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        yield connection
+
+
+def run(conn, statements):
+    for stmt, params in statements:
+        conn.execute(stmt, params)
+    return len(statements)
+
+
+def usage_rows(n, value, node_id=1):
+    return [{"created_at": HOUR, "user_id": uid, "node_id": node_id, "used_traffic": value} for uid in range(n)]
+
+
+def upsert_usages(conn, rows, chunk_size=bulk.DEFAULT_CHUNK_SIZE):
+    statements = bulk.upsert_statements(
+        "sqlite",
+        usages,
+        rows,
+        ["created_at", "user_id", "node_id"],
+        bulk.increment_set("used_traffic"),
+        chunk_size=chunk_size,
+    )
+    return run(conn, statements)
+
+
+def test_upsert_inserts_then_increments(conn):
+    upsert_usages(conn, usage_rows(3, 10))
+    upsert_usages(conn, usage_rows(5, 7))
+    got = dict(conn.execute(select(usages.c.user_id, usages.c.used_traffic)).all())
+    assert got == {0: 17, 1: 17, 2: 17, 3: 7, 4: 7}
+
+
+def test_upsert_is_chunked(conn):
+    assert upsert_usages(conn, usage_rows(25, 1), chunk_size=10) == 3
+    assert len(conn.execute(select(usages.c.id)).all()) == 25
+
+
+def test_upsert_counter_reset_via_case(conn):
+    def counter_set(excluded, table):
+        return [
+            (
+                "monthly_used",
+                case(
+                    (table.c.monthly_period == excluded.monthly_period, table.c.monthly_used + excluded.monthly_used),
+                    else_=excluded.monthly_used,
+                ),
+            ),
+            ("monthly_period", excluded.monthly_period),
+        ]
+
+    def step(user_id, used, period):
+        row = {"node_id": 1, "user_id": user_id, "monthly_used": used, "monthly_period": period}
+        run(conn, bulk.upsert_statements("sqlite", bs_usage, [row], ["node_id", "user_id"], counter_set))
+
+    step(1, 5, "2026-01")
+    step(1, 3, "2026-01")
+    assert conn.execute(select(bs_usage.c.monthly_used, bs_usage.c.monthly_period)).one() == (8, "2026-01")
+    step(1, 2, "2026-02")
+    assert conn.execute(select(bs_usage.c.monthly_used, bs_usage.c.monthly_period)).one() == (2, "2026-02")
+
+
+def test_mysql_upsert_keeps_set_order():
+    def factory(excluded, table):
+        return [
+            ("monthly_used", table.c.monthly_used + excluded.monthly_used),
+            ("monthly_period", excluded.monthly_period),
+        ]
+
+    row = {"node_id": 1, "user_id": 1, "monthly_used": 1, "monthly_period": "2026-01"}
+    ((stmt, params),) = bulk.upsert_statements("mysql", bs_usage, [row], ["node_id", "user_id"], factory)
+    assert params == [row]
+    sql = str(stmt.compile(dialect=mysql.dialect()))
+    assert "ON DUPLICATE KEY UPDATE" in sql
+    assert "VALUES(monthly_used)" in sql
+    assert sql.index("monthly_used = ") < sql.index("monthly_period = ")
+
+
+def test_increment_updates_only_existing_rows(conn):
+    conn.execute(users.insert(), [{"id": i, "used_traffic": 100} for i in range(1, 4)])
+    online_at = datetime(2026, 1, 1, 12)
+    statements = bulk.increment_statements(
+        "sqlite", users, "id", "used_traffic", {1: 5, 3: 7, 99: 1}, values={"online_at": online_at}, chunk_size=2
+    )
+    assert run(conn, statements) == 2
+    got = {r.id: (r.used_traffic, r.online_at) for r in conn.execute(select(users)).all()}
+    assert got == {1: (105, online_at), 2: (100, None), 3: (107, online_at)}
+
+
+def test_increment_latest_never_moves_backwards(conn):
+    old, new = datetime(2026, 1, 1, 12), datetime(2026, 1, 2, 12)
+    conn.execute(
+        users.insert(),
+        [{"id": 1, "used_traffic": 0, "online_at": new}, {"id": 2, "used_traffic": 0, "online_at": None}],
+    )
+    statements = bulk.increment_statements(
+        "sqlite", users, "id", "used_traffic", {1: 5, 2: 5}, latest={"online_at": old}
+    )
+    run(conn, statements)
+    got = {r.id: (r.used_traffic, r.online_at) for r in conn.execute(select(users)).all()}
+    assert got == {1: (5, new), 2: (5, old)}
+
+
+def test_mysql_increment_joins_derived_table():
+    ((stmt, params),) = bulk.increment_statements("mysql", users, "id", "used_traffic", {1: 5, 2: 7})
+    sql = str(stmt)
+    assert sql.startswith("UPDATE users JOIN (SELECT :k0 AS k, :v0 AS v UNION ALL SELECT :k1, :v1) AS d")
+    assert "SET users.used_traffic = users.used_traffic + d.v" in sql
+    assert params == {"k0": 1, "v0": 5, "k1": 2, "v1": 7}
+
+
+def test_mysql_increment_latest_is_guarded():
+    online_at = datetime(2026, 1, 1, 12)
+    ((stmt, params),) = bulk.increment_statements(
+        "mysql", users, "id", "used_traffic", {1: 5}, latest={"online_at": online_at}
+    )
+    assert (
+        "users.online_at = CASE WHEN users.online_at IS NULL OR users.online_at < :online_at "
+        "THEN :online_at ELSE users.online_at END"
+    ) in str(stmt)
+    assert params["online_at"] == online_at
@@ -0,0 +1,117 @@
+import time
+from concurrent import futures
+
+import grpc
+import pytest
+
+from app.xray.grpc_channels import ChannelLease, ChannelPool, channel_key, channel_options
+from xray_api import XRay as XRayAPI
+from xray_api.proto.app.stats.command import command_pb2, command_pb2_grpc
+
+
+class FakeStats(command_pb2_grpc.StatsServiceServicer):
+    def __init__(self):
+        self.calls = 0
+
+    def GetSysStats(self, request, context):
+        self.calls += 1
+        return command_pb2.SysStatsResponse(Uptime=self.calls)
+
+
+def serve(port=0):
+    servicer = FakeStats()
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=2))
+    command_pb2_grpc.add_StatsServiceServicer_to_server(servicer, server)
+    port = server.add_insecure_port(f"127.0.0.1:{port}")
+    server.start()
+    return server, port
+
+
+@pytest.fixture
+def pool():
+    pool = ChannelPool()
+    yield pool
+    pool.close_all()
+
+
+def test_keepalive_never_below_server_minimum():
+    options = dict(channel_options("Gozargah", keepalive_time=10))
+
+    assert options["grpc.keepalive_time_ms"] == 300_000
+    assert options["grpc.keepalive_permit_without_calls"] == 0
+    assert options["grpc.ssl_target_name_override"] == "Gozargah"
+
+
+def test_one_channel_per_target(pool):
+    key = channel_key("127.0.0.1", 1)
+
+    assert pool.acquire(key) is pool.acquire(key) is pool.get(key)
+    assert pool.get(channel_key("127.0.0.1", 2)) is not pool.get(key)
+    assert len(pool) == 2
+
+
+def test_idle_channel_closed_after_ttl_only_without_owners(pool):
+    pool.idle_ttl = 0
+    busy, idle = channel_key("127.0.0.1", 1), channel_key("127.0.0.1", 2)
+    busy_channel = pool.acquire(busy)
+    idle_channel = pool.acquire(idle)
+    pool.release(idle)
+    time.sleep(0.01)
+
+    pool.acquire(busy)  # уборка простаивающих — на acquire
+
+    assert pool.get(busy) is busy_channel
+    assert pool.get(idle) is not idle_channel
+
+
+def test_lease_switches_target_and_releases_previous(pool):
+    lease = ChannelLease(pool)
+    old, new = (
+        channel_key("127.0.0.1", 1, b"old-cert", "Gozargah"),
+        channel_key("127.0.0.1", 1, b"new-cert", "Gozargah"),
+    )
+
+    first = lease.channel(old)
+    assert lease.channel(old) is first
+    lease.channel(new)
+
+    assert pool._entries[old].refs == 0 and pool._entries[new].refs == 1
+    lease.release()
+    assert pool._entries[new].refs == 0
+
+
+def test_api_reuses_channel_and_stub_across_server_restart(pool):
+    server, port = serve()
+    key = channel_key("127.0.0.1", port)
+    api = XRayAPI("127.0.0.1", port, channel=pool.acquire(key))
+
+    assert api.get_sys_stats(timeout=5).uptime == 1
+    stub = api._stubs[command_pb2_grpc.StatsServiceStub]
+
+    server.stop(None).wait()
+    server, _ = serve(port)
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                # после рестарта сервера тот же канал переподключается сам
+                assert api.get_sys_stats(timeout=2).uptime == 1
+                break
+            except Exception:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.2)
+    finally:
+        server.stop(None)
+
+    assert api._stubs[command_pb2_grpc.StatsServiceStub] is stub
+    assert api._channel is pool.get(key)
+
+
+def test_closed_channel_is_replaced(pool):
+    key = channel_key("127.0.0.1", 1)
+    channel = pool.get(key)
+
+    pool.close(key)
+
+    assert pool.get(key) is not channel
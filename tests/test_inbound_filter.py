@@ -42,7 +42,7 @@ from app.xray.inbound_filter import apply_inbound_filter
 
 
 class FakeConfig(dict):
-    """Мимикрия XRayConfig: dict + .copy() (deep) + .inbounds_by_tag."""
+    """Мимикрия XRayConfig: dict + .copy() (поверхностный, copy-on-write) + .inbounds_by_tag."""
 
     def __init__(self, *args, inbounds_by_tag=None, **kwargs):
         super().__init__(*args, **kwargs)
@@ -53,9 +53,7 @@ class FakeConfig(dict):
         return self._inbounds_by_tag
 
     def copy(self):
-        clone = FakeConfig(inbounds_by_tag=self._inbounds_by_tag)
-        clone["inbounds"] = [dict(i) for i in self["inbounds"]]
-        return clone
+        return FakeConfig(self, inbounds_by_tag=self._inbounds_by_tag)
 
 
 def _base_config():
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.xray import node_client
+from app.xray.node_client import AsyncNodeClient, NodeAPIError, gather_bounded, run_sync
+
+
+@pytest.fixture
+def server():
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if self.path == "/slow":
+                time.sleep(body["delay"])
+            status, data = (404, {"detail": "not found"}) if self.path == "/missing" else (200, {"echo": body})
+            payload = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=["httpx", "requests"])
+def backend(request, monkeypatch):
+    """Оба пути клиента: httpx (extra node-http2) и прежний requests."""
+    if request.param == "httpx" and node_client.httpx is None:
+        pytest.skip("httpx не установлен")
+    if request.param == "requests":
+        monkeypatch.setattr(node_client, "httpx", None)
+    return request.param
+
+
+def test_post_returns_status_and_json(server, backend):
+    client = AsyncNodeClient(server, http2=True)
+
+    assert run_sync(client.post("/ping", 5, json={"session_id": "s"})) == (200, {"echo": {"session_id": "s"}})
+    assert run_sync(client.post("/missing", 5, json={})) == (404, {"detail": "not found"})
+
+
+def test_network_error_is_node_api_error(backend):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    client = AsyncNodeClient(f"http://127.0.0.1:{port}")
+
+    with pytest.raises(NodeAPIError) as exc:
+        run_sync(client.post("/ping", 1, json={}))
+    assert exc.value.status_code == 0
+
+
+def test_http2_only_with_the_extra(monkeypatch, caplog):
+    assert not AsyncNodeClient("https://node").http2
+    assert AsyncNodeClient("https://node", http2=True).http2 is node_client.HTTP2_AVAILABLE
+
+    monkeypatch.setattr(node_client, "HTTP2_AVAILABLE", False)
+    node_client._warn_http2_unavailable.cache_clear()
+    with caplog.at_level("WARNING", logger="uvicorn.error"):
+        AsyncNodeClient("https://node", http2=True)
+        AsyncNodeClient("https://node", http2=True)
+
+    assert [r.message for r in caplog.records if "XRAY_NODE_HTTP2" in r.message] == [
+        "XRAY_NODE_HTTP2 is on but httpx/h2 are not installed (extra node-http2), using HTTP/1.1"
+    ]
+
+
+@pytest.mark.skipif(not node_client.HTTP2_AVAILABLE, reason="httpx[http2] не установлен")
+def test_httpx_client_is_used_when_installed(server):
+    client = AsyncNodeClient(server, http2=True)
+
+    assert run_sync(client.post("/ping", 5, json={}))[0] == 200
+    assert isinstance(client._client, node_client.httpx.AsyncClient)
+    client.reset()
+
+
+def test_slow_node_does_not_delay_others(server):
+    clients = [AsyncNodeClient(server) for _ in range(10)]
+
+    async def probe(i, client):
+        return await client.post("/slow", 10, json={"delay": 1.5 if i == 0 else 0.1})
+
+    t0 = time.perf_counter()
+    results = run_sync(gather_bounded((probe(i, c) for i, c in enumerate(clients)), limit=5))
+    elapsed = time.perf_counter() - t0
+
+    assert [status for status, _ in results] == [200] * 10
+    assert elapsed < 2.5  # последовательно было бы 1.5 + 9 × 0.1 плюс накладные расходы
+
+
+def test_gather_bounded_limits_concurrency_and_returns_exceptions():
+    running = peak = 0
+
+    async def job(i):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        if i == 3:
+            raise ValueError(i)
+        return i
+
+    results = run_sync(gather_bounded((job(i) for i in range(20)), limit=4))
+
+    assert peak == 4
+    assert isinstance(results[3], ValueError)
+    assert [r for i, r in enumerate(results) if i != 3] == [i for i in range(20) if i != 3]
+
+
+def test_run_sync_inside_loop_is_rejected():
+    async def nested():
+        run_sync(asyncio.sleep(0))
+
+    with pytest.raises(RuntimeError):
+        run_sync(nested())
@@ -0,0 +1,89 @@
+import asyncio
+
+from app.xray.node_client import gather_bounded
+from app.xray.node_health import DEGRADED, DOWN, READY, NodeHealthCollector, NodeHealthRegistry, probe_all
+
+
+def test_ok_probe_is_ready_and_slow_one_degraded():
+    registry = NodeHealthRegistry(slow_rtt=1.0)
+
+    assert registry.record(1, "ok", 0.05).state == READY
+    assert registry.record(2, "ok", 1.5).state == DEGRADED
+    assert registry.usable(1) and registry.usable(2)
+    assert registry.get(1).rtt == 0.05
+
+
+def test_stopped_and_disconnected_are_down_immediately():
+    registry = NodeHealthRegistry()
+    registry.mark_ready(1)
+    registry.mark_ready(2)
+
+    stopped = registry.record(1, "stopped")
+    disconnected = registry.record(2, "disconnected")
+
+    assert stopped.state == disconnected.state == DOWN
+    # restart vs connect: у остановленного ядра сессия есть
+    assert stopped.connected and not disconnected.connected
+    assert not registry.usable(1) and registry.down(1)
+
+
+def test_probe_errors_degrade_then_go_down():
+    registry = NodeHealthRegistry(down_after=3)
+    registry.record(1, "ok", 0.01)
+
+    states = [registry.record(1, TimeoutError("slow")).state for _ in range(3)]
+
+    assert states == [DEGRADED, DEGRADED, DOWN]
+    health = registry.get(1)
+    assert health.consecutive_failures == 3 and health.last_error == "TimeoutError: slow"
+    assert registry.record(1, "ok", 0.01).consecutive_failures == 0
+
+
+def test_events_update_state_without_probe():
+    registry = NodeHealthRegistry()
+
+    assert registry.get(1) is None and not registry.connected(1) and not registry.down(1)
+    registry.mark_down(1, "connect failed")
+    assert registry.down(1) and registry.get(1).last_error == "connect failed"
+    registry.mark_ready(1)
+    assert registry.state(1) == READY and registry.connected(1)
+    registry.forget(1)
+    assert registry.get(1) is None
+
+
+def test_probe_all_records_every_node_concurrently():
+    registry = NodeHealthRegistry(down_after=1)
+    nodes = [(i, i) for i in range(20)]
+
+    async def probe(node):
+        await asyncio.sleep(0.05)
+        if node == 3:
+            raise ConnectionError("refused")
+        return "stopped" if node == 4 else "ok"
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        t0 = loop.time()
+        await probe_all(registry, nodes, probe, gather_bounded, limit=10)
+        return loop.time() - t0
+
+    elapsed = asyncio.run(run())
+
+    assert elapsed < 0.5
+    assert {h.node_id for h in registry.snapshot()} == set(range(20))
+    assert registry.state(3) == registry.state(4) == DOWN
+    assert registry.state(0) == READY
+
+
+def test_collector_exports_state_rtt_and_failures():
+    registry = NodeHealthRegistry()
+    registry.record(7, "ok", 0.2)
+    registry.record(8, "disconnected")
+
+    families = {family.name: family for family in NodeHealthCollector(registry).collect()}
+
+    states = {(s.labels["node_id"], s.labels["state"]): s.value for s in families["xray_node_state"].samples}
+    assert states[("7", READY)] == 1 and states[("7", DOWN)] == 0 and states[("8", DOWN)] == 1
+    assert [s.value for s in families["xray_node_probe_rtt_seconds"].samples] == [0.2]
+    failures = {s.labels["node_id"]: s.value for s in families["xray_node_consecutive_failures"].samples}
+    assert failures == {"7": 0, "8": 1}
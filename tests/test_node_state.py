@@ -0,0 +1,94 @@
+from app.xray.node_state import (
+    PushedState,
+    client_fingerprint,
+    config_fingerprints,
+    diff_state,
+    reconcile_ops,
+)
+from app.xray.user_ops import ADD, ALTER, REMOVE, UserOp
+
+
+def client(uid, name, **settings):
+    return {"email": f"{uid}.{name}", "id": f"uuid-{uid}", **settings}
+
+
+def config(**clients_by_tag):
+    return {
+        "inbounds": [
+            {"tag": tag, "protocol": "vless", "settings": {"clients": clients}}
+            for tag, clients in clients_by_tag.items()
+        ]
+        + [{"tag": "api", "protocol": "dokodemo-door", "settings": {}}]
+    }
+
+
+def test_fingerprint_ignores_key_order():
+    assert client_fingerprint({"email": "1.a", "id": "x"}) == client_fingerprint({"id": "x", "email": "1.a"})
+    assert client_fingerprint({"email": "1.a", "id": "x"}) != client_fingerprint({"email": "1.a", "id": "y"})
+
+
+def test_config_fingerprints_skips_clients_without_email():
+    cfg = config(vless=[client(1, "alice"), {"id": "cascade", "flow": "xtls-rprx-vision"}])
+    fps = config_fingerprints(cfg)
+    assert set(fps) == {"vless"}  # без clients инбаунд не учитывается
+    assert list(fps["vless"]) == ["1.alice"]
+
+
+def test_config_fingerprints_cache_shares_client_objects():
+    shared = client(1, "alice")
+    cache = {}
+    first = config_fingerprints(config(a=[shared]), cache)
+    second = config_fingerprints(config(b=[shared]), cache)
+    assert first["a"] == second["b"]
+    assert len(cache) == 1
+
+
+def test_diff_state():
+    desired = {"vless": {"1.alice": 1, "2.bob": 2, "3.carol": 3}, "trojan": {}}
+    pushed = {"vless": {"1.alice": 1, "2.bob": 20, "4.dave": 4}, "vmess": {"5.eve": 5}}
+    to_push, to_remove = diff_state(desired, pushed)
+    assert sorted(to_push) == [("vless", "2.bob"), ("vless", "3.carol")]
+    # vmess нет в желаемом конфиге ноды — его не трогаем
+    assert to_remove == [("vless", "4.dave")]
+
+
+def test_diff_state_unknown_fingerprint_is_repushed():
+    to_push, _ = diff_state({"vless": {"1.alice": 1}}, {"vless": {"1.alice": None}})
+    assert to_push == [("vless", "1.alice")]
+
+
+def test_reconcile_ops_and_skip():
+    alice, bob = client(1, "alice"), client(2, "bob")
+    state = PushedState()
+    state.reset(7, config_fingerprints(config(vless=[alice, client(3, "carol")])))
+
+    ops = reconcile_ops(config(vless=[alice, bob]), state.snapshot(7))
+    assert ops == [
+        UserOp(REMOVE, "vless", "3.carol"),
+        UserOp(ALTER, "vless", "2.bob", client=bob, protocol="vless"),
+    ]
+    assert reconcile_ops(config(vless=[alice, bob]), state.snapshot(7), skip={("vless", "3.carol")}) == ops[1:]
+
+
+def test_pushed_state_record():
+    alice = client(1, "alice")
+    state = PushedState()
+    state.record(7, UserOp(ADD, "vless", "1.alice", client=alice), True)
+    assert not state.known(7)  # без снимка ничего не знаем
+
+    state.reset(7, {"vless": {}})
+    mark = state.mark()
+    state.record(7, UserOp(ADD, "vless", "1.alice", client=alice), True)
+    state.record(7, UserOp(ADD, "trojan", "1.alice", client=alice), True)  # инбаунда нет на ноде
+    assert state.snapshot(7) == {"vless": {"1.alice": client_fingerprint(alice)}}
+    assert state.changed_since(7, mark) == {("vless", "1.alice")}
+
+    state.record(7, UserOp(ALTER, "vless", "1.alice", client=alice), False)
+    assert state.snapshot(7) == {"vless": {"1.alice": None}}
+
+    state.record(7, UserOp(REMOVE, "vless", "1.alice"), True)
+    assert state.snapshot(7) == {"vless": {}}
+
+    state.drop(7)
+    assert not state.known(7)
+    assert state.changed_since(7, mark) == set()
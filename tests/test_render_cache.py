@@ -0,0 +1,62 @@
+from app.subscription.bs_context import BsContext
+from app.subscription.render_cache import RenderCache, render_key
+from app.subscription.subscription_service import SubscriptionRenderPlan
+
+PLAN = SubscriptionRenderPlan("sing-box", False, False, "application/json")
+
+
+def test_key_tracks_everything_that_shapes_the_body(render_ctx):
+    base = render_key(render_ctx(), PLAN, 3)
+
+    assert render_key(render_ctx(), PLAN, 3) == base
+    assert render_key(render_ctx(bs=BsContext.empty()), PLAN, 3) == base
+    assert render_key(render_ctx(user_key=(1, 8)), PLAN, 3) != base
+    assert render_key(render_ctx(), PLAN, 4) != base
+    assert render_key(render_ctx(), PLAN._replace(reverse=True), 3) != base
+    assert render_key(render_ctx(device_limited=True), PLAN, 3) != base
+    assert render_key(render_ctx(bs=BsContext(frozenset({1}), frozenset({1}), "limit")), PLAN, 3) != base
+    assert render_key(render_ctx(user_key=None), PLAN, 3) is None
+
+
+def test_renders_once_per_key():
+    cache = RenderCache(1024, ttl=60)
+    calls = []
+
+    def render():
+        calls.append(1)
+        return f"body{len(calls)}"
+
+    assert cache.get_or_render(("k",), "sing-box", render) == "body1"
+    assert cache.get_or_render(("k",), "sing-box", render) == "body1"
+    assert cache.get_or_render(None, "sing-box", render) == "body2"
+    assert (cache.hits, len(calls)) == (1, 2)
+
+
+def test_fresh_formats_and_disabled_cache_always_render():
+    fresh = RenderCache(1024, ttl=60, fresh_formats=["v2ray"])
+    disabled = RenderCache(0, ttl=60)
+    counter = iter(range(100))
+
+    def render():
+        return str(next(counter))
+
+    assert fresh.get_or_render(("k",), "v2ray", render) != fresh.get_or_render(("k",), "v2ray", render)
+    assert disabled.get_or_render(("k",), "clash", render) != disabled.get_or_render(("k",), "clash", render)
+    assert len(fresh) == len(disabled) == 0
+
+
+def test_evicts_by_size_and_ttl(clock):
+    cache = RenderCache(10, ttl=60, clock=clock)
+    cache.put(("a",), "aaaa")
+    cache.put(("b",), "bbbb")
+    cache.get(("a",))  # b — самый старый
+
+    cache.put(("c",), "cccc")
+    cache.put(("huge",), "x" * 11)  # больше бюджета — не кладём
+
+    assert cache.get(("b",)) is None and cache.get(("huge",)) is None
+    assert cache.size == 8
+
+    clock.now = 60
+    assert cache.get(("a",)) is None
+    assert cache.size == 4
@@ -0,0 +1,154 @@
+"""app/db/review.py: SQL-отбор кандидатов review_users и set-based смена статусов.
+
+Модуль грузим напрямую через importlib, как app/db/bulk.py в tests/test_db_bulk.py.
+"""
+
+import importlib.util
+import pathlib
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import BigInteger, Column, DateTime, Integer, String, create_engine
+from sqlalchemy.orm import DeclarativeBase, Session
+
+_spec = importlib.util.spec_from_file_location(
+    "app_db_review", pathlib.Path(__file__).parent.parent / "app" / "db" / "review.py"
+)
+review = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(review)
+
+NOW = datetime(2026, 1, 1)
+NOW_TS = int(NOW.timestamp())
+DAY = 86400
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class User(Base):
+    __tablename__ = "users"
+
+    id = Column(Integer, primary_key=True)
+    status = Column(String(16), nullable=False, default="active")
+    used_traffic = Column(BigInteger, default=0)
+    data_limit = Column(BigInteger, nullable=True)
+    expire = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=lambda: NOW - timedelta(days=30))
+    edit_at = Column(DateTime, nullable=True)
+    online_at = Column(DateTime, nullable=True)
+    on_hold_expire_duration = Column(BigInteger, nullable=True)
+    on_hold_timeout = Column(DateTime, nullable=True)
+    last_status_change = Column(DateTime, nullable=True)
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+def ids(db, status, condition):
+    return db.execute(review.candidate_ids_stmt(User, status, condition)).scalars().all()
+
+
+def test_due_picks_only_over_limit_or_expired(db):
+    db.add_all(
+        [
+            User(id=1, used_traffic=10, data_limit=10),  # limited
+            User(id=2, used_traffic=10, data_limit=0),  # 0 — без лимита
+            User(id=3, used_traffic=10, data_limit=None, expire=NOW_TS - 1),  # expired
+            User(id=4, expire=0),
+            User(id=5, expire=NOW_TS + DAY),
+            User(id=6, used_traffic=99, data_limit=10, status="limited"),  # уже не active
+        ]
+    )
+    db.commit()
+
+    assert ids(db, "active", review.due_condition(User, NOW_TS)) == [1, 3]
+
+
+def test_reminders_exclude_due_and_keep_null_columns(db):
+    db.add_all(
+        [
+            User(id=1, used_traffic=80, data_limit=100),  # ≥ 80%
+            User(id=2, used_traffic=50, data_limit=100),
+            User(id=3, data_limit=None, expire=NOW_TS + 2 * DAY),  # NULL data_limit не теряет юзера
+            User(id=4, expire=NOW_TS + 30 * DAY),
+            User(id=5, used_traffic=100, data_limit=100),  # due — его review меняет статус
+        ]
+    )
+    db.commit()
+
+    condition = review.reminder_condition(User, NOW_TS, [80, 90], [1, 3])
+
+    assert ids(db, "active", condition) == [1, 3]
+    assert review.reminder_condition(User, NOW_TS, [], []) is None
+
+
+def test_on_hold_candidates(db):
+    db.add_all(
+        [
+            User(id=1, status="on_hold", online_at=NOW - timedelta(days=1)),  # подключился после создания
+            User(id=2, status="on_hold", edit_at=NOW, online_at=NOW - timedelta(days=1)),  # до правки
+            User(id=3, status="on_hold", on_hold_timeout=NOW - timedelta(seconds=1)),
+            User(id=4, status="on_hold", on_hold_timeout=NOW + timedelta(days=1)),
+        ]
+    )
+    db.commit()
+
+    assert ids(db, "on_hold", review.on_hold_condition(User, NOW)) == [1, 3]
+
+
+def test_set_status_updates_in_one_statement_and_syncs_session(db):
+    db.add_all([User(id=1), User(id=2), User(id=3, status="disabled")])
+    db.commit()
+    users = db.query(User).order_by(User.id).all()
+
+    result = db.execute(review.set_status_stmt(User, [1, 2, 3], "active", "limited", NOW))
+
+    assert result.rowcount == 2  # статус 3 сменили параллельно — не трогаем
+    assert [u.status for u in users] == ["limited", "limited", "disabled"]
+    assert users[0].last_status_change == NOW and users[2].last_status_change is None
+
+
+def test_lock_status_sees_changes_the_session_does_not(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'review.db'}")
+    Base.metadata.create_all(engine)
+    with Session(engine) as db, Session(engine) as other:
+        db.add_all([User(id=1), User(id=2), User(id=3)])
+        db.commit()
+        users = db.query(User).order_by(User.id).all()
+        other.get(User, 2).status = "disabled"  # админ сменил статус после выборки кандидатов
+        other.commit()
+
+        locked = db.execute(review.lock_status_stmt(User, [1, 2, 3], "active")).scalars().all()
+        db.execute(review.set_status_stmt(User, locked, "active", "limited", NOW))
+
+        assert locked == [1, 3]
+        assert [u.status for u in users] == ["limited", "active", "limited"]  # объект 2 устарел, а не сменён
+        db.commit()
+        assert db.get(User, 2).status == "disabled"
+
+
+def test_activate_on_hold_starts_expire(db):
+    db.add_all(
+        [
+            User(id=1, status="on_hold", on_hold_expire_duration=7 * DAY, on_hold_timeout=NOW),
+            User(id=2, status="on_hold", on_hold_expire_duration=None),
+        ]
+    )
+    db.commit()
+    users = db.query(User).order_by(User.id).all()
+
+    for stmt in review.activate_on_hold_statements(User, [1, 2], "on_hold", "active", NOW):
+        db.execute(stmt)
+
+    first, second = users  # объекты сессии синхронизированы до commit (по ним шлётся report)
+    assert first.status == second.status == "active"
+    assert first.expire == NOW_TS + 7 * DAY and first.on_hold_timeout is None
+    assert first.on_hold_expire_duration is None and second.expire is None
+    db.commit()
+    assert db.get(User, 1).expire == NOW_TS + 7 * DAY
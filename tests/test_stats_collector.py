@@ -0,0 +1,146 @@
+import asyncio
+import time
+from concurrent import futures
+from types import SimpleNamespace
+
+import grpc
+import pytest
+
+from app.utils.usage_buffer import UsageBuffer
+from app.utils.usage_spool import UsageSpool
+from app.xray import stats_collector
+from app.xray.stats_collector import AsyncStatsCollector, NodeStatsPoller, columns_to_params, parse_users_usage
+from xray_api.proto.app.stats.command import command_pb2, command_pb2_grpc
+
+
+def stat(name, value):
+    return SimpleNamespace(name=name, value=value)
+
+
+def test_parse_sums_links_and_skips_garbage():
+    uids, values = parse_users_usage(
+        [
+            stat("user>>>1.alice>>>traffic>>>uplink", 10),
+            stat("user>>>1.alice>>>traffic>>>downlink", 5),
+            stat("user>>>2.bob>>>traffic>>>downlink", 0),
+            stat("user>>>x.bad>>>traffic>>>uplink", 7),
+            stat("user>>>nodot>>>traffic>>>uplink", 7),
+            stat("inbound>>>3.tag>>>traffic>>>uplink", 7),
+            stat("user>>>3.carol>>>traffic>>>uplink", 2**40),
+        ]
+    )
+    assert columns_to_params(uids, values) == [{"uid": 1, "value": 15}, {"uid": 3, "value": 2**40}]
+
+
+class FakeStats(command_pb2_grpc.StatsServiceServicer):
+    def __init__(self):
+        self.requests = []
+
+    def QueryStats(self, request, context):
+        self.requests.append((request.pattern, request.reset))
+        return command_pb2.QueryStatsResponse(
+            stat=[
+                command_pb2.Stat(name="user>>>7.u>>>traffic>>>uplink", value=3),
+                command_pb2.Stat(name="user>>>7.u>>>traffic>>>downlink", value=4),
+            ]
+        )
+
+
+@pytest.fixture
+def stats_server():
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=2))
+    servicer = FakeStats()
+    command_pb2_grpc.add_StatsServiceServicer_to_server(servicer, server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    yield servicer, port
+    server.stop(None)
+
+
+def test_collect_polls_all_instances(stats_server):
+    servicer, port = stats_server
+    up = SimpleNamespace(address="127.0.0.1", port=port, ssl_cert=None, ssl_target_name=None)
+    # на порт 1 никто не слушает — нода не ответила, остальные не страдают
+    down = SimpleNamespace(address="127.0.0.1", port=1, ssl_cert=None, ssl_target_name=None)
+    collector = AsyncStatsCollector()
+    try:
+        result = collector.collect({None: up, 5: down}, reset=True, timeout=5)
+    finally:
+        collector.close()
+
+    assert result[5] is None
+    assert columns_to_params(*result[None]) == [{"uid": 7, "value": 7}]
+    assert servicer.requests == [("user>>>", True)]
+
+
+def test_collect_returns_partial_results_when_a_node_hangs(monkeypatch):
+    collector = AsyncStatsCollector()
+    fast = SimpleNamespace(address="fast", port=1, ssl_cert=None, ssl_target_name=None)
+    hung = SimpleNamespace(address="hung", port=1, ssl_cert=None, ssl_target_name=None)
+
+    async def query(key, reset, timeout):
+        if key[0] == "hung":
+            await asyncio.sleep(60)  # игнорирует gRPC-дедлайн
+        return parse_users_usage([stat("user>>>9.u>>>traffic>>>uplink", 4)])
+
+    monkeypatch.setattr(collector, "_query", query)
+    monkeypatch.setattr(stats_collector, "COLLECT_GRACE", 0)
+    try:
+        result = collector.collect({1: fast, 2: hung}, timeout=0.3)
+    finally:
+        collector.close()
+
+    assert result[2] is None
+    assert columns_to_params(*result[1]) == [{"uid": 9, "value": 4}]
+
+
+def test_poller_feeds_buffer_and_slow_node_does_not_block(stats_server):
+    servicer, port = stats_server
+    up = SimpleNamespace(address="127.0.0.1", port=port, ssl_cert=None, ssl_target_name=None)
+    down = SimpleNamespace(address="127.0.0.1", port=1, ssl_cert=None, ssl_target_name=None)
+    collector = AsyncStatsCollector()
+    buffer = UsageBuffer()
+    poller = NodeStatsPoller(collector, buffer, interval=0.2, timeout=0.2)
+    try:
+        poller.sync({3: (up, 2.0), 4: (down, 1)})
+        deadline = time.monotonic() + 5
+        while len(servicer.requests) < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        poller.sync({})
+    finally:
+        poller.stop()
+        collector.close()
+
+    (delta,) = buffer.drain()
+    assert delta.node_id == 3 and delta.coefficient == 2.0
+    # опрос, отменённый посреди RPC, мог не успеть дойти до буфера
+    assert list(delta.uids) == [7]
+    assert delta.values[0] % 7 == 0 and 7 <= delta.values[0] <= 7 * len(servicer.requests)
+
+
+def test_poller_spools_each_poll_before_buffering(stats_server, tmp_path):
+    servicer, port = stats_server
+    up = SimpleNamespace(address="127.0.0.1", port=port, ssl_cert=None, ssl_target_name=None)
+    collector = AsyncStatsCollector()
+    buffer = UsageBuffer()
+    spool = UsageSpool(str(tmp_path), fsync=False)
+    poller = NodeStatsPoller(collector, buffer, interval=0.2, timeout=0.2, spool=spool)
+    try:
+        poller.sync({3: (up, 1)})
+        deadline = time.monotonic() + 5
+        while not len(buffer) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        poller.sync({})
+    finally:
+        poller.stop()
+        collector.close()
+
+    deltas, tick_ids = buffer.drain_ticks()
+    assert tick_ids and spool.pending_count() == len(tick_ids)
+    # тики опросов удержаны процессом — реплей их не трогает
+    assert list(spool.pending()) == []
+    spool.close()
+
+    # а после рестарта до сброса буфера они — единственная копия дельт
+    replayed = list(UsageSpool(str(tmp_path), fsync=False).pending())
+    assert sum(t.nodes[0].values[0] for t in replayed) == deltas[0].values[0]
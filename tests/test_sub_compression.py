@@ -0,0 +1,109 @@
+import pytest
+
+from app.subscription import compression
+from app.subscription.compression import SubCompression, add_vary, parse_accept_encoding
+from app.subscription.etag import matched_etag, variant_etag
+from app.subscription.render_cache import RenderCache
+
+BODY = ('{"outbounds": [' + ", ".join(['{"tag": "proxy", "server": "node.example.com"}'] * 200) + "]}").encode()
+
+
+def test_parse_accept_encoding():
+    assert parse_accept_encoding("gzip, br;q=0.5, zstd;q=0, deflate;q=bad") == {
+        "gzip": 1.0,
+        "br": 0.5,
+        "zstd": 0.0,
+        "deflate": 0.0,
+    }
+    assert parse_accept_encoding(None) == {}
+
+
+def test_negotiation_follows_q_then_server_preference(monkeypatch):
+    monkeypatch.setattr(compression, "SUPPORTED_ENCODINGS", ("br", "zstd", "gzip"))
+    sub = SubCompression(["br", "zstd", "gzip"], min_bytes=100, cpu_share=1)
+
+    assert sub.acceptable("gzip, br", 1000) == ["br", "gzip"]
+    assert sub.acceptable("gzip, br;q=0.5", 1000) == ["gzip", "br"]
+    assert sub.acceptable("*, br;q=0", 1000) == ["zstd", "gzip"]
+    assert sub.acceptable("identity", 1000) == []
+    assert sub.acceptable("gzip", 99) == []  # меньше порога — как есть
+    assert SubCompression(["gzip"], 0, cpu_share=0).acceptable("gzip", 1000) == []
+
+
+def test_unavailable_encodings_are_not_offered(monkeypatch):
+    monkeypatch.setattr(compression, "SUPPORTED_ENCODINGS", ("gzip",))
+
+    sub = SubCompression(["br", "zstd", "gzip", "deflate"], 0, 1)
+
+    assert sub.acceptable("br, zstd, gzip", 10) == ["gzip"]
+    assert sub.unavailable == ("br", "zstd", "deflate")  # пишутся в лог на старте
+
+
+def test_compression_roundtrip_and_cpu_budget(monkeypatch, clock, cpu_clock):
+    original = compression.compress
+
+    def slow_compress(*args):
+        cpu_clock.now += 0.3
+        return original(*args)
+
+    monkeypatch.setattr(compression, "compress", slow_compress)
+    sub = SubCompression(["gzip"], 0, cpu_share=0.25, clock=clock, cpu_clock=cpu_clock)
+
+    data = sub.compress(BODY, "gzip")
+    assert compression.decompress(data, "gzip") == BODY
+    assert len(data) * 5 < len(BODY)
+
+    assert sub.compress(BODY, "gzip") is None  # бюджет ушёл в минус: 0.25 − 0.3
+    clock.now = 0.1
+    assert sub.compress(BODY, "gzip") is None
+    clock.now = 0.5
+    assert sub.compress(BODY, "gzip") is not None
+
+
+def test_add_vary_keeps_existing_headers():
+    headers = {"subscription-userinfo": "upload=0", "vary": "User-Agent"}
+
+    assert add_vary(headers) == {"subscription-userinfo": "upload=0", "vary": "User-Agent, Accept-Encoding"}
+    assert add_vary({"Vary": "accept-encoding"}) == {"Vary": "accept-encoding"}
+    assert add_vary({}) == {"vary": "Accept-Encoding"}
+    assert headers == {"subscription-userinfo": "upload=0", "vary": "User-Agent"}
+
+
+def test_variants_live_next_to_the_body(clock):
+    cache = RenderCache(1000, ttl=60, clock=clock)
+
+    cache.put_variant(("k",), "gzip", b"x")  # без тела не сохраняется
+    assert cache.get_variant(("k",), "gzip") is None
+
+    cache.put(("k",), "a" * 100)
+    cache.put_variant(("k",), "gzip", b"z" * 20)
+    assert cache.get_variant(("k",), "gzip") == b"z" * 20
+    assert cache.get_variant(("k",), "br") is None
+    assert cache.size == 120
+
+    cache.put(("other",), "b" * 890)  # вытесняет старое тело вместе с вариантом
+    assert cache.get_variant(("k",), "gzip") is None
+    assert cache.size == 890
+
+    clock.now = 60
+    assert cache.get_variant(("other",), "gzip") is None
+
+
+def test_variant_etags_differ_but_match_weakly():
+    etag = '"abc"'
+
+    assert variant_etag(etag, None) == etag
+    assert variant_etag(etag, "gzip") == '"abc-gzip"'
+    assert matched_etag('"abc-gzip"', etag) == '"abc-gzip"'
+    assert matched_etag('W/"abc-br", "zzz"', etag) == 'W/"abc-br"'
+    assert matched_etag('"abd-gzip"', etag) is None
+
+
+@pytest.mark.skipif("br" not in compression.SUPPORTED_ENCODINGS, reason="brotli не установлен")
+def test_brotli_roundtrip():
+    assert compression.decompress(compression.compress(BODY, "br"), "br") == BODY
+
+
+@pytest.mark.skipif("zstd" not in compression.SUPPORTED_ENCODINGS, reason="zstandard не установлен")
+def test_zstd_roundtrip():
+    assert compression.decompress(compression.compress(BODY, "zstd"), "zstd") == BODY
@@ -0,0 +1,100 @@
+from datetime import datetime
+
+from pydantic import BaseModel
+
+from app.subscription import randomness
+from app.subscription.bs_context import BsContext
+from app.subscription.etag import SubscriptionETags, etag_matches, snapshot_digest
+from app.subscription.subscription_service import SubscriptionRenderPlan
+
+PLAN = SubscriptionRenderPlan("sing-box", False, False, "application/json")
+HOSTS = {"VLESS TCP": [{"remark": "node", "node_ids": {2, 1}}]}
+
+
+class User(BaseModel):
+    username: str
+    used_traffic: int
+    links: list[str] = []
+    sub_updated_at: datetime | None = None
+
+
+def test_validator_tracks_everything_that_shapes_the_body(clock, render_ctx):
+    etags = SubscriptionETags(3600, clock=clock)
+    base = etags.validator(render_ctx(), PLAN, 3, lambda: HOSTS)
+
+    assert base.startswith('"') and base.endswith('"')
+    # версия снимка (перезагрузка из БД) валидатор не меняет — только содержимое
+    assert etags.validator(render_ctx(user_key=(1, 8)), PLAN, 3, lambda: HOSTS) == base
+    assert etags.validator(render_ctx(user_digest="u2"), PLAN, 3, lambda: HOSTS) != base
+    assert etags.validator(render_ctx(), PLAN._replace(config_format="clash"), 3, lambda: HOSTS) != base
+    assert etags.validator(render_ctx(device_limited=True), PLAN, 3, lambda: HOSTS) != base
+    assert etags.validator(render_ctx(bs=BsContext(frozenset({1}), frozenset(), "")), PLAN, 3, lambda: HOSTS) != base
+    assert etags.validator(render_ctx(), PLAN, 4, lambda: {}) != base
+    assert etags.validator(render_ctx(user_key=None), PLAN, 3, lambda: HOSTS) is None
+    assert etags.validator(render_ctx(user_digest=""), PLAN, 3, lambda: HOSTS) is None
+
+
+def test_hosts_digest_is_computed_once_per_version():
+    etags = SubscriptionETags(3600)
+    calls = []
+
+    def hosts_state():
+        calls.append(1)
+        return HOSTS
+
+    assert etags.hosts_digest(1, hosts_state) == etags.hosts_digest(1, hosts_state)
+    etags.hosts_digest(2, hosts_state)
+
+    assert len(calls) == 2
+    # множества сериализуются в порядке сортировки — digest одинаков в любом воркере
+    assert etags.hosts_digest(3, lambda: {"VLESS TCP": [{"remark": "node", "node_ids": {1, 2}}]}) == (
+        etags.hosts_digest(4, lambda: HOSTS)
+    )
+
+
+def test_validator_expires_per_user_window(clock, render_ctx):
+    etags = SubscriptionETags(100, clock=clock)
+    first = etags.validator(render_ctx(user_key=(30, 1)), PLAN, 1, dict)
+
+    clock.now = 69
+    assert etags.validator(render_ctx(user_key=(30, 1)), PLAN, 1, dict) == first
+    clock.now = 70  # окно юзера 30 сдвинуто на 30 секунд
+    assert etags.validator(render_ctx(user_key=(30, 1)), PLAN, 1, dict) != first
+
+
+def test_fresh_formats_get_etag_only_with_stable_random(render_ctx):
+    plan = PLAN._replace(config_format="v2ray")
+
+    assert SubscriptionETags(0).validator(render_ctx(), PLAN, 1, dict) is None
+    assert SubscriptionETags(60, ["v2ray"]).validator(render_ctx(), plan, 1, dict) is None
+    assert SubscriptionETags(60, ["v2ray"], stable_random=True).validator(render_ctx(), plan, 1, dict) is not None
+
+
+def test_if_none_match_uses_weak_comparison():
+    assert etag_matches('"abc"', '"abc"')
+    assert etag_matches('W/"old", W/"abc"', '"abc"')
+    assert etag_matches("*", '"abc"')
+    assert not etag_matches('"abcd"', '"abc"')
+    assert not etag_matches(None, '"abc"')
+
+
+def test_snapshot_digest_ignores_fields_touched_by_polling():
+    user = User(username="u", used_traffic=1, links=["vless://a"])
+    polled = User(username="u", used_traffic=1, links=["vless://b"], sub_updated_at=datetime(2026, 1, 1))
+
+    assert snapshot_digest(user, {"a": 1}) == snapshot_digest(polled, {"a": 1})
+    assert snapshot_digest(user, {"a": 1}) != snapshot_digest(user, {"a": 2})
+    assert snapshot_digest(user, None) != snapshot_digest(User(username="u", used_traffic=2), None)
+
+
+def test_seeded_randomness_is_deterministic_and_scoped():
+    def draw():
+        return randomness.choice("abcdefgh"), randomness.token_hex(8)
+
+    with randomness.seeded('"etag"'):
+        first = draw()
+    with randomness.seeded('"etag"'):
+        assert draw() == first
+    with randomness.seeded('"other"'):
+        assert draw() != first
+    assert randomness._rng.get() is None
@@ -64,9 +64,13 @@ def _load_real_module(name: str, path: pathlib.Path) -> types.ModuleType:
 _templates_filters = _load_real_module("app.templates.filters", _ROOT / "app" / "templates" / "filters.py")
 _env = jinja2.Environment(loader=jinja2.FileSystemLoader(str(_ROOT / "app" / "templates")))
 _env.filters.update(_templates_filters.CUSTOM_FILTERS)
+_templates_registry = _load_real_module("app.templates.registry", _ROOT / "app" / "templates" / "registry.py")
 _stub_module(
     "app.templates",
-    {"render_template": lambda template, context=None: _env.get_template(template).render(context or {})},
+    {
+        "render_template": lambda template, context=None: _env.get_template(template).render(context or {}),
+        "template_registry": _templates_registry.TemplateRegistry(_env),
+    },
 )
 
 from app.subscription.bs_context import ZERO_STUB, BsContext, StubEndpoint  # noqa: E402
@@ -0,0 +1,149 @@
+"""app/templates/registry.py: разбор шаблонов раз на версию файла и компиляция в Frame.
+
+Модуль грузим напрямую через importlib: `import app.templates` запустил бы
+app/templates/__init__.py (config, фильтры → app.utils.system → app.scheduler).
+"""
+
+import importlib.util
+import json
+import os
+import pathlib
+import sys
+
+import jinja2
+import pytest
+import yaml
+
+_spec = importlib.util.spec_from_file_location(
+    "app_templates_registry", pathlib.Path(__file__).parent.parent / "app" / "templates" / "registry.py"
+)
+registry = importlib.util.module_from_spec(_spec)
+sys.modules[_spec.name] = registry
+_spec.loader.exec_module(registry)
+
+CLASH_LIKE = """mode: Global
+{{ conf | except("proxy-groups") | yaml }}
+proxy-groups:
+- name: auto
+  proxies:
+  {{ proxy_remarks | yaml | indent(2) }}
+{{ conf.get("proxy-groups", []) | yaml }}
+"""
+PROBE = {
+    "conf": {
+        "proxies": [{"name": "a", "port": 1}, {"name": "b", "port": 2}],
+        "proxy-groups": [{"name": "g"}, {"name": "h"}],
+    },
+    "proxy_remarks": ["a", "b"],
+}
+
+
+def to_yaml(obj):
+    return yaml.dump(obj, allow_unicode=True, indent=2) if obj else ""
+
+
+def yaml_plain(value):
+    if isinstance(value, dict):
+        return {key: yaml_plain(value[key]) for key in sorted(value)}
+    if isinstance(value, list):
+        return [yaml_plain(item) for item in value]
+    return value
+
+
+@pytest.fixture
+def env(tmp_path):
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(str(tmp_path)))
+    env.filters.update(yaml=to_yaml, **{"except": lambda obj, *keys: {k: v for k, v in obj.items() if k not in keys}})
+    return env
+
+
+def write(tmp_path, name, text, mtime_ns):
+    path = tmp_path / name
+    path.write_text(text)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_parses_once_per_file_version(env, tmp_path):
+    calls = []
+
+    def parse(text):
+        calls.append(text)
+        return json.loads(text)
+
+    templates = registry.TemplateRegistry(env)
+    write(tmp_path, "mux.json", '{"v2ray": {"enabled": true}}', 10**18)
+
+    first = templates.get("mux.json", parse)
+    assert templates.get("mux.json", parse) is first
+    assert templates.get("mux.json") == '{"v2ray": {"enabled": true}}'
+    assert len(calls) == 1
+
+    write(tmp_path, "mux.json", '{"v2ray": {"enabled": false}}', 2 * 10**18)
+    assert templates.get("mux.json", parse) == {"v2ray": {"enabled": False}}
+    assert len(calls) == 2
+
+
+def test_missing_template_is_rechecked_later(env, tmp_path, clock):
+    templates = registry.TemplateRegistry(env, clock=clock)
+
+    with pytest.raises(jinja2.TemplateNotFound):
+        templates.get("settings.json", json.loads)
+    write(tmp_path, "settings.json", "{}", 10**18)
+    with pytest.raises(jinja2.TemplateNotFound):
+        templates.get("settings.json", json.loads)  # отсутствие закэшировано
+
+    clock.now = registry.MISSING_RECHECK
+    assert templates.get("settings.json", json.loads) == {}
+
+
+def test_parse_text_caches_by_string():
+    templates = registry.TemplateRegistry(jinja2.Environment(), max_texts=1)
+    calls = []
+
+    def parse(raw):
+        calls.append(raw)
+        return json.loads(raw)
+
+    assert templates.parse_text('{"a": 1}', parse) is templates.parse_text('{"a": 1}', parse)
+    templates.parse_text('{"b": 2}', parse)
+    templates.parse_text('{"a": 1}', parse)  # вытеснен
+
+    assert calls == ['{"a": 1}', '{"b": 2}', '{"a": 1}']
+
+
+def test_clone_copies_containers_only():
+    tree = {"outbounds": [{"tag": "direct", "settings": {}}], "remarks": "x"}
+    copy = registry.clone(tree)
+
+    copy["outbounds"][0]["settings"]["mark"] = 1
+    assert copy == {"outbounds": [{"tag": "direct", "settings": {"mark": 1}}], "remarks": "x"}
+    assert tree["outbounds"][0]["settings"] == {}
+
+
+@pytest.mark.parametrize(
+    "context",
+    [
+        PROBE,
+        {
+            "conf": {"proxies": [{"port": 3, "name": "c"}], "proxy-groups": []},
+            "proxy_remarks": ["c"],
+        },
+        {"conf": {"proxies": [], "proxy-groups": []}, "proxy_remarks": []},
+    ],
+)
+def test_frame_matches_full_render(env, tmp_path, context):
+    write(tmp_path, "clash.yml", CLASH_LIKE, 10**18)
+    templates = registry.TemplateRegistry(env)
+
+    tree = templates.render_frame("clash.yml", yaml.safe_load, context, PROBE, yaml_plain)
+
+    expected = yaml.safe_load(env.get_template("clash.yml").render(context))
+    assert tree is not None
+    assert yaml.dump(tree, sort_keys=False) == yaml.dump(expected, sort_keys=False)
+
+
+def test_frame_refuses_templates_that_inspect_lists(env, tmp_path):
+    write(tmp_path, "loop.yml", "count: {{ proxy_remarks | length }}\nnames: {{ proxy_remarks | yaml }}", 10**18)
+    templates = registry.TemplateRegistry(env)
+
+    assert templates.render_frame("loop.yml", yaml.safe_load, PROBE, PROBE, yaml_plain) is None
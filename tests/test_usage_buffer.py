@@ -0,0 +1,31 @@
+from array import array
+
+from app.utils.usage_buffer import UsageBuffer
+
+
+def test_add_accumulates_per_node_and_drain_clears():
+    buffer = UsageBuffer()
+    buffer.add(1, 1.5, array("q", [10, 11]), array("q", [100, 5]))
+    buffer.add(1, 2.0, array("q", [10]), array("q", [50]))
+    buffer.add(None, 1, array("q", [10]), array("q", [7]))
+    buffer.add(2, 1, array("q"), array("q"))
+    assert len(buffer) == 3
+
+    deltas = {d.node_id: d for d in buffer.drain()}
+    assert set(deltas) == {1, None}
+    assert dict(zip(deltas[1].uids, deltas[1].values)) == {10: 150, 11: 5}
+    assert deltas[1].coefficient == 2.0
+    assert len(buffer) == 0
+    assert buffer.drain() == []
+
+
+def test_drain_ticks_returns_spooled_poll_ids():
+    buffer = UsageBuffer()
+    buffer.add(1, 1, array("q", [10]), array("q", [5]), "aa" * 16)
+    buffer.add(1, 1, array("q", [10]), array("q", [5]))
+    buffer.add(2, 1, array("q"), array("q"), "bb" * 16)
+
+    deltas, tick_ids = buffer.drain_ticks()
+    assert [(d.node_id, list(d.values)) for d in deltas] == [(1, [10])]
+    assert tick_ids == ["aa" * 16]
+    assert buffer.drain_ticks() == ([], [])
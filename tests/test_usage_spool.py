@@ -0,0 +1,199 @@
+import os
+import struct
+import zlib
+from array import array
+
+import pytest
+
+from app.utils.usage_spool import (
+    NodeDelta,
+    UsageSpool,
+    UsageTick,
+    decode_tick,
+    encode_tick,
+    params_from_tick,
+    stage_tick_id,
+    tick_from_params,
+)
+
+
+def make_tick(tick_id="00" * 16, n=3):
+    return UsageTick(
+        tick_id,
+        1700000000.5,
+        [
+            NodeDelta(None, 1.0, array("q", range(1, n + 1)), array("q", [100] * n)),
+            NodeDelta(7, 1.5, array("q", [42]), array("q", [2**40])),
+        ],
+    )
+
+
+def segments(path):
+    return sorted(name for name in os.listdir(path) if name.endswith(".seg"))
+
+
+def test_encode_decode_roundtrip():
+    tick = make_tick()
+    assert decode_tick(encode_tick(tick)) == tick
+
+
+def test_params_roundtrip_keeps_main_core_and_coefficient():
+    api_params = {None: [{"uid": 1, "value": 10}], 3: [{"uid": 2, "value": 20}], 4: []}
+    tick = tick_from_params(api_params, {None: 1, 3: 0.5, 4: 2})
+    params, coefficients = params_from_tick(tick)
+    assert params == {None: [{"uid": 1, "value": 10}], 3: [{"uid": 2, "value": 20}]}
+    assert coefficients == {None: 1.0, 3: 0.5}
+
+
+def test_append_survives_reopen_until_commit(tmp_path):
+    spool = UsageSpool(str(tmp_path), fsync=False)
+    spool.append(make_tick("11" * 16))
+    spool.append(make_tick("22" * 16))
+    spool.commit("11" * 16)
+    spool.close()
+
+    reopened = UsageSpool(str(tmp_path), fsync=False)
+    assert [t.tick_id for t in reopened.pending()] == ["22" * 16]
+    assert reopened.pending_count() == 1
+
+
+def test_held_ticks_are_skipped_until_merged_or_released(tmp_path):
+    spool = UsageSpool(str(tmp_path), fsync=False)
+    spool.append(make_tick("11" * 16), hold=True)
+    spool.append(make_tick("22" * 16), hold=True)
+    spool.append(make_tick("33" * 16), hold=True)
+    assert list(spool.pending()) == []
+    assert spool.pending_count() == 3
+
+    spool.merge(make_tick("44" * 16), ["11" * 16, "22" * 16])
+    assert [t.tick_id for t in spool.pending()] == ["44" * 16]
+    spool.release(["33" * 16])
+    assert [t.tick_id for t in spool.pending()] == ["33" * 16, "44" * 16]
+
+
+def test_merge_survives_reopen_and_replaces_merged_ticks(tmp_path):
+    spool = UsageSpool(str(tmp_path), fsync=False)
+    spool.append(make_tick("11" * 16), hold=True)
+    spool.append(make_tick("22" * 16), hold=True)
+    spool.merge(make_tick("33" * 16, n=5), ["11" * 16])
+    spool.close()
+
+    # после рестарта удержанных нет: незаменённый тик опроса уходит в реплей
+    reopened = UsageSpool(str(tmp_path), fsync=False)
+    pending = list(reopened.pending())
+    assert [t.tick_id for t in pending] == ["22" * 16, "33" * 16]
+    assert pending[1] == make_tick("33" * 16, n=5)
+
+    reopened.commit("33" * 16)
+    reopened.commit("22" * 16)
+    reopened.close()
+    assert UsageSpool(str(tmp_path), fsync=False).pending_count() == 0
+
+
+def test_quarantined_tick_leaves_the_queue_and_requeues_when_moved_back(tmp_path):
+    spool = UsageSpool(str(tmp_path), fsync=False)
+    spool.append(make_tick("11" * 16))
+    spool.append(make_tick("22" * 16))
+    path = spool.quarantine(make_tick("11" * 16))
+    assert [t.tick_id for t in spool.pending()] == ["22" * 16]
+    spool.close()
+    assert [t.tick_id for t in UsageSpool(str(tmp_path), fsync=False).pending()] == ["22" * 16]
+
+    # ручной реплей: файл из карантина возвращают в каталог спула
+    os.replace(path, tmp_path / os.path.basename(path))
+    requeued = UsageSpool(str(tmp_path), fsync=False)
+    assert [t.tick_id for t in requeued.pending()] == ["22" * 16, "11" * 16]
+    assert next(iter(requeued.pending())) == make_tick("22" * 16)
+    assert not any(name.endswith(".tick") for name in os.listdir(tmp_path))
+    requeued.close()
+    # после рестарта тик по-прежнему в очереди, хоть его старый commit и раньше в журнале
+    assert UsageSpool(str(tmp_path), fsync=False).pending_count() == 2
+
+
+def test_commit_unknown_tick_is_noop(tmp_path):
+    spool = UsageSpool(str(tmp_path), fsync=False)
+    spool.commit("ff" * 16)
+    assert spool.pending_count() == 0
+
+
+def test_torn_tail_is_ignored(tmp_path):
+    spool = UsageSpool(str(tmp_path), fsync=False)
+    spool.append(make_tick("11" * 16))
+    spool.append(make_tick("22" * 16))
+    spool.close()
+    path = os.path.join(tmp_path, segments(tmp_path)[-1])
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 5)
+
+    reopened = UsageSpool(str(tmp_path), fsync=False)
+    assert [t.tick_id for t in reopened.pending()] == ["11" * 16]
+
+
+def test_corrupt_frame_is_dropped_instead_of_pinning_the_spool(tmp_path):
+    spool = UsageSpool(str(tmp_path), fsync=False)
+    spool.append(make_tick("11" * 16))
+    spool.append(make_tick("22" * 16))
+    path = os.path.join(tmp_path, segments(tmp_path)[-1])
+    with open(path, "r+b") as f:
+        f.seek(9 + 16 + 4)  # заголовок фрейма + tick_id: CRC первого тика больше не сходится
+        f.write(b"\xff\xff\xff\xff")
+
+    assert [t.tick_id for t in spool.pending()] == ["22" * 16]
+    assert spool.pending_count() == 1
+    spool.commit("22" * 16)
+    spool.close()
+
+    reopened = UsageSpool(str(tmp_path), fsync=False)
+    assert reopened.pending_count() == 0
+    assert segments(tmp_path) == [segments(tmp_path)[-1]]  # старый сегмент удалён
+
+
+def test_undecodable_frame_with_valid_crc_is_dropped(tmp_path):
+    payload = bytes.fromhex("33" * 16) + b"garbage"
+    with open(os.path.join(tmp_path, "usage-000000000001.seg"), "wb") as f:
+        f.write(struct.pack("<BII", 1, len(payload), zlib.crc32(payload)) + payload)
+
+    spool = UsageSpool(str(tmp_path), fsync=False)
+    assert spool.pending_count() == 1
+    assert list(spool.pending()) == []
+    assert spool.pending_count() == 0
+
+
+def test_decode_rejects_truncated_payload():
+    payload = encode_tick(make_tick())
+    with pytest.raises(ValueError):
+        decode_tick(payload[:-8])
+
+
+def test_committed_segments_are_removed_after_rotation(tmp_path):
+    spool = UsageSpool(str(tmp_path), segment_bytes=1, fsync=False)
+    for i in range(1, 4):
+        spool.append(make_tick(f"{i:02d}" * 16))
+    assert len(segments(tmp_path)) == 3
+
+    for i in range(1, 4):
+        spool.commit(f"{i:02d}" * 16)
+    # активный сегмент (с последними commit-отметками) остаётся, остальные удалены
+    assert len(segments(tmp_path)) == 1
+    assert list(spool.pending()) == []
+
+
+def test_pending_segment_blocks_removal_of_later_ones(tmp_path):
+    spool = UsageSpool(str(tmp_path), segment_bytes=1, fsync=False)
+    for i in range(1, 4):
+        spool.append(make_tick(f"{i:02d}" * 16))
+    spool.commit("02" * 16)
+    spool.commit("03" * 16)
+    spool.close()
+
+    reopened = UsageSpool(str(tmp_path), fsync=False)
+    assert [t.tick_id for t in reopened.pending()] == ["01" * 16]
+
+
+def test_stage_tick_ids_are_distinct_and_fit_the_marker_column():
+    tick_id = "ab" * 16
+    stages = {stage_tick_id(tick_id, stage) for stage in ("nodes", "node:main", "node:7", "bs:7")}
+
+    assert len(stages) == 4 and tick_id not in stages
+    assert all(len(marker) == 32 and bytes.fromhex(marker) for marker in stages)
+    assert stage_tick_id(tick_id, "nodes") == stage_tick_id(tick_id, "nodes")
@@ -0,0 +1,162 @@
+"""app/db/usage_tiers.py: план сегментов по уровням и свёртка часовых строк.
+
+Модуль грузим напрямую через importlib, как app/db/bulk.py в tests/test_db_bulk.py.
+"""
+
+import importlib.util
+import pathlib
+import random
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import BigInteger, Column, DateTime, Integer, MetaData, Table, create_engine, insert, select
+
+_spec = importlib.util.spec_from_file_location(
+    "app_db_usage_tiers", pathlib.Path(__file__).parent.parent / "app" / "db" / "usage_tiers.py"
+)
+tiers = importlib.util.module_from_spec(_spec)
+sys.modules[_spec.name] = tiers  # dataclass ищет свой модуль в sys.modules
+_spec.loader.exec_module(tiers)
+
+H, D, M = tiers.HOURLY, tiers.DAILY, tiers.MONTHLY
+HOUR = timedelta(hours=1)
+
+metadata = MetaData()
+
+
+def usage_table(name):
+    return Table(
+        name,
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("created_at", DateTime, nullable=False),
+        Column("user_id", Integer),
+        Column("node_id", Integer, nullable=True),
+        Column("used_traffic", BigInteger),
+    )
+
+
+TABLES = {H: usage_table("node_user_usages"), D: usage_table("daily"), M: usage_table("monthly")}
+users = Table("users", metadata, Column("id", Integer, primary_key=True), Column("admin_id", Integer))
+
+
+def spans(segments):
+    return [(s.tier, s.start, s.end, s.inclusive) for s in segments]
+
+
+def test_plan_without_rollups_reads_hourly():
+    start, end = datetime(2026, 1, 3, 5), datetime(2026, 3, 1)
+
+    assert spans(tiers.plan(start, end, None, None)) == [(H, start, end, True)]
+
+
+def test_plan_uses_coarsest_tier_below_rollup_bounds():
+    start, end = datetime(2025, 12, 30, 13), datetime(2026, 3, 4, 7)
+
+    segments = tiers.plan(start, end, daily_until=datetime(2026, 3, 3), monthly_until=datetime(2026, 3, 1))
+
+    assert spans(segments) == [
+        (H, start, datetime(2025, 12, 31), False),
+        (D, datetime(2025, 12, 31), datetime(2026, 1, 1), False),
+        (M, datetime(2026, 1, 1), datetime(2026, 3, 1), False),
+        (D, datetime(2026, 3, 1), datetime(2026, 3, 3), False),
+        (H, datetime(2026, 3, 3), end, True),
+    ]
+
+
+def test_plan_keeps_hour_at_end_of_range():
+    # [00:00, 00:00 следующего дня] включительно — последний час уже следующих суток
+    start, end = datetime(2026, 1, 1), datetime(2026, 1, 2)
+
+    assert spans(tiers.plan(start, end, datetime(2026, 2, 1), None)) == [
+        (D, start, end, False),
+        (H, end, end, True),
+    ]
+
+
+def test_due_periods_respect_lag_and_limit():
+    ready = datetime(2026, 1, 5, 2)
+
+    assert tiers.due_periods(D, None, datetime(2026, 1, 1, 17), ready, 10) == [
+        datetime(2026, 1, d) for d in (1, 2, 3, 4)
+    ]
+    assert tiers.due_periods(D, datetime(2026, 1, 3), None, ready, 1) == [datetime(2026, 1, 3)]
+    assert tiers.due_periods(M, None, datetime(2025, 11, 20), datetime(2026, 1, 5), 10) == [
+        datetime(2025, 11, 1),
+        datetime(2025, 12, 1),
+    ]
+    assert tiers.due_periods(D, None, None, ready, 10) == []
+
+
+@pytest.fixture
+def conn():
+    engine = create_engine("sqlite://")
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        yield conn
+
+
+def test_rollups_sum_like_hourly_rows(conn):
+    rng = random.Random(7)
+    first = datetime(2025, 12, 28)
+    rows = [
+        {"created_at": first + HOUR * h, "user_id": user, "node_id": node, "used_traffic": rng.randint(1, 10**6)}
+        for h in range(24 * 40)
+        for user in (1, 2)
+        for node in (None, 5)
+        if rng.random() < 0.7
+    ]
+    conn.execute(insert(TABLES[H]), rows)
+
+    def roll(tier, source, start, until):
+        while start < until:
+            end = tiers.next_period(tier, start)
+            for stmt in tiers.rollup_statements(TABLES[source], TABLES[tier], start, end):
+                conn.execute(stmt)
+            start = end
+
+    daily_until, monthly_until = datetime(2026, 2, 3), datetime(2026, 2, 1)
+    roll(D, H, first, daily_until)
+    roll(D, H, datetime(2026, 1, 10), datetime(2026, 1, 11))  # повторная свёртка идемпотентна
+    roll(M, D, datetime(2025, 12, 1), monthly_until)
+    conn.execute(TABLES[H].delete().where(TABLES[H].c.created_at < datetime(2026, 1, 20)))
+
+    start, end = datetime(2025, 12, 1), datetime(2026, 2, 5, 11)
+    expected = {}
+    for row in rows:
+        if row["user_id"] == 2 and start <= row["created_at"] <= end:
+            expected[row["node_id"]] = expected.get(row["node_id"], 0) + row["used_traffic"]
+
+    segments = tiers.plan(start, end, daily_until, monthly_until)
+    totals = tiers.usage_by_node(conn.execute, TABLES, segments, lambda t: t.c.user_id == 2)
+
+    assert [s.tier for s in segments] == [M, D, H]
+    assert totals == expected
+    assert conn.execute(select(TABLES[M].c.id)).all()  # месячные строки есть, в т.ч. для node_id NULL
+
+
+def test_usage_by_node_filters_through_join(conn):
+    # как get_all_users_usages: JOIN users и фильтр по admin_id вместо IN-списка id
+    conn.execute(insert(users), [{"id": 1, "admin_id": 10}, {"id": 2, "admin_id": 20}, {"id": 3, "admin_id": 10}])
+    hour = datetime(2026, 1, 1, 5)
+    conn.execute(
+        insert(TABLES[H]),
+        [
+            {"created_at": hour, "user_id": 1, "node_id": None, "used_traffic": 1},
+            {"created_at": hour, "user_id": 2, "node_id": None, "used_traffic": 10},
+            {"created_at": hour, "user_id": 3, "node_id": 5, "used_traffic": 100},
+            {"created_at": hour, "user_id": 3, "node_id": None, "used_traffic": 1000},
+            {"created_at": hour, "user_id": 4, "node_id": 5, "used_traffic": 10000},  # юзера уже нет
+        ],
+    )
+
+    totals = tiers.usage_by_node(
+        conn.execute,
+        TABLES,
+        tiers.plan(hour, hour, None, None),
+        lambda t: users.c.admin_id.in_([10]),
+        join=lambda t: (users, users.c.id == t.c.user_id),
+    )
+
+    assert totals == {None: 1001, 5: 100}
@@ -0,0 +1,84 @@
+from app.subscription.user_cache import UserSnapshot, UserSnapshotCache
+
+
+def snapshot(user_id, username="alice"):
+    return UserSnapshot(
+        id=user_id,
+        username=username,
+        created_at=None,
+        sub_revoked_at=None,
+        expire=None,
+        device_limit=None,
+        bs_extra=None,
+        subscription_token="t",
+        user=object(),
+        bot_settings={},
+    )
+
+
+def test_hit_is_case_insensitive_and_expires_after_ttl(clock):
+    cache = UserSnapshotCache(10, ttl=60, clock=clock)
+    alice = snapshot(1, "Alice")
+
+    assert cache.get("alice") is None
+    assert cache.put(alice, cache.epoch())
+    assert cache.get("ALICE") is alice
+
+    clock.now = 60
+    assert cache.get("alice") is None
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_evicts_least_recently_used():
+    cache = UserSnapshotCache(2, ttl=60)
+    for user_id, name in ((1, "a"), (2, "b")):
+        cache.put(snapshot(user_id, name), cache.epoch())
+    cache.get("a")  # b теперь самый старый
+
+    cache.put(snapshot(3, "c"), cache.epoch())
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+
+
+def test_invalidate_ids_and_clear():
+    cache = UserSnapshotCache(10, ttl=60)
+    cache.put(snapshot(1, "a"), cache.epoch())
+    cache.put(snapshot(2, "b"), cache.epoch())
+
+    cache.invalidate_ids([1, 42])
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+
+    cache.clear()
+    assert cache.get("b") is None
+
+
+def test_put_after_invalidation_is_rejected():
+    # читатель взял эпоху, прочитал строку, а писатель закоммитил и инвалидировал до put
+    cache = UserSnapshotCache(10, ttl=60)
+    epoch = cache.epoch()
+    cache.invalidate_ids([1])
+
+    assert not cache.put(snapshot(1), epoch)
+    assert cache.get("alice") is None
+    assert cache.put(snapshot(1), cache.epoch())
+
+
+def test_rename_replaces_old_key():
+    cache = UserSnapshotCache(10, ttl=60)
+    cache.put(snapshot(1, "old"), cache.epoch())
+    cache.put(snapshot(1, "new"), cache.epoch())
+
+    assert cache.get("old") is None
+    cache.invalidate_ids([1])
+    assert cache.get("new") is None
+    assert len(cache) == 0
+
+
+def test_disabled_cache_stores_nothing():
+    cache = UserSnapshotCache(0, ttl=60)
+
+    assert not cache.put(snapshot(1), cache.epoch())
+    assert cache.get("alice") is None
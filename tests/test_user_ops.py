@@ -0,0 +1,67 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app.xray.user_ops import ADD, ALTER, REMOVE, UserOp, UserOpDispatcher, merge_op
+
+
+def op(kind, account=None):
+    return UserOp(kind, "vless", "1.alice", account)
+
+
+def test_merge_rules():
+    assert merge_op(None, op(ADD, 1)) == op(ADD, 1)
+    assert merge_op(op(ADD, 1), op(ADD, 2)) == op(ADD, 2)
+    assert merge_op(op(ADD, 1), op(REMOVE)) == op(REMOVE)
+    assert merge_op(op(ALTER, 1), op(REMOVE)) == op(REMOVE)
+    assert merge_op(op(REMOVE), op(ADD, 2)) == op(ALTER, 2)
+    assert merge_op(op(ALTER, 1), op(ADD, 2)) == op(ALTER, 2)
+    assert merge_op(op(ADD, 1), op(ALTER, 2)) == op(ALTER, 2)
+
+
+def test_dispatcher_coalesces_per_target_within_window():
+    sent = []
+    lock = threading.Lock()
+
+    def send(target, ops):
+        with lock:
+            sent.append((target, ops))
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        dispatcher = UserOpDispatcher(send, pool.submit, window=0.05)
+        for i in range(10):
+            # update_user в цикле: remove+add одного email схлопывается в один alter
+            dispatcher.enqueue(None, [op(ALTER, i), UserOp(REMOVE, "trojan", "1.alice")])
+            dispatcher.enqueue(7, [op(ALTER, i)])
+        assert dispatcher.flush(timeout=5)
+
+    by_target = dict(sent)
+    assert len(sent) == 2
+    assert by_target[None] == [op(ALTER, 9), UserOp(REMOVE, "trojan", "1.alice")]
+    assert by_target[7] == [op(ALTER, 9)]
+
+
+def test_send_errors_do_not_block_the_queue():
+    calls = []
+
+    def send(target, ops):
+        calls.append(target)
+        raise ValueError("node down")
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        dispatcher = UserOpDispatcher(send, pool.submit, window=0)
+        dispatcher.enqueue(1, [op(REMOVE)])
+        assert dispatcher.flush(timeout=5)
+        dispatcher.enqueue(1, [op(ADD, 1)])
+        assert dispatcher.flush(timeout=5)
+    assert calls == [1, 1]
+
+
+def test_enqueue_without_overwrite_keeps_pending():
+    sent = []
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        dispatcher = UserOpDispatcher(lambda target, ops: sent.extend(ops), pool.submit, window=0.05)
+        dispatcher.enqueue(7, [op(REMOVE)])
+        # реконсилятор со старым снимком БД не перебивает ожидающий remove
+        dispatcher.enqueue(7, [op(ALTER, 1), UserOp(ADD, "trojan", "1.alice", 2)], overwrite=False)
+        assert dispatcher.flush(timeout=5)
+    assert sent == [op(REMOVE), UserOp(ADD, "trojan", "1.alice", 2)]
@@ -0,0 +1,78 @@
+import threading
+import time
+from concurrent import futures
+
+import grpc
+import pytest
+
+from app.xray.user_ops import ADD, ALTER, REMOVE, UserOp
+from app.xray.user_stream import stream_user_ops
+from xray_api import XRay as XRayAPI
+from xray_api.proto.app.proxyman.command import command_pb2, command_pb2_grpc
+from xray_api.types.account import VLESSAccount
+
+
+class FakeHandler(command_pb2_grpc.HandlerServiceServicer):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = []
+
+    def AlterInbound(self, request, context):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.calls.append(request.tag)
+        time.sleep(0.02)
+        with self.lock:
+            self.in_flight -= 1
+        if request.tag == "missing":
+            context.abort(grpc.StatusCode.UNKNOWN, "User 1.alice not found.")
+        if request.tag == "broken":
+            context.abort(grpc.StatusCode.UNKNOWN, "handler not found: broken")
+        return command_pb2.AlterInboundResponse()
+
+
+@pytest.fixture
+def handler():
+    servicer = FakeHandler()
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=32))
+    command_pb2_grpc.add_HandlerServiceServicer_to_server(servicer, server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    api = XRayAPI("127.0.0.1", port)
+    yield servicer, api
+    api._channel.close()
+    server.stop(None)
+
+
+def test_streams_with_bounded_in_flight(handler):
+    servicer, api = handler
+    ops = [UserOp(REMOVE, f"in-{i % 4}", f"{i}.user") for i in range(40)]
+
+    t0 = time.monotonic()
+    ok, errors = stream_user_ops(api, ops, lambda op: op.account, limit=8, timeout=5)
+    elapsed = time.monotonic() - t0
+
+    assert all(ok) and not errors
+    assert len(servicer.calls) == 40
+    assert 1 < servicer.max_in_flight <= 8
+    assert elapsed < 40 * 0.02  # быстрее, чем строго по очереди
+
+
+def test_results_follow_ops_and_missing_email_is_removed(handler):
+    _, api = handler
+    account = VLESSAccount(email="1.alice", id="6a8f0f2c-2f2a-4d6a-8a7a-6d9b0f3f8c11")
+    ops = [
+        UserOp(REMOVE, "missing", "1.alice"),
+        UserOp(ADD, "missing", "1.alice", account),
+        UserOp(REMOVE, "broken", "1.alice"),
+        UserOp(ADD, "ok", "1.alice", account),
+        UserOp(ALTER, "ok", "1.alice", account),
+    ]
+
+    ok, errors = stream_user_ops(api, ops, lambda op: op.account, limit=2, timeout=5)
+
+    assert ok == [True, False, False, True, False]
+    assert errors == {"EmailNotFoundError": 1, "TagNotFoundError": 1, "ValueError": 1}
@@ -7,6 +7,7 @@
 from __future__ import annotations
 
 import base64  # noqa: E402
+import copy
 import json
 import sys
 import types
@@ -16,8 +17,10 @@ from urllib.parse import parse_qs
 # которые не нужны для проверки сериализации xhttp-ссылок. Заглушаем их.
 # Значения — заглушки-константы: в тестируемом пути (xhttp) они не вызываются.
 for _name, _attrs in {
-    "app.subscription.funcs": {"get_grpc_gun": None, "get_grpc_multi": None},
-    "app.templates": {"render_template": None},
+    "app.subscription.funcs": {"get_grpc_gun": None, "get_grpc_multi": None, "parse_user_agent_list": None},
+    "app.templates": {"render_template": None, "template_registry": None},
+    # clone из реестра шаблонов — структурная копия, в тестах её заменяет deepcopy
+    "app.templates.registry": {"clone": copy.deepcopy},
     "app.utils.helpers": {"UUIDEncoder": json.JSONEncoder},
     "app.xray.bs_routing": {"select_routing": None},
 }.items():
@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta
+
+from app.subscription.write_behind import DeviceTouch, SubWriteBuffer
+
+T0 = datetime(2026, 1, 1)
+
+
+def touch(minutes, device_os=None, user_agent=None):
+    return DeviceTouch(device_os, None, None, user_agent, T0 + timedelta(minutes=minutes))
+
+
+def test_touches_coalesce_per_user_and_device():
+    buffer = SubWriteBuffer(10, 60)
+    buffer.touch_user(1, "Happ/1", T0 + timedelta(minutes=2))
+    buffer.touch_user(1, "Happ/0", T0)  # опоздавший запрос не затирает более свежий
+    buffer.touch_device(1, "h", touch(0, device_os="Android", user_agent="Happ/1"))
+    buffer.touch_device(1, "h", touch(1, user_agent="Happ/2"))
+    buffer.touch_device(2, "h", touch(0))
+
+    assert len(buffer) == 3
+    users, devices = buffer.drain()
+
+    assert users == {1: (T0 + timedelta(minutes=2), "Happ/1")}
+    assert devices[(1, "h")] == touch(1, device_os="Android", user_agent="Happ/2")
+    assert set(devices) == {(1, "h"), (2, "h")}
+    assert len(buffer) == 0
+
+
+def test_restore_keeps_newer_touches():
+    buffer = SubWriteBuffer(10, 60)
+    buffer.touch_user(1, "old", T0)
+    buffer.touch_device(1, "h", touch(0, device_os="iOS", user_agent="old"))
+    users, devices = buffer.drain()
+
+    # пока запись падала, пришли новые визиты
+    buffer.touch_user(1, "new", T0 + timedelta(minutes=1))
+    buffer.touch_device(1, "h", touch(1, user_agent="new"))
+    buffer.restore(users, devices)
+
+    users, devices = buffer.drain()
+    assert users == {1: (T0 + timedelta(minutes=1), "new")}
+    assert devices == {(1, "h"): touch(1, device_os="iOS", user_agent="new")}
+
+
+def test_known_devices_expire_and_are_forgotten_per_user(clock):
+    buffer = SubWriteBuffer(10, 60, clock=clock)
+    buffer.remember_device(1, "a", "Happ/1")
+    buffer.remember_device(1, "b", None)
+    buffer.remember_device(2, "a", None)
+
+    assert buffer.known_device(1, "a") == (True, "Happ/1")
+    assert buffer.known_device(1, "x") == (False, None)
+
+    buffer.forget_devices([1])
+    assert not buffer.known_device(1, "a")[0] and not buffer.known_device(1, "b")[0]
+    assert buffer.known_device(2, "a")[0]
+
+    clock.now = 60
+    assert buffer.known_device(2, "a") == (False, None)
+
+
+def test_known_devices_evict_least_recently_used():
+    buffer = SubWriteBuffer(2, 60)
+    buffer.remember_device(1, "a", None)
+    buffer.remember_device(1, "b", None)
+    buffer.known_device(1, "a")  # b теперь самый старый
+
+    buffer.remember_device(2, "c", None)
+
+    assert not buffer.known_device(1, "b")[0]
+    assert buffer.known_device(1, "a")[0] and buffer.known_device(2, "c")[0]
+
+
+def test_disabled_view_knows_nothing():
+    buffer = SubWriteBuffer(0, 60)
+    buffer.remember_device(1, "a", None)
+
+    assert buffer.known_device(1, "a") == (False, None)
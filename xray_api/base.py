@@ -2,8 +2,20 @@ import grpc
 
 
 class XRayBase(object):
-    def __init__(self, address: str, port: int, ssl_cert: str = None, ssl_target_name: str = None):
-        if ssl_cert is None:
+    def __init__(self, address: str, port: int, ssl_cert: str = None, ssl_target_name: str = None,
+                 channel: grpc.Channel = None):
+        # параметры канала сохраняем — по ним строятся grpc.aio-каналы того же адресата
+        self.ssl_cert = ssl_cert
+        self.ssl_target_name = ssl_target_name
+        # стабы сервисов создаются один раз на канал, а не на каждый вызов
+        self._stubs: dict[type, object] = {}
+        if channel is not None:
+            # готовый (например, общий долгоживущий) канал — см. app/xray/grpc_channels.py
+            self.address = address
+            self.port = port
+            self._channel = channel
+
+        elif ssl_cert is None:
             self.address = address
             self.port = port
             self._channel = grpc.insecure_channel(f"{address}:{port}")
@@ -17,3 +29,9 @@ class XRayBase(object):
             self._channel = grpc.secure_channel(f"{address}:{port}",
                                                 credentials=creds,
                                                 options=opts)
+
+    def _stub(self, stub_class):
+        stub = self._stubs.get(stub_class)
+        if stub is None:
+            stub = self._stubs[stub_class] = stub_class(self._channel)
+        return stub
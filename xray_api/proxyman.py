@@ -15,7 +15,7 @@ except ModuleNotFoundError:
 
 class Proxyman(XRayBase):
     def alter_inbound(self, tag: str, operation: TypedMessage, timeout: int = None) -> bool:
-        stub = command_pb2_grpc.HandlerServiceStub(self._channel)
+        stub = self._stub(command_pb2_grpc.HandlerServiceStub)
         try:
             stub.AlterInbound(command_pb2.AlterInboundRequest(tag=tag, operation=operation), timeout=timeout)
             return True
@@ -24,7 +24,7 @@ class Proxyman(XRayBase):
             raise RelatedError(e)
 
     def alter_outbound(self, tag: str, operation: TypedMessage, timeout: int = None) -> bool:
-        stub = command_pb2_grpc.HandlerServiceStub(self._channel)
+        stub = self._stub(command_pb2_grpc.HandlerServiceStub)
         try:
             stub.AlterInbound(command_pb2.AlterOutboundRequest(tag=tag, operation=operation), timeout=timeout)
             return True
@@ -32,27 +32,36 @@ class Proxyman(XRayBase):
         except grpc.RpcError as e:
             raise RelatedError(e)
 
-    def add_inbound_user(self, tag: str, user: Account, timeout: int = None) -> bool:
-        return self.alter_inbound(
-            tag=tag,
-            operation=Message(
-                command_pb2.AddUserOperation(
-                    user=user_pb2.User(
-                        level=user.level,
-                        email=user.email,
-                        account=user.message
-                    )
+    def alter_inbound_future(self, tag: str, operation: TypedMessage, timeout: int = None) -> grpc.Future:
+        """Неблокирующий AlterInbound: future по тому же каналу, ошибки — через RelatedError(future.exception())."""
+        stub = self._stub(command_pb2_grpc.HandlerServiceStub)
+        return stub.AlterInbound.future(command_pb2.AlterInboundRequest(tag=tag, operation=operation), timeout=timeout)
+
+    @staticmethod
+    def add_user_operation(user: Account) -> TypedMessage:
+        return Message(
+            command_pb2.AddUserOperation(
+                user=user_pb2.User(
+                    level=user.level,
+                    email=user.email,
+                    account=user.message
                 )
-            ), timeout=timeout)
+            )
+        )
+
+    @staticmethod
+    def remove_user_operation(email: str) -> TypedMessage:
+        return Message(
+            command_pb2.RemoveUserOperation(
+                email=email
+            )
+        )
+
+    def add_inbound_user(self, tag: str, user: Account, timeout: int = None) -> bool:
+        return self.alter_inbound(tag=tag, operation=self.add_user_operation(user), timeout=timeout)
 
     def remove_inbound_user(self, tag: str, email: str, timeout: int = None) -> bool:
-        return self.alter_inbound(
-            tag=tag,
-            operation=Message(
-                command_pb2.RemoveUserOperation(
-                    email=email
-                )
-            ), timeout=timeout)
+        return self.alter_inbound(tag=tag, operation=self.remove_user_operation(email), timeout=timeout)
 
     def add_outbound_user(self, tag: str, user: Account, timeout: int = None) -> bool:
         return self.alter_outbound(
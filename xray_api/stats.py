@@ -54,7 +54,7 @@ class OutboundStatsResponse:
 class Stats(XRayBase):
     def get_sys_stats(self, timeout: int = None) -> SysStatsResponse:
         try:
-            stub = command_pb2_grpc.StatsServiceStub(self._channel)
+            stub = self._stub(command_pb2_grpc.StatsServiceStub)
             r = stub.GetSysStats(command_pb2.SysStatsRequest(), timeout=timeout)
 
         except grpc.RpcError as e:
@@ -75,7 +75,7 @@ class Stats(XRayBase):
 
     def query_stats(self, pattern: str, reset: bool = False, timeout: int = None) -> typing.Iterable[StatResponse]:
         try:
-            stub = command_pb2_grpc.StatsServiceStub(self._channel)
+            stub = self._stub(command_pb2_grpc.StatsServiceStub)
             r = stub.QueryStats(command_pb2.QueryStatsRequest(pattern=pattern, reset=reset), timeout=timeout)
 
         except grpc.RpcError as e: